@@ -3,4 +3,4 @@ cd /django-rq
 
 ls -ld ../.. $PWD/*
 
-python manage.py rqworker default
\ No newline at end of file
+python manage.py rqworker low default high
\ No newline at end of file
@@ -62,7 +62,7 @@ class RasterValueMappingInline(admin.TabularInline):
     extra = 1
 
 class ScheduledTaskAdmin(admin.ModelAdmin):
-	list_display = ['name', 'created_on', 'status', 'succeeded']
+	list_display = ['name', 'created_on', 'status', 'succeeded', 'estimated_cost']
 	list_filter = ['succeeded']
 
 class RasterTypeAdmin(admin.ModelAdmin):
@@ -26,6 +26,8 @@ import django_rq
 from django.utils.translation import gettext as _
 from django_rq import job
 from rq import get_current_job
+from rq.job import Job, JobStatus, Retry
+from rq.exceptions import NoSuchJobError
 
 # from ldms.tasks import add_numbers
 from ldms.queue import RedisQueue
@@ -40,10 +42,62 @@ from django.template.loader import render_to_string
 from ldms.utils import email_helper
 from ldms.utils.settings_util import get_settings
 from ldms.utils.vector_util import get_vector, queue_threshold_exceeded, get_admin_level_ids_from_db
-from ldms.utils.cache_util import set_cache_key, get_cached_results, generate_cache_key
+from ldms.utils.cache_util import (set_cache_key, get_cache_key, get_cached_results, generate_cache_key, 
+				get_cache_timeout, get_api_name)
+from ldms.utils.singleflight_util import (is_single_flight_enabled, acquire_flight, get_flight_owner, 
+				release_flight, wait_for_flight, SYNC_OWNER, JOB_OWNER)
 from ldms.utils.file_util import (get_download_url)
+from ldms.utils.json_util import encode_result
+from ldms.utils.cost_util import estimate_job_cost
+from ldms.utils.instrument_util import finish_progress, timed_stage
+from ldms.utils.raster_util import is_raw_result
+from ldms.utils.metrics_util import time_analysis, observe_analysis
+from ldms.utils.log_util import log, log_context, set_log_context, new_request_id, get_aoi_hash, flush_logs
+from ldms.utils.scratch_util import scratch_scope, cleanup_scratch
+from ldms.utils.zonal_util import get_zones_extent, rasterize_zones, get_zonal_counts, get_zonal_stats
+from ldms.utils.tile_util import (get_tiled_jobs_settings, split_vector, save_tile, load_tile, 
+				count_done_tiles, claim_merge, is_merge_claimed, merge_tiles, remove_run)
 
 import copy
+import time
+import rasterio
+
+# Analyses whose queued computations are split in tiles when they are large. The values are 
+# the Medalus index computed by the tiles. Productivity is not tiled since Performance compares 
+# pixels to the other pixels of the same ecological unit within the whole area
+TILED_ANALYSES = {
+	"aridity_index": MedalusCalcEnum.ARIDITY_INDEX,
+	"climate_quality_index": MedalusCalcEnum.CLIMATE_QUALITY_INDEX,
+	"soil_quality_index": MedalusCalcEnum.SOIL_QUALITY_INDEX,
+	"vegetation_quality_index": MedalusCalcEnum.VEGETATION_QUALITY_INDEX,
+	"management_quality_index": MedalusCalcEnum.MANAGEMENT_QUALITY_INDEX,
+	"esai": MedalusCalcEnum.ESAI,
+}
+
+# Analyses that can be computed for many areas at once and the default source of their rasters. 
+# See `batch_analysis`
+BATCH_ANALYSES = {
+	"lulc": RasterSourceEnum.LULC.value,
+	"soc": RasterSourceEnum.LULC.value,
+	"state": RasterSourceEnum.MODIS.value,
+	"trajectory": RasterSourceEnum.MODIS.value,
+	"performance": RasterSourceEnum.MODIS.value,
+	"productivity": RasterSourceEnum.MODIS.value,
+	"land_degradation": RasterSourceEnum.MODIS.value,
+	"aridity_index": RasterSourceEnum.MODIS.value,
+	"climate_quality_index": RasterSourceEnum.MODIS.value,
+	"soil_quality_index": RasterSourceEnum.MODIS.value,
+	"vegetation_quality_index": RasterSourceEnum.MODIS.value,
+	"management_quality_index": RasterSourceEnum.MODIS.value,
+	"esai": RasterSourceEnum.MODIS.value,
+}
+BATCH_PRODUCTIVITY_ANALYSES = {
+	"state": ProductivityCalcEnum.STATE,
+	"trajectory": ProductivityCalcEnum.TRAJECTORY,
+	"performance": ProductivityCalcEnum.PERFORMANCE,
+	"productivity": ProductivityCalcEnum.PRODUCTIVITY,
+}
+MAX_BATCH_TARGETS = 1000
 
 LULC_ANALYSIS = 1
 LULC_CHANGE_ANALYSIS = 2
@@ -131,6 +185,52 @@ def enqueue_rusle(request):
 def enqueue_cvi(request):
 	return _enqueue(func=coastal_vulnerability_index, request=request)
 
+@api_view(['POST'])
+def enqueue_batch(request):
+	"""Compute an analysis for many areas at once. The areas are passed as `targets`, a list of 
+	{admin_level, vector} or {custom_coords}, and the analysis as `analysis`, one of BATCH_ANALYSES. 
+	`periods`, a list of [start_year, end_year], may be passed instead of start_year and end_year. 
+	The extent of the targets is set as `custom_coords` so that the batch is cached, queued and 
+	routed like the analysis of a single area. See `batch_analysis`
+	"""
+	params = request.data
+	vectors, error = get_batch_vectors(request, params)
+	if error:
+		return Response({ "success": 'false', 'message': error })
+	params['custom_coords'] = get_zones_extent(vectors)
+	return _enqueue(func=batch_analysis, request=request)
+
+def get_batch_vectors(request, params):
+	"""Validate the parameters of a batch analysis and get the polygons of its targets
+
+	Returns:
+		tuple(list, error): GeoJSON of the targets in the order they were passed
+	"""
+	if params.get('analysis') not in BATCH_ANALYSES:
+		return (None, _("Invalid analysis. Specify one of {0}".format(", ".join(BATCH_ANALYSES))))
+	targets = params.get('targets')
+	if not isinstance(targets, list) or not targets:
+		return (None, _("Specify the targets of the analysis"))
+	if len(targets) > MAX_BATCH_TARGETS:
+		return (None, _("A batch analysis cannot have more than {0} targets".format(MAX_BATCH_TARGETS)))
+	periods = params.get('periods')
+	if periods and not all(isinstance(x, (list, tuple)) and len(x) == 2 for x in periods):
+		return (None, _("Specify the periods as a list of [start_year, end_year]"))
+
+	vectors = []
+	for target in targets:
+		if not isinstance(target, dict):
+			return (None, _("Specify each target as {admin_level, vector} or {custom_coords}"))
+		vector, error = get_vector(admin_level=target.get('admin_level', None), 
+						  shapefile_id=target.get('vector', None), 
+						  custom_vector_coords=target.get('custom_coords', None), 
+						  admin_0=None,
+						  request=request)
+		if error:
+			return (None, error)
+		vectors.append(vector)
+	return (vectors, None)
+
 def _enqueue(func, request, force_queue=False):
 	"""Enqueue computation
 
@@ -148,6 +248,7 @@ def _enqueue(func, request, force_queue=False):
 		for fld in fields:
 			req[fld] = getattr(request._request, fld)
 		req['is_queued'] = True # set to True to distinguish between direct and cloned requests. 
+		req['request_id'] = request_id # trace the request in the logs of its job
 		return req	
 
 	def validate_vector_threshold():
@@ -165,7 +266,8 @@ def _enqueue(func, request, force_queue=False):
 						  admin_0=None,
 						  request=request
 				)
-		return queue_threshold_exceeded(request, vector)
+		exceeded, do_queue, msg = queue_threshold_exceeded(request, vector)
+		return exceeded, do_queue, msg, vector
 
 	def append_admin_level_args():
 		"""Append level 0, level 1 and level2 ids given the passed admin_level
@@ -181,22 +283,31 @@ def _enqueue(func, request, force_queue=False):
 		request.data['admin1'] = level_1
 		request.data['admin2'] = level_2
 
+	request_id = new_request_id(request)
 	system_settings = get_settings()
+	use_cache = False # True if cached results can be returned
 	#If caching enabled, try retrieve cached vals. ForestFire is not cached since GEE urls expire after some time
 	if system_settings.enable_cache and func != forest_fire: 
 		cached = None
 		if "cached" in request.data:
 			if request.data.get("cached") == 1 or request.data.get("cached") == "true":
-				cached = get_cached_results(request)
+				use_cache = True
 		else:
+			use_cache = True
+		if use_cache:
 			cached = get_cached_results(request)
 
 		if cached: # return cached results
 			val = json.loads(cached)
 			return Response(val)
 
+	# Identical requests that are being computed share the results of the first one
+	flight_key = None
+	if use_cache and is_single_flight_enabled():
+		flight_key = generate_cache_key(copy.copy(request.data), request.path)
+
 	# do_queue = can_queue(request)
-	exceeded, do_queue, msg = validate_vector_threshold()
+	exceeded, do_queue, msg, vector = validate_vector_threshold()
 	
 	if exceeded and not do_queue: # if threshold hit and user not allowed to queue, return error/msg
 		return Response({ "success": 'false', 'message': msg })
@@ -220,25 +331,370 @@ def _enqueue(func, request, force_queue=False):
 
 		orig_data = copy.copy(request.data)
 		append_admin_level_args()
+		# route the job to a queue matching its cost so that small jobs do not wait behind large ones
+		cost = estimate_job_cost(request.path, orig_data, vector)
 		q = RedisQueue()
-		q.enqueue_medium(func=func, 
-						request=None, 
-						data=request.data, 
-						user=user, 
-						orig_request=clone_request(), 
-						orig_data=orig_data,
-						can_queue=do_queue)
+		kwargs = {
+			"request": None, 
+			"data": request.data, 
+			"user": user, 
+			"orig_request": clone_request(), 
+			"orig_data": orig_data,
+			"can_queue": do_queue
+		}
+		if flight_key:
+			enqueue_coalesced(q, func, flight_key, cost=cost, vector=vector, **kwargs)
+		else:
+			enqueue_analysis(q, func, cost=cost, vector=vector, **kwargs)
 		return Response({ "success": 'true', 'message': get_enqueue_message(request) })
 	else:
-		results = func(request)		
-		# we are not caching forest_fire since GEE urls expire after some time
-		if system_settings.enable_cache and func != forest_fire:		
-			# Only save to cache if there is no error and if caching enabled
-			if 'error' not in results.data:				
-				set_cache_key(key=generate_cache_key(request.data, request.path), 
-						value=json.dumps(eval(str(results.data))))
+		flight_owner = None
+		if flight_key:
+			owner = SYNC_OWNER + get_random_string(length=16)
+			if acquire_flight(flight_key, owner):
+				flight_owner = owner
+			elif (get_flight_owner(flight_key) or "").startswith(SYNC_OWNER):
+				# an identical request is being computed. Wait for it and return its results
+				if wait_for_flight(flight_key):
+					cached = get_cache_key(flight_key)
+					if cached:
+						return Response(json.loads(cached))
+		try:
+			start = time.time()
+			with log_context(request_id=request_id, indicator=get_api_name(request.path), 
+						aoi_hash=get_aoi_hash(request.data)):
+				with time_analysis(get_api_name(request.path)), scratch_scope():
+					results = func(request)		
+				log("Computed analysis in %.2f seconds" % (time.time() - start))
+			# we are not caching forest_fire since GEE urls expire after some time
+			if system_settings.enable_cache and func != forest_fire:		
+				# Only save to cache if there is no error and if caching enabled
+				if 'error' not in results.data:				
+					set_cache_key(key=generate_cache_key(request.data, request.path), 
+							value=encode_result(results.data),
+							timeout=get_cache_timeout(request.path, system_settings))
+		finally:
+			if flight_owner:
+				release_flight(flight_key, flight_owner)
 		return results
 
+def enqueue_coalesced(queue, func, flight_key, cost=None, vector=None, **kwargs):
+	"""Queue a computation unless an identical one is already queued or running, in which case 
+	a job that returns the results of the running one once it finishes is queued instead.
+
+	Args:
+		queue (RedisQueue): Queue
+		func (function): Function to be queued
+		flight_key (string): Cache key of the request
+		cost (float, optional): Estimated cost of the computation. Identical requests have the same 
+				cost and are therefore routed to the same queue
+		vector (geojson, optional): Area of interest. See `enqueue_analysis`
+	"""
+	job_id = get_random_string(length=20)
+	if acquire_flight(flight_key, JOB_OWNER + job_id):
+		return enqueue_analysis(queue, func, cost=cost, vector=vector, job_id=job_id, 
+						flight_key=flight_key, **kwargs)
+
+	# depend on the job computing the same results
+	depends_on = None
+	owner = get_flight_owner(flight_key) or ""
+	if owner.startswith(JOB_OWNER):
+		try:
+			leader = Job.fetch(owner[len(JOB_OWNER):], connection=django_rq.get_connection('default'))
+			if leader.get_status() in [JobStatus.QUEUED, JobStatus.STARTED, JobStatus.DEFERRED]:
+				depends_on = leader
+		except NoSuchJobError:
+			pass
+	return queue.enqueue_by_cost(cost, func=run_flight_follower, depends_on=depends_on,
+					analysis_func=func, flight_key=flight_key, **kwargs)
+
+def enqueue_analysis(queue, func, cost=None, vector=None, job_id=None, flight_key=None, **kwargs):
+	"""Queue a computation. Large computations of analyses in TILED_ANALYSES are split in tiles, 
+	see `enqueue_tiled`
+
+	Args:
+		queue (RedisQueue): Queue
+		func (function): Function to be queued
+		cost (float, optional): Estimated cost of the computation
+		vector (geojson, optional): Area of interest
+		job_id (string, optional): ID of the job. If flight_key is set, the ID of the flight owner
+		flight_key (string, optional): Cache key of the request if the job holds its flight
+	"""
+	setts = get_tiled_jobs_settings()
+	if (setts['ENABLED'] and vector and func.__name__ in TILED_ANALYSES 
+			and cost is not None and cost >= setts['MIN_COST']):
+		job = enqueue_tiled(queue, func, cost=cost, vector=vector, job_id=job_id, 
+						flight_key=flight_key, **kwargs)
+		if job:
+			return job
+	if flight_key:
+		return queue.enqueue_by_cost(cost, func=run_flight_leader, job_id=job_id, 
+						analysis_func=func, flight_key=flight_key, **kwargs)
+	return queue.enqueue_by_cost(cost, func=func, job_id=job_id, **kwargs)
+
+def enqueue_tiled(queue, func, cost, vector, job_id=None, flight_key=None, data=None, 
+				user=None, orig_request=None, orig_data=None, **kwargs):
+	"""Split a computation into jobs computing the tiles of its area of interest and a merge job
+	that runs once all the tiles are done. See `ldms.utils.tile_util`
+
+	Returns:
+		Job: The merge job, whose ID is `job_id`, or None if the area fits in a single tile
+	"""
+	setts = get_tiled_jobs_settings()
+	tiles = split_vector(vector, setts['TILE_SIZE'])
+	if len(tiles) < 2:
+		return None
+	run_id = job_id or get_random_string(length=20)
+	job, task = pre_analysis_save_task(request=orig_request, data=data, user=user, 
+						task_name=func.__name__, orig_data=orig_data, 
+						job_id=run_id, estimated_cost=cost)
+	task.status = get_tiles_status(0, len(tiles))
+	task.save()
+
+	merge_queue, merge_job = queue.create_by_cost(cost, func=run_tiles_merge, job_id=run_id, 
+						meta={'task_id': task.id}, analysis_func=func, run_id=run_id, count=len(tiles), task_id=task.id, 
+						flight_key=flight_key, data=data, user=user, orig_request=orig_request)
+	retry = Retry(max=setts['RETRIES']) if setts['RETRIES'] else None
+	job_ids = []
+	for i, tile in enumerate(tiles):
+		tile_job = queue.enqueue_by_cost(cost / len(tiles), func=run_analysis_tile, retry=retry,
+						meta={'task_id': task.id}, analysis_func=func, run_id=run_id, index=i, count=len(tiles), tile=tile, 
+						task_id=task.id, merge_queue=merge_queue, data=data, user=user, 
+						orig_request=orig_request)
+		job_ids.append(tile_job.id)
+	schedule_tiles_watchdog(run_id, job_ids, task.id, merge_queue)
+	return merge_job
+
+def get_tiles_status(done, count):
+	return _("Processing (%s of %s tiles)") % (done, count)
+
+def run_analysis_tile(analysis_func, run_id, index, count, tile, task_id, merge_queue, 
+				data=None, user=None, orig_request=None, **kwargs):
+	"""Compute a tile of a queued analysis and checkpoint it. The tile is skipped if it was done by 
+	a previous attempt. The last tile to finish queues the merge job
+
+	A tile that raises on its last attempt is checkpointed as failed so that the merge job still 
+	runs. The merge job then saves the task as failed, releases the flight and its dependents. 
+	Tiles whose job is killed are checkpointed by `check_tiles`
+	"""
+	if load_tile(run_id, index) is None:
+		try:
+			request = clone_post_request(data, user, orig_request)
+			raster_source = map_raster_source(data.get('raster_source', RasterSourceEnum.MODIS.value))
+			medalus = get_medalus(request, data, raster_source, return_raw=True, clip_vector=tile)
+			res = run_medalus(medalus, TILED_ANALYSES[analysis_func.__name__])
+			save_tile(run_id, index, res, medalus.error)
+		except Exception:
+			job = get_current_job()
+			if job and job.retries_left: # the tile will be retried
+				raise
+			save_tile(run_id, index, None, _("Failed to compute tile %s of the analysis") % (index + 1))
+			queue_tiles_merge(run_id, count, task_id, merge_queue)
+			raise
+	queue_tiles_merge(run_id, count, task_id, merge_queue)
+	flush_logs()
+
+def queue_tiles_merge(run_id, count, task_id, merge_queue):
+	"""Update the progress of a tiled run and queue its merge job once all the tiles are done
+	"""
+	done = count_done_tiles(run_id, count)
+	ScheduledTask.objects.filter(pk=task_id).update(status=get_tiles_status(done, count))
+	if done == count and claim_merge(run_id):
+		RedisQueue().enqueue_deferred(merge_queue, run_id)
+
+def schedule_tiles_watchdog(run_id, job_ids, task_id, merge_queue):
+	"""Schedule `check_tiles` to run once WATCHDOG_INTERVAL seconds have passed
+	"""
+	interval = get_tiled_jobs_settings()['WATCHDOG_INTERVAL']
+	django_rq.get_scheduler('default').enqueue_in(datetime.timedelta(seconds=interval), check_tiles, 
+						run_id=run_id, job_ids=job_ids, task_id=task_id, merge_queue=merge_queue)
+
+def check_tiles(run_id, job_ids, task_id, merge_queue):
+	"""Watchdog of a tiled run. The job of a tile that dies without raising e.g because its work-horse 
+	was killed when out of memory never checkpoints the tile, so the merge job would never run and the 
+	flight would be held until it times out. The tiles of such jobs are checkpointed as failed so that 
+	the merge job saves the task as failed and releases the flight. The check is scheduled again 
+	while jobs of tiles are pending
+	"""
+	if is_merge_claimed(run_id):
+		return
+	conn = django_rq.get_connection('default')
+	pending = False
+	for index, job_id in enumerate(job_ids):
+		if load_tile(run_id, index) is not None:
+			continue
+		try:
+			status = Job.fetch(job_id, connection=conn).get_status()
+		except NoSuchJobError:
+			status = None
+		if status in [JobStatus.QUEUED, JobStatus.STARTED, JobStatus.SCHEDULED, JobStatus.DEFERRED]:
+			pending = True
+		else:
+			save_tile(run_id, index, None, _("Failed to compute tile %s of the analysis") % (index + 1))
+	queue_tiles_merge(run_id, len(job_ids), task_id, merge_queue)
+	if pending:
+		schedule_tiles_watchdog(run_id, job_ids, task_id, merge_queue)
+
+def run_tiles_merge(analysis_func, run_id, count, task_id, flight_key=None, data=None, 
+				user=None, orig_request=None, **kwargs):
+	"""Mosaic the tiles of a queued analysis and save the statistics of the whole area as 
+	the results of its task
+	"""
+	job = get_current_job()
+	try:
+		task = ScheduledTask.objects.get(pk=task_id)
+		request = clone_post_request(data, user, orig_request)
+		res, error = merge_tiles(request, run_id, count)
+		post_analysis_save_task(request, task, res, error, data)
+		remove_run(run_id)
+		if error:
+			return Response({ "error": error })
+		return Response(res)
+	except Exception:
+		# jobs depending on this one would otherwise stay deferred. They will compute the results themselves
+		if job and flight_key:
+			django_rq.get_queue(job.origin).enqueue_dependents(job)
+		raise
+	finally:
+		if flight_key:
+			release_flight(flight_key, JOB_OWNER + run_id)
+
+def run_flight_leader(analysis_func, flight_key, **kwargs):
+	"""Compute a queued analysis and release the flight of its cache key once done
+	"""
+	job = get_current_job()
+	try:
+		return analysis_func(**kwargs)
+	except Exception:
+		# jobs depending on this one would otherwise stay deferred. They will compute the results themselves
+		if job:
+			django_rq.get_queue(job.origin).enqueue_dependents(job)
+		raise
+	finally:
+		release_flight(flight_key, JOB_OWNER + (job.get_id() if job else ""))
+
+def run_flight_follower(analysis_func, flight_key, data=None, user=None, orig_request=None, orig_data=None, **kwargs):
+	"""Save the results of an identical queued analysis as the results of this task. 
+	The analysis is computed if the results were not cached e.g because it failed
+	"""
+	cached = get_cache_key(flight_key)
+	if cached is None:
+		return analysis_func(data=data, user=user, orig_request=orig_request, orig_data=orig_data, **kwargs)
+
+	job, task = pre_analysis_save_task(request=orig_request, data=data, user=user, 
+						task_name=analysis_func.__name__, orig_data=orig_data)
+	res = json.loads(cached)
+	request = clone_post_request(data, user, orig_request)
+	post_analysis_save_task(request, task, res, None, data)
+	return Response(res)
+
+def batch_analysis(request, data=None, user=None, orig_request=None, can_queue=False, orig_data=None):
+	"""Compute an analysis for many areas and periods at once. See `enqueue_batch`
+
+	Each period is computed once over the extent of the targets so that the rasters are read and 
+	clipped once instead of once per target. The statistics of each target are then counted on 
+	the pixels of the target. Note that indicators relative to the whole area of interest e.g 
+	Performance compare the pixels to those of the whole extent.
+
+	Returns:
+		Response: {analysis, periods: [{base, target, nodataval, units: [{target fields, stats, nodata}]}]}
+	"""
+	if can_queue:
+		job, task = pre_analysis_save_task(request=orig_request, data=data, user=user, 
+						task_name="batch_analysis", orig_data=orig_data)
+
+	params = data
+	if not request:
+		request = clone_post_request(data, user, orig_request)
+	else:
+		params = request.data
+
+	res, error = compute_batch(request, params)
+
+	if can_queue:
+		post_analysis_save_task(request, task, res, error, data)
+
+	if error:
+		return Response({ "error": error })
+	else:
+		return Response(res)
+
+def compute_batch(request, params):
+	"""Compute the statistics of each target and period of a batch analysis
+
+	Returns:
+		tuple(dict, error): See `batch_analysis`
+	"""
+	vectors, error = get_batch_vectors(request, params)
+	if error:
+		return (None, error)
+	extent = get_zones_extent(vectors)
+	targets = params.get('targets')
+	periods = params.get('periods') or [[params.get('start_year', None), params.get('end_year', None)]]
+
+	results = []
+	zones_by_grid = {} # the zones are rasterised once per grid
+	for start_year, end_year in periods:
+		period_params = dict(params, start_year=start_year, end_year=end_year)
+		raw, error = compute_raw_analysis(request, period_params, params.get('analysis'), extent)
+		if error:
+			return (None, error)
+		datasource, nodata, resolution = raw['datasource'], raw['nodata'], raw['resolution']
+		shape = datasource.shape[-2:]
+		with rasterio.open(raw['meta_path']) as src:
+			grid = (shape, tuple(src.transform))
+		if grid not in zones_by_grid:
+			zones_by_grid[grid] = rasterize_zones(vectors, raw['meta_path'], shape)
+		with timed_stage("zonal_stats", pixels=datasource.size):
+			zonal_counts = get_zonal_counts(datasource, zones_by_grid[grid], len(vectors), nodata)
+		units = []
+		for target, val_counts in zip(targets, zonal_counts):
+			units.append(dict(target, **get_zonal_stats(val_counts, raw['stats_args'].get('change_enum'), 
+								nodata, resolution)))
+		results.append({
+			'base': raw['stats_args'].get('start_year', start_year),
+			'target': raw['stats_args'].get('end_year', end_year),
+			'nodataval': nodata,
+			'units': units
+		})
+	return ({'analysis': params.get('analysis'), 'periods': results}, None)
+
+def compute_raw_analysis(request, params, analysis, clip_vector):
+	"""Compute the raw result of an analysis over a polygon
+
+	Args:
+		analysis (string): One of BATCH_ANALYSES
+		clip_vector (geojson): Polygon to compute the analysis over
+
+	Returns:
+		tuple(dict, error): See `ldms.utils.raster_util.get_raw_result`
+	"""
+	raster_source = map_raster_source(params.get('raster_source', BATCH_ANALYSES[analysis]))
+	if raster_source == None:
+		return (None, _("Invalid value for raster source"))
+	kwargs = {'return_raw': True, 'clip_vector': clip_vector}
+	if analysis == "lulc":
+		obj = get_lulc(request, params, raster_source, **kwargs)
+		show_change = params.get('show_change', False) in [True, "true", 1]
+		res = obj.calculate_lulc_change() if show_change else obj.calculate_lulc()
+	elif analysis == "soc":
+		obj = get_soc(request, params, raster_source, **kwargs)
+		res = obj.calculate_soc_change()
+	elif analysis in BATCH_PRODUCTIVITY_ANALYSES:
+		obj = get_productivity(request, params, raster_source, **kwargs)
+		res = run_productivity(obj, BATCH_PRODUCTIVITY_ANALYSES[analysis])
+	elif analysis == "land_degradation":
+		obj = get_land_degradation(request, params, raster_source, **kwargs)
+		res = obj.calculate_land_degradation()
+	else:
+		obj = get_medalus(request, params, raster_source, **kwargs)
+		res = run_medalus(obj, TILED_ANALYSES[analysis])
+	if obj.error:
+		return (None, obj.error)
+	if not is_raw_result(res):
+		return (None, _("The analysis did not return a raster"))
+	return (res, None)
+
 def get_user_fields():
 	return ["email", "first_name", "last_name", "id", "username"]
 
@@ -268,7 +724,25 @@ def task_result(request, task_id):
 		return Response({'success': 'false', 'message': 'The results no longer exist. Please schedule another task'})
 	
 	from django.forms.models import model_to_dict
-	return Response(model_to_dict(tsk))
+	res = model_to_dict(tsk)
+	res['progress'] = get_task_progress(tsk)
+	return Response(res)
+
+def get_task_progress(task):
+	"""Get the progress of a task. The progress of a running task is read from its job 
+	since the task is only updated periodically
+
+	Returns:
+		dict: See `ldms.utils.instrument_util.get_progress_data`
+	"""
+	if not task.completed_on:
+		try:
+			job = Job.fetch(task.job_id, connection=django_rq.get_connection('default'))
+			if job.meta.get('progress'):
+				return job.meta['progress']
+		except NoSuchJobError:
+			pass
+	return json.loads(task.progress) if task.progress else None
 
 # @api_view(['POST'])
 # @permission_classes([IsAuthenticated])
@@ -291,35 +765,12 @@ def lulc(request, data=None, user=None, orig_request=None, can_queue=False, orig
 	else:
 		params = request.data
 
-	# params = request.data	
-	vector_id = params.get('vector', None)
-	admin_level = params.get('admin_level', None)
-	admin_0 = params.get('admin_0', None)
-	raster_type = params.get('raster_type', None)
-	start_year = params.get('start_year', None)
-	end_year = params.get('end_year', None)
-	custom_coords = params.get('custom_coords', None)
-	transform = params.get('transform', "area")
 	show_change = params.get('show_change', False)
-	raster_source = params.get('raster_source', RasterSourceEnum.LULC.value)
-
-	raster_source = map_raster_source(raster_source)
+	raster_source = map_raster_source(params.get('raster_source', RasterSourceEnum.LULC.value))
 	if raster_source == None:
 		return Response({ "error": _("Invalid value for raster source") })
 
-	lulc = LULC(
-		admin_0=admin_0,
-		admin_level=admin_level,
-		shapefile_id = vector_id,
-		custom_vector_coords = custom_coords,
-		raster_type = raster_type,
-		start_year=start_year,
-		end_year=end_year,
-		transform=transform,
-		raster_source=raster_source,
-		enforce_single_year=True,
-		request=request,
-	)
+	lulc = get_lulc(request, params, raster_source)
 	error = ""
 	if show_change == False:
 		res = lulc.calculate_lulc()
@@ -336,6 +787,30 @@ def lulc(request, data=None, user=None, orig_request=None, can_queue=False, orig
 	else:
 		return Response(res)
 		
+def get_lulc(request, params, raster_source, **kwargs):
+	"""Create a LULC object from the parameters of a request
+
+	Args:
+		request: Request object
+		params (dict): Parameters of the request
+		raster_source (RasterSourceEnum): Source of the rasters
+		kwargs: Extra arguments of LULC e.g return_raw
+	"""
+	return LULC(
+		admin_0=params.get('admin_0', None),
+		admin_level=params.get('admin_level', None),
+		shapefile_id = params.get('vector', None),
+		custom_vector_coords = params.get('custom_coords', None),
+		raster_type = params.get('raster_type', None),
+		start_year=params.get('start_year', None),
+		end_year=params.get('end_year', None),
+		transform=params.get('transform', "area"),
+		raster_source=raster_source,
+		enforce_single_year=True,
+		request=request,
+		**kwargs
+	)
+
 # @api_view(['POST'])
 def forest_change(request, data=None, user=None, orig_request=None, can_queue=False, orig_data=None):
 	"""Generate Forest Change Cover
@@ -543,37 +1018,12 @@ def soc(request, data=None, user=None, orig_request=None, can_queue=False, orig_
 	else:
 		params = request.data
 	
-	vector_id = params.get('vector', None)
-	admin_level = params.get('admin_level', None)
-	raster_type = params.get('raster_type', None)
-	start_year = params.get('start_year', None)
-	end_year = params.get('end_year', None)
-	custom_coords = params.get('custom_coords', None)
-	transform = params.get('transform', "area")
 	show_change = params.get('show_change', False)
-	reference_raster = params.get('reference_raster', 3)
-	raster_source = params.get('raster_source', RasterSourceEnum.LULC.value)
-	admin_0 = params.get('admin_0', None)
-
-	raster_source = map_raster_source(raster_source)
+	raster_source = map_raster_source(params.get('raster_source', RasterSourceEnum.LULC.value))
 	if raster_source == None:
 		return Response({ "error": _("Invalid value for raster source") })
 
-	soc = SOC(
-		admin_0=admin_0,
-		admin_level=admin_level,
-		shapefile_id = vector_id,
-		custom_vector_coords = custom_coords, # custom_coords,
-		raster_type = raster_type,
-		start_year=start_year,
-		end_year=end_year,
-		transform=transform,
-		write_to_disk=True,
-		climatic_region=ClimaticRegionEnum.TemperateDry,
-		reference_soc=reference_raster,
-		raster_source=raster_source,
-		request=request,
-	)
+	soc = get_soc(request, params, raster_source)
 
 	res = ""
 	error = ""
@@ -593,6 +1043,26 @@ def soc(request, data=None, user=None, orig_request=None, can_queue=False, orig_
 	else:
 		return Response(res)
 
+def get_soc(request, params, raster_source, **kwargs):
+	"""Create a SOC object from the parameters of a request. See `get_lulc`
+	"""
+	return SOC(
+		admin_0=params.get('admin_0', None),
+		admin_level=params.get('admin_level', None),
+		shapefile_id = params.get('vector', None),
+		custom_vector_coords = params.get('custom_coords', None),
+		raster_type = params.get('raster_type', None),
+		start_year=params.get('start_year', None),
+		end_year=params.get('end_year', None),
+		transform=params.get('transform', "area"),
+		write_to_disk=True,
+		climatic_region=ClimaticRegionEnum.TemperateDry,
+		reference_soc=params.get('reference_raster', 3),
+		raster_source=raster_source,
+		request=request,
+		**kwargs
+	)
+
 # @api_view(['POST'])
 # @permission_classes([IsAuthenticated])
 def trajectory(request, data=None, user=None, orig_request=None, can_queue=False, orig_data=None):
@@ -679,46 +1149,54 @@ def dispatch_productivity(request, productivity_calc_enum, data=None, user=None,
 	else:
 		params = request.data
 
-	vector_id = params.get('vector', None)
-	admin_level = params.get('admin_level', None)
-	raster_type = params.get('raster_type', None)
-	start_year = params.get('start_year', None)
-	end_year = params.get('end_year', None)
-	custom_coords = params.get('custom_coords', None)
-	transform = params.get('transform', "area")
-	show_change = params.get('show_change', False)
-	reference_eco_units = params.get('reference_eco_units', None)
-	raster_source = params.get('raster_source', RasterSourceEnum.MODIS.value)
-	admin_0 = params.get('admin_0', None)
-	veg_index = params.get('veg_index', RasterCategoryEnum.NDVI.value)
-	version = params.get("version", 1)
-	class_map = params.get('class_map', 3)
-
-	# reference_raster = params.get('reference_raster', 3)
-	raster_source = map_raster_source(raster_source)
+	raster_source = map_raster_source(params.get('raster_source', RasterSourceEnum.MODIS.value))
 	if raster_source == None:
 		return Response({ "error": _("Invalid value for raster source") })
 
-	prod = Productivity(
-		admin_0=admin_0,
-		admin_level=admin_level,
-		shapefile_id = vector_id,
-		custom_vector_coords = custom_coords, # custom_coords,
-		raster_type = raster_type,
-		start_year=start_year,
-		end_year=end_year,
-		transform=transform,
+	prod = get_productivity(request, params, raster_source)
+	res = run_productivity(prod, productivity_calc_enum)
+	error = prod.error 
+
+	if can_queue:
+		post_analysis_save_task(request, task, res, error, data)
+
+	if error:
+		return Response({ "error": error })
+	else:
+		return Response(res)
+
+def get_productivity(request, params, raster_source, **kwargs):
+	"""Create a Productivity object from the parameters of a request. See `get_lulc`
+	"""
+	return Productivity(
+		admin_0=params.get('admin_0', None),
+		admin_level=params.get('admin_level', None),
+		shapefile_id = params.get('vector', None),
+		custom_vector_coords = params.get('custom_coords', None),
+		raster_type = params.get('raster_type', None),
+		start_year=params.get('start_year', None),
+		end_year=params.get('end_year', None),
+		transform=params.get('transform', "area"),
 		write_to_disk=True,
 		climatic_region=ClimaticRegionEnum.TemperateDry,
-		# reference_soc=reference_raster,
-		show_change=show_change,
+		show_change=params.get('show_change', False),
 		request=request,
 		raster_source=raster_source,
-		reference_eco_units=reference_eco_units,
-		veg_index=veg_index,
-		version=version,
-		class_map=class_map
+		reference_eco_units=params.get('reference_eco_units', None),
+		veg_index=params.get('veg_index', RasterCategoryEnum.NDVI.value),
+		version=params.get("version", 1),
+		class_map=params.get('class_map', 3),
+		**kwargs
 	)
+
+def run_productivity(prod, productivity_calc_enum):
+	"""Compute a productivity sub-indicator
+
+	Args:
+		prod (Productivity): See `get_productivity`
+		productivity_calc_enum (ProductivityCalcEnum)
+	"""
+	res = None
 	if productivity_calc_enum == ProductivityCalcEnum.TRAJECTORY:
 		res = prod.calculate_trajectory()
 	if productivity_calc_enum == ProductivityCalcEnum.STATE:
@@ -727,16 +1205,7 @@ def dispatch_productivity(request, productivity_calc_enum, data=None, user=None,
 		res = prod.calculate_performance()
 	if productivity_calc_enum == ProductivityCalcEnum.PRODUCTIVITY:
 		res = prod.calculate_productivity()
-
-	error = prod.error 
-
-	if can_queue:
-		post_analysis_save_task(request, task, res, error, data)
-
-	if error:
-		return Response({ "error": error })
-	else:
-		return Response(res)
+	return res
 
 # @api_view(['POST'])
 # @permission_classes([IsAuthenticated])
@@ -760,44 +1229,11 @@ def land_degradation(request, data=None, user=None, orig_request=None, can_queue
 		params = request.data
 	
 	params = request.data
-	vector_id = params.get('vector', None)
-	admin_level = params.get('admin_level', None)
-	raster_type = params.get('raster_type', None)
-	start_year = params.get('start_year', None)
-	end_year = params.get('end_year', None)
-	custom_coords = params.get('custom_coords', None)
-	transform = params.get('transform', "area")
-	show_change = params.get('show_change', False)
-	reference_eco_units = params.get('reference_eco_units', None)
-	reference_soc = params.get('reference_raster', None)
-	raster_source = params.get('raster_source', RasterSourceEnum.MODIS.value)
-	admin_0 = params.get('admin_0', None)
-	veg_index = params.get('veg_index', RasterCategoryEnum.NDVI.value)
-
-	raster_source = map_raster_source(raster_source)
+	raster_source = map_raster_source(params.get('raster_source', RasterSourceEnum.MODIS.value))
 	if raster_source == None:
 		return Response({ "error": _("Invalid value for raster source") })
 
-	prod = LandDegradation(
-		admin_0=admin_0,
-		admin_level=admin_level,
-		shapefile_id = vector_id,
-		custom_vector_coords = custom_coords, # custom_coords,
-		raster_type = raster_type,
-		start_year=start_year,
-		end_year=end_year,
-		transform=transform,
-		write_to_disk=True,
-		climatic_region=ClimaticRegionEnum.TemperateDry,
-		# reference_soc=reference_raster,
-		show_change=show_change,
-		request=request,
-		reference_soc=reference_soc,
-		raster_source=raster_source,
-		reference_eco_units=reference_eco_units,
-		veg_index=veg_index
-	)
-
+	prod = get_land_degradation(request, params, raster_source)
 	res = prod.calculate_land_degradation()
 	error = prod.error 
 
@@ -809,6 +1245,29 @@ def land_degradation(request, data=None, user=None, orig_request=None, can_queue
 	else:
 		return Response(res)
 
+def get_land_degradation(request, params, raster_source, **kwargs):
+	"""Create a LandDegradation object from the parameters of a request. See `get_lulc`
+	"""
+	return LandDegradation(
+		admin_0=params.get('admin_0', None),
+		admin_level=params.get('admin_level', None),
+		shapefile_id = params.get('vector', None),
+		custom_vector_coords = params.get('custom_coords', None),
+		raster_type = params.get('raster_type', None),
+		start_year=params.get('start_year', None),
+		end_year=params.get('end_year', None),
+		transform=params.get('transform', "area"),
+		write_to_disk=True,
+		climatic_region=ClimaticRegionEnum.TemperateDry,
+		show_change=params.get('show_change', False),
+		request=request,
+		reference_soc=params.get('reference_raster', None),
+		raster_source=raster_source,
+		reference_eco_units=params.get('reference_eco_units', None),
+		veg_index=params.get('veg_index', RasterCategoryEnum.NDVI.value),
+		**kwargs
+	)
+
 # @api_view(['POST'])
 # @permission_classes([IsAuthenticated])
 def aridity_index(request, data=None, user=None, orig_request=None, can_queue=False, orig_data=None):
@@ -924,6 +1383,34 @@ def dispatch_medalus(request, medalus_calc_enum, data=None, user=None, orig_requ
 		params = request.data
 
 	params = request.data
+	raster_source = map_raster_source(params.get('raster_source', RasterSourceEnum.MODIS.value))
+	if raster_source == None:
+		return Response({ "error": _("Invalid value for raster source") })
+
+	medalus = get_medalus(request, params, raster_source)
+	res = run_medalus(medalus, medalus_calc_enum)
+	error = medalus.error
+
+	if can_queue:
+		post_analysis_save_task(request, task, res, error, data)
+	# else: # try cache results if no error
+	# 	if not error:
+	# 		cache_results(params, res, error)
+
+	if error:
+		return Response({ "error": error })
+	else:
+		return Response(res)
+
+def get_medalus(request, params, raster_source, **kwargs):
+	"""Create a Medalus object from the parameters of a request
+
+	Args:
+		request: Request object
+		params (dict): Parameters of the request
+		raster_source (RasterSourceEnum): Source of the rasters
+		kwargs: Extra arguments of Medalus e.g return_raw
+	"""
 	vector_id = params.get('vector', None)
 	admin_level = params.get('admin_level', None)
 	raster_type = params.get('raster_type', None)
@@ -934,14 +1421,9 @@ def dispatch_medalus(request, medalus_calc_enum, data=None, user=None, orig_requ
 	show_change = params.get('show_change', False)
 	reference_eco_units = params.get('reference_eco_units', None)
 	reference_soc = params.get('reference_raster', None)
-	raster_source = params.get('raster_source', RasterSourceEnum.MODIS.value)
 	admin_0 = params.get('admin_0', None)
-	
-	raster_source = map_raster_source(raster_source)
-	if raster_source == None:
-		return Response({ "error": _("Invalid value for raster source") })
 
-	medalus = Medalus(
+	return Medalus(
 		admin_0=admin_0,
 		admin_level=admin_level,
 		shapefile_id = vector_id,
@@ -959,8 +1441,17 @@ def dispatch_medalus(request, medalus_calc_enum, data=None, user=None, orig_requ
 		raster_source=raster_source,
 		reference_eco_units=reference_eco_units,
 		# veg_index=veg_index
+		**kwargs
 	)
 
+def run_medalus(medalus, medalus_calc_enum):
+	"""Compute a Medalus index
+
+	Args:
+		medalus (Medalus): See `get_medalus`
+		medalus_calc_enum (MedalusCalcEnum)
+	"""
+	res = None
 	if medalus_calc_enum == MedalusCalcEnum.ARIDITY_INDEX:
 		res = medalus.calculate_aridity_index()
 	if medalus_calc_enum == MedalusCalcEnum.CLIMATE_QUALITY_INDEX:
@@ -973,19 +1464,7 @@ def dispatch_medalus(request, medalus_calc_enum, data=None, user=None, orig_requ
 		res = medalus.calculate_management_quality_index()
 	if medalus_calc_enum == MedalusCalcEnum.ESAI:
 		res = medalus.calculate_esai()
-
-	error = medalus.error
-
-	if can_queue:
-		post_analysis_save_task(request, task, res, error, data)
-	# else: # try cache results if no error
-	# 	if not error:
-	# 		cache_results(params, res, error)
-
-	if error:
-		return Response({ "error": error })
-	else:
-		return Response(res)
+	return res
 
 def forest_carbon_emission(request, data=None, user=None, orig_request=None, can_queue=False, orig_data=None):
 	"""Generate Forest Carbon Emission
@@ -1326,13 +1805,18 @@ def coastal_vulnerability_index(request, data=None, user=None, orig_request=None
 	else:
 		return Response(res)
 
-def pre_analysis_save_task(request, data, user, task_name, orig_data):
-	"""Save task"""
+def pre_analysis_save_task(request, data, user, task_name, orig_data, job_id=None, estimated_cost=None):
+	"""Save task
+
+	Args:
+		job_id (string, optional): ID of the job if the task is not saved from within its job
+		estimated_cost (float, optional): Estimated cost if the task is not saved from within its job
+	"""
 	job = get_current_job()
 	print("User email: ",  user['email'] if user else "" )
 	task = ScheduledTask.objects.create(
 		owner=user['email'] if user else "",
-		job_id=job.get_id() if job else get_random_string(length=10),
+		job_id=job.get_id() if job else (job_id or get_random_string(length=10)),
 		name=task_name,
 		method=request['path'],
 		#args=json.dumps(json.loads(data)) if data else "{}",
@@ -1340,15 +1824,25 @@ def pre_analysis_save_task(request, data, user, task_name, orig_data):
 		orig_args=json.dumps(orig_data) if orig_data else "{}",
 		status=_("Processing"),
 		request=request,
+		estimated_cost=job.meta.get('estimated_cost') if job else estimated_cost,
 	)
+	if job: # stages of the job are saved to the task. See ldms.utils.instrument_util
+		job.meta['task_id'] = task.id
+		job.save_meta()
+		# records logged by the rest of the job carry the fields of the request
+		set_log_context(request_id=request.get('request_id') or "-", task_id=task.id, 
+					indicator=get_api_name(task.method), aoi_hash=get_aoi_hash(orig_data or {}))
+		log("Started task %s" % (task.id))
 	return job, task
 	
 def post_analysis_save_task(request, task, res, error, data):
 	"""Update task with results of analysis"""
-	def parse_result():
-		if isinstance(res, dict):
-			return json.dumps(eval(str(res)))
-		return res
+	system_settings = get_settings()
+
+	# encode once for both the task and the cache
+	result = None
+	if not error:
+		result = encode_result(res) if isinstance(res, dict) else res
 
 	def cache_results():
 		# cache results. Only save to cache if there is no error
@@ -1357,19 +1851,29 @@ def post_analysis_save_task(request, task, res, error, data):
 			the original user payload while request.data may have been interfered with 
 			when adminlevel one and two ids are appended"""
 			set_cache_key(key=generate_cache_key(json.loads(task.orig_args), task.method), 
-					value=parse_result())
+					value=result,
+					timeout=get_cache_timeout(task.method, system_settings))
 
-	task.result = parse_result() if not error else ""
+	task.result = result if not error else ""
+	task.progress = finish_progress() or task.progress
 	task.error = error
 	task.succeeded = True if not error else False
 	task.status = _("Finished") if not error else _("Failed")
 	task.completed_on = timezone.now()
 	task.save()
-
-	if get_settings().enable_cache:
+	# includes the time spent in the queue
+	observe_analysis(get_api_name(task.method), (task.completed_on - task.created_on).total_seconds(), queued=True)
+	log("Finished task %s in %.2f seconds" % (task.id, (task.completed_on - task.created_on).total_seconds()), 
+				task_id=task.id)
+	# the memory-mapped arrays of the job are no longer needed
+	cleanup_scratch()
+
+	if system_settings.enable_cache:
 		cache_results()
 		# cache_results(task.orig_args, res, error)
 	notify_user(request, task, task.owner)	
+	# the process of the job exits without writing the records left on the log queues
+	flush_logs()
 
 def notify_user(request, task, email_addr):
 	"""Send an email"""
@@ -1,6 +1,5 @@
 import numpy as np
 import numpy.ma as ma
-import pandas as pd
 import tempfile
 from django.utils.translation import gettext as _
 from rest_framework.response import Response
@@ -8,11 +7,13 @@ from rest_framework.response import Response
 from ldms.utils.vector_util import get_vector
 from ldms.utils.raster_util import (get_raster_values, save_raster, reproject_raster, 
 					do_raster_operation, get_raster_models, clip_raster_to_vector,
-					clip_rasters, mask_rasters,
-					get_raster_meta, return_raster_with_stats, reshape_rasters)
+					get_raster_meta, return_raster_with_stats,
+					reclassify_by_matrix, is_block_processing_enabled, 
+					return_raster_with_stats_by_block, RasterStack)
 from ldms.enums import (RasterSourceEnum, RasterOperationEnum, RasterCategoryEnum, 
 						CVIEnum, CVIFactorsEnum, CVIComputationTypeEnum)
 from ldms.utils.common_util import return_with_error, get_random_floats, cint, validate_years
+from ldms.utils.dtype_util import to_class_dtype
 from ldms.utils.file_util import (generate_file_name, get_absolute_media_path, get_download_url, 
 								file_exists, get_physical_file_path_from_url)
 from ldms import ModelNotExistError, AnalysisParamError
@@ -117,29 +118,24 @@ class CoastalVulnerabilityIndex:
 			if mdl and not does_rasterfile_exist(mdl):
 				return self.return_with_error(_("Raster file {0} does not exist".format(mdl.rasterfile.name)))
 
-		# Clip rasters
-		nodata, clipped_rasters = clip_rasters(vector, 
-										[geo_model, slope_model, sealevel_model, shoreline_model, tide_model, wave_model], 
-										ref_model=ref_model,
-										raise_file_missing_exception=self.computation_type == CVIComputationTypeEnum.CVI)
-		
-		# get the rasters and leave out the file
-		clipped_raster_paths = [x[1] for x in clipped_rasters]
-		clipped_rasters = [x[0] for x in clipped_rasters]
-		# mask arrays to ensure nodata pixels are not considered
-		clipped_rasters = mask_rasters(clipped_rasters, nodata)
-		# geo_raster = clipped_rasters[0][0] 
-		# coastal_slope_raster = clipped_rasters[1][0] 
-		# sealevel_change_raster = clipped_rasters[2][0]
-		# shoreline_erosion_raster = clipped_rasters[3][0]
-		# mean_tide_raster = clipped_rasters[4][0]
-		# mean_wave_raster = clipped_rasters[5][0]
-		geo_raster = clipped_rasters[0]
-		coastal_slope_raster = clipped_rasters[1]
-		sealevel_change_raster = clipped_rasters[2]
-		shoreline_erosion_raster = clipped_rasters[3]
-		mean_tide_raster = clipped_rasters[4]
-		mean_wave_raster = clipped_rasters[5]
+		if is_block_processing_enabled():
+			return self.calculate_cvi_by_block(vector, ref_model, 
+										[geo_model, slope_model, sealevel_model, shoreline_model, tide_model, wave_model])
+
+		models = [geo_model, slope_model, sealevel_model, shoreline_model, tide_model, wave_model]
+		if self.computation_type != CVIComputationTypeEnum.CVI:
+			# only the raster of the factor is needed
+			models = [mdl if mdl == ref_model else None for mdl in models]
+		input_models = [mdl for mdl in models if mdl]
+
+		# Clip and align the rasters. Pixels with nodata are masked
+		with RasterStack([x.rasterfile.name for x in input_models], vector, 
+						ref_file=ref_model.rasterfile.name if ref_model else None) as stack:
+			nodata = stack.nodata
+			rasters = list(stack.read())
+			metadata_raster_path = stack.save_meta_raster()
+		geo_raster, coastal_slope_raster, sealevel_change_raster, shoreline_erosion_raster, \
+			mean_tide_raster, mean_wave_raster = [rasters.pop(0) if mdl else None for mdl in models]
 
 		prefix = "cvi"
 		change_enum = CVIFactorsEnum
@@ -164,33 +160,21 @@ class CoastalVulnerabilityIndex:
 		if self.computation_type == CVIComputationTypeEnum.CVI:
 			change_enum = CVIEnum
 			# Multiply factors.
-			rasters = reshape_rasters([geo_raster, coastal_slope_raster, sealevel_change_raster, shoreline_erosion_raster, mean_tide_raster, mean_wave_raster])
-			cvi = np.sqrt((rasters[0] * rasters[1] * rasters[2] * rasters[3] * rasters[4] * rasters[5])/6)
+			cvi = np.sqrt((geo_raster * coastal_slope_raster * sealevel_change_raster * shoreline_erosion_raster * mean_tide_raster * mean_wave_raster)/6)
 
 		cvi = ma.array(cvi)		
 		
 		# Step 3
 		matrix = self.initialize_matrix()
-		df = pd.DataFrame({
-						'ratio': cvi.filled(fill_value=nodata).flatten(),												
-					})
-		df['mapping'] = nodata
-		no_data_mask = df['ratio'] != nodata
-		# Replace values
-		for row in matrix:
-			# filter all matching entries as per the matrix
-			mask = (df['ratio'] >= row['low']) & (df['ratio'] < row['high'])
-			df.loc[mask & no_data_mask, ['mapping']] = row['mapping']
-		
-		out_raster = df['mapping'].values.reshape(cvi.shape)
-		out_raster = out_raster.astype(np.int32)
+		out_raster = reclassify_by_matrix(cvi, matrix, nodata)
+		out_raster = to_class_dtype(out_raster, nodata)
 		resolution = geo_model.resolution if self.computation_type == CVIComputationTypeEnum.CVI else ref_model.resolution
 		return return_raster_with_stats(
 			request=self.request,
-			datasource=out_raster[0], 
+			datasource=out_raster, 
 			prefix=prefix, 
 			change_enum=change_enum, 
-			metadata_raster_path=[x for x in clipped_raster_paths if x][0], #clipped_rasters[0][1],
+			metadata_raster_path=metadata_raster_path,
 			nodata=nodata, 
 			resolution=resolution,
 			start_year=self.start_year,
@@ -198,6 +182,48 @@ class CoastalVulnerabilityIndex:
 			subdir=CVISettings.SUB_DIR
 		)
 	
+	def calculate_cvi_by_block(self, vector, ref_model, models):
+		"""
+		Compute CVI block by block so that only a window of each raster is held in memory at a time
+
+		Args:
+			vector (geojson): Polygon to be used for clipping
+			ref_model (Raster): Model of the factor being computed. None if computing CVI
+			models (list): Models of all the factors
+		"""
+		prefixes = {
+			CVIComputationTypeEnum.GEOMORPHOLOGY: "geo_",
+			CVIComputationTypeEnum.COASTAL_SLOPE: "cs_",
+			CVIComputationTypeEnum.SEALEVEL_CHANGE: "slc_",
+			CVIComputationTypeEnum.SHORELINE_EROSION: "sre_",
+			CVIComputationTypeEnum.TIDE_RANGE: "mtr_",
+			CVIComputationTypeEnum.WAVE_HEIGHT: "mwh_",
+		}
+		is_cvi = self.computation_type == CVIComputationTypeEnum.CVI
+		input_models = models if is_cvi else [ref_model]
+		nodata = get_raster_meta(input_models[0].rasterfile.name)['nodata']
+		matrix = self.initialize_matrix()
+
+		def compute_block(blocks):
+			cvi = blocks[0]
+			if is_cvi:
+				cvi = np.sqrt((blocks[0] * blocks[1] * blocks[2] * blocks[3] * blocks[4] * blocks[5])/6)
+			return reclassify_by_matrix(cvi, matrix, nodata)
+
+		return return_raster_with_stats_by_block(
+			request=self.request,
+			raster_files=[x.rasterfile.name for x in input_models],
+			vector=vector,
+			func=compute_block,
+			prefix="cvi" if is_cvi else prefixes[self.computation_type],
+			change_enum=CVIEnum if is_cvi else CVIFactorsEnum,
+			nodata=nodata,
+			resolution=input_models[0].resolution,
+			start_year=self.start_year,
+			end_year=self.end_year,
+			subdir=CVISettings.SUB_DIR
+		)
+
 	def prevalidate(self, both_valid=True):
 		"""
 		Do common prevalidations and processing
@@ -5,11 +5,14 @@ from ldms.analysis.lulc import LULC
 from ldms.enums import RasterSourceEnum
 import ee
 from ldms.utils.vector_util import get_vector
+from ldms.utils.instrument_util import instrumented
 from ldms.utils.raster_util import RasterCalcHelper
 from ldms.utils.common_util import cint, return_with_error, validate_years
+from ldms.utils.dtype_util import to_class_dtype
 from ldms.utils.raster_util import (
 								clip_raster_to_vector, clip_raster_to_vector_windowed,
-								return_raster_with_stats, get_raster_models)
+								return_raster_with_stats, get_raster_models, get_class_counts,
+								get_block_percentages)
 from ldms.utils.file_util import (get_media_dir, file_exists)
 from ldms.enums import (RasterSourceEnum, RasterCategoryEnum, 
 						ForestCoverLossQuinaryEnum, ForestChangeTernaryEnum,
@@ -103,6 +106,7 @@ class ForestCarbonEmission:
 						  request=self.request
 						)
 
+	@instrumented()
 	def calculate_carbon_emission(self):
 		#return self._calculate_carbon_emission_with_ready_activity_map()
 		return self._calculate_carbon_emission_without_activity_map()
@@ -176,7 +180,7 @@ class ForestCarbonEmission:
 					vector=vector, 
 					window_size=(self.mfu, self.mfu),
 					use_temp_dir=True, 
-					apply_func=self.generate_forest_activity_map, 
+					block_func=self.generate_forest_activity_map, 
 					dest_nodata=ForestCarbonEmissionSettings.MFU_NODATA
 			)
 
@@ -202,8 +206,7 @@ class ForestCarbonEmission:
 
 		ton_per_ha = raster_model.resolution * 0.0001 # 1 square metre = 0.0001 ha
 		results = []
-		unique, counts = np.unique(forest_activity_raster, return_counts=True)			
-		val_counts = dict(zip(unique, counts))
+		val_counts = get_class_counts(forest_activity_raster)
 		for mapping in change_matrix:
 			key = cint(mapping.get('key'))
 			if key in val_counts:
@@ -225,7 +228,7 @@ class ForestCarbonEmission:
 				})
 		
 		datasource = df['mapping'].values.reshape(forest_activity_raster.shape)
-		datasource = datasource.astype(np.int32)
+		datasource = to_class_dtype(datasource, nodata)
 
 		# hlper = RasterCalcHelper(vector=vector,
 		# 			rasters=raster_models,
@@ -246,7 +249,8 @@ class ForestCarbonEmission:
 			start_year=self.start_year,
 			end_year=self.end_year,
 			subdir=ForestCarbonEmissionSettings.SUB_DIR,
-			results=results #None #res
+			results=results, #None #res
+			val_counts=val_counts
 		)	
 
 	def _calculate_carbon_emission_with_ready_activity_map(self):
@@ -349,8 +353,7 @@ class ForestCarbonEmission:
 		# 	df.loc[mask, ['mapping']] = valid['base'] / np.log(z_valid['b'])
 
 		results = []
-		unique, counts = np.unique(lulc_raster, return_counts=True)			
-		val_counts = dict(zip(unique, counts))
+		val_counts = get_class_counts(lulc_raster)
 		for mapping in change_matrix:
 			key = cint(mapping.get('key'))
 			if key in val_counts:
@@ -372,7 +375,7 @@ class ForestCarbonEmission:
 				})
 		
 		datasource = df['mapping'].values.reshape(lulc_raster.shape)
-		datasource = datasource.astype(np.int32)
+		datasource = to_class_dtype(datasource, nodata)
 
 		return return_raster_with_stats(
 			request=self.request,
@@ -385,12 +388,15 @@ class ForestCarbonEmission:
 			start_year=start_year,
 			end_year=end_year,
 			subdir=ForestCarbonEmissionSettings.SUB_DIR,
-			results=results #None #res
+			results=results, #None #res
+			val_counts=val_counts
 		)
 
 	def generate_forest_activity_map(self, array):
 		"""
-		Generate Forest Activity Map from the Tree Cover Loss
+		Generate Forest Activity Map from the Tree Cover Loss. Each MFU (block of mfu x mfu pixels) 
+		is classified using the percentage of its pixels in each class. MFUs on the right and bottom 
+		edges of the raster may be smaller.
 
 		Decision Rules are as below:
 
@@ -409,29 +415,33 @@ class ForestCarbonEmission:
 			A MFU is considered as degraded if the remaining percentage of tree cover after the
 			two periods is above the minimum percentage required by the forest definition; 
 			and deforested if the tree cover is lowered below this percentage.
+
+		Args:
+			array (array): Tree Cover Loss
+
+		Returns:
+			array: Class of each MFU
 		"""
-		def get_key_val(key):
-			return counts.get(key, 0)
-
-		# get count of unique values
-		vals, cnts = np.unique(array, return_counts=True)
-		# get percentage count for each unique pixel value
-		counts = dict(zip(vals, [x/sum(cnts) * 100 for x in cnts]))
-
-		change = ForestCarbonEmissionSettings.NODATA
-		if get_key_val(ForestCarbonEmissionSettings.NODATA) > self.mfu_forest_threshold:
-			change = ForestCarbonEmissionSettings.NODATA if ForestCarbonEmissionSettings.EXCLUDE_NOT_A_FOREST else ForestCarbonEmissionSettings.NODATA
-		elif get_key_val(ForestCoverLossQuinaryEnum.TREES_IN_BOTH_PERIODS.key) < self.mfu_forest_threshold:
-			change = ForestCarbonEmissionSettings.NODATA if ForestCarbonEmissionSettings.EXCLUDE_NOT_A_FOREST else ForestChangeQuinaryEnum.NOT_FOREST.key
-		elif get_key_val(ForestCoverLossQuinaryEnum.TREES_IN_BOTH_PERIODS.key) >= self.mfu_forest_threshold and \
-			get_key_val(ForestCoverLossQuinaryEnum.TREE_LOSS_IN_PERIOD1.key) == 0 and \
-			get_key_val(ForestCoverLossQuinaryEnum.TREE_LOSS_IN_PERIOD2.key) == 0:
-			change = ForestChangeQuinaryEnum.UNDISTURBED_FOREST.key
-		else:
-			if get_key_val(ForestCoverLossQuinaryEnum.TREES_IN_BOTH_PERIODS) > self.mfu_forest_threshold:
-				change = ForestChangeQuinaryEnum.DEGRADED_FOREST.key
-			change = ForestChangeQuinaryEnum.DEFORESTED.key
-		return np.array([[change]]) #ensure you return an ndarray
+		percentages = get_block_percentages(array, (self.mfu, self.mfu), [
+							ForestCarbonEmissionSettings.NODATA,
+							ForestCoverLossQuinaryEnum.TREES_IN_BOTH_PERIODS.key,
+							ForestCoverLossQuinaryEnum.TREE_LOSS_IN_PERIOD1.key,
+							ForestCoverLossQuinaryEnum.TREE_LOSS_IN_PERIOD2.key])
+		nodata = percentages[ForestCarbonEmissionSettings.NODATA]
+		trees = percentages[ForestCoverLossQuinaryEnum.TREES_IN_BOTH_PERIODS.key]
+		no_loss = (percentages[ForestCoverLossQuinaryEnum.TREE_LOSS_IN_PERIOD1.key] == 0) & \
+				(percentages[ForestCoverLossQuinaryEnum.TREE_LOSS_IN_PERIOD2.key] == 0)
+
+		# the rules are applied in order, the first that matches gives the class of the MFU
+		return np.select([
+				nodata > self.mfu_forest_threshold,
+				trees < self.mfu_forest_threshold,
+				no_loss
+			], [
+				ForestCarbonEmissionSettings.NODATA,
+				ForestCarbonEmissionSettings.NODATA if ForestCarbonEmissionSettings.EXCLUDE_NOT_A_FOREST else ForestChangeQuinaryEnum.NOT_FOREST.key,
+				ForestChangeQuinaryEnum.UNDISTURBED_FOREST.key
+			], default=ForestChangeQuinaryEnum.DEFORESTED.key)
 
 	def initialize_forest_activity_map_matrix(self):
 		"""
@@ -1,17 +1,18 @@
 import numpy as np
 import numpy.ma as ma
-import pandas as pd
 import tempfile
 from django.utils.translation import gettext as _
 from rest_framework.response import Response
 
 from ldms.utils.vector_util import get_vector
 from ldms.utils.raster_util import (get_raster_values, save_raster, reproject_raster, 
-					do_raster_operation, get_raster_models, clip_raster_to_vector, clip_rasters,
-					get_raster_meta, return_raster_with_stats, reshape_rasters, mask_rasters)
+					do_raster_operation, get_raster_models, clip_raster_to_vector,
+					get_raster_meta, return_raster_with_stats,
+					reclassify_by_matrix, RasterStack, accumulate_masked)
 from ldms.enums import (RasterSourceEnum, RasterOperationEnum, RasterCategoryEnum, 
 						ILSWEEnum, ILSWEFactorsEnum, ILSWEComputationTypeEnum)
 from ldms.utils.common_util import return_with_error, get_random_floats, cint, validate_years
+from ldms.utils.dtype_util import to_class_dtype
 from ldms.utils.file_util import (generate_file_name, get_absolute_media_path, get_download_url, 
 								file_exists, get_physical_file_path_from_url)
 from ldms import ModelNotExistError, AnalysisParamError
@@ -114,34 +115,26 @@ class ILSWE:
 			if mdl and not does_rasterfile_exist(mdl):
 				return self.return_with_error(_("Raster file {0} does not exist".format(mdl.rasterfile.name)))
 
-		#nodata, clipped_rasters = self.clip_rasters(vector, [vc_model, sr_model, sc_model, ef_model, ce_model], ref_model=ref_model)
-		nodata, clipped_rasters = clip_rasters(vector, 
-										[vc_model, sr_model, sc_model, ef_model, ce_model], 
-										ref_model=ref_model,
-										raise_file_missing_exception=self.computation_type == ILSWEComputationTypeEnum.ILSWE)
-		# vc_raster = clipped_rasters[0][0] 
-		# sr_raster = clipped_rasters[1][0] 
-		# sc_raster = clipped_rasters[2][0]
-		# ef_raster = clipped_rasters[3][0]
-		# ce_raster = clipped_rasters[4][0]
-
-		clipped_raster_paths = [x[1] for x in clipped_rasters]
-		clipped_rasters = [x[0] for x in clipped_rasters]
-		# mask arrays to ensure nodata pixels are not considered
-		#clipped_rasters = mask_rasters([x[0] for x in clipped_rasters], nodata)
-		clipped_rasters = mask_rasters(clipped_rasters, nodata)
-		vc_raster = clipped_rasters[0]
-		sr_raster = clipped_rasters[1] 
-		sc_raster = clipped_rasters[2]
-		ef_raster = clipped_rasters[3]
-		ce_raster = clipped_rasters[4]
+		models = [vc_model, sr_model, sc_model, ef_model, ce_model]
+		if self.computation_type != ILSWEComputationTypeEnum.ILSWE:
+			# only the raster of the factor is needed
+			models = [mdl if mdl == ref_model else None for mdl in models]
+		input_models = [mdl for mdl in models if mdl]
+
+		# Clip and align the rasters. Pixels with nodata are masked
+		with RasterStack([x.rasterfile.name for x in input_models], vector, 
+						ref_file=ref_model.rasterfile.name if ref_model else None) as stack:
+			nodata = stack.nodata
+			rasters = list(stack.read())
+			metadata_raster_path = stack.save_meta_raster()
+		vc_raster, sr_raster, sc_raster, ef_raster, ce_raster = [rasters.pop(0) if mdl else None for mdl in models]
 
 		# Step 1
-		vc_fuzz = self.fuzzify_vegetation_cover(vc_raster, nodata) if vc_raster.shape else None
-		sr_fuzz = self.fuzzify_soil_roughness(sr_raster, nodata) if sr_raster.shape else None
-		sc_fuzz = self.fuzzify_soil_crust(sc_raster, nodata) if sc_raster.shape else None
-		ef_fuzz = self.fuzzify_erodible_fraction(ef_raster, nodata) if ef_raster.shape else None
-		ce_fuzz = self.fuzzify_climatic_erosivity(ce_raster, nodata) if ce_raster.shape else None
+		vc_fuzz = self.fuzzify_vegetation_cover(vc_raster, nodata) if vc_raster is not None else None
+		sr_fuzz = self.fuzzify_soil_roughness(sr_raster, nodata) if sr_raster is not None else None
+		sc_fuzz = self.fuzzify_soil_crust(sc_raster, nodata) if sc_raster is not None else None
+		ef_fuzz = self.fuzzify_erodible_fraction(ef_raster, nodata) if ef_raster is not None else None
+		ce_fuzz = self.fuzzify_climatic_erosivity(ce_raster, nodata) if ce_raster is not None else None
 
 		prefix = "ilswe"
 		change_enum = ILSWEFactorsEnum
@@ -163,32 +156,20 @@ class ILSWE:
 			prefix = "ce_"
 		if self.computation_type == ILSWEComputationTypeEnum.ILSWE:
 			change_enum = ILSWEEnum
-			rasters = reshape_rasters([vc_fuzz, sr_fuzz, sc_fuzz, ef_fuzz, ce_fuzz])
 			# multiply rasters
-			ilswe = rasters[0] * rasters[1] * rasters[2] * rasters[3] * rasters[4]
+			ilswe = accumulate_masked(np.multiply, [vc_fuzz, sr_fuzz, sc_fuzz, ef_fuzz, ce_fuzz], nodata)
 
 		# Step 3
 		matrix = self.initialize_matrix()
-		df = pd.DataFrame({
-						'ratio': ilswe.filled(fill_value=nodata).flatten(),												
-					})
-		df['mapping'] = nodata
-		no_data_mask = df['ratio'] != nodata
-		# Replace values
-		for row in matrix:
-			# filter all matching entries as per the matrix
-			mask = (df['ratio'] >= row['low']) & (df['ratio'] < row['high'])
-			df.loc[mask & no_data_mask, ['mapping']] = row['mapping']
-		
-		out_raster = df['mapping'].values.reshape(ilswe.shape)
-		out_raster = out_raster.astype(np.int32)
+		out_raster = reclassify_by_matrix(ilswe, matrix, nodata)
+		out_raster = to_class_dtype(out_raster, nodata)
 		resolution = vc_model.resolution if self.computation_type == ILSWEComputationTypeEnum.ILSWE else ref_model.resolution
 		return return_raster_with_stats(
 			request=self.request,
-			datasource=out_raster[0], 
+			datasource=out_raster, 
 			prefix=prefix, 
 			change_enum=change_enum, 
-			metadata_raster_path=[x for x in clipped_raster_paths if x][0], #clipped_raster_paths[0], #clipped_rasters[0][1],
+			metadata_raster_path=metadata_raster_path,
 			nodata=nodata, 
 			resolution=resolution,
 			start_year=self.start_year,
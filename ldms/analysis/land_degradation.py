@@ -7,12 +7,15 @@ from ldms.enums import (ClimaticRegionEnum, LandDegradationChangeEnum,
 		ProductivityChangeTernaryEnum, SOCChangeEnum, LulcChangeEnum, RasterCategoryEnum)
 from ldms.utils.raster_util import (extract_pixels_using_vector, get_raster_meta, clip_raster_to_vector,
 				return_raster_with_stats, get_raster_models)
-import pandas as pd
+from ldms.utils.instrument_util import instrumented
 import numpy as np
 from ldms.utils.vector_util import get_vector
+from ldms.utils.memo_util import ComputationMemo
+from ldms.utils.parallel_util import stage, run_stages
 from ldms import ModelNotExistError, AnalysisParamError
 from ldms.utils.common_util import cint, return_with_error
-from ldms.utils.raster_util import reshape_raster, reshape_rasters
+from ldms.utils.dtype_util import to_class_dtype
+from ldms.utils.raster_util import reshape_raster, reshape_rasters, reclassify_combinations
 from django.conf import settings
 from django.utils.translation import gettext as _
 
@@ -49,6 +52,13 @@ class LandDegradation:
 				Either of:
 					- "area"
 					- a string with placeholder e.g x * x to mean square of that value
+			save_stage_rasters (bool):
+				If True, sub-indicators are saved to raster files. By default they are passed in memory
+			return_raw (bool):
+				If True, return the raw array instead of saving it to a raster file. Used by batch analyses
+			clip_vector (GeoJSON):
+				Already validated polygon to use instead of admin_level, shapefile_id and custom_coords 
+				e.g the extent of the areas of a batch analysis. Passed on to the sub-indicators
 			request (Request): 
 				A Web request object
 		""" 
@@ -67,6 +77,9 @@ class LandDegradation:
 		self.raster_source = kwargs.get('raster_source', RasterSourceEnum.MODIS)
 		self.admin_0 = kwargs.get('admin_0', None)
 		self.veg_index = kwargs.get('veg_index', RasterCategoryEnum.NDVI.value)
+		self.save_stage_rasters = kwargs.get('save_stage_rasters', False)
+		self.return_raw = kwargs.get('return_raw', False)
+		self.clip_vector = kwargs.get('clip_vector', None)
 
 		self.kwargs = kwargs
 			
@@ -87,6 +100,7 @@ class LandDegradation:
 				raise ModelNotExistError(error)
 		return (model, error)
 
+	@instrumented()
 	def calculate_land_degradation(self):
 		"""
 		Compute land degradation
@@ -94,6 +108,10 @@ class LandDegradation:
 		kwargs = self.kwargs
 		kwargs['write_to_disk'] = True
 		kwargs['climatic_region'] = ClimaticRegionEnum.TemperateDry
+		# Pass the sub-indicators in memory unless they are explicitly required on disk
+		kwargs['return_raw'] = not self.save_stage_rasters
+		# Share sub-computations e.g LULC change is needed by both SOC and LULC
+		kwargs['memo'] = kwargs.get('memo') or ComputationMemo()
 		
 		# Clip the raster and save for later referencing
 		vector, error = self.get_vector()
@@ -101,56 +119,49 @@ class LandDegradation:
 		meta_raster, meta_raster_path, nodata = clip_raster_to_vector(start_model.rasterfile.name, vector)
 		
 		soc = SOC(**kwargs)
-		soc_res = soc.calculate_soc_change()
-		if soc.error:
-			return self.return_with_error(soc.error)
-		
 		lulc = LULC(**kwargs)
-		lulc_res = lulc.calculate_lulc_change()
-		if lulc.error:
-			return self.return_with_error(lulc.error)
-
 		prod = Productivity(**kwargs)
-		prod_res = prod.calculate_productivity()
-		if prod.error:
-			return self.return_with_error(prod.error)
+		results = run_stages([
+			stage(soc, soc.calculate_soc_change),
+			stage(lulc, lulc.calculate_lulc_change),
+			stage(prod, prod.calculate_productivity)
+		])
+		for result, error in results:
+			if error:
+				return self.return_with_error(error)
+		soc_res, lulc_res, prod_res = [result for result, error in results]
 
-		prod_array = prod.read_raster(prod_res['rasterfile'])
-		soc_array = prod.read_raster(soc_res['rasterfile'])
-		lulc_array = prod.read_raster(lulc_res['rasterfile'])
+		prod_array = prod.get_stage_array(prod_res)
+		soc_array = prod.get_stage_array(soc_res)
+		lulc_array = prod.get_stage_array(lulc_res)
 
 		lst = reshape_rasters([prod_array, soc_array, lulc_array])
 		prod_array, soc_array, lulc_array = lst[0], lst[1], lst[2]
 
 		self.initialize_degradation_matrix()
 
-		df = pd.DataFrame({
-						'productivity': prod_array.flatten(),
-						'soc': soc_array.flatten(),
-						'lulc': lulc_array.flatten()
-					})
-		df['mapping'] = nodata
-
 		if LandDegrationSettings.OUTPUT_BINARY:
+			datasource = np.full(prod_array.shape, nodata)
 			# If any of the indicators has degraded, then output degraded else output not-degraded
-			degraded_mask = (df['productivity'] == ProductivityChangeTernaryEnum.DEGRADED.key) | (df['soc'] == SOCChangeEnum.DEGRADED.key) | (df['lulc'] == LulcChangeEnum.DEGRADED.key)
-			nodata_mask = (df['productivity'] != nodata) & (df['soc'] != nodata) & (df['lulc'] != nodata)
-			df.loc[degraded_mask, ['mapping']] = LandDegradationChangeEnum.DEGRADED.key
+			degraded_mask = (prod_array == ProductivityChangeTernaryEnum.DEGRADED.key) | (soc_array == SOCChangeEnum.DEGRADED.key) | (lulc_array == LulcChangeEnum.DEGRADED.key)
+			nodata_mask = (prod_array != nodata) & (soc_array != nodata) & (lulc_array != nodata)
+			datasource[degraded_mask] = LandDegradationChangeEnum.DEGRADED.key
 
 			# exclude no_data values
-			df.loc[~degraded_mask & nodata_mask, ['mapping']] = LandDegradationChangeEnum.IMPROVED.key
+			datasource[~degraded_mask & nodata_mask] = LandDegradationChangeEnum.IMPROVED.key
 		else:
-			# Replace values
+			matrix = []
 			for row in self.degradation_matrix:
-				# filter all matching entries as per the matrix
-				mask = (df['productivity'] == row['prod']) & (df['soc'] == row['soc']) & (df['lulc'] == row['lulc'])
 				if row['mapping'] == LandDegradationChangeEnum.STABLE and LandDegrationSettings.OVERRIDE_STABLE:
-					df.loc[mask, ['mapping']] = LandDegradationChangeEnum.IMPROVED
-				else:
-					df.loc[mask, ['mapping']] = row['mapping']
-		
-		datasource = df['mapping'].values.reshape(prod_array.shape)
-		datasource = datasource.astype(np.int32)
+					row = dict(row, mapping=LandDegradationChangeEnum.IMPROVED.key)
+				matrix.append(row)
+			# Replace values
+			datasource = reclassify_combinations(
+							arrays=[prod_array, soc_array, lulc_array],
+							keys=['prod', 'soc', 'lulc'],
+							matrix=matrix,
+							nodata=nodata)
+		datasource = to_class_dtype(datasource, nodata)
 
 		return return_raster_with_stats(
 			request=self.request,
@@ -162,10 +173,13 @@ class LandDegradation:
 			resolution=start_model.resolution,
 			start_year=self.start_year,
 			end_year=self.end_year,
-			subdir=LandDegrationSettings.SUB_DIR 
+			subdir=LandDegrationSettings.SUB_DIR,
+			return_raw=self.return_raw
 		)
 	
 	def get_vector(self):
+		if self.clip_vector:
+			return (self.clip_vector, None)
 		return get_vector(admin_level=self.admin_level, 
 						  shapefile_id=self.shapefile_id, 
 						  custom_vector_coords=self.custom_vector_coords, 
@@ -1,5 +1,6 @@
 from django.utils.translation import gettext as _
 from ldms.utils.raster_util import RasterCalcHelper
+from ldms.utils.instrument_util import instrumented
 from django.conf import settings
 from django.contrib.gis.geos import GEOSGeometry
 
@@ -13,10 +14,10 @@ from ldms.utils.file_util import (get_absolute_media_path, get_download_url,
 from ldms.utils.raster_util import (get_raster_values, get_raster_object, 
 								save_raster, get_raster_meta, reproject_raster,
 								extract_pixels_using_vector, clip_raster_to_vector,
-								return_raster_with_stats, get_raster_models)
+								return_raster_with_stats, get_raster_models, reclassify_combinations)
 from ldms.utils.vector_util import get_vector
+from ldms.utils.memo_util import get_or_compute
 import numpy as np
-import pandas as pd
 import enum
 import rasterio
 from rasterio.warp import Resampling
@@ -52,6 +53,13 @@ class LULC:
 				Either of:
 					- "area"
 					- a string with placeholder e.g x * x to mean square of that value
+			**memo (ComputationMemo)**:
+				Memo of computations shared with the other indicators of the same run
+			**return_raw (bool)**:
+				If True, return the raw array instead of saving it to a raster file. Used by composite indicators
+			**clip_vector (GeoJSON)**:
+				Already validated polygon to use instead of admin_level, shapefile_id and custom_coords 
+				e.g the extent of the areas of a batch analysis
 			**request (Request)**: 
 				A Web request object
 		""" 
@@ -68,6 +76,9 @@ class LULC:
 		self.raster_source = RasterSourceEnum.LULC # kwargs.get('raster_source', RasterSourceEnum.LULC)
 		self.enforce_single_year = kwargs.get('enforce_single_year', True)
 		self.admin_0 = kwargs.get('admin_0', None)
+		self.return_raw = kwargs.get('return_raw', False)
+		self.memo = kwargs.get('memo', None)
+		self.clip_vector = kwargs.get('clip_vector', None)
 
 		# #matrix to define land change type. The dict key is the base value
 		self.transition_matrix = {
@@ -129,6 +140,8 @@ class LULC:
 							both_valid=self.analysis_type == LulcCalcEnum.LULC_CHANGE)
 
 	def get_vector(self):
+		if self.clip_vector:
+			return (self.clip_vector, None)
 		return get_vector(admin_level=self.admin_level, 
 						  shapefile_id=self.shapefile_id, 
 						  custom_vector_coords=self.custom_vector_coords, 
@@ -136,6 +149,7 @@ class LULC:
 						  request=self.request
 						)
 
+	@instrumented()
 	def calculate_lulc(self):
 		"""
 		Compute Land Use Land Cover
@@ -222,19 +236,21 @@ class LULC:
 			start_year=start_year,
 			end_year=end_year,
 			subdir=LuLcSettings.SUB_DIR,
-			results=res
+			results=res,
+			return_raw=self.return_raw
 		)
 
+	@instrumented()
 	def calculate_lulc_change(self, return_no_map=False):
 		"""
 		Compute Land Use Land Cover Change between two rasters
 
 		Args:
 			return_no_map (bool): Determines if mapping will be done or
-			only a Pandas dataframe will be returned with column indicies
-			`start` and `end`.		
+			only the values of the base and target rasters will be returned		
 		Returns:
-			[Response]: [A JSON string with statistic values]		
+			[Response]: [A JSON string with statistic values]
+			or tuple(base, target, nodata) if return_no_map is True		
 		# TODO: Validate the rasters are similar
 		"""
 
@@ -274,46 +290,30 @@ class LULC:
 		if error:
 			return self.return_with_error(error)
 
-		# Read the values of the rasters
-		meta_raster, meta_raster_path, nodata = clip_raster_to_vector(start_model.rasterfile.name, vector)
-		start_arry, nodata, start_rastfile = extract_pixels_using_vector(start_model.rasterfile.name, 
-										vector, use_temp_dir=False)
-
-		# Reproject based on the start model
-		end_raster_file, nodata = reproject_raster(reference_raster=start_model.rasterfile.name, 
-										   raster=end_model.rasterfile.name,
-										   resampling=Resampling.average)
-
-		end_arry, nodata, end_rastfile = extract_pixels_using_vector(end_raster_file, 
-										vector, use_temp_dir=False)
+		# Read the values of the rasters. SOC and Land Degradation share them within a run
+		meta_raster_path, nodata, start_arry, start_rastfile, end_arry, end_rastfile = get_or_compute(
+					self.memo, "lulc_change_rasters", 
+					{'start_model': start_model.id, 'end_model': end_model.id}, vector,
+					lambda: self.read_change_rasters(start_model, end_model, vector))
 		
 		meta = get_raster_meta(start_model.rasterfile.name)
-		df = pd.DataFrame({'base': start_arry.flatten(), 'target': end_arry.flatten()})
-
-		# fill nan with nodata values
-		df['change'] = np.full(df['base'].shape, meta['nodata'])
-
 		if return_no_map == True:
-			return df
+			return (start_arry, end_arry, meta['nodata'])
 
+		"""
+		The dict key of transition_matrix is the value of the base period. Each of its
+		(base, target) transitions is a row of the combination matrix
+		"""
+		change_matrix = []
 		for key in transition_matrix.keys():
-			"""
-			get where the 'start' is equal to the dict key
-			df['base'] contains pixel values for the base period
-			df['target'] contains pixel values for the target period
-			"""
-			stable = transition_matrix[key]['stable']
-			improved = transition_matrix[key]['improved']
-			degraded = transition_matrix[key]['degraded']
-			if stable:
-				df.loc[(df['base']==key) & (df['target'].isin(stable)), ['change']] = LulcChangeEnum.STABLE.key # stable
-			if improved:
-				df.loc[(df['base']==key) & (df['target'].isin(improved)), ['change']] = LulcChangeEnum.IMPROVED.key # improved
-			if degraded:
-				df.loc[(df['base']==key) & (df['target'].isin(degraded)), ['change']] = LulcChangeEnum.DEGRADED.key # degraded
-					
-		# convert to old shape
-		dataset = df['change'].values.reshape(start_arry.shape)
+			for change, change_type in [('stable', LulcChangeEnum.STABLE), ('improved', LulcChangeEnum.IMPROVED),
+										('degraded', LulcChangeEnum.DEGRADED)]:
+				change_matrix += [{'base': key, 'target': target, 'mapping': change_type.key} 
+									for target in transition_matrix[key][change]]
+		dataset = reclassify_combinations(arrays=[start_arry, end_arry], 
+						keys=['base', 'target'], 
+						matrix=change_matrix, 
+						nodata=meta['nodata'])
 
 		return return_raster_with_stats(
 			request=self.request,
@@ -330,9 +330,30 @@ class LULC:
 								start_model.raster_year: get_download_url(self.request, start_rastfile.split("/")[-1]), 
 								end_model.raster_year: get_download_url(self.request, end_rastfile.split("/")[-1])
 							}
-						}
+						},
+			return_raw=self.return_raw
 		)
 		
+	def read_change_rasters(self, start_model, end_model, vector):
+		"""
+		Clip the start and end rasters, reprojecting the end raster to the start raster
+
+		Returns:
+			tuple (meta_raster_path, nodata, start_arry, start_rastfile, end_arry, end_rastfile)
+		"""
+		meta_raster, meta_raster_path, nodata = clip_raster_to_vector(start_model.rasterfile.name, vector)
+		start_arry, nodata, start_rastfile = extract_pixels_using_vector(start_model.rasterfile.name, 
+										vector, use_temp_dir=False)
+
+		# Reproject based on the start model
+		end_raster_file, nodata = reproject_raster(reference_raster=start_model.rasterfile.name, 
+										   raster=end_model.rasterfile.name,
+										   resampling=Resampling.average)
+
+		end_arry, nodata, end_rastfile = extract_pixels_using_vector(end_raster_file, 
+										vector, use_temp_dir=False)
+		return (meta_raster_path, nodata, start_arry, start_rastfile, end_arry, end_rastfile)
+
 	def get_comparative_rasters(self):
 		"""
 		Returns a Pandas Dataframe of the values of two comparing 
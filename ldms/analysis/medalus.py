@@ -1,15 +1,15 @@
 import rasterio
 import numpy as np
 import numpy.ma as ma
-import pandas as pd
 import enum
 from django.utils.translation import gettext as _
 from rest_framework.response import Response
+from ldms.utils.parallel_util import stage, run_stages
+from ldms.utils.instrument_util import instrumented
 from ldms.utils.raster_util import (extract_pixels_using_vector, get_raster_meta, clip_raster_to_vector,
 				return_raster_with_stats, do_raster_operation,
-				get_raster_meta, clip_raster_to_vector,
 				reshape_raster, reshape_rasters, reproject_raster, get_raster_values,
-				harmonize_raster_nodata, get_raster_models)
+				harmonize_raster_nodata, get_raster_models, reclassify_by_matrix, RasterStack, is_raw_result)
 from ldms.enums import (AridityIndexEnum, RasterCategoryEnum, RasterSourceEnum, 
 					RasterOperationEnum, ClimateQualityIndexEnum,
 					SoilQualityIndexEnum, SoilSlopeIndexEnum,
@@ -20,6 +20,7 @@ from ldms.enums import (AridityIndexEnum, RasterCategoryEnum, RasterSourceEnum,
 from ldms.utils.vector_util import get_vector
 from ldms import ModelNotExistError, AnalysisParamError
 from ldms.utils.common_util import cint, return_with_error, validate_years
+from ldms.utils.dtype_util import to_class_dtype, to_continuous
 from django.conf import settings
 from rasterio.warp import Resampling
 from ldms.utils.file_util import (get_physical_file_path_from_url)
@@ -58,6 +59,13 @@ class Medalus:
 				Either of:
 					- "area"
 					- a string with placeholder e.g x * x to mean square of that value
+			return_raw (bool):
+				If True, return the raw array instead of saving it to a raster file. Used by composite indicators
+			save_stage_rasters (bool):
+				If True, sub-indicators are saved to raster files. By default they are passed in memory
+			clip_vector (GeoJSON):
+				Already validated polygon to use instead of admin_level, shapefile_id and custom_coords 
+				e.g a tile of a large area. See `ldms.utils.tile_util`
 			request (Request): 
 				A Web request object
 		""" 
@@ -73,6 +81,9 @@ class Medalus:
 		self.analysis_type = None #one of ProductivityCalcEnum				
 		self.raster_source = kwargs.get('raster_source', RasterSourceEnum.MODIS)
 		self.admin_0 = kwargs.get('admin_0', None)
+		self.return_raw = kwargs.get('return_raw', False)
+		self.save_stage_rasters = kwargs.get('save_stage_rasters', False)
+		self.clip_vector = kwargs.get('clip_vector', None)
 
 		self.BASE_RESAMPLING_PATH = None # Base resampling path that should be used to reproject other rasters
 		
@@ -93,6 +104,21 @@ class Medalus:
 		raster, nodata, raster_path = extract_pixels_using_vector(reprojected_raster_file, vector)
 		return (raster, nodata, raster_path)
 
+	def read_rasters(self, reference_raster, raster_files, vector, nodata):
+		"""
+		Clip the rasters and align them onto a common grid. The grid is that of `reference_raster`, 
+		else BASE_RESAMPLING_PATH if defined, else the first raster
+
+		Returns:
+			tuple (list, nodata, path): Masked rasters, nodata and the path of a raster with the metadata of the grid
+		"""
+		ref_raster = reference_raster or self.BASE_RESAMPLING_PATH
+		with RasterStack(raster_files, vector, ref_file=ref_raster, nodata=nodata, 
+						resampling=Resampling.nearest) as stack:
+			rasters = list(stack.read())
+			metadata_raster_path = stack.save_meta_raster()
+			return (rasters, stack.nodata, metadata_raster_path)
+
 	def validate_periods(self):
 		"""
 		Validate the start and end periods
@@ -108,6 +134,7 @@ class Medalus:
 							end_year=end_year,
 							both_valid=False)
 
+	@instrumented()
 	def calculate_aridity_index(self, return_raster=False, resampling_raster=None):
 		"""
 		Compute Aridity Index (AI)
@@ -129,41 +156,19 @@ class Medalus:
 		map_meta = get_raster_meta(map_model.rasterfile.name)
 		nodata = map_meta['nodata'] 
 		
-		# Clip the raster
+		# Clip the rasters and align MAE to MAP
 		# Resampling will use self.BASE_RESAMPLING_PATH if it exists
-		map_meta_raster, nodata, map_meta_raster_path = self.resample(reference_raster=resampling_raster, 
-																	  raster_file=map_model.rasterfile.name, 
-																	  vector=vector, nodata=nodata)
-		# Extract MAE Raster
-		mae_meta = get_raster_meta(mae_model.rasterfile.name)		
-		
-		"""
-		Reproject ndvi_start_raster, ndvi_end_raster and soil_grid_raster based on base_lc_cover raster
-		"""
-		# reproject soil raster to modis resolution
-		
-		# Do `resampling_raster or map_model` so that it picks resampling_raster first if any as the reference raster
-		mae_meta_raster, nodata, mae_meta_raster_path = self.resample(reference_raster=resampling_raster or map_model.rasterfile.name, 
-																raster_file=mae_model.rasterfile.name, 
-																vector=vector, nodata=nodata)
+		rasters, nodata, map_meta_raster_path = self.read_rasters(reference_raster=resampling_raster, 
+										raster_files=[map_model.rasterfile.name, mae_model.rasterfile.name], 
+										vector=vector, nodata=nodata)
+		map_meta_raster, mae_meta_raster = rasters
 
 		ratios = do_raster_operation([map_meta_raster, mae_meta_raster], RasterOperationEnum.DIVIDE, nodata)
 
 		self.initialize_aridity_matrix()
 
-		df = pd.DataFrame({
-						'ratio': ratios.filled(fill_value=nodata).flatten(),												
-					})
-		df['mapping'] = nodata
-		no_data_mask = df['ratio'] != nodata
-		# Replace values
-		for row in self.aridity_matrix:
-			# filter all matching entries as per the matrix
-			mask = (df['ratio'] >= row['low']) & (df['ratio'] < row['high']) & (df['ratio'] != nodata)
-			df.loc[mask & no_data_mask, ['mapping']] = row['mapping']
-
-		datasource = df['mapping'].values.reshape(ratios.shape)
-		datasource = datasource.astype(np.int32)
+		datasource = reclassify_by_matrix(ratios, self.aridity_matrix, nodata)
+		datasource = to_class_dtype(datasource, nodata)
 		
 		self.ratios = ratios # just for unit testing purposes
 		if return_raster:
@@ -178,9 +183,11 @@ class Medalus:
 			resolution=map_model.resolution,
 			start_year=self.start_year,
 			end_year=self.end_year,
-			subdir=MedalusSettings.SUB_DIR
+			subdir=MedalusSettings.SUB_DIR,
+			return_raw=self.return_raw
 		)
 	
+	@instrumented()
 	def calculate_climate_quality_index(self, resampling_raster=None):
 		return self.calculate_climate_quality_index_without_aspect(resampling_raster)
 
@@ -205,15 +212,12 @@ class Medalus:
 		meta = get_raster_meta(resampling_raster or aridity_model.rasterfile.name)
 		nodata = meta['nodata']
 
-		# Clip the raster		
-		aridity_raster, _, aridity_raster_path = self.resample(reference_raster=resampling_raster, 
-																raster_file=aridity_model.rasterfile.name, 
-																vector=vector, nodata=nodata)	
-
+		# Clip the rasters and align rainfall to aridity
 		# Resampling will use self.BASE_RESAMPLING_PATH if it exists
-		rain_meta_raster, _, rain_meta_raster_path = self.resample(reference_raster=resampling_raster or aridity_model.rasterfile.name, 
-																raster_file=rain_model.rasterfile.name, 
-																vector=vector, nodata=nodata)		
+		rasters, nodata, rain_meta_raster_path = self.read_rasters(reference_raster=resampling_raster, 
+										raster_files=[aridity_model.rasterfile.name, rain_model.rasterfile.name], 
+										vector=vector, nodata=nodata)
+		aridity_raster, rain_meta_raster = rasters
 		
 		# self.initialize_rainfall_reclassification_matrix()
 		
@@ -244,31 +248,21 @@ class Medalus:
 		CQI = power(R * AI, 1/2)
 		"""
 		#initialize a masked array to allow for multiplying of only valid data
-		ma_rainfall = ma.array(reclassed_rainfall.astype(float)) #initialize a masked array
-		ma_ai_raster = ma.array(ai_raster.astype(float))
+		ma_rainfall = ma.array(to_continuous(reclassed_rainfall)) #initialize a masked array
+		ma_ai_raster = ma.array(to_continuous(ai_raster))
 		
 		ma_rainfall[ma_rainfall==nodata] = ma.masked
 		ma_ai_raster[ma_ai_raster==nodata] = ma.masked
 		
-		cqi = np.power(np.multiply(ma_rainfall.astype(float), ma_ai_raster.astype(float)), 1/2)
+		cqi = np.power(np.multiply(ma_rainfall, ma_ai_raster), 1/2)
 
 		self.initialize_cqi_matrix()
 
-		df = pd.DataFrame({
-						'ratio': cqi.flatten(),												
-					})
-		df['mapping'] = nodata
-		no_data_mask = df['ratio'] != nodata
-		# Replace values
-		for row in self.cqi_matrix:
-			# filter all matching entries as per the matrix
-			mask = (df['ratio'] >= row['low']) & (df['ratio'] < row['high'])
-			df.loc[mask & no_data_mask, ['mapping']] = row['mapping']
+		datasource = reclassify_by_matrix(cqi, self.cqi_matrix, nodata)
+		datasource = to_class_dtype(datasource, nodata)
 		
-		datasource = df['mapping'].values.reshape(cqi.shape)
-		datasource = datasource.astype(np.int32)
-		
-		extras = {'raw_raster': str(cqi.tolist())}
+		# the values as a string are only built for the response, not for composite indicators or tiles
+		extras = {} if self.return_raw else {'raw_raster': str(cqi.tolist())}
 		# self.ratios = ratios # just for unit testing purposes
 		return return_raster_with_stats(
 			request=self.request,
@@ -281,7 +275,8 @@ class Medalus:
 			start_year=self.start_year,
 			end_year=self.end_year,
 			subdir=MedalusSettings.SUB_DIR,
-			extras=extras
+			extras=extras,
+			return_raw=self.return_raw
 		)
 
 	def calculate_climate_quality_index_with_aspect(self, resampling_raster=None):
@@ -305,46 +300,19 @@ class Medalus:
 		rain_meta = get_raster_meta(resampling_raster or rain_model.rasterfile.name)
 		nodata = rain_meta['nodata']
 		
-		# Clip the raster		
+		# Clip the rasters and align aspect and aridity to rainfall
 		# Resampling will use self.BASE_RESAMPLING_PATH if it exists
-		rain_meta_raster, _, rain_meta_raster_path = self.resample(reference_raster=resampling_raster, 
-																raster_file=rain_model.rasterfile.name, 
-																vector=vector, nodata=nodata)
-																
-		# Extract MAE Raster
-		aspect_meta = get_raster_meta(aspect_model.rasterfile.name)
-		# nodata = aspect_meta['nodata']		
-		
-		"""
-		Reproject ndvi_start_raster, ndvi_end_raster and soil_grid_raster based on base_lc_cover raster
-		"""
-		# reproject soil raster to modis resolution
-		
-		# Do `resampling_raster or slope_model` so that it picks resampling_raster first if any as the reference raster
-		aspect_meta_raster, _, aspect_meta_raster_path = self.resample(reference_raster=resampling_raster or rain_model.rasterfile.name, 
-																raster_file=aspect_model.rasterfile.name, 
-																vector=vector, nodata=nodata)
-
-		# Do `resampling_raster or slope_model` so that it picks resampling_raster first if any as the reference raster
-		aridity_raster, _, aridity_meta_raster_path = self.resample(reference_raster=resampling_raster or rain_model.rasterfile.name, 
-																raster_file=aridity_model.rasterfile.name, 
-																vector=vector, nodata=nodata)
+		rasters, nodata, rain_meta_raster_path = self.read_rasters(reference_raster=resampling_raster, 
+										raster_files=[rain_model.rasterfile.name, aspect_model.rasterfile.name, 
+													aridity_model.rasterfile.name], 
+										vector=vector, nodata=nodata)
+		rain_meta_raster, aspect_meta_raster, aridity_raster = rasters
 
 		self.initialize_rainfall_reclassification_matrix()
 		
 		"""Replace the values of rainfall by an index as specified in the self.rainfall_matrix"""
-		df = pd.DataFrame({
-						'ratio': rain_meta_raster.flatten(),												
-					})
-		df['mapping'] = nodata
-		# Replace values
-		for row in self.rainfall_matrix:
-			# filter all matching entries as per the matrix
-			mask = (df['ratio'] >= row['low']) & (df['ratio'] < row['high']) & (df['ratio'] != nodata)
-			df.loc[mask, ['mapping']] = row['mapping']
-
-		reclassed_rainfall = df['mapping'].values.reshape(rain_meta_raster.shape)
-		reclassed_rainfall = reclassed_rainfall.astype(np.int32)
+		reclassed_rainfall = reclassify_by_matrix(rain_meta_raster, self.rainfall_matrix, nodata)
+		reclassed_rainfall = to_class_dtype(reclassed_rainfall, nodata)
 
 		# compute AI
 		# ai_raster =  self.calculate_aridity_index(return_raster=True)
@@ -356,31 +324,20 @@ class Medalus:
 		CQI = power(R * AI * A, 1/3)
 		"""
 		#initialize a masked array to allow for multiplying of only valid data
-		ma_rainfall = ma.array(reclassed_rainfall.astype(float)) #initialize a masked array
-		ma_ai_raster = ma.array(ai_raster.astype(float))
-		ma_aspect_meta_raster = ma.array(aspect_meta_raster.astype(float))
+		ma_rainfall = ma.array(to_continuous(reclassed_rainfall)) #initialize a masked array
+		ma_ai_raster = ma.array(to_continuous(ai_raster))
+		ma_aspect_meta_raster = ma.array(to_continuous(aspect_meta_raster))
 
 		ma_rainfall[ma_rainfall==nodata] = ma.masked
 		ma_ai_raster[ma_ai_raster==nodata] = ma.masked
 		ma_aspect_meta_raster[ma_aspect_meta_raster==nodata] = ma.masked
 
-		cqi = np.power(np.multiply(ma_rainfall.astype(float), ma_ai_raster.astype(float), ma_aspect_meta_raster.astype(float)), 1/3)
+		cqi = np.power(np.multiply(ma_rainfall, ma_ai_raster, ma_aspect_meta_raster), 1/3)
 
 		self.initialize_cqi_matrix()
 
-		df = pd.DataFrame({
-						'ratio': cqi.flatten(),												
-					})
-		df['mapping'] = nodata
-		no_data_mask = df['ratio'] != nodata
-		# Replace values
-		for row in self.cqi_matrix:
-			# filter all matching entries as per the matrix
-			mask = (df['ratio'] >= row['low']) & (df['ratio'] < row['high'])
-			df.loc[mask & no_data_mask, ['mapping']] = row['mapping']
-		
-		datasource = df['mapping'].values.reshape(cqi.shape)
-		datasource = datasource.astype(np.int32)
+		datasource = reclassify_by_matrix(cqi, self.cqi_matrix, nodata)
+		datasource = to_class_dtype(datasource, nodata)
 				
 		# self.ratios = ratios # just for unit testing purposes
 		return return_raster_with_stats(
@@ -393,9 +350,11 @@ class Medalus:
 			resolution=rain_model.resolution,
 			start_year=self.start_year,
 			end_year=self.end_year,
-			subdir=MedalusSettings.SUB_DIR 
+			subdir=MedalusSettings.SUB_DIR,
+			return_raw=self.return_raw
 		)
 
+	@instrumented()
 	def calculate_soil_quality_index(self, resampling_raster=None):
 		"""
 		Calculate Soil Quality Index (SQI)
@@ -413,44 +372,14 @@ class Medalus:
 		# Extract Slope raster meta data
 		slope_meta = get_raster_meta(resampling_raster or slope_model.rasterfile.name)
 		nodata = slope_meta['nodata']
-		# Clip the raster
-		
+		# Clip the rasters and align the other rasters to slope
 		# Resampling will use self.BASE_RESAMPLING_PATH if it exists
-		slope_raster, _, slope_raster_path = self.resample(reference_raster=resampling_raster, 
-																raster_file=slope_model.rasterfile.name, 
-																vector=vector, nodata=nodata)
-		"""
-		Reproject other rasters based on slope raster
-		"""
-		# reproject depth raster to slope resolution		
-		# Resampling will use self.BASE_RESAMPLING_PATH if it exists
-		group_raster, _, _ = self.resample(reference_raster=resampling_raster or slope_model.rasterfile.name, 
-																raster_file=depth_model.rasterfile.name, 
-																vector=vector, nodata=nodata)
-
-		# reproject drainage raster to slope resolution		
-		# Do `resampling_raster or slope_model` so that it picks resampling_raster first if any as the reference raster
-		drainage_raster, _, _ = self.resample(reference_raster=resampling_raster or slope_model.rasterfile.name, 
-																raster_file=drainage_model.rasterfile.name, 
-																vector=vector, nodata=nodata)
-
-		# reproject parentmaterial raster to slope resolution		
-		# Do `resampling_raster or slope_model` so that it picks resampling_raster first if any as the reference raster
-		parentmaterial_raster, _, _ = self.resample(reference_raster=resampling_raster or slope_model.rasterfile.name, 
-																raster_file=parentmaterial_model.rasterfile.name, 
-																vector=vector, nodata=nodata)
-
-		# reproject texture raster to slope resolution		
-		# Do `resampling_raster or slope_model` so that it picks resampling_raster first if any as the reference raster
-		texture_raster, _, _ = self.resample(reference_raster=resampling_raster or slope_model.rasterfile.name, 
-																raster_file=texture_model.rasterfile.name, 
-																vector=vector, nodata=nodata)
-
-		# reproject rockfragment raster to slope resolution		
-		# Do `resampling_raster or slope_model` so that it picks resampling_raster first if any as the reference raster
-		rockfragment_raster, _, _ = self.resample(reference_raster=resampling_raster or slope_model.rasterfile.name, 
-																raster_file=rockfragment_model.rasterfile.name, 
-																vector=vector, nodata=nodata)
+		rasters, nodata, slope_raster_path = self.read_rasters(reference_raster=resampling_raster, 
+										raster_files=[slope_model.rasterfile.name, depth_model.rasterfile.name,
+													drainage_model.rasterfile.name, parentmaterial_model.rasterfile.name,
+													texture_model.rasterfile.name, rockfragment_model.rasterfile.name], 
+										vector=vector, nodata=nodata)
+		slope_raster, group_raster, drainage_raster, parentmaterial_raster, texture_raster, rockfragment_raster = rasters
 
 		# self.initialize_soil_slope_matrix()
 		# slope_raster = self.normalize_rasters(slope_raster, self.slope_matrix, nodata)
@@ -477,19 +406,8 @@ class Medalus:
 								
 		self.initialize_sqi_matrix()
 		
-		df = pd.DataFrame({
-						'ratio': sqi.filled(fill_value=nodata).flatten(),												
-					})
-		df['mapping'] = nodata
-		no_data_mask = df['ratio'] != nodata
-		# Replace values
-		for row in self.sqi_matrix:
-			# filter all matching entries as per the matrix
-			mask = (df['ratio'] >= row['low']) & (df['ratio'] < row['high'])
-			df.loc[mask & no_data_mask, ['mapping']] = row['mapping']
-		
-		datasource = df['mapping'].values.reshape(sqi.shape)
-		datasource = datasource.astype(np.int32)
+		datasource = reclassify_by_matrix(sqi, self.sqi_matrix, nodata)
+		datasource = to_class_dtype(datasource, nodata)
 		
 		# self.ratios = ratios # just for unit testing purposes
 		return return_raster_with_stats(
@@ -502,9 +420,11 @@ class Medalus:
 			resolution=slope_model.resolution,
 			start_year=self.start_year,
 			end_year=self.end_year,
-			subdir=MedalusSettings.SUB_DIR
+			subdir=MedalusSettings.SUB_DIR,
+			return_raw=self.return_raw
 		)		
 
+	@instrumented()
 	def calculate_management_quality_index(self, return_raster=False, resampling_raster=None):
 		"""
 		Compute Management Quality Index (MQI)
@@ -525,45 +445,20 @@ class Medalus:
 		# Extract Population Density raster meta data
 		pop_density_meta = get_raster_meta(resampling_raster or pop_density_model.rasterfile.name)
 		nodata = pop_density_meta['nodata']
-		# Clip the raster
-		# pop_density_meta_raster, nodata, pop_density_meta_raster_path = extract_pixels_using_vector(pop_density_model.rasterfile.name, vector, nodata)
-
+		# Clip the rasters and align land use to population density
 		# Resampling will use self.BASE_RESAMPLING_PATH if it exists
-		pop_density_meta_raster, _, pop_density_meta_raster_path = self.resample(reference_raster=resampling_raster, 
-																raster_file=pop_density_model.rasterfile.name, 
-																vector=vector, nodata=nodata)
-
-		# Extract Land use Intensity raster meta data
-		land_use_meta = get_raster_meta(land_use_model.rasterfile.name)
-		
-		"""
-		Reproject land use raster 
-		"""
-		# reproject soil raster to modis resolution
-		
-		# Do `resampling_raster or slope_model` so that it picks resampling_raster first if any as the reference raster
-		land_use_meta_raster, _, land_use_meta_raster_path = self.resample(reference_raster=resampling_raster or pop_density_model.rasterfile.name, 
-																raster_file=land_use_model.rasterfile.name, 
-																vector=vector, nodata=nodata)
+		rasters, nodata, pop_density_meta_raster_path = self.read_rasters(reference_raster=resampling_raster, 
+										raster_files=[pop_density_model.rasterfile.name, land_use_model.rasterfile.name], 
+										vector=vector, nodata=nodata)
+		pop_density_meta_raster, land_use_meta_raster = rasters
 																
 		ratios = do_raster_operation([pop_density_meta_raster, land_use_meta_raster], RasterOperationEnum.MULTIPLY, nodata)
 		ratios = np.power(ratios, 1/2) # Raise to 1/2
 
 		self.initialize_mqi_matrix()
 
-		df = pd.DataFrame({
-						'ratio': ratios.filled(fill_value=nodata).flatten(),												
-					})
-		df['mapping'] = nodata
-		no_data_mask = df['ratio'] != nodata
-		# Replace values
-		for row in self.mqi_matrix:
-			# filter all matching entries as per the matrix
-			mask = (df['ratio'] >= row['low']) & (df['ratio'] < row['high']) & (df['ratio'] != nodata)
-			df.loc[mask & no_data_mask, ['mapping']] = row['mapping']
-
-		datasource = df['mapping'].values.reshape(ratios.shape)
-		datasource = datasource.astype(np.int32)
+		datasource = reclassify_by_matrix(ratios, self.mqi_matrix, nodata)
+		datasource = to_class_dtype(datasource, nodata)
 		
 		self.ratios = ratios # just for unit testing purposes
 		if return_raster:
@@ -578,9 +473,11 @@ class Medalus:
 			resolution=pop_density_model.resolution,
 			start_year=self.start_year,
 			end_year=self.end_year,
-			subdir=MedalusSettings.SUB_DIR
+			subdir=MedalusSettings.SUB_DIR,
+			return_raw=self.return_raw
 		)
 
+	@instrumented()
 	def calculate_vegetation_quality_index(self, resampling_raster=None):
 		"""
 		Calculate Vegetation Quality Index (SQI)
@@ -601,32 +498,13 @@ class Medalus:
 		# if nodata == float("nan"):
 		# 	nodata = MedalusSettings.DEFAULT_NODATA
 		
+		# Clip the rasters and align the other rasters to fire risk
 		# Resampling will use self.BASE_RESAMPLING_PATH if it exists
-		fire_risk_raster, _, fire_risk_path = self.resample(reference_raster=resampling_raster, 
-																raster_file=fire_risk_model.rasterfile.name, 
-																vector=vector, nodata=nodata)
-
-		"""
-		Reproject other rasters based on fire_risk raster
-		"""
-		# reproject erosion_protection raster to slope resolution
-		
-		# Do `resampling_raster or fire_risk_model` so that it picks resampling_raster first if any as the reference raster
-		erosion_raster, _, erosion_path = self.resample(reference_raster=resampling_raster or fire_risk_model.rasterfile.name, 
-															raster_file=erosion_model.rasterfile.name, 
-															vector=vector, nodata=nodata)
-
-		# reproject drought resistance raster to slope resolution
-		# Do `resampling_raster or drought_model` so that it picks resampling_raster first if any as the reference raster
-		drought_raster, _, drought_raster_path = self.resample(reference_raster=resampling_raster or fire_risk_model.rasterfile.name, 
-																raster_file=drought_model.rasterfile.name, 
-																vector=vector, nodata=nodata)
-
-		# reproject plant cover raster to slope resolution
-		# Do `resampling_raster or drought_model` so that it picks resampling_raster first if any as the reference raster
-		plant_cover_raster, _, plant_cover_raster_path = self.resample(reference_raster=resampling_raster or fire_risk_model.rasterfile.name, 
-																raster_file=plant_cover_model.rasterfile.name, 
-																vector=vector, nodata=nodata)
+		rasters, nodata, fire_risk_path = self.read_rasters(reference_raster=resampling_raster, 
+										raster_files=[fire_risk_model.rasterfile.name, erosion_model.rasterfile.name,
+													drought_model.rasterfile.name, plant_cover_model.rasterfile.name], 
+										vector=vector, nodata=nodata)
+		fire_risk_raster, erosion_raster, drought_raster, plant_cover_raster = rasters
 
 		# self.initialize_fire_risk_matrix()
 		# fire_risk_raster = self.normalize_rasters(fire_risk_raster, self.fire_risk_matrix, nodata)
@@ -648,19 +526,8 @@ class Medalus:
 								
 		self.initialize_vqi_matrix()
 		
-		df = pd.DataFrame({
-						'ratio': vqi.filled(fill_value=nodata).flatten(),												
-					})
-		df['mapping'] = nodata
-		no_data_mask = df['ratio'] != nodata
-		# Replace values
-		for row in self.vqi_matrix:
-			# filter all matching entries as per the matrix
-			mask = (df['ratio'] >= row['low']) & (df['ratio'] < row['high'])
-			df.loc[mask & no_data_mask, ['mapping']] = row['mapping']
-		
-		datasource = df['mapping'].values.reshape(vqi.shape)
-		datasource = datasource.astype(np.int32)
+		datasource = reclassify_by_matrix(vqi, self.vqi_matrix, nodata)
+		datasource = to_class_dtype(datasource, nodata)
 		
 		# self.ratios = ratios # just for unit testing purposes
 		return return_raster_with_stats(
@@ -673,9 +540,11 @@ class Medalus:
 			resolution=fire_risk_model.resolution,
 			start_year=self.start_year,
 			end_year=self.end_year,
-			subdir=MedalusSettings.SUB_DIR
+			subdir=MedalusSettings.SUB_DIR,
+			return_raw=self.return_raw
 		)	
 
+	@instrumented()
 	def calculate_esai(self):
 		"""
 		Compute ESAI
@@ -694,36 +563,46 @@ class Medalus:
 		start_meta = get_raster_meta(self.BASE_RESAMPLING_PATH)
 		nodata = start_meta['nodata'] 
 
-		self.error = None
-		cqi = self.calculate_climate_quality_index(resampling_raster=self.BASE_RESAMPLING_PATH)
-		if self.error:
-			return self.return_with_error(self.error)
-
-		sqi = self.calculate_soil_quality_index(resampling_raster=self.BASE_RESAMPLING_PATH)
-		if self.error:
-			return self.return_with_error(self.error)
-
-		vqi = self.calculate_vegetation_quality_index(resampling_raster=self.BASE_RESAMPLING_PATH)
-		if self.error:
-			return self.return_with_error(self.error)
-
-		mqi = self.calculate_management_quality_index(resampling_raster=self.BASE_RESAMPLING_PATH)
-		if self.error:
-			return self.return_with_error(self.error)
-
-		base_file = cqi['rasterfile']
-		cqi_raster = self.read_raster(cqi['rasterfile'], base_file)
-		sqi_raster = self.read_raster(sqi['rasterfile'], base_file)
-		mqi_raster = self.read_raster(mqi['rasterfile'], base_file)
-		vqi_raster = self.read_raster(vqi['rasterfile'], base_file)
+		# Pass the sub-indicators in memory unless they are explicitly required on disk
+		return_raw = self.return_raw
+		self.return_raw = not self.save_stage_rasters
+		try:
+			results = run_stages([
+				stage(self, self.calculate_climate_quality_index, resampling_raster=self.BASE_RESAMPLING_PATH),
+				stage(self, self.calculate_soil_quality_index, resampling_raster=self.BASE_RESAMPLING_PATH),
+				stage(self, self.calculate_vegetation_quality_index, resampling_raster=self.BASE_RESAMPLING_PATH),
+				stage(self, self.calculate_management_quality_index, resampling_raster=self.BASE_RESAMPLING_PATH)
+			])
+		finally:
+			self.return_raw = return_raw
+		for result, error in results:
+			if error:
+				return self.return_with_error(error)
+		cqi, sqi, vqi, mqi = [result for result, error in results]
+
+		if is_raw_result(cqi):
+			# harmonize nodata values
+			nodata = cqi['nodata']
+			metadata_raster_path = cqi['meta_path']
+			cqi_raster, sqi_raster, mqi_raster, vqi_raster = [
+				np.where(x['datasource'] == x['nodata'], nodata, x['datasource'])
+				for x in [cqi, sqi, mqi, vqi]]
+		else:
+			base_file = cqi['rasterfile']
+			cqi_raster = self.read_raster(cqi['rasterfile'], base_file)
+			sqi_raster = self.read_raster(sqi['rasterfile'], base_file)
+			mqi_raster = self.read_raster(mqi['rasterfile'], base_file)
+			vqi_raster = self.read_raster(vqi['rasterfile'], base_file)
 
-		# harmonize nodata values
-		base_meta = get_raster_meta(self.get_file_path(base_file))
-		nodata = base_meta.get('nodata')
+			# harmonize nodata values
+			base_meta = get_raster_meta(self.get_file_path(base_file))
+			nodata = base_meta.get('nodata')
+			metadata_raster_path = self.get_file_path(base_file)
 
 		# replace with metadata 
  		
-		rasters = reshape_rasters([cqi_raster, sqi_raster, mqi_raster, vqi_raster])
+		# the class maps may be uint8, see ldms.utils.dtype_util
+		rasters = [to_continuous(x) for x in reshape_rasters([cqi_raster, sqi_raster, mqi_raster, vqi_raster])]
 		esai = do_raster_operation(rasters=rasters,
 								operation=RasterOperationEnum.MULTIPLY, 
 								nodata=nodata)
@@ -731,19 +610,8 @@ class Medalus:
 
 		self.initialize_esai_matrix()
 		
-		df = pd.DataFrame({
-						'ratio': esai.filled(fill_value=nodata).flatten(),												
-					})
-		df['mapping'] = nodata
-		no_data_mask = df['ratio'] != nodata
-		# Replace values
-		for row in self.esai_matrix:
-			# filter all matching entries as per the matrix
-			mask = (df['ratio'] >= row['low']) & (df['ratio'] < row['high'])
-			df.loc[mask & no_data_mask, ['mapping']] = row['mapping']
-		
-		datasource = df['mapping'].values.reshape(esai.shape)
-		datasource = datasource.astype(np.int32)
+		datasource = reclassify_by_matrix(esai, self.esai_matrix, nodata)
+		datasource = to_class_dtype(datasource, nodata)
 		
 		# self.ratios = ratios # just for unit testing purposes
 		return return_raster_with_stats(
@@ -751,12 +619,13 @@ class Medalus:
 			datasource=datasource, 
 			prefix="esai", 
 			change_enum=ESAIEnum, 
-			metadata_raster_path=self.get_file_path(base_file), #meta_raster_path,  
+			metadata_raster_path=metadata_raster_path,  
 			nodata=nodata, 
 			resolution=start_model.resolution,
 			start_year=self.start_year,
 			end_year=self.end_year,
-			subdir=MedalusSettings.SUB_DIR
+			subdir=MedalusSettings.SUB_DIR,
+			return_raw=self.return_raw
 		)	
 
 	def get_file_path(self, url):
@@ -779,19 +648,8 @@ class Medalus:
 		"""
 		Replace raster values with the matrix index values
 		"""
-		df = pd.DataFrame({
-					'ratio': raster.flatten(),												
-				})
-		df['index'] = nodata
-		no_data_mask = df['ratio'] != nodata
-		# Replace values
-		for row in matrix:
-			# filter all matching entries as per the matrix
-			mask = (df['ratio'] >= row['low']) & (df['ratio'] < row['high'])
-			df.loc[mask & no_data_mask, ['index']] = row['index']
-
-		ds = df['index'].values.reshape(raster.shape)
-		ds = ds.astype(float)
+		ds = reclassify_by_matrix(raster, matrix, nodata, key='index')
+		ds = to_continuous(ds)
 		return ds
 	
 	def initialize_aridity_matrix(self):
@@ -1251,6 +1109,8 @@ class Medalus:
 		return (model, error)
 		
 	def get_vector(self):
+		if self.clip_vector:
+			return (self.clip_vector, None)
 		return get_vector(admin_level=self.admin_level, 
 						  shapefile_id=self.shapefile_id, 
 						  custom_vector_coords=self.custom_vector_coords, 
@@ -1,7 +1,6 @@
 import rasterio
 import numpy as np
 import numpy.ma as ma
-import pandas as pd
 import enum
 import math
 from django.utils.translation import gettext as _
@@ -9,6 +8,7 @@ from rest_framework.response import Response
 from ldms.analysis.vegetation_index import VegetationIndex
 from ldms.utils.raster_util import (get_raster_values, save_raster, reproject_raster, 
 					do_raster_operation, get_raster_models)
+from ldms.utils.instrument_util import instrumented
 from ldms.enums import (RasterOperationEnum, RasterCategoryEnum, GenericRasterBandEnum, 
 			RasterSourceEnum, TrajectoryChangeTernaryEnum, StateChangeTernaryEnum,
 			PerformanceChangeBinaryEnum, ProductivityChangeTernaryEnum,
@@ -20,12 +20,17 @@ from ldms.utils.common_util import return_with_error, get_random_floats, cint, v
 from ldms.utils.file_util import (generate_file_name, get_absolute_media_path, get_download_url, 
 								file_exists, get_physical_file_path_from_url)
 from sklearn.linear_model import LinearRegression
-from scipy import stats
 import tempfile 
 from ldms.utils.raster_util import (extract_pixels_using_vector, get_raster_meta, clip_raster_to_vector, reshape_rasters,
-				return_raster_with_stats)
+				return_raster_with_stats, reclassify, reclassify_by_matrix, reclassify_combinations, is_raw_result)
 from ldms.utils.vector_util import get_vector
-from scipy.stats import percentileofscore
+from ldms.utils.zonal_util import get_zonal_percentiles
+from ldms.utils.timeseries_util import VITimeSeriesCube
+from ldms.utils.scratch_util import reduce_arrays
+from ldms.utils.dtype_util import to_class_dtype
+from ldms.utils.trend_util import compute_trend
+from ldms.utils.memo_util import ComputationMemo, get_or_compute
+from ldms.utils.parallel_util import stage, run_stages
 from ldms import ModelNotExistError, AnalysisParamError
 import collections 
 from rasterio.warp import Resampling
@@ -101,6 +106,15 @@ class Productivity:
 				Vegetation Index to use. One of NDVI, MSAVI or SAVI
 			baseline_year (int):
 				The baseline selected when computing main indicator in the updated SDG 15.3.1 
+			return_raw (bool):
+				If True, return the raw array instead of saving it to a raster file. Used by composite indicators
+			save_stage_rasters (bool):
+				If True, sub-indicators are saved to raster files. By default they are passed in memory
+			memo (ComputationMemo):
+				Memo of computations shared with the other indicators of the same run
+			clip_vector (GeoJSON):
+				Already validated polygon to use instead of admin_level, shapefile_id and custom_coords 
+				e.g the extent of the areas of a batch analysis
 			request (Request): 
 				A Web request object
 		""" 
@@ -120,6 +134,11 @@ class Productivity:
 		self.veg_index = kwargs.get('veg_index', RasterCategoryEnum.NDVI.value)
 		self.compute_version = kwargs.get('version', 1) #Are we computed updated indicators
 		self.class_map = kwargs.get('class_map', THREE_CLASS_MAP) #class-map for state to use
+		self.return_raw = kwargs.get('return_raw', False)
+		self.save_stage_rasters = kwargs.get('save_stage_rasters', False)
+		self.memo = kwargs.get('memo', None)
+		self.clip_vector = kwargs.get('clip_vector', None)
+		self.vi_cube = None
 
 		self.settings = ProductivitySettings()
 
@@ -142,15 +161,22 @@ class Productivity:
 							end_year=end_year,
 							both_valid=both_valid)
 
+	def get_vi_cube(self):
+		"""
+		Get the NDVI/SAVI/MSAVI rasters of all the years, shared with the other indicators using the same memo
+		"""
+		if self.vi_cube is None:
+			vector, error = self.get_vector()
+			params = {'raster_source': self.raster_source.value, 'veg_index': self.veg_index, 'admin_0': self.admin_0}
+			self.vi_cube = get_or_compute(self.memo, "vi_cube", params, vector,
+								lambda: VITimeSeriesCube(self.raster_source.value, self.veg_index, vector, admin_0=self.admin_0))
+		return self.vi_cube
+
 	def get_vi_raster_model(self, year, throw_error=True):
 		"""
 		Get the NDVI/SAVI/MSAVI models associated with start and end period
 		"""
-		model = get_raster_models(raster_year=year, 
-								raster_source=self.raster_source.value,
-								raster_category=self.veg_index, 
-								admin_zero_id=self.admin_0
-							).first()
+		model = self.get_vi_cube().get_model(year)
 		error = None
 		if not model:
 			error = _("Year {0} does not have an associated {1} {2} raster{3}.".format(year, self.veg_index,
@@ -186,13 +212,9 @@ class Productivity:
 
 	def get_vi_raster_models(self, start_year, end_year):
 		"""
-		Get the NDVI/MSAVI/SAVI models associated with start and end period
+		Get the NDVI/MSAVI/SAVI models associated with start and end period ordered by year
 		"""
-		return get_raster_models(raster_year__gte=start_year, 
-									raster_year__lte=end_year,
-									raster_source=self.raster_source.value,
-									raster_category=self.veg_index, 
-									admin_zero_id=self.admin_0)
+		return self.get_vi_cube().get_models(start_year, end_year)
 
 	def prevalidate(self, both_valid=True):
 		"""
@@ -210,12 +232,15 @@ class Productivity:
 		return (error, vector, start_model, end_model, start_year,  end_year)
 
 	def get_vector(self):
+		if self.clip_vector:
+			return (self.clip_vector, None)
 		return get_vector(admin_level=self.admin_level, 
 						  shapefile_id=self.shapefile_id, 
 						  custom_vector_coords=self.custom_vector_coords, 
 						  admin_0=self.admin_0,
 						  request=self.request)
 
+	@instrumented()
 	def calculate_trajectory(self):
 		"""
 		Calculate Trajectory sub-indicator. Trajectory measures the rate of change in 
@@ -245,20 +270,12 @@ class Productivity:
 
 				change_matrix = self.initialize_trajectory_change_matrix()
 
-				df = pd.DataFrame({
-								'baseline': baseline['datasource'].flatten(),
-								'reporting': reporting['datasource'].flatten(),
-							})
-				df['mapping'] = reporting['nodata']
-
-				# Replace values
-				for row in change_matrix:
-					# filter all matching entries as per the matrix
-					mask = (df['baseline'] == row['base']) & (df['reporting'] == row['curr'])
-					df.loc[mask, ['mapping']] = row['mapping']
-				
-				datasource = df['mapping'].values.reshape(baseline['datasource'].shape)
-				datasource = datasource.astype(np.int32)
+				datasource = reclassify_combinations(
+								arrays=[baseline['datasource'], reporting['datasource']],
+								keys=['base', 'curr'],
+								matrix=change_matrix,
+								nodata=reporting['nodata'])
+				datasource = to_class_dtype(datasource, reporting['nodata'])
 
 				return return_raster_with_stats(
 					request=self.request,
@@ -270,7 +287,8 @@ class Productivity:
 					resolution=reporting['resolution'],
 					start_year=baseline_start_year,
 					end_year=self.end_year,
-					subdir=ProductivitySettings.SUB_DIR 
+					subdir=ProductivitySettings.SUB_DIR,
+					return_raw=self.return_raw
 				)
 		return self._calculate_trajectory_version1()
 
@@ -287,37 +305,6 @@ class Productivity:
 		4. Generate a raster containing the transitional values
 		5. compute the raster statistics to be returned together with the raster
 		"""
-		def get_linear_regression(item):
-			"""Get the slope"""
-			# slope, intercept, r_value, p_value, std_err = stats.linregress(time_array, item['values'])
-			data = extract_period_values(item)
-			if data == nodata:
-				return nodata		
-			
-			slope, intercept, r_value, p_value, std_err = stats.linregress(time_array, data)
-			return slope
-
-		def extract_period_values(item):
-			data = []			
-			# Extract values for all the periods to form the data series
-			for i, tm in enumerate(time_array):
-				val = item[str(tm)]
-				if val == nodata: # if any value has nodata, then return nodata as val of slope
-					return nodata
-				data.append(val)
-			return data
-
-		def get_pvalue(item):
-			"""Get pvalue"""
-			data = extract_period_values(item)
-			if data == nodata:
-				return nodata	
-			tau, p_value = stats.kendalltau(time_array, data)
-			# tau, p_value = stats.kendalltau(time_array, [item['base'], item['target']])
-			# p_value = p_value if not np.isnan(p_value) else 1.
-			return p_value
-
-		
 		error, vector, start_model, end_model, start_year, end_year = self.prevalidate()
 		if error:
 			return self.return_with_error(error)
@@ -369,85 +356,46 @@ class Productivity:
 
 		time_array = [x.raster_year for x in ndvi_models]
 		
-		"""
-		stack pixel values. This will put all pixel values at specific location 
-		into one single array such that values at the same location for different 
-		pixel location will be contained in a single array. The array will be of size 
-		(raster_rows, raster_cols, no_of_rasters)
-
-		To get mean of rasters by their positions, use the below form
-			np.mean(np.dstack([x, y, z]).transpose(), axis=0).transpose()
-		"""
-		rasters = np.dstack(ndvi_rasters)
-
 		if len(ndvi_rasters) != len(time_array):
 			error = _("The number of available datasets is different from the number of periods selected. Number of datasets is {0} while the number of periods is {1}. Ensure there is a dataset for each of the years within the reporting period."
 					.format(len(ndvi_rasters), len(time_array)))
 			return self.return_with_error(error)
 
-		# Create dataframe
-		df = pd.DataFrame()
-		# create dynamic index for each reporting period
-		for i, tm in enumerate(time_array):
-			df[str(tm)] = ndvi_rasters[i].flatten()
-
-		df['mapping'] = nodata #initialize all to nodata
-		df['slope'] = nodata #initialize all to nodata
-		df['pvalue'] = nodata #initialize all to nodata
-
-		# create masks
-		nodata_masks = []
-		for i, tm in enumerate(time_array):
-			msk = (df[str(tm)] == nodata)
-			nodata_masks.append(msk)
-	
-		# Compute slope
-		# 1.  compute slope		
+		# Compute slope and pvalue
 		"""
 		do linear regression on every pixel and for this 
-		we are getting the r/ship btwn base and target years pixel values
-		We only consider slope and the p_value. stats.linregress returns values as below
-			slope, intercept, r_value, p_value, std_err = stats.linregress(time_array, data_array).
+		we are getting the r/ship btwn base and target years pixel values.
 		linregress() uses Wald Test with t-distribution, not mann kandell, so we use kendalltau since
-		we want to do a non-parametric significance test
-		"""	
-		# for those values that have not changed, the slope is 0
-		df.loc[~np.logical_and.reduce(nodata_masks), ['slope']] = 0 # combine and apply masks
+		we want to do a non-parametric significance test.
+		Both are computed for all pixels at once. Pixels with nodata in any period get nodata
+		as the slope and pvalue.
+		"""
+		slope, pvalue = compute_trend(ndvi_rasters, time_array, nodata)
 
-		# Only do regression where pixel values have changed
-		df.loc[~np.logical_and.reduce(nodata_masks), ['slope']] = df.apply(lambda x: get_linear_regression(x), axis=1) 
+		# create mask of pixels that are nodata in all the periods
+		nodata_mask = np.logical_and.reduce([raster == nodata for raster in ndvi_rasters])
 
-		# get p value
-		# 2. Compute pvalues to perform significance test
-		"""
-		If p Value is more than cutoff, then its stable.
-		p value will be nan if both x and y are the same. if values 
-		of x (base) and y (target) are same, it returns nan values.	
-		"""
-		# get p value where the base and target are different, else assign p value to 1.0
-		df.loc[~np.logical_and.reduce(nodata_masks), ['pvalue']] = df.apply(lambda x: get_pvalue(x), axis=1) 
-		
 		# set mapping to stable first for all non-masked values
-		df.loc[~np.logical_and.reduce(nodata_masks), ['mapping']] = TrajectoryChangeTernaryEnum.STABLE.key
+		out_raster = np.full(slope.shape, nodata)
+		out_raster[~nodata_mask] = TrajectoryChangeTernaryEnum.STABLE.key
 
 		# 3. Set transitions. 
 		"""
 		Degraded: If pvalue <= ProductivitySettings.PVALUE_CUTOFF and slope < 0
 		Improved: If pvalue <= ProductivitySettings.PVALUE_CUTOFF and slope > 0
 		Stable: If pvalue > ProductivitySettings.PVALUE_CUTOFF or (pvalue <= ProductivitySettings.PVALUE_CUTOFF and slope = 0)
+		p value will be nan if all the values of the series are the same, hence stable
 		"""
-		significant_pvalue_mask = (df['pvalue'] <= ProductivitySettings.PVALUE_CUTOFF)
+		with np.errstate(invalid='ignore'):
+			significant_pvalue_mask = (pvalue <= ProductivitySettings.PVALUE_CUTOFF)
 		
 		# improved
-		improved_mask = (df['slope'] >= 0)
-		df.loc[~np.logical_and.reduce(nodata_masks) & improved_mask & significant_pvalue_mask, ['mapping']] = TrajectoryChangeTernaryEnum.IMPROVED.key
+		improved_mask = (slope >= 0)
+		out_raster[~nodata_mask & improved_mask & significant_pvalue_mask] = TrajectoryChangeTernaryEnum.IMPROVED.key
 		
 		# degraded
-		degraded_mask = (df['slope'] < 0)
-		df.loc[~np.logical_and.reduce(nodata_masks) & degraded_mask & significant_pvalue_mask, ['mapping']] = TrajectoryChangeTernaryEnum.DEGRADED.key
-
-		# reshape the pd.series into 2d array
-		out_raster = df['mapping'].values.reshape(ndvi_rasters[0].shape)
+		degraded_mask = (slope < 0)
+		out_raster[~nodata_mask & degraded_mask & significant_pvalue_mask] = TrajectoryChangeTernaryEnum.DEGRADED.key
 
 		# Clip the raster and save for later referencing
 		meta_raster, meta_raster_path, nodata = clip_raster_to_vector(start_model.rasterfile.name, vector)
@@ -462,7 +410,8 @@ class Productivity:
 			resolution=start_model.resolution,
 			start_year=self.start_year,
 			end_year=self.end_year,
-			subdir=ProductivitySettings.SUB_DIR
+			subdir=ProductivitySettings.SUB_DIR,
+			return_raw=self.return_raw
 		)
 
 	def _calculate_trajectory_version2(self, start_year, end_year, return_raw=False, is_baseline=False):
@@ -489,36 +438,6 @@ class Productivity:
 		4. Generate a raster containing the transitional values
 		5. compute the raster statistics to be returned together with the raster
 		"""
-		def get_linear_regression(item):
-			"""Get the slope"""
-			# slope, intercept, r_value, p_value, std_err = stats.linregress(time_array, item['values'])
-			data = extract_period_values(item)
-			if data == nodata:
-				return nodata		
-			
-			slope, intercept, r_value, p_value, std_err = stats.linregress(time_array, data)
-			return slope
-
-		def extract_period_values(item):
-			data = []			
-			# Extract values for all the periods to form the data series
-			for i, tm in enumerate(time_array):
-				val = item[str(tm)]
-				if val == nodata: # if any value has nodata, then return nodata as val of slope
-					return nodata
-				data.append(val)
-			return data
-
-		def get_pvalue(item):
-			"""Get pvalue"""
-			data = extract_period_values(item)
-			if data == nodata:
-				return nodata	
-			tau, p_value = stats.kendalltau(time_array, data)
-			# tau, p_value = stats.kendalltau(time_array, [item['base'], item['target']])
-			# p_value = p_value if not np.isnan(p_value) else 1.
-			return p_value
-		
 		self.start_year = start_year
 		self.end_year = end_year
 
@@ -574,85 +493,19 @@ class Productivity:
 
 		time_array = [x.raster_year for x in ndvi_models]
 		
-		"""
-		stack pixel values. This will put all pixel values at specific location 
-		into one single array such that values at the same location for different 
-		pixel location will be contained in a single array. The array will be of size 
-		(raster_rows, raster_cols, no_of_rasters)
-
-		To get mean of rasters by their positions, use the below form
-			np.mean(np.dstack([x, y, z]).transpose(), axis=0).transpose()
-		"""
-		rasters = np.dstack(ndvi_rasters)
-
 		if len(ndvi_rasters) != len(time_array):
 			error = _("The number of available datasets is different from the number of periods selected. Number of datasets is {0} while the number of periods is {1}. Ensure there is a dataset for each of the years within the reporting period."
 					.format(len(ndvi_rasters), len(time_array)))
 			return self.return_with_error(error)
 
-		# Create dataframe
-		df = pd.DataFrame()
-		# create dynamic index for each reporting period
-		for i, tm in enumerate(time_array):
-			df[str(tm)] = ndvi_rasters[i].flatten()
-
-		df['mapping'] = nodata #initialize all to nodata
-		df['slope'] = nodata #initialize all to nodata
-		df['pvalue'] = nodata #initialize all to nodata
-
-		# create masks
-		nodata_masks = []
-		for i, tm in enumerate(time_array):
-			msk = (df[str(tm)] == nodata)
-			nodata_masks.append(msk)
-	
 		# Compute slope
-		# 1.  compute slope		
 		"""
 		do linear regression on every pixel and for this 
-		we are getting the r/ship btwn base and target years pixel values
-		We only consider slope and the p_value. stats.linregress returns values as below
-			slope, intercept, r_value, p_value, std_err = stats.linregress(time_array, data_array).
-		linregress() uses Wald Test with t-distribution, not mann kandell, so we use kendalltau since
-		we want to do a non-parametric significance test
-		"""	
-		# for those values that have not changed, the slope is 0
-		df.loc[~np.logical_and.reduce(nodata_masks), ['slope']] = 0 # combine and apply masks
-
-		# Only do regression where pixel values have changed
-		df.loc[~np.logical_and.reduce(nodata_masks), ['slope']] = df.apply(lambda x: get_linear_regression(x), axis=1) 
-
-		# get p value
-		# 2. Compute pvalues to perform significance test
+		we are getting the r/ship btwn base and target years pixel values.
+		Slope is computed for all pixels at once. Pixels with nodata in any period get nodata.
+		The classification below only relies on the slope, so the significance test is skipped.
 		"""
-		If p Value is more than cutoff, then its stable.
-		p value will be nan if both x and y are the same. if values 
-		of x (base) and y (target) are same, it returns nan values.	
-		"""
-		# get p value where the base and target are different, else assign p value to 1.0
-		df.loc[~np.logical_and.reduce(nodata_masks), ['pvalue']] = df.apply(lambda x: get_pvalue(x), axis=1) 
-		
-		# set mapping to stable first for all non-masked values
-		# df.loc[~np.logical_and.reduce(nodata_masks), ['mapping']] = TrajectoryChangeTernaryEnum.STABLE.key
-
-		# 3. Set transitions. 
-		"""
-		Degraded: If pvalue <= ProductivitySettings.PVALUE_CUTOFF and slope < 0
-		Improved: If pvalue <= ProductivitySettings.PVALUE_CUTOFF and slope > 0
-		Stable: If pvalue > ProductivitySettings.PVALUE_CUTOFF or (pvalue <= ProductivitySettings.PVALUE_CUTOFF and slope = 0)
-		"""
-		# significant_pvalue_mask = (df['pvalue'] <= ProductivitySettings.PVALUE_CUTOFF)
-		
-		# improved
-		# improved_mask = (df['slope'] >= 0)
-		# df.loc[~np.logical_and.reduce(nodata_masks) & improved_mask & significant_pvalue_mask, ['mapping']] = TrajectoryChangeTernaryEnum.IMPROVED.key
-		
-		# degraded
-		# degraded_mask = (df['slope'] < 0)
-		# df.loc[~np.logical_and.reduce(nodata_masks) & degraded_mask & significant_pvalue_mask, ['mapping']] = TrajectoryChangeTernaryEnum.DEGRADED.key
-
-		# reshape the pd.series into 2d array
-		out_raster = df['slope'].values.reshape(ndvi_rasters[0].shape)
+		out_raster, pvalue = compute_trend(ndvi_rasters, time_array, nodata, compute_pvalue=False)
 
 		out_raster = self.mask_array(out_raster, nodata)
 		# Clip the raster and save for later referencing
@@ -661,19 +514,8 @@ class Productivity:
 		trend_enum, change_map = self.initialize_trajectory_matrix() 
 		
 		ds = out_raster
-		df = pd.DataFrame({
-						'ratio': ds.filled(fill_value=nodata).flatten(),												
-					})
-		df['mapping'] = nodata
-		no_data_mask = df['ratio'] != nodata
-		# Replace values
-		for row in change_map:
-			# filter all matching entries as per the matrix
-			mask = (df['ratio'] >= row['low']) & (df['ratio'] < row['high'])
-			df.loc[mask & no_data_mask, ['mapping']] = row['mapping']
-		
-		out_raster = df['mapping'].values.reshape(ds.shape)
-		out_raster = out_raster.astype(np.int32)
+		out_raster = reclassify_by_matrix(ds, change_map, nodata)
+		out_raster = to_class_dtype(out_raster, nodata)
 
 		if return_raw:
 			return {
@@ -692,9 +534,11 @@ class Productivity:
 			resolution=start_model.resolution,
 			start_year=self.start_year,
 			end_year=self.end_year,
-			subdir=ProductivitySettings.SUB_DIR
+			subdir=ProductivitySettings.SUB_DIR,
+			return_raw=self.return_raw
 		)
 
+	@instrumented()
 	def calculate_state(self):
 		"""
 		Calculate State sub-indicator.
@@ -725,20 +569,12 @@ class Productivity:
 
 				change_matrix = self.initialize_state_change_matrix()
 
-				df = pd.DataFrame({
-								'baseline': baseline['datasource'].flatten(),
-								'reporting': reporting['datasource'].flatten(),
-							})
-				df['mapping'] = reporting['nodata']
-
-				# Replace values
-				for row in change_matrix:
-					# filter all matching entries as per the matrix
-					mask = (df['baseline'] == row['base']) & (df['reporting'] == row['curr'])
-					df.loc[mask, ['mapping']] = row['mapping']
-				
-				datasource = df['mapping'].values.reshape(baseline['datasource'].shape)
-				datasource = datasource.astype(np.int32)
+				datasource = reclassify_combinations(
+								arrays=[baseline['datasource'], reporting['datasource']],
+								keys=['base', 'curr'],
+								matrix=change_matrix,
+								nodata=reporting['nodata'])
+				datasource = to_class_dtype(datasource, reporting['nodata'])
 
 				return return_raster_with_stats(
 					request=self.request,
@@ -750,7 +586,8 @@ class Productivity:
 					resolution=reporting['resolution'],
 					start_year=baseline_start_year,
 					end_year=self.end_year,
-					subdir=ProductivitySettings.SUB_DIR 
+					subdir=ProductivitySettings.SUB_DIR,
+					return_raw=self.return_raw
 				)
 			
 		return self._calculate_state_version1()
@@ -877,22 +714,16 @@ class Productivity:
 		Improved: If change >= 2
 		Stable: If -2<=change<=2
 		"""
-		df = pd.DataFrame({'base': base_raster.flatten(), 'target': comparison_raster.flatten()})		
-		df['mapping'] = nodata #initialize all to nodata
-
-		nodata_mask = (df['base'] == nodata) | (df['target'] == nodata)
-		df.loc[~nodata_mask, ['diff']] = df['target'] - df['base']
+		nodata_mask = (base_raster == nodata) | (comparison_raster == nodata)
+		diff = ma.array(comparison_raster - base_raster, mask=nodata_mask)
 		
-		# set mapping to stable first for all non-masked values
-		df.loc[~nodata_mask, ['mapping']] = StateChangeTernaryEnum.STABLE.key		
-		
-		improved_mask = (df['diff'] > ProductivitySettings.STATE_CHANGE_POSITIVE_CUTOFF)
-		df.loc[~nodata_mask & improved_mask, ['mapping']] = StateChangeTernaryEnum.IMPROVED.key
-
-		degraded_mask = (df['diff'] < ProductivitySettings.STATE_CHANGE_NEGATIVE_CUTOFF)
-		df.loc[~nodata_mask & degraded_mask, ['mapping']] = StateChangeTernaryEnum.DEGRADED.key
-
-		out_raster = df['mapping'].values.reshape(base_raster.shape)
+		# degraded if diff < negative cutoff, improved if diff > positive cutoff, else stable
+		out_raster = reclassify(diff, 
+						breaks=[MIN_INT, ProductivitySettings.STATE_CHANGE_NEGATIVE_CUTOFF, 
+								np.nextafter(ProductivitySettings.STATE_CHANGE_POSITIVE_CUTOFF, MAX_INT), MAX_INT],
+						labels=[StateChangeTernaryEnum.DEGRADED.key, StateChangeTernaryEnum.STABLE.key, 
+								StateChangeTernaryEnum.IMPROVED.key],
+						nodata=nodata)
 
 		return return_raster_with_stats(
 			request=self.request,
@@ -904,7 +735,8 @@ class Productivity:
 			resolution=start_model.resolution,
 			start_year=self.start_year,
 			end_year=self.end_year,
-			subdir=ProductivitySettings.SUB_DIR
+			subdir=ProductivitySettings.SUB_DIR,
+			return_raw=self.return_raw
 		)
 
 	def _calculate_state_version2(self, start_year, end_year, return_raw=False):
@@ -1023,19 +855,8 @@ class Productivity:
 		# Step 3
 		state_enum, change_map = self.initialize_state_matrix() 
 		
-		df = pd.DataFrame({
-						'ratio': z_stats.filled(fill_value=nodata).flatten(),												
-					})
-		df['mapping'] = nodata
-		no_data_mask = df['ratio'] != nodata
-		# Replace values
-		for row in change_map:
-			# filter all matching entries as per the matrix
-			mask = (df['ratio'] >= row['low']) & (df['ratio'] < row['high'])
-			df.loc[mask & no_data_mask, ['mapping']] = row['mapping']
-		
-		out_raster = df['mapping'].values.reshape(z_stats.shape)
-		out_raster = out_raster.astype(np.int32)
+		out_raster = reclassify_by_matrix(z_stats, change_map, nodata)
+		out_raster = to_class_dtype(out_raster, nodata)
 
 		if return_raw:
 			return {
@@ -1054,7 +875,8 @@ class Productivity:
 			resolution=start_model.resolution,
 			start_year=self.start_year,
 			end_year=self.end_year,
-			subdir=ProductivitySettings.SUB_DIR
+			subdir=ProductivitySettings.SUB_DIR,
+			return_raw=self.return_raw
 		)
 
 	def mask_array(self, rast, nodata):
@@ -1069,14 +891,10 @@ class Productivity:
 		Validate that we have enough raters to compute state.
 		Convention is to have at least 10 rasters
 		"""
-		rasters = get_raster_models(
-						raster_category=self.veg_index, 
-						raster_source=self.raster_source.value,
-						raster_year__lte=self.end_year,
-						admin_zero_id=self.admin_0)
+		rasters = self.get_vi_cube().get_years(end_year=self.end_year)
 
 		min_rasters = ProductivitySettings.MIN_RASTERS_FOR_STATE if self.compute_version == 1 else ProductivitySettings.MIN_RASTERS_FOR_STATE_V2
-		if rasters.count() < min_rasters:
+		if len(rasters) < min_rasters:
 			return _("""You need at least %s years of data until %s inorder to 
 									compute productivity""" % (min_rasters, self.end_year))
 	
@@ -1085,14 +903,10 @@ class Productivity:
 		Validate that we have enough raters to compute performance.
 		Convention is to have at least 15 rasters
 		"""
-		rasters = get_raster_models(
-						raster_category=self.veg_index, 
-						raster_source=self.raster_source.value,
-						raster_year__lte=self.end_year,
-						admin_zero_id=self.admin_0)
+		rasters = self.get_vi_cube().get_years(end_year=self.end_year)
 
 		min_rasters = ProductivitySettings.MIN_RASTERS_FOR_PERFORMANCE_V2 if self.compute_version == 1 else ProductivitySettings.MIN_RASTERS_FOR_PERFORMANCE_V2
-		if rasters.count() < min_rasters:
+		if len(rasters) < min_rasters:
 			return _("""You need at least %s years of data until %s inorder to 
 									compute productivity""" % (min_rasters, self.end_year))
 	
@@ -1105,12 +919,7 @@ class Productivity:
 		comparison period will be 2011-2013, while the baseline period will be 2001-2010
 		"""
 		# get list of available rasters
-		rasters = get_raster_models(#raster_type=self.raster_type, 
-						raster_category=self.veg_index, 
-						raster_source=self.raster_source.value,
-						raster_year__lte=self.end_year,
-						admin_zero_id=self.admin_0)
-		periods = sorted([x.raster_year for x in rasters])
+		periods = self.get_vi_cube().get_years(end_year=self.end_year)
 		
 		# Get the other periods except the last N periods
 		baseline_period = periods[:-ProductivitySettings.MIN_COMPARISON_RANGE:]
@@ -1122,27 +931,14 @@ class Productivity:
 	def get_vi_rasters(self, start_period, end_period):
 		"""Get rasters between start and end periods
 
+		Each year is only read once per analysis, see `VITimeSeriesCube`. The rasters
+		are shared by the sub-indicators and must not be modified in place.
+
 		Args:
 			start_year (int): Start period
 			end_year (int): End period
 		"""
-		rasters_list = []
-		vector, error = self.get_vector()	
-		period = start_period
-		min_shape = None # store smallest array size
-		while period <= end_period:
-			model, error = self.get_vi_raster_model(period, throw_error=False)
-			if model:
-				# Extract raster meta data
-				meta = get_raster_meta(model.rasterfile.name)				
-				"""
-				Extract pixels of the vector we are interested in.
-				We ignore the rest of the raster
-				"""
-				raster, nodata, rastfile = extract_pixels_using_vector(model.rasterfile.name, vector)				
-				rasters_list.append(raster)
-			period += 1
-		return rasters_list
+		return self.get_vi_cube().get_rasters(start_period, end_period)
 		
 	def get_frequency_distribution(self, rasters, nodata):
 		"""Get the frequency distribution for different rasters 
@@ -1209,9 +1005,10 @@ class Productivity:
 			A raster whose values are the average of different values per pixel
 		"""
 		# use axis=0 so that it returns the mean per pixel correctly
+		# computed by bands of rows so that the rasters are not all copied at once
 		if not isinstance(rasters, list): # np.ndarray):
 			rasters = [rasters]
-		avg_raster = np.mean(rasters, axis=0)
+		avg_raster = reduce_arrays(np.mean, rasters)
 		return avg_raster
 
 	def compute_std_deviation(self, rasters):
@@ -1221,7 +1018,7 @@ class Productivity:
 			A value are the std dev of different values per pixel
 		"""
 		# use axis=0 so that it returns the mean per pixel correctly
-		std_raster = np.std(rasters, axis=0)
+		std_raster = reduce_arrays(np.std, rasters)
 		return std_raster
 
 	def initialize_state_matrix(self):
@@ -1452,24 +1249,25 @@ class Productivity:
 
 		Returns:
 			Raster whose values are the different percentile classes
-
-		TODO : https://engineering.upside.com/a-beginners-guide-to-optimizing-pandas-code-for-speed-c09ef2c6a4d6
 		"""
-
-		def get_percentile(val):
-			return percentileofscore(unique_vals, val)
-
 		raster_shape = raster.shape
 
-		# create an ndarray of unique values to speed up operations
-		unique_vals = np.array(list(freq_dist.keys())) #rem the keys rep the unique pixel val
-	
-		df = pd.DataFrame({'item': raster.flatten()})
-		df['percentile'] = nodata
+		# sorted unique values. The keys of freq_dist rep the unique pixel values
+		unique_vals = np.sort(np.array(list(freq_dist.keys()), dtype=np.float64))
+		values = ma.filled(ma.asarray(raster).astype(np.float64), np.nan).ravel()
 
-		df.loc[df['item'] != nodata, ['percentile']] = df['item'].map(lambda x: percentileofscore(unique_vals, x) if x != nodata else nodata, na_action='ignore')
-		return df['percentile'].values.reshape(raster_shape)
+		# same as percentileofscore(unique_vals, x, kind='rank') for all the pixels at once
+		left = np.searchsorted(unique_vals, values, side='left')
+		right = np.searchsorted(unique_vals, values, side='right')
+		if unique_vals.size:
+			percentiles = (right + left + (right > left)) * 50.0 / unique_vals.size
+		else:
+			percentiles = np.full(values.shape, 100.0)
+		percentiles[np.isnan(values)] = np.nan
+		percentiles[values == nodata] = nodata
+		return percentiles.reshape(raster_shape)
 	
+	@instrumented()
 	def calculate_performance(self):
 		"""
 		Calculate Performance sub-indicator.
@@ -1500,20 +1298,12 @@ class Productivity:
 
 				change_matrix = self.initialize_performance_change_matrix()
 
-				df = pd.DataFrame({
-								'baseline': baseline['datasource'].flatten(),
-								'reporting': reporting['datasource'].flatten(),
-							})
-				df['mapping'] = reporting['nodata']
-
-				# Replace values
-				for row in change_matrix:
-					# filter all matching entries as per the matrix
-					mask = (df['baseline'] == row['base']) & (df['reporting'] == row['curr'])
-					df.loc[mask, ['mapping']] = row['mapping']
-				
-				datasource = df['mapping'].values.reshape(baseline['datasource'].shape)
-				datasource = datasource.astype(np.int32)
+				datasource = reclassify_combinations(
+								arrays=[baseline['datasource'], reporting['datasource']],
+								keys=['base', 'curr'],
+								matrix=change_matrix,
+								nodata=reporting['nodata'])
+				datasource = to_class_dtype(datasource, reporting['nodata'])
 
 				return return_raster_with_stats(
 					request=self.request,
@@ -1525,7 +1315,8 @@ class Productivity:
 					resolution=reporting['resolution'],
 					start_year=baseline_start_year,
 					end_year=self.end_year,
-					subdir=ProductivitySettings.SUB_DIR 
+					subdir=ProductivitySettings.SUB_DIR,
+					return_raw=self.return_raw
 				)
 			
 		return self._calculate_performance_version1()
@@ -1590,7 +1381,8 @@ class Productivity:
 			resolution=start_model.resolution,
 			start_year=self.start_year,
 			end_year=self.end_year,
-			subdir=ProductivitySettings.SUB_DIR
+			subdir=ProductivitySettings.SUB_DIR,
+			return_raw=self.return_raw
 		) 
 
 	def _calculate_performance_version2_deprecated(self, start_year, end_year, return_raw=False):
@@ -1683,7 +1475,8 @@ class Productivity:
 			resolution=start_model.resolution,
 			start_year=self.start_year,
 			end_year=self.end_year,
-			subdir=ProductivitySettings.SUB_DIR
+			subdir=ProductivitySettings.SUB_DIR,
+			return_raw=self.return_raw
 		) 
 
 	def _calculate_performance_version2(self, start_year, end_year, return_raw=False):
@@ -1759,7 +1552,8 @@ class Productivity:
 			resolution=start_model.resolution,
 			start_year=self.start_year,
 			end_year=self.end_year,
-			subdir=ProductivitySettings.SUB_DIR
+			subdir=ProductivitySettings.SUB_DIR,
+			return_raw=self.return_raw
 		) 
 
 	def _do_compute_performance(self, ndvi_rasters, base_rasters, nodata):
@@ -1793,37 +1587,16 @@ class Productivity:
 		# eco_units = do_raster_operation([base_lc_raster, base_soil_raster], 
 		# 								 RasterOperationEnum.ADD, nodata=nodata)
 
+		# mask nodata values
+		mean_ndvi[mean_ndvi==nodata] = ma.masked
+
 		"""
-		Get the frequency distributions of the ecological units
-		For each eco unit, get the value of the corresponding pixel
-		values from the mean ndvi raster
+		Get the 90th percentile of the mean ndvi values of each ecological unit
+		and set it as the value of the pixels of the unit
 		"""
-		unique_eco_units = self.get_frequency_distribution(reference_eco_units_raster, nodata)
-
-		"""Initialize new array to store max ndvi values"""
-		max_ndvi_raster = np.full(comparison_rasters[0].shape, nodata, dtype=float)
+		max_ndvi_raster = get_zonal_percentiles(mean_ndvi, reference_eco_units_raster, 90,
+										zone_nodata=nodata, fill_value=nodata)
 		max_ndvi_raster = ma.array(max_ndvi_raster) #initialize a masked array
-
-		"""Remove nodata from eco units"""
-		unique_eco_units = [x for x in unique_eco_units if x != nodata]
-		for eco in unique_eco_units:			
-			"""Get index of matching values"""
-			indices = np.where(reference_eco_units_raster==eco)
-
-			"""Extract the corresponding mean ndvi values"""
-			# mean_ndvi_vals = np.take(mean_ndvi, indices)
-			mean_ndvi_vals = mean_ndvi[tuple(indices)]
-			
-			# mask nodata values
-			mean_ndvi[mean_ndvi==nodata] = ma.masked
-			if mean_ndvi_vals.size != 0: #percentile requires an array			
-				"""Get the 90th percentile"""
-				perc_90 = np.percentile(mean_ndvi_vals, 90) 
-
-				"""Set this 90th percentile value as the value for the matching pixels"""
-				# for row, col in zip(indices[0], indices[1]):
-				# 	max_ndvi_raster[row, col] = perc_90
-				max_ndvi_raster[tuple(indices)] = perc_90
 		
 		"""Compute mean_ndiv / max_ndvi"""
 		max_ndvi_raster[max_ndvi_raster==nodata] = ma.masked
@@ -1831,18 +1604,11 @@ class Productivity:
 		ratios = do_raster_operation([mean_ndvi, max_ndvi_raster], RasterOperationEnum.DIVIDE, nodata)
 
 		"""If ratio < 0.5, then degraded else stable"""
-		df = pd.DataFrame({'ratio': ratios.flatten()})
-		df['mapping'] = nodata
-		df[np.isnan(df['ratio'])] = nodata
-		
-		degraded_mask = df['ratio'] < ProductivitySettings.PERFORMANCE_DEGRADED_CUTOFF
-		stable_mask = df['ratio'] >= ProductivitySettings.PERFORMANCE_DEGRADED_CUTOFF
-		valid_data = df['ratio'] != nodata
-		df.loc[degraded_mask & valid_data, ['mapping']] = PerformanceChangeBinaryEnum.DEGRADED.key
-		df.loc[stable_mask & valid_data, ['mapping']] = PerformanceChangeBinaryEnum.STABLE.key
-
-		datasource = df['mapping'].values.reshape(ratios.shape)
-		datasource = datasource.astype(np.int32)
+		datasource = reclassify(ratios, 
+						breaks=[MIN_INT, ProductivitySettings.PERFORMANCE_DEGRADED_CUTOFF, MAX_INT],
+						labels=[PerformanceChangeBinaryEnum.DEGRADED.key, PerformanceChangeBinaryEnum.STABLE.key],
+						nodata=nodata)
+		datasource = to_class_dtype(datasource, nodata)
 		
 		self.max_ndvi_raster = max_ndvi_raster # just for unit testing purposes
 		self.mean_ndvi = mean_ndvi # just for unit testing purposes
@@ -1850,12 +1616,15 @@ class Productivity:
 
 		return datasource
 
+	@instrumented()
 	def calculate_productivity(self):
 		"""
 		Calculate overall Productivity indicator
 		Combines Trajectory, State, and Performance sub-indicators
 		"""
 		self.in_sub_indicator_context = False
+		if self.memo is None: # trajectory, state and performance read the same rasters
+			self.memo = ComputationMemo()
 
 		# Clip the raster and save for later referencing
 		vector, error = self.get_vector()	
@@ -1864,50 +1633,42 @@ class Productivity:
 			return self.return_with_error(self.error)
 		meta_raster, meta_raster_path, nodata = clip_raster_to_vector(start_model.rasterfile.name, vector)
 		
-		self.error = None
-		trajectory = self.calculate_trajectory()
-		if self.error:
-			return self.return_with_error(self.error)
-
-		self.error = None
-		state = self.calculate_state()
-		if self.error:
-			return self.return_with_error(self.error)
-		
-		self.error = None
-		performance = self.calculate_performance()
-		if self.error:
-			return self.return_with_error(self.error)
+		# Pass the sub-indicators in memory unless they are explicitly required on disk
+		return_raw = self.return_raw
+		self.return_raw = not self.save_stage_rasters
+		try:
+			results = run_stages([
+				stage(self, self.calculate_trajectory),
+				stage(self, self.calculate_state),
+				stage(self, self.calculate_performance)
+			])
+		finally:
+			self.return_raw = return_raw
+		for result, error in results:
+			if error:
+				return self.return_with_error(error)
+		trajectory, state, performance = [result for result, error in results]
 
 		prod_enum, prod_matrix = self.initialize_productivity_matrix()
 
-		base_file = trajectory['rasterfile']
-		traj_array = self.read_raster(trajectory['rasterfile'])
-		state_array = self.read_raster(state['rasterfile'])
-		perf_array = self.read_raster(performance['rasterfile'])
+		traj_array = self.get_stage_array(trajectory)
+		state_array = self.get_stage_array(state)
+		perf_array = self.get_stage_array(performance)
 
 		# harmonize nodata values
-		base_meta = get_raster_meta(self.get_file_path(base_file))
-		nodata = base_meta.get('nodata')
+		nodata = self.get_stage_nodata(trajectory)
 
 		rasters = reshape_rasters([traj_array, state_array, perf_array])
 		traj_array = rasters[0]
 		state_array = rasters[1]
 		perf_array = rasters[2]
  
-		df = pd.DataFrame({
-						'trajectory': traj_array.flatten(),
-						'state': state_array.flatten(),
-						'performance': perf_array.flatten()
-					})
-		df['mapping'] = nodata
-		for row in prod_matrix:
-			# filter all matching entries as per the matrix
-			mask = (df['trajectory'] == row['traj']) & (df['state'] == row['state']) & (df['performance'] == row['perf'])
-			df.loc[mask, ['mapping']] = row['mapping']
-		
-		datasource = df['mapping'].values.reshape(traj_array.shape)
-		datasource = datasource.astype(np.int32)
+		datasource = reclassify_combinations(
+						arrays=[traj_array, state_array, perf_array],
+						keys=['traj', 'state', 'perf'],
+						matrix=prod_matrix,
+						nodata=nodata)
+		datasource = to_class_dtype(datasource, nodata)
 
 		return return_raster_with_stats(
 			request=self.request,
@@ -1919,12 +1680,29 @@ class Productivity:
 			resolution=start_model.resolution,
 			start_year=self.start_year,
 			end_year=self.end_year,
-			subdir=ProductivitySettings.SUB_DIR
+			subdir=ProductivitySettings.SUB_DIR,
+			return_raw=self.return_raw
 		)
 
 	def get_file_path(self, url):
 		return get_physical_file_path_from_url(self.request, url)
 
+	def get_stage_array(self, result):
+		"""
+		Get the array of a sub-indicator result whether it was returned in memory or saved to a file
+		"""
+		if is_raw_result(result):
+			return result['datasource']
+		return self.read_raster(result['rasterfile'])
+
+	def get_stage_nodata(self, result):
+		"""
+		Get the nodata value of a sub-indicator result whether it was returned in memory or saved to a file
+		"""
+		if is_raw_result(result):
+			return result['nodata']
+		return get_raster_meta(self.get_file_path(result['rasterfile'])).get('nodata')
+
 	def read_raster(self, file):
 		return get_raster_values(self.get_file_path(file), 
 									band=GenericRasterBandEnum.HAS_SINGLE_BAND, 
@@ -1,6 +1,4 @@
 import numpy as np
-import numpy.ma as ma
-import pandas as pd
 import tempfile
 from django.utils.translation import gettext as _
 from rest_framework.response import Response
@@ -8,11 +6,13 @@ from rest_framework.response import Response
 from ldms.utils.vector_util import get_vector
 from ldms.utils.raster_util import (get_raster_values, save_raster, reproject_raster, 
 					do_raster_operation, get_raster_models, clip_raster_to_vector,
-					clip_rasters, mask_rasters,
-					get_raster_meta, return_raster_with_stats, reshape_rasters)
+					get_raster_meta, return_raster_with_stats,
+					reclassify_by_matrix, is_block_processing_enabled, 
+					return_raster_with_stats_by_block, RasterStack, accumulate_masked)
 from ldms.enums import (RasterSourceEnum, RasterOperationEnum, 
 						RasterCategoryEnum, RUSLEEnum, RUSLEComputationTypeEnum, RUSLEFactorsEnum)
 from ldms.utils.common_util import return_with_error, get_random_floats, cint, validate_years
+from ldms.utils.dtype_util import to_class_dtype
 from ldms.utils.file_util import (generate_file_name, get_absolute_media_path, get_download_url, 
 								file_exists, get_physical_file_path_from_url)
 from ldms import ModelNotExistError, AnalysisParamError
@@ -92,76 +92,89 @@ class RUSLE:
 		error, vector, r_model, k_model, s_model, c_model, p_model = self.prevalidate()
 		if error:
 			return self.return_with_error(error) 
-		# Clip rasters
-		nodata, clipped_rasters = clip_rasters(vector, [r_model, k_model, s_model, c_model, p_model])
-		# r_raster = clipped_rasters[0][0] 
-		# k_raster = clipped_rasters[1][0] 
-		# s_raster = clipped_rasters[2][0]
-		# c_raster = clipped_rasters[3][0]
-		# p_raster = clipped_rasters[4][0]
-		clipped_raster_paths = [x[1] for x in clipped_rasters]
-		# mask arrays to ensure nodata pixels are not considered
-		clipped_rasters = mask_rasters([x[0] for x in clipped_rasters], nodata)
-		r_raster = clipped_rasters[0]
-		k_raster = clipped_rasters[1]
-		s_raster = clipped_rasters[2]
-		c_raster = clipped_rasters[3]
-		p_raster = clipped_rasters[4]
+		if is_block_processing_enabled():
+			return self.calculate_rusle_by_block(vector, [r_model, k_model, s_model, c_model, p_model])
+		prefix, change_enum, input_models = self.get_input_models([r_model, k_model, s_model, c_model, p_model])
+		# Clip and align the rasters. Pixels with nodata are masked
+		with RasterStack([x.rasterfile.name for x in input_models], vector) as stack:
+			nodata = stack.nodata
+			rasters = stack.read()
+			metadata_raster_path = stack.save_meta_raster()
 
-		prefix = "rusle"
-		change_enum = RUSLEFactorsEnum
-		if self.computation_type == RUSLEComputationTypeEnum.RAINFALL_EROSIVITY:
-			rusle = r_raster
-			prefix = "r_"
-		if self.computation_type == RUSLEComputationTypeEnum.SOIL_ERODIBILITY:
-			rusle = k_raster
-			prefix = "k_"
-		if self.computation_type == RUSLEComputationTypeEnum.SLOPE_STEEPNESS:
-			rusle = s_raster
-			prefix = "s_"
-		if self.computation_type == RUSLEComputationTypeEnum.COVER_MANAGEMENT:
-			rusle = c_raster
-			prefix = "c_"
-		if self.computation_type == RUSLEComputationTypeEnum.CONSERVATION_PRACTICES:
-			rusle = p_raster
-			prefix = "p_"
-		if self.computation_type == RUSLEComputationTypeEnum.RUSLE:
-			change_enum = RUSLEEnum
-			# Multiply factors.
-			rasters = reshape_rasters([r_raster, k_raster, s_raster, c_raster, p_raster])
-			rusle = rasters[0] * rasters[1] * rasters[2] * rasters[3] * rasters[4]
-
-		rusle = ma.array(rusle)		
+		# Multiply factors.
+		rusle = accumulate_masked(np.multiply, list(rasters), nodata)
 		
 		# Step 3
 		matrix = self.initialize_matrix()
-		df = pd.DataFrame({
-						'ratio': rusle.filled(fill_value=nodata).flatten(),												
-					})
-		df['mapping'] = nodata
-		no_data_mask = df['ratio'] != nodata
-		# Replace values
-		for row in matrix:
-			# filter all matching entries as per the matrix
-			mask = (df['ratio'] >= row['low']) & (df['ratio'] < row['high'])
-			df.loc[mask & no_data_mask, ['mapping']] = row['mapping']
-		
-		out_raster = df['mapping'].values.reshape(rusle.shape)
-		out_raster = out_raster.astype(np.int32)
+		out_raster = reclassify_by_matrix(rusle, matrix, nodata)
+		out_raster = to_class_dtype(out_raster, nodata)
 
 		return return_raster_with_stats(
 			request=self.request,
-			datasource=out_raster[0], 
+			datasource=out_raster, 
 			prefix=prefix, 
 			change_enum=change_enum, 
-			metadata_raster_path=clipped_raster_paths[0], #clipped_rasters[0][1],
+			metadata_raster_path=metadata_raster_path,
 			nodata=nodata, 
 			resolution=r_model.resolution,
 			start_year=self.start_year,
 			end_year=self.end_year,
 			subdir=RUSLESettings.SUB_DIR
 		)
+
+	def get_input_models(self, models):
+		"""Get the models of the rasters needed for the computation type
+
+		Args:
+			models (list): Models of the R, K, S, C and P factors in that order
+
+		Returns:
+			tuple (prefix, change_enum, list of models)
+		"""
+		factors = {
+			RUSLEComputationTypeEnum.RAINFALL_EROSIVITY: (0, "r_"),
+			RUSLEComputationTypeEnum.SOIL_ERODIBILITY: (1, "k_"),
+			RUSLEComputationTypeEnum.SLOPE_STEEPNESS: (2, "s_"),
+			RUSLEComputationTypeEnum.COVER_MANAGEMENT: (3, "c_"),
+			RUSLEComputationTypeEnum.CONSERVATION_PRACTICES: (4, "p_"),
+		}
+		if self.computation_type == RUSLEComputationTypeEnum.RUSLE:
+			return ("rusle", RUSLEEnum, models)
+		index, prefix = factors[self.computation_type]
+		return (prefix, RUSLEFactorsEnum, [models[index]])
 	
+	def calculate_rusle_by_block(self, vector, models):
+		"""
+		Compute RUSLE block by block so that only a window of each raster is held in memory at a time
+
+		Args:
+			vector (geojson): Polygon to be used for clipping
+			models (list): Models of the R, K, S, C and P factors in that order
+		"""
+		nodata = get_raster_meta(models[0].rasterfile.name)['nodata']
+		prefix, change_enum, input_models = self.get_input_models(models)
+		matrix = self.initialize_matrix()
+
+		def compute_block(blocks):
+			rusle = blocks[0]
+			for block in blocks[1:]:
+				rusle = rusle * block
+			return reclassify_by_matrix(rusle, matrix, nodata)
+
+		return return_raster_with_stats_by_block(
+			request=self.request,
+			raster_files=[x.rasterfile.name for x in input_models],
+			vector=vector,
+			func=compute_block,
+			prefix=prefix,
+			change_enum=change_enum,
+			nodata=nodata,
+			resolution=models[0].resolution,
+			start_year=self.start_year,
+			end_year=self.end_year,
+			subdir=RUSLESettings.SUB_DIR
+		)
+
 	def return_input_rasters(self, vector, raster, raster_model, 
 					raster_type, nodata, metadata_raster_path, transform="area"):
 		"""Return input rasters
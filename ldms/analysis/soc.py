@@ -1,16 +1,18 @@
 import rasterio
 import numpy as np
-import pandas as pd
 import enum
 from django.utils.translation import gettext as _
 from rest_framework.response import Response
 from ldms.analysis.lulc import LULC, LCEnum
 from ldms.utils.raster_util import (get_raster_values, save_raster, 
 			reproject_raster, extract_pixels_using_vector,
-			clip_raster_to_vector, return_raster_with_stats, get_raster_models)
+			clip_raster_to_vector, return_raster_with_stats, get_raster_models, reclassify, 
+			reclassify_combinations)
+from ldms.utils.instrument_util import instrumented
 from ldms.utils.file_util import get_download_url, get_absolute_media_path
 from rasterio.warp import Resampling
 from ldms.utils.common_util import cint, return_with_error
+from ldms.utils.dtype_util import to_class_dtype
 from ldms.enums import SOCChangeEnum, LulcChangeEnum, ClimaticRegionEnum, \
 		GenericRasterBandEnum, RasterSourceEnum, RasterCategoryEnum
 from ldms import AnalysisParamError
@@ -55,6 +57,7 @@ class SOC:
 		# self.write_to_disk = kwargs.get('write_to_disk', False)
 		self.request = kwargs.get('request', None)
 		self.admin_0 = kwargs.get('admin_0', None)
+		self.return_raw = kwargs.get('return_raw', False)
  
 		self.initialize_coefficients()
 		self.kwargs = kwargs
@@ -153,6 +156,7 @@ class SOC:
 				},
 			]  
 
+	@instrumented()
 	def calculate_soc_change(self):
 		"""
 		Calculate SOC
@@ -163,26 +167,28 @@ class SOC:
 
 		"""Calculate LULC Change first"""
 		lulc = LULC(**self.kwargs)
-		df = lulc.calculate_lulc_change(return_no_map=True)
+		res = lulc.calculate_lulc_change(return_no_map=True)
 		if lulc.error:
 			return self.return_with_error(lulc.error) 
+		base_arry, target_arry, lulc_nodata = res
 
 		vector, error = lulc.get_vector()
 		if error:
 			return self.return_with_error(error)
 
+		"""
+		Each (base, target) transition of the coefficient matrix is a row of the combination 
+		matrix. Only a single dict is expected with key == self.climatic_region
+		"""
+		coeff_matrix = []
 		for key in self.coefficient_matrix:
-			""" only a single dict expected with key == self.climatic_region"""
-			vals = self.coefficient_matrix[key]
-			for mapping in vals:
-				""" 
-				df['base'] contains pixel values for the base period
-				df['target'] contains pixel values for the target period
-				"""
-				for target_lc_key in mapping['coeffs']:
-					target_lc_coeff = mapping['coeffs'][target_lc_key]
-					mask = (df['base']==mapping['base_lc']) & (df['target']== target_lc_key)
-					df.loc[mask, ['change']] = target_lc_coeff # Assign coefficient value 
+			for mapping in self.coefficient_matrix[key]:
+				coeff_matrix += [{'base': mapping['base_lc'], 'target': target_lc_key, 'mapping': coeff} 
+									for target_lc_key, coeff in mapping['coeffs'].items()]
+		change = reclassify_combinations(arrays=[base_arry, target_arry], 
+						keys=['base', 'target'], 
+						matrix=coeff_matrix, 
+						nodata=lulc_nodata)
 
 		base_model = get_raster_models(
 						raster_category=RasterCategoryEnum.LULC.value,
@@ -205,47 +211,31 @@ class SOC:
 		reference_soc, nodata, rastfile = extract_pixels_using_vector(meta_raster_path, 
 										vector)
 
-		# Reshape the df_change since it had been flattened earlier
-		df_change = df['change'].values.reshape(reference_soc.shape) 
+		change = change.reshape(reference_soc.shape) 
 
-		# Multiply the reference_soc with the change as proxied by the df
-		soc_current = reference_soc * df_change
+		# Multiply the reference_soc with the change as proxied by the coefficients
+		soc_current = reference_soc * change
 
 		# Subtract reference_soc from soc_current
 		soc_change = soc_current - reference_soc
 		
-		# Create a new dataframe with new fields
-		df_soc_change = pd.DataFrame({'base_soc': reference_soc.flatten(), 'soc_change': soc_change.flatten()})
-		
 		# change_range = 2 - (-1) # the max range within which the soc can change
 		"""
-		To get the % change within, we divide the change by the df['base_soc']
+		To get the % change within, we divide the change by the reference_soc
 		"""
 		nodatavalue = nodata
-		valid_vals_mask = (df['change'] != nodatavalue) & (~np.isnan(df_soc_change['soc_change']))
-		df_soc_change.loc[valid_vals_mask, ['perc_change']] =  np.divide(df_soc_change['soc_change'] * 100,  df_soc_change['base_soc'])
-		df_soc_change['mapping'] = np.nan # initialize mapping index
-
-		"""Transpose the change into Stable, Potentially Degraded or Potentially Improved"""
-		mask = (df_soc_change['perc_change'] < (-1 * self.cutoff_percentage))
-		df_soc_change.loc[mask, ['mapping']] = SOCChangeEnum.DEGRADED.key
-
-		mask = (df_soc_change['perc_change'] > self.cutoff_percentage)
-		df_soc_change.loc[mask, ['mapping']] = SOCChangeEnum.IMPROVED.key
-		
-		"""cutoff<=value<=cutoff"""
-		mask = np.logical_and(
-						(df_soc_change['perc_change'] >= (-1 * self.cutoff_percentage)),
-						(df_soc_change['perc_change'] <= self.cutoff_percentage)
-						)
-		df_soc_change.loc[mask, ['mapping']] = SOCChangeEnum.STABLE.key
-	
-		# change the nan into nodatavalue
-		df_soc_change.loc[np.isnan(df_soc_change['perc_change']), ['mapping']] = nodatavalue
+		valid_vals_mask = (change != lulc_nodata) & (~np.isnan(soc_change))
+		with np.errstate(divide='ignore', invalid='ignore'):
+			perc_change = np.where(valid_vals_mask, np.divide(soc_change * 100, reference_soc), np.nan)
 
-		# convert to old shape to allow writing a valid raster
-		datasource = df_soc_change['mapping'].values.reshape(reference_soc.shape)
-		datasource = datasource.astype(np.int32)
+		"""Transpose the change into Potentially Degraded (< -cutoff), Stable (-cutoff<=value<=cutoff) 
+		or Potentially Improved (> cutoff). nan are assigned nodata"""
+		datasource = reclassify(perc_change, 
+						breaks=[-np.inf, -1 * self.cutoff_percentage, 
+								np.nextafter(self.cutoff_percentage, np.inf), np.inf],
+						labels=[SOCChangeEnum.DEGRADED.key, SOCChangeEnum.STABLE.key, SOCChangeEnum.IMPROVED.key],
+						nodata=nodatavalue)
+		datasource = to_class_dtype(datasource, nodata)
 
 		return return_raster_with_stats(
 			request=self.request,
@@ -257,7 +247,8 @@ class SOC:
 			resolution=base_model.resolution,
 			start_year=self.start_year,
 			end_year=self.end_year,
-			subdir=SocSettings.SUB_DIR
+			subdir=SocSettings.SUB_DIR,
+			return_raw=self.return_raw
 		)
 
 	def return_with_error(self, error):		
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+from ldms.utils.admin_raster_util import (ADMIN_LEVEL_MODELS, precompute_admin_unit_rasters,
+					enqueue_precompute_admin_unit_rasters)
+
+class Command(BaseCommand):
+	help = "Clip rasters to every administrative unit they overlap and store them as Cloud Optimized GeoTIFFs"
+
+	def add_arguments(self, parser):
+		parser.add_argument('--raster', type=int, action='append', dest='raster_ids',
+				help="Id of the raster to clip. Can be repeated. Defaults to all rasters")
+		parser.add_argument('--level', type=int, action='append', dest='admin_levels',
+				choices=list(ADMIN_LEVEL_MODELS.keys()),
+				help="Admin level to clip to. Can be repeated. Defaults to all levels")
+		parser.add_argument('--unit', type=int, action='append', dest='admin_unit_ids',
+				help="Id of the administrative unit to clip to. Can be repeated")
+		parser.add_argument('--overwrite', action='store_true',
+				help="Clip again rasters that are up to date")
+		parser.add_argument('--background', action='store_true',
+				help="Queue the computation as a background job instead of running it now")
+
+	def handle(self, *args, **options):
+		kwargs = {
+			"raster_ids": options['raster_ids'],
+			"admin_levels": options['admin_levels'],
+			"admin_unit_ids": options['admin_unit_ids'],
+			"overwrite": options['overwrite'],
+		}
+		if options['background']:
+			enqueue_precompute_admin_unit_rasters(**kwargs)
+			self.stdout.write("Queued precomputation of administrative unit rasters")
+			return
+		count = precompute_admin_unit_rasters(**kwargs)
+		self.stdout.write(self.style.SUCCESS("Clipped %s rasters" % count))
@@ -0,0 +1,23 @@
+# Generated by Django 3.1 on 2026-10-18 09:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ldms', '0063_auto_20220421_0530'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='systemsettings',
+            name='block_processing_window_budget',
+            field=models.IntegerField(default=1048576, help_text='Maximum number of pixels per block when block processing is enabled'),
+        ),
+        migrations.AddField(
+            model_name='systemsettings',
+            name='enable_block_processing',
+            field=models.BooleanField(blank=True, default=False, help_text='If enabled, supported analysis will clip, compute and write rasters block by block so that memory usage is bounded by the window budget instead of the size of the area of interest'),
+        ),
+    ]
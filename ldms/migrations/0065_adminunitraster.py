@@ -0,0 +1,33 @@
+# Generated by Django 3.1 on 2026-10-18 10:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ldms', '0064_auto_20261018_0900'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AdminUnitRaster',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('admin_level', models.IntegerField(help_text='Admin level of the unit. -1 for regional, 0, 1 or 2')),
+                ('admin_unit_id', models.IntegerField()),
+                ('source_file', models.CharField(help_text='Raster file that was clipped', max_length=255)),
+                ('source_modified', models.BigIntegerField(help_text='Modification time (ns) of the source file when it was clipped')),
+                ('geometry_hash', models.CharField(db_index=True, max_length=64)),
+                ('clipping_algorithm', models.CharField(max_length=50)),
+                ('nodata', models.FloatField()),
+                ('rasterfile', models.CharField(help_text='Path of the clipped Cloud Optimized GeoTIFF', max_length=255)),
+                ('created_on', models.DateTimeField(auto_now=True)),
+                ('raster', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='ldms.raster')),
+            ],
+            options={
+                'unique_together': {('raster', 'admin_level', 'admin_unit_id')},
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.1 on 2026-10-18 10:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ldms', '0065_adminunitraster'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='systemsettings',
+            name='enable_parallel_stages',
+            field=models.BooleanField(blank=True, default=False, help_text='If enabled, the independent sub-indicators of composite indicators (Productivity, ESAI and Land Degradation) will be computed in parallel processes'),
+        ),
+        migrations.AddField(
+            model_name='systemsettings',
+            name='max_stage_workers',
+            field=models.IntegerField(default=0, help_text='Maximum number of processes used to compute sub-indicators in parallel. 0 means the number of CPUs'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.1 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ldms', '0066_auto_20261018_1000'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='scheduledtask',
+            name='estimated_cost',
+            field=models.FloatField(blank=True, help_text='Estimated cost of the task used to select its queue. See ldms.utils.cost_util', null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.1 on 2026-10-18 14:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ldms', '0067_scheduledtask_estimated_cost'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='scheduledtask',
+            name='progress',
+            field=models.TextField(blank=True, help_text='Running stage and durations of the stages of the task as JSON. See ldms.utils.instrument_util', null=True),
+        ),
+    ]
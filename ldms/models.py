@@ -11,7 +11,7 @@ from django.utils.translation import gettext as _
 from django.utils import timezone
 from django.template.defaultfilters import slugify
 
-from django.db.models.signals import pre_save, post_save
+from django.db.models.signals import pre_save, post_save, post_delete
 from django.dispatch import receiver
 import os
 
@@ -226,6 +226,36 @@ class Raster(models.Model):
 	def __str__(self):
 		return self.name
 
+class AdminUnitRaster(models.Model):
+	"""
+	Model for rasters that have been pre-clipped to an administrative unit.
+	Clipping looks up this table before clipping on the fly.
+	"""
+	raster = models.ForeignKey(Raster, on_delete=models.CASCADE)
+	admin_level = models.IntegerField(help_text=_("Admin level of the unit. -1 for regional, 0, 1 or 2"))
+	admin_unit_id = models.IntegerField()
+	source_file = models.CharField(max_length=255, help_text=_("Raster file that was clipped"))
+	source_modified = models.BigIntegerField(help_text=_("Modification time (ns) of the source file when it was clipped"))
+	geometry_hash = models.CharField(max_length=64, db_index=True)
+	clipping_algorithm = models.CharField(max_length=50)
+	nodata = models.FloatField()
+	rasterfile = models.CharField(max_length=255, help_text=_("Path of the clipped Cloud Optimized GeoTIFF"))
+	created_on = models.DateTimeField(auto_now=True)
+
+	class Meta:
+		unique_together = ['raster', 'admin_level', 'admin_unit_id']
+
+	def __str__(self):
+		return "%s (level %s: %s)" % (self.raster, self.admin_level, self.admin_unit_id)
+
+@receiver(post_delete, sender=AdminUnitRaster)
+def delete_admin_unit_raster_file(sender, instance, **kwargs):
+	"""
+	Delete the clipped raster file
+	"""
+	if instance.rasterfile and os.path.isfile(instance.rasterfile):
+		os.remove(instance.rasterfile)
+
 class RasterCache(models.Model):
 	"""
 	Model for caching analysis results
@@ -262,6 +292,8 @@ class ScheduledTask(models.Model):
 	completed_on = models.DateTimeField(blank=True, null=True)
 	notified_owner = models.BooleanField(default=False)
 	notified_on = models.DateTimeField(blank=True, null=True)
+	estimated_cost = models.FloatField(blank=True, null=True, help_text=_("Estimated cost of the task used to select its queue. See ldms.utils.cost_util"))
+	progress = models.TextField(blank=True, null=True, help_text=_("Running stage and durations of the stages of the task as JSON. See ldms.utils.instrument_util"))
 
 class SystemSettings(models.Model):
 	"""Singleton Django Model
@@ -304,6 +336,10 @@ class SystemSettings(models.Model):
 	backend_url = models.CharField(_("Backend url"), max_length=255, default='http://127.0.0.1/', null=True, help_text=_("Url of the backend. Do NOT include the port"))
 	backend_port = models.IntegerField(_("Backend port"), default=80, help_text=_("Port from which the system is served"))
 	enable_tiles = models.BooleanField(default=False, blank=True, help_text=_("If enabled, a WMS link will be returned for all analysis to allow rendering of tiles"))
+	enable_block_processing = models.BooleanField(default=False, blank=True, help_text=_("If enabled, supported analysis will clip, compute and write rasters block by block so that memory usage is bounded by the window budget instead of the size of the area of interest"))
+	block_processing_window_budget = models.IntegerField(default=1048576, help_text=_("Maximum number of pixels per block when block processing is enabled"))
+	enable_parallel_stages = models.BooleanField(default=False, blank=True, help_text=_("If enabled, the independent sub-indicators of composite indicators (Productivity, ESAI and Land Degradation) will be computed in parallel processes"))
+	max_stage_workers = models.IntegerField(default=0, help_text=_("Maximum number of processes used to compute sub-indicators in parallel. 0 means the number of CPUs"))
 	 
 	class Meta:
 		abstract = False # True
@@ -1,7 +1,10 @@
 import django_rq
 import redis
+from rq.job import JobStatus
 
 from ldms.tasks import add_numbers
+from ldms.utils.cost_util import get_queue_for_cost
+from ldms.utils.metrics_util import count_enqueued_job
 
 # http://peter-hoffmann.com/2012/python-simple-queue-redis-queue.html
 # https://levelup.gitconnected.com/unleashing-the-power-of-redis-x-django-1c84b716679b
@@ -45,21 +48,21 @@ class RedisQueue(object):
         """
         Queue task to the default duration queue
         """
-        self.enqueue_medium(func, *args, **kwargs)
+        return self.enqueue_medium(func, *args, **kwargs)
 
     def enqueue_high(self, func, *args, **kwargs):
         """
         Queue task to the high duration queue
         """
         queue = self._get_queue('high')
-        self._enqueue(queue, func, *args, **kwargs)
+        return self._enqueue(queue, func, *args, **kwargs)
 
     def enqueue_low(self, func, *args, **kwargs):
         """
         Queue task to the low duration queue
         """
         queue = self._get_queue('low')
-        self._enqueue(queue, func, *args, **kwargs)
+        return self._enqueue(queue, func, *args, **kwargs)
 
     def enqueue_medium(self, func, *args, **kwargs):
         """
@@ -67,14 +70,56 @@ class RedisQueue(object):
         """
         print ("Enqueuing...")
         queue = self._get_queue('default')
-        self._enqueue(queue, func, *args, **kwargs)
+        job = self._enqueue(queue, func, *args, **kwargs)
         print ("Enqueued..")
+        return job
+
+    def enqueue_by_cost(self, cost, func, *args, **kwargs):
+        """
+        Queue task to the duration queue matching its estimated cost, with a job timeout
+        that grows with the cost. The cost is saved in `job.meta['estimated_cost']`
+
+        Args:
+            cost (float): Estimated cost of the task. See `ldms.utils.cost_util.estimate_job_cost`
+        """
+        queue_name, timeout = get_queue_for_cost(cost)
+        if timeout and 'job_timeout' not in kwargs:
+            kwargs['job_timeout'] = timeout
+        meta = kwargs.pop('meta', None) or {}
+        meta['estimated_cost'] = cost
+        return self._enqueue(self._get_queue(queue_name), func, *args, meta=meta, **kwargs)
+
+    def create_by_cost(self, cost, func, job_id, meta=None, **kwargs):
+        """
+        Create a deferred job on the duration queue matching its estimated cost. The job
+        only runs once it is passed to `enqueue_deferred`
+
+        Returns:
+            tuple(string, Job): Name of the queue and the job
+        """
+        queue_name, timeout = get_queue_for_cost(cost)
+        queue = self._get_queue(queue_name)
+        meta = meta or {}
+        meta['estimated_cost'] = cost
+        job = queue.create_job(func, kwargs=kwargs, timeout=timeout, job_id=job_id,
+                        meta=meta, status=JobStatus.DEFERRED)
+        job.save()
+        return (queue_name, job)
+
+    def enqueue_deferred(self, queue_name, job_id):
+        """
+        Queue a job created by `create_by_cost`
+        """
+        queue = self._get_queue(queue_name)
+        count_enqueued_job(queue_name)
+        return queue.enqueue_job(queue.fetch_job(job_id))
 
     def _enqueue(self, queue, func, *args, **kwargs):
         """
         Queue task
         """
-        queue.enqueue(func, *args, **kwargs)
+        count_enqueued_job(queue.name)
+        return queue.enqueue(func, *args, **kwargs)
 
     def _get_queue(self, queue_name):
         """Get queue"""
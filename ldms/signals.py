@@ -1,11 +1,12 @@
-from ldms.models import Raster
-from django.db.models.signals import post_save
+from ldms.models import Raster, RegionalAdminLevel, AdminLevelZero, AdminLevelOne, AdminLevelTwo
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 from django.contrib.gis.gdal import GDALRaster
 from django.conf import settings
 from ldms.utils.file_util import file_exists, get_media_dir
 from pathlib import Path
 from ldms.utils.raster_util import get_raster_object 
+from ldms.utils.admin_raster_util import get_admin_level, invalidate_raster, invalidate_admin_unit
 
 # from cmdbox.profiles.models import Profile
 
@@ -38,4 +39,32 @@ def generate_raster_metadata(sender, instance, **kwargs):
 			"srid" : rst.srs.srid, 
 			# "max_zoom" : rst.x
 		}
-		Raster.objects.filter(id=instance.id).update(**vals)
\ No newline at end of file
+		Raster.objects.filter(id=instance.id).update(**vals)
+
+@receiver(post_save, sender=Raster)
+def invalidate_admin_unit_rasters(sender, instance, **kwargs):
+	"""
+	Invalidate rasters pre-clipped to administrative units if the raster file has changed
+	"""
+	invalidate_raster(instance)
+
+@receiver(post_save, sender=RegionalAdminLevel)
+@receiver(post_save, sender=AdminLevelZero)
+@receiver(post_save, sender=AdminLevelOne)
+@receiver(post_save, sender=AdminLevelTwo)
+def invalidate_admin_unit_geometry(sender, instance, created, **kwargs):
+	"""
+	Invalidate rasters pre-clipped to an administrative unit if its geometry has changed
+	"""
+	if not created:
+		invalidate_admin_unit(get_admin_level(sender), instance)
+
+@receiver(post_delete, sender=RegionalAdminLevel)
+@receiver(post_delete, sender=AdminLevelZero)
+@receiver(post_delete, sender=AdminLevelOne)
+@receiver(post_delete, sender=AdminLevelTwo)
+def delete_admin_unit_rasters(sender, instance, **kwargs):
+	"""
+	Delete rasters pre-clipped to a deleted administrative unit
+	"""
+	invalidate_admin_unit(get_admin_level(sender), instance, deleted=True)
@@ -1,15 +1,48 @@
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from django.urls import include, path
-from ldms.models import AdminLevelZero, AdminLevelOne, AdminLevelTwo
+from ldms.models import AdminLevelZero, AdminLevelOne, AdminLevelTwo, Raster, AdminUnitRaster
 
 from rest_framework.test import APITestCase, RequestsClient, URLPatternsTestCase
 from ldms.utils.common_util import get_random_string, get_random_int
 import numpy as np
 import numpy.ma as ma
 from ldms.analysis.productivity import Productivity
+from ldms.utils.trend_util import compute_trend
+from ldms.utils.raster_util import (reclassify_by_matrix, reclassify_combinations, get_block_windows, RasterStack,
+				get_class_counts, get_block_counts, accumulate_masked, get_raw_result, is_raw_result)
+import rasterio
+from rasterio.transform import from_origin
+from ldms.utils.raster_cache_util import ClippedRasterCache, is_temp_file
+from ldms.utils.memo_util import ComputationMemo
+from ldms.utils.cache_util import generate_cache_key
+from ldms.utils.json_util import encode_result
+from ldms.utils.cost_util import get_year_count, get_queue_for_cost, get_worker_queues
+from ldms.utils.tile_util import split_vector
+from rq.job import JobStatus
+from ldms.utils.zonal_util import get_zonal_counts, get_zonal_percentiles, get_zone_layers, rasterize_zones
+from ldms.utils import (instrument_util, metrics_util, log_util, timeseries_util, scratch_util, admin_raster_util,
+				parallel_util, redis_cache, singleflight_util, tile_util, zonal_util, raster_util)
+from ldms.analysis import analysis_router, medalus
+from ldms.utils.settings_util import get_settings
+from ldms.utils.vector_util import get_geometry_hash
+from ldms.utils.dtype_util import get_class_dtype, to_class_dtype, to_continuous
+from unittest import mock
+from django.contrib.gis.geos import GEOSGeometry, Polygon, MultiPolygon
+from django.core.management import call_command
+from scipy import stats
+import tempfile
+import logging
+import shutil
 from django.conf import settings
 
 import json
+import os
+import io
+import zlib
+import pickle
+import queue
+import threading
+import time
 
 class ProductivityTest(TestCase):
 	def setUp(self):
@@ -237,4 +270,1148 @@ class ProductivityTest(TestCase):
 				expected_mapping, 
 				result),
 				"Mapping not matching"
-		)
\ No newline at end of file
+		)
+
+class TrendTest(TestCase):
+	def test_trend_matches_scipy(self):
+		"""
+		Test that the vectorized slope and pvalue match linregress and kendalltau
+		"""
+		time_array = list(range(2001, 2011))
+		rasters = np.array([
+			[[1, 5], [7, 3]],
+			[[2, 5], [6, 3]],
+			[[3, 5], [8, 2]],
+			[[5, 5], [5, 3]],
+			[[4, 5], [4, 1]],
+			[[6, 5], [6, 3]],
+			[[7, 5], [3, 2]],
+			[[9, 5], [2, 3]],
+			[[8, 5], [1, 1]],
+			[[10, 5], [1, 3]],
+		])
+		slope, pvalue = compute_trend(rasters, time_array, settings.DEFAULT_NODATA)
+		for row in range(2):
+			for col in range(2):
+				data = rasters[:, row, col]
+				expected_slope = stats.linregress(time_array, data)[0]
+				tau, expected_pvalue = stats.kendalltau(time_array, data)
+				self.assertAlmostEqual(slope[row, col], expected_slope)
+				if np.isnan(expected_pvalue):
+					self.assertTrue(np.isnan(pvalue[row, col]), "Constant series should have nan pvalue")
+				else:
+					self.assertAlmostEqual(pvalue[row, col], expected_pvalue)
+
+	def test_trend_with_missing_data(self):
+		"""
+		Test that pixels with nodata in any period are set to nodata
+		"""
+		nodata = settings.DEFAULT_NODATA
+		rasters = [
+			np.array([[1, nodata]]),
+			np.array([[2, 3]]),
+			np.array([[3, 4]]),
+		]
+		slope, pvalue = compute_trend(rasters, [2001, 2002, 2003], nodata)
+		self.assertEquals(slope[0, 1], nodata)
+		self.assertEquals(pvalue[0, 1], nodata)
+		self.assertAlmostEqual(slope[0, 0], 1.0)
+
+
+class ReclassifyTest(TestCase):
+	def test_reclassify_by_matrix(self):
+		"""
+		Test that overlapping rows are resolved in favour of the last row and
+		that gaps, nan and nodata values are assigned nodata
+		"""
+		nodata = settings.DEFAULT_NODATA
+		matrix = [
+			{'low': settings.MIN_INT, 'high': 1, 'mapping': 1},
+			{'low': 1, 'high': 5, 'mapping': 2},
+			{'low': 3, 'high': 10, 'mapping': 3},
+			{'low': 20, 'high': settings.MAX_INT, 'mapping': 4},
+		]
+		raster = np.array([
+			[-3, 1, 4.9],
+			[10, 15, 20],
+			[np.nan, nodata, 2.5]
+		])
+		expected = np.array([
+			[1, 2, 3],
+			[nodata, nodata, 4],
+			[nodata, nodata, 2]
+		])
+		self.assertTrue(np.array_equal(reclassify_by_matrix(raster, matrix, nodata), expected))
+
+	def test_reclassify_combinations(self):
+		"""
+		Test mapping of combinations of class values
+		"""
+		nodata = settings.DEFAULT_NODATA
+		matrix = [
+			{'base': 1, 'curr': 1, 'mapping': 1},
+			{'base': 1, 'curr': 2, 'mapping': 2},
+			{'base': 2, 'curr': 1, 'mapping': 3},
+		]
+		base = np.array([[1, 1, 2, nodata]])
+		curr = np.array([[1, 2, 1, 1]])
+		result = reclassify_combinations([base, curr], ['base', 'curr'], matrix, nodata)
+		self.assertTrue(np.array_equal(result, np.array([[1, 2, 3, nodata]])))
+
+	def test_block_windows(self):
+		"""
+		Test that block windows cover the raster without exceeding the window budget
+		"""
+		for height, width, budget in [(7, 5, 10), (7, 5, 4), (1, 1, 100)]:
+			covered = np.zeros((height, width), dtype=int)
+			for window in get_block_windows(height, width, budget):
+				self.assertTrue(window.width * window.height <= budget)
+				covered[window.row_off:window.row_off + window.height, 
+						window.col_off:window.col_off + window.width] += 1
+			self.assertTrue(np.all(covered == 1))
+
+class ClassCountsTest(TestCase):
+	def test_class_counts(self):
+		"""
+		Test that class counts match np.unique for class maps, wide ranges, floats and blocks
+		"""
+		arrays = [np.array([[1, 2, 2], [3, 255, 255]], dtype=np.int32),
+				np.array([-3, 0, 70000, -3], dtype=np.int64),
+				np.array([0.5, 0.5, 1.25])]
+		for arry in arrays:
+			unique, counts = np.unique(arry, return_counts=True)
+			self.assertEquals(get_class_counts(arry), dict(zip(unique.tolist(), counts.tolist())))
+
+		masked = ma.masked_equal(np.array([1, 1, 2, 255]), 255)
+		self.assertEquals(get_class_counts(masked), {1: 2, 2: 1})
+
+		val_counts = {}
+		get_class_counts(np.array([1, 2]), val_counts)
+		get_class_counts(np.array([2, 3]), val_counts)
+		self.assertEquals(val_counts, {1: 1, 2: 2, 3: 1})
+
+class ClippedRasterCacheTest(TestCase):
+	def setUp(self):
+		self.location = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.location, ignore_errors=True)
+
+	def write_file(self, size):
+		fd, file = tempfile.mkstemp(suffix=".tif", dir=self.location)
+		with os.fdopen(fd, "wb") as fp:
+			fp.write(b"0" * size)
+		return file
+
+	def test_cache_eviction(self):
+		"""
+		Test that least recently used entries are evicted once the budgets are exceeded
+		"""
+		cache = ClippedRasterCache(location=os.path.join(self.location, "cache"), 
+								max_bytes=250, memory_max_bytes=16)
+		array = np.zeros((1, 1), dtype=np.int64)
+		cache.set("a", array, self.write_file(100), 255)
+		cache.set("b", array, self.write_file(100), 255)
+		self.assertEquals(cache.get("a")[2], 255) # "a" is now the most recently used entry
+		os.utime(cache.get_file_path("b"), (0, 0))
+		cache.set("c", array, self.write_file(100), 255)
+		self.assertTrue(os.path.exists(cache.get_file_path("a")))
+		self.assertFalse(os.path.exists(cache.get_file_path("b")))
+		self.assertIsNone(cache.get("b"))
+		self.assertEquals(list(cache.memory.keys()), ["a", "c"])
+
+	def test_private_paths(self):
+		"""
+		Test that clipped files are moved to the cache and that the returned paths remain 
+		valid after their entry has been evicted
+		"""
+		cache = ClippedRasterCache(location=os.path.join(self.location, "cache"), 
+								max_bytes=150, memory_max_bytes=16)
+		array = np.zeros((1, 1), dtype=np.int64)
+		out_file = self.write_file(100)
+		private_file = cache.set("a", array, out_file, 255)
+		self.assertFalse(os.path.exists(out_file))
+		self.assertNotEqual(private_file, cache.get_file_path("a"))
+		hit_file = cache.get("a")[1]
+		os.utime(cache.get_file_path("a"), (0, 0))
+		cache.set("b", array, self.write_file(100), 255)
+		self.assertFalse(os.path.exists(cache.get_file_path("a")))
+		for file in [private_file, hit_file]:
+			self.assertEquals(os.path.getsize(file), 100)
+			os.remove(file)
+
+	def test_temp_sources_not_cached(self):
+		"""
+		Test that rasters in the temp dir e.g reprojected rasters are clipped without being cached
+		"""
+		self.assertTrue(is_temp_file(os.path.join(tempfile.gettempdir(), "reprojected.tif")))
+		self.assertFalse(is_temp_file(os.path.join(settings.MEDIA_ROOT, "lulc.tif")))
+		source = os.path.join(self.location, "reprojected.tif")
+		with rasterio.open(source, "w", driver="GTiff", height=4, width=4, count=1, dtype=np.int16, 
+						crs="EPSG:4326", transform=from_origin(0, 4, 1, 1), nodata=-1) as dst:
+			dst.write(np.ones((4, 4), dtype=np.int16), 1)
+		cache = mock.Mock()
+		with mock.patch.object(raster_util, "get_clip_cache", return_value=cache):
+			array, out_file, nodata = raster_util.clip_raster_to_vector(source, Polygon.from_bbox((0, 0, 2, 2)).geojson)
+		self.assertEquals(array.shape, (1, 2, 2))
+		cache.get.assert_not_called()
+		cache.set.assert_not_called()
+		os.remove(out_file)
+
+class AdminUnitRasterTest(TestCase):
+	def setUp(self):
+		self.location = tempfile.mkdtemp()
+		self.source_file = os.path.join(self.location, "source.tif")
+		self.nodata = -32768
+		with rasterio.open(self.source_file, "w", driver="GTiff", height=4, width=4, count=1, dtype=np.int16, 
+						crs="EPSG:4326", transform=from_origin(0, 4, 1, 1), nodata=self.nodata) as dst:
+			dst.write(np.arange(16, dtype=np.int16).reshape(4, 4), 1)
+		self.raster = Raster.objects.create(name="source", raster_year=2000, rasterfile=self.source_file)
+		geom = MultiPolygon(Polygon.from_bbox((0, 0, 2, 2)))
+		geom.srid = 4326
+		self.unit = AdminLevelZero.objects.create(gid_0="TST", name_0="Test", geom=geom)
+		self.vector = self.unit.geom.geojson
+		self.clipping_algorithm = get_settings().raster_clipping_algorithm
+		admin_raster_util.reset_stored_sources()
+
+	def tearDown(self):
+		admin_raster_util.reset_stored_sources()
+		shutil.rmtree(self.location, ignore_errors=True)
+
+	def get_stored(self):
+		return admin_raster_util.get_admin_unit_raster(self.source_file, self.vector, 
+									self.nodata, self.clipping_algorithm)
+
+	def test_precompute_and_lookup(self):
+		"""
+		Test that the command stores the clipped raster and that clipping to the unit returns it
+		"""
+		self.assertIsNone(self.get_stored())
+		with override_settings(MEDIA_ROOT=self.location):
+			call_command("precompute_admin_rasters", "--raster", str(self.raster.id), "--level", "0", stdout=io.StringIO())
+		entry = AdminUnitRaster.objects.get(raster=self.raster, admin_level=0, admin_unit_id=self.unit.id)
+		self.assertTrue(os.path.exists(entry.rasterfile))
+		self.assertEquals(entry.geometry_hash, get_geometry_hash(self.vector))
+
+		admin_raster_util.reset_stored_sources() # as if the command ran in another process
+		out_image, out_file, nodata = self.get_stored()
+		self.assertEquals(out_file, entry.rasterfile)
+		self.assertEquals(nodata, self.nodata)
+		self.assertEquals(out_image[0].tolist(), [[8, 9], [12, 13]])
+
+	def test_invalidation(self):
+		"""
+		Test that entries whose source raster changed or whose file is missing are deleted
+		"""
+		with override_settings(MEDIA_ROOT=self.location):
+			admin_raster_util.precompute_admin_unit_rasters(raster_ids=[self.raster.id], admin_levels=[0])
+		entry = AdminUnitRaster.objects.get(raster=self.raster)
+		AdminUnitRaster.objects.filter(id=entry.id).update(source_modified=0)
+		self.assertIsNone(self.get_stored())
+		self.assertFalse(AdminUnitRaster.objects.filter(id=entry.id).exists())
+		self.assertFalse(os.path.exists(entry.rasterfile))
+
+		with override_settings(MEDIA_ROOT=self.location):
+			admin_raster_util.precompute_admin_unit_rasters(raster_ids=[self.raster.id], admin_levels=[0])
+		entry = AdminUnitRaster.objects.get(raster=self.raster)
+		os.remove(entry.rasterfile)
+		self.assertIsNone(self.get_stored())
+		self.assertFalse(AdminUnitRaster.objects.filter(id=entry.id).exists())
+
+	@override_settings(ADMIN_RASTER_STORE={'ENABLED': False})
+	def test_disabled_store(self):
+		"""
+		Test that the store is not queried when it is disabled
+		"""
+		with mock.patch.object(admin_raster_util, "get_stored_sources") as get_stored_sources:
+			self.assertIsNone(self.get_stored())
+		get_stored_sources.assert_not_called()
+
+class RasterStackTest(TestCase):
+	def write_raster(self, arry, transform, nodata):
+		fd, file = tempfile.mkstemp(suffix=".tif")
+		os.close(fd)
+		with rasterio.open(file, "w", driver="GTiff", height=arry.shape[0], width=arry.shape[1], count=1,
+						dtype=arry.dtype, crs="EPSG:4326", transform=transform, nodata=nodata) as dst:
+			dst.write(arry, 1)
+		return file
+
+	def test_stack_alignment(self):
+		"""
+		Test that rasters with different extents and resolutions are aligned to the first raster
+		"""
+		base = np.arange(100, dtype=np.int16).reshape(10, 10)
+		base[2, 3] = -1
+		# same area at half the resolution with one extra column on the west
+		coarse = np.arange(30, dtype=np.int16).reshape(5, 6)
+		files = [self.write_raster(base, from_origin(0, 10, 1, 1), -1),
+				self.write_raster(coarse, from_origin(-2, 10, 2, 2), -1)]
+		vector = json.dumps({"type": "Polygon", "coordinates": [[[1, 1], [9, 1], [9, 9], [1, 9], [1, 1]]]})
+		with RasterStack(files, vector) as stack:
+			rasters = stack.read()
+		self.assertEquals(rasters.shape, (2, 8, 8))
+		self.assertTrue(rasters.mask[0][1, 2]) # nodata is masked
+		self.assertEquals(rasters[0][0, 0], base[1, 1])
+		self.assertEquals(rasters[1][0, 0], coarse[0, 1])
+		self.assertEquals(rasters[1][7, 7], coarse[4, 5])
+		for file in files:
+			os.remove(file)
+
+class MedalusTest(TestCase):
+	def test_in_memory_esai(self):
+		"""
+		Test that the sub-indicators of ESAI are passed in memory without building the values of 
+		CQI as a string
+		"""
+		nodata = 255
+		indicator = medalus.Medalus(start_year=2015, end_year=2020, return_raw=True)
+		model = mock.Mock(resolution=250)
+		def get_raw(**kwargs):
+			return get_raw_result(np.array([[1, 2], [2, nodata]], dtype=np.uint8), nodata, 250, "meta.tif")
+		aridity, rainfall = np.array([[1., 1.5], [2., nodata]]), np.array([[1., 1.], [1.5, nodata]])
+		with mock.patch.object(indicator, "get_vector", return_value=("vector", None)), \
+				mock.patch.object(indicator, "get_raster_model", return_value=(model, None)), \
+				mock.patch.object(indicator, "validate_periods", return_value=(2015, 2020, None)), \
+				mock.patch.object(indicator, "get_cqi_raster_models", return_value=(model, model, None)), \
+				mock.patch.object(indicator, "read_rasters", return_value=([aridity, rainfall], nodata, "meta.tif")), \
+				mock.patch.object(indicator, "calculate_soil_quality_index", side_effect=get_raw), \
+				mock.patch.object(indicator, "calculate_vegetation_quality_index", side_effect=get_raw), \
+				mock.patch.object(indicator, "calculate_management_quality_index", side_effect=get_raw), \
+				mock.patch.object(medalus, "get_raster_meta", return_value={'nodata': nodata}), \
+				mock.patch.object(parallel_util, "get_settings", return_value=mock.Mock(enable_parallel_stages=False)), \
+				mock.patch.object(medalus, "return_raster_with_stats", wraps=medalus.return_raster_with_stats) as stats_func:
+			res = indicator.calculate_esai()
+		self.assertIsNone(indicator.error)
+		self.assertTrue(is_raw_result(res))
+		self.assertEquals(res['datasource'].shape, (2, 2))
+		self.assertEquals(res['datasource'][1, 1], nodata)
+		self.assertEquals([x[1]['prefix'] for x in stats_func.call_args_list], ["cqi", "esai"])
+		for args in stats_func.call_args_list:
+			self.assertTrue(args[1]['return_raw'])
+			self.assertNotIn('raw_raster', args[1].get('extras', {}))
+
+class ComputationMemoTest(TestCase):
+	def test_memo(self):
+		"""
+		Test that a computation with the same parameters only runs once
+		"""
+		memo = ComputationMemo()
+		calls = []
+		def compute():
+			calls.append(1)
+			return len(calls)
+		self.assertEquals(memo.get_or_compute("lulc", {'start': 2001, 'end': 2010}, None, compute), 1)
+		self.assertEquals(memo.get_or_compute("lulc", {'end': 2010, 'start': 2001}, None, compute), 1)
+		self.assertEquals(memo.get_or_compute("lulc", {'start': 2001, 'end': 2011}, None, compute), 2)
+		self.assertEquals(memo.hits, 1)
+
+class ParallelStagesTest(TestCase):
+	class Indicator:
+		error = None
+
+	def get_settings(self, enabled):
+		return mock.patch.object(parallel_util, "get_settings", 
+					return_value=mock.Mock(enable_parallel_stages=enabled, max_stage_workers=2))
+
+	def test_sequential_stages(self):
+		"""
+		Test that sequential stages return (result, error) tuples and stop at the first error
+		"""
+		indicator = self.Indicator()
+		calls = []
+		def compute(value):
+			calls.append(value)
+			if value == "fail":
+				indicator.error = "Failed"
+			return value
+		stages = [parallel_util.stage(indicator, compute, x) for x in ["a", "fail", "b"]]
+		with self.get_settings(False):
+			results = parallel_util.run_stages(stages)
+		self.assertEquals(results, [("a", None), (None, "Failed")])
+		self.assertEquals(calls, ["a", "fail"])
+
+	def test_nested_stages(self):
+		"""
+		Test that stages run in forked processes and that their nested stages run in-process
+		"""
+		indicator = self.Indicator()
+		def compute():
+			nested = parallel_util.run_stages([parallel_util.stage(indicator, os.getpid)])
+			return (os.getpid(), nested[0][0], parallel_util.get_stage_workers())
+		stages = [parallel_util.stage(indicator, compute) for i in range(2)]
+		# the connection of the test transaction must not be closed
+		with self.get_settings(True), mock.patch.object(parallel_util.db.connections, "close_all"):
+			results = parallel_util.run_stages(stages)
+		for (pid, nested_pid, workers), error in results:
+			self.assertIsNone(error)
+			self.assertNotEqual(pid, os.getpid())
+			self.assertEquals(nested_pid, pid)
+			self.assertEquals(workers, 0)
+
+class CacheKeyTest(TestCase):
+	def test_equivalent_payloads(self):
+		"""
+		Test that equivalent payloads give the same cache key
+		"""
+		key = generate_cache_key({'vector': 5, 'admin_level': 0, 'start_year': 2015, 'end_year': 2020, 
+						'show_change': 1, 'cached': 1}, "/api/lulc/")
+		self.assertEquals(key, generate_cache_key({'vector': "5", 'admin_level': "0", 'start_year': "2015", 
+						'end_year': 2020.0, 'show_change': True, 'cached': "true", 
+						'transform': "area", 'raster_source': "LULC"}, "/api/lulc/"))
+		self.assertNotEqual(key, generate_cache_key({'vector': 5, 'admin_level': 0, 'start_year': 2015, 
+						'end_year': 2020, 'show_change': 1}, "/api/soc/"))
+		self.assertNotEqual(key, generate_cache_key({'vector': 5, 'admin_level': 0, 'start_year': 2015, 
+						'end_year': 2020, 'show_change': "true"}, "/api/lulc/"))
+
+	def test_equivalent_geometries(self):
+		"""
+		Test that the same polygon written with a different precision or starting vertex gives the same key
+		"""
+		coords = [[36.1, -1.2], [36.3, -1.2], [36.3, -1.4], [36.1, -1.4], [36.1, -1.2]]
+		shifted = [[36.30000000001, -1.2], [36.3, -1.4], [36.1, -1.4], [36.1, -1.2], [36.3, -1.2]]
+		key = generate_cache_key({'custom_coords': json.dumps({"type": "Polygon", "coordinates": [coords]})}, "/api/lulc/")
+		self.assertEquals(key, generate_cache_key({'custom_coords': json.dumps({"type": "Polygon", 
+						"coordinates": [shifted]})}, "/api/lulc/"))
+
+class ResultEncoderTest(TestCase):
+	def test_numpy_values(self):
+		"""
+		Test that results with numpy values are encoded like plain Python values
+		"""
+		res = {'base': 2015, 'nodata': np.int64(255), 'rasterfile': "a.tif",
+				'stats': [{'change_type': np.uint8(1), 'count': np.int64(10), 'area': np.float64(2.5),
+						'mean': np.float32(0.1)}],
+				'raw': np.array([[1, 2], [3, 4]], dtype=np.int16)}
+		self.assertEquals(json.loads(encode_result(res)), {'base': 2015, 'nodata': 255, 'rasterfile': "a.tif",
+				'stats': [{'change_type': 1, 'count': 10, 'area': 2.5, 'mean': 0.1}],
+				'raw': [[1, 2], [3, 4]]})
+		self.assertEquals(json.loads(encode_result({np.int64(1): 2})), {"1": 2})
+		self.assertEquals(encode_result('{"a": 1}'), '{"a": 1}')
+
+class JobCostTest(TestCase):
+	def test_year_count(self):
+		"""
+		Test that time series indicators count every year while others count the end years
+		"""
+		self.assertEquals(get_year_count("productivity", {'start_year': 2001, 'end_year': "2015"}), 15)
+		self.assertEquals(get_year_count("lulc", {'start_year': 2001, 'end_year': 2015}), 2)
+		self.assertEquals(get_year_count("lulc", {'end_year': 2015}), 1)
+
+	@override_settings(JOB_COST_ROUTING={'ENABLED': True, 'QUEUES': [('low', 10), ('default', 200), ('high', None)],
+						'SECONDS_PER_UNIT': 1.0, 'TIMEOUT_FACTOR': 4, 'MAX_JOB_TIMEOUT': 3600})
+	def test_queue_for_cost(self):
+		"""
+		Test that jobs are routed by cost and that their timeout grows with the cost
+		"""
+		self.assertEquals(get_queue_for_cost(None), ('default', None))
+		self.assertEquals(get_queue_for_cost(1)[0], 'low')
+		self.assertEquals(get_queue_for_cost(150), ('default', 600))
+		self.assertEquals(get_queue_for_cost(100000)[0], 'high')
+		self.assertEquals(get_queue_for_cost(100000)[1], 3600)
+
+	def test_worker_queues(self):
+		"""
+		Test that the cheapest jobs are routed to the first queue the workers listen on
+		"""
+		queues = get_worker_queues()
+		self.assertEquals(get_queue_for_cost(0)[0], queues[0])
+		self.assertEquals(get_queue_for_cost(10 ** 9)[0], queues[-1])
+		for file in ["compose/run_rq.sh", "deploy/supervisor_dev.conf", "deploy/supervisor_prod.conf", 
+					"Dockerfile.prod", "Dockerfile_2.prod", "Dockerfile_old.prod"]:
+			with open(os.path.join(settings.BASE_DIR, file)) as f:
+				command = [x for x in f.read().split("\n") if "manage.py rqworker" in x][0]
+			listened = command.split("rqworker")[1].split("&&")[0].strip('" ').split()
+			self.assertEquals(listened, queues, file)
+
+class TileSplitTest(TestCase):
+	def test_split_vector(self):
+		"""
+		Test that the tiles of a polygon cover it without overlapping
+		"""
+		vector = json.dumps({"type": "Polygon", "coordinates": [[[36, -1], [41, -1], [41, 2], [36, 2], [36, -1]]]})
+		tiles = split_vector(vector, 2)
+		self.assertEquals(len(tiles), 6)
+		self.assertAlmostEquals(sum([GEOSGeometry(x).area for x in tiles]), GEOSGeometry(vector).area)
+		self.assertEquals(len(split_vector(vector, 10)), 1)
+
+class TiledJobsTest(TestCase):
+	def setUp(self):
+		self.location = tempfile.mkdtemp()
+		media = self.settings(MEDIA_ROOT=self.location)
+		media.enable()
+		self.addCleanup(media.disable)
+		self.client = FakeRedis()
+		patcher = mock.patch.object(tile_util.django_rq, "get_connection", return_value=self.client)
+		patcher.start()
+		self.addCleanup(patcher.stop)
+		self.run_id = get_random_string(length=20)
+		self.redis_queue = mock.Mock()
+		self.enqueue_deferred = self.redis_queue.return_value.enqueue_deferred
+
+	def tearDown(self):
+		shutil.rmtree(self.location, ignore_errors=True)
+
+	def get_result(self, array, west):
+		"""Get the raw result of a tile whose raster starts at `west`
+		"""
+		source = os.path.join(self.location, "source_%s.tif" % (west))
+		with rasterio.open(source, "w", driver="GTiff", height=array.shape[0], width=array.shape[1], count=1, 
+						dtype=np.int32, crs="EPSG:4326", transform=from_origin(west, 2, 1, 1), nodata=-1) as dst:
+			dst.write(array, 1)
+		return {'datasource': array, 'meta_path': source, 'nodata': -1, 'resolution': 250, 
+				'stats_args': {'prefix': "esai", 'start_year': 2015, 'end_year': 2020, 'extras': {'raw_raster': "[[1]]"}}}
+
+	def run_tile(self, index, get_medalus, retries_left=0):
+		"""Run the job of a tile. The merge job is queued with `self.redis_queue`
+		"""
+		with mock.patch.object(analysis_router, "get_current_job", return_value=mock.Mock(retries_left=retries_left)), \
+				mock.patch.object(analysis_router, "clone_post_request"), \
+				mock.patch.object(analysis_router, "get_medalus", get_medalus), \
+				mock.patch.object(analysis_router, "run_medalus"), \
+				mock.patch.object(analysis_router, "RedisQueue", self.redis_queue):
+			analysis_router.run_analysis_tile(analysis_router.esai, self.run_id, index, 2, tile=None, task_id=0, 
+							merge_queue="high", data={})
+
+	def test_resume(self):
+		"""
+		Test that tiles done by a previous attempt are skipped and that the merge is claimed once
+		"""
+		tile_util.save_tile(self.run_id, 0, self.get_result(np.ones((2, 2), dtype=np.int32), 0), None)
+		self.assertEquals(tile_util.load_tile(self.run_id, 0)['nodata'], -1)
+		self.assertIsNone(tile_util.load_tile(self.run_id, 1))
+		self.assertEquals(tile_util.count_done_tiles(self.run_id, 2), 1)
+
+		get_medalus = mock.Mock()
+		self.run_tile(0, get_medalus)
+		get_medalus.assert_not_called()
+		self.enqueue_deferred.assert_not_called() # tile 1 is not done
+
+		tile_util.save_tile(self.run_id, 1, None, "Failed")
+		self.run_tile(0, get_medalus)
+		self.enqueue_deferred.assert_called_once_with("high", self.run_id)
+		self.run_tile(1, get_medalus)
+		self.enqueue_deferred.assert_called_once() # the merge was already claimed
+		self.assertFalse(tile_util.claim_merge(self.run_id))
+		self.assertTrue(tile_util.claim_merge(get_random_string(length=20)))
+
+	def test_failed_tile(self):
+		"""
+		Test that a tile raising on its last attempt is checkpointed as failed and queues the merge
+		"""
+		tile_util.save_tile(self.run_id, 1, self.get_result(np.ones((2, 2), dtype=np.int32), 2), None)
+		get_medalus = mock.Mock(side_effect=ValueError("Failed"))
+		with self.assertRaises(ValueError):
+			self.run_tile(0, get_medalus, retries_left=1)
+		self.assertIsNone(tile_util.load_tile(self.run_id, 0))
+		self.enqueue_deferred.assert_not_called()
+
+		with self.assertRaises(ValueError):
+			self.run_tile(0, get_medalus, retries_left=0)
+		error = tile_util.load_tile(self.run_id, 0)['error']
+		self.assertTrue(error)
+		self.enqueue_deferred.assert_called_once_with("high", self.run_id)
+		self.assertEquals(tile_util.merge_tiles(None, self.run_id, 2), (None, error))
+
+	def test_killed_tile(self):
+		"""
+		Test that the watchdog checkpoints the tiles whose job died without raising as failed and 
+		queues the merge once no tile is pending
+		"""
+		tile_util.save_tile(self.run_id, 0, self.get_result(np.ones((2, 2), dtype=np.int32), 0), None)
+		statuses = {'tile0': JobStatus.FINISHED, 'tile1': JobStatus.STARTED}
+		def fetch(job_id, connection=None):
+			return mock.Mock(get_status=mock.Mock(return_value=statuses[job_id]))
+		with mock.patch.object(analysis_router.Job, "fetch", side_effect=fetch), \
+				mock.patch.object(analysis_router.django_rq, "get_scheduler") as get_scheduler, \
+				mock.patch.object(analysis_router, "RedisQueue", self.redis_queue):
+			analysis_router.check_tiles(self.run_id, ["tile0", "tile1"], task_id=0, merge_queue="high")
+			self.assertIsNone(tile_util.load_tile(self.run_id, 1))
+			self.enqueue_deferred.assert_not_called()
+			get_scheduler.return_value.enqueue_in.assert_called_once()
+
+			statuses['tile1'] = JobStatus.FAILED # the work-horse was killed on the last attempt
+			analysis_router.check_tiles(self.run_id, ["tile0", "tile1"], task_id=0, merge_queue="high")
+			self.assertTrue(tile_util.load_tile(self.run_id, 1)['error'])
+			self.enqueue_deferred.assert_called_once_with("high", self.run_id)
+			get_scheduler.return_value.enqueue_in.assert_called_once()
+
+			analysis_router.check_tiles(self.run_id, ["tile0", "tile1"], task_id=0, merge_queue="high")
+			self.enqueue_deferred.assert_called_once() # the merge was already claimed
+
+	def test_merge_tiles(self):
+		"""
+		Test that the tiles of a run are mosaicked and that missing tiles fail the merge
+		"""
+		tile_util.save_tile(self.run_id, 0, self.get_result(np.array([[1, 2], [3, -1]], dtype=np.int32), 0), None)
+		res, error = tile_util.merge_tiles(None, self.run_id, 2)
+		self.assertIsNone(res)
+		self.assertTrue(error)
+
+		tile_util.save_tile(self.run_id, 1, self.get_result(np.array([[5, 6], [7, 8]], dtype=np.int32), 2), None)
+		with mock.patch.object(tile_util, "return_raster_with_stats", return_value={'stats': []}) as stats_func:
+			res, error = tile_util.merge_tiles(None, self.run_id, 2)
+		self.assertIsNone(error)
+		self.assertEquals(res, {'stats': []})
+		kwargs = stats_func.call_args[1]
+		self.assertEquals(kwargs['datasource'].tolist(), [[1, 2, 5, 6], [3, -1, 7, 8]])
+		self.assertEquals((kwargs['nodata'], kwargs['prefix']), (-1, "esai"))
+		self.assertNotIn('extras', kwargs) # the extras of the first tile do not describe the whole area
+		tile_util.remove_run(self.run_id)
+		self.assertFalse(os.path.exists(tile_util.get_run_dir(self.run_id)))
+
+class InstrumentTest(TestCase):
+	def test_stages_outside_job(self):
+		"""
+		Test that stages run outside of a job are not recorded
+		"""
+		with instrument_util.timed_stage("clip") as info:
+			info['pixels'] += 10
+		self.assertIsNone(instrument_util.finish_progress())
+
+	def test_stage_totals(self):
+		"""
+		Test that the stages of a job are totalled by name
+		"""
+		job = mock.Mock(id="instrument-test", meta={})
+		with mock.patch.object(instrument_util, "get_current_job", return_value=job):
+			with instrument_util.timed_stage("esai"):
+				for i in range(3):
+					with instrument_util.timed_stage("clip") as info:
+						info['pixels'] += 10
+			progress = json.loads(instrument_util.finish_progress())
+		self.assertIsNone(progress['stage'])
+		self.assertEquals([x['name'] for x in progress['stages']], ["esai", "esai/clip"])
+		self.assertEquals(progress['stages'][1]['calls'], 3)
+		self.assertEquals(progress['stages'][1]['pixels'], 30)
+		self.assertEquals(job.meta['progress']['stages'], progress['stages'])
+
+class MetricsTest(TestCase):
+	def test_stage_metrics_outside_job(self):
+		"""
+		Test that stages are exported as metrics whether run within a job or not
+		"""
+		with mock.patch.object(instrument_util, "observe_stage") as observe:
+			with instrument_util.timed_stage("clip") as info:
+				info['pixels'] += 10
+				info['bytes_read'] += 40
+		self.assertEquals(observe.call_args[0][0], "clip")
+		self.assertEquals(observe.call_args[0][2:], (40, 10))
+
+	@override_settings(METRICS={'ENABLED': False})
+	def test_disabled_metrics(self):
+		"""
+		Test that the metrics are not exposed when disabled
+		"""
+		metrics_util.observe_analysis("lulc", 1.5)
+		response = self.client.get("/metrics/")
+		self.assertEquals(response.status_code, 404)
+
+	@override_settings(METRICS={'ENABLED': True, 'ALLOWED_NETWORKS': ["127.0.0.1/32", "10.0.0.0/8"]})
+	def test_metrics_access(self):
+		"""
+		Test that the metrics are only served to staff users and to the allowed networks
+		"""
+		with mock.patch("ldms.views.generate_metrics", return_value=(b"", "text/plain")):
+			self.assertEquals(self.client.get("/metrics/", REMOTE_ADDR="10.1.2.3").status_code, 200)
+			self.assertEquals(self.client.get("/metrics/", REMOTE_ADDR="203.0.113.5").status_code, 403)
+		staff = mock.Mock(is_staff=True)
+		self.assertTrue(metrics_util.is_metrics_client_allowed(mock.Mock(user=staff, META={})))
+		self.assertFalse(metrics_util.is_metrics_client_allowed(mock.Mock(user=None, META={'REMOTE_ADDR': "::2"})))
+
+	@override_settings(METRICS={'ENABLED': True, 'MULTIPROC_DIR': None})
+	def test_queue_collector_registered_on_scrape(self):
+		"""
+		Test that the depth of the queues is registered once, when the metrics are first scraped
+		"""
+		with mock.patch.object(metrics_util, "QUEUE_COLLECTOR", None), \
+				mock.patch.object(metrics_util.prometheus_client.REGISTRY, "register") as register:
+			metrics_util.get_registry()
+			metrics_util.get_registry()
+		register.assert_called_once()
+		self.assertIsInstance(register.call_args[0][0], metrics_util.QueueCollector)
+
+	@override_settings(METRICS={'ENABLED': True, 'MULTIPROC_DIR': "/tmp/metrics"})
+	def test_worker_marks_horse_dead(self):
+		"""
+		Test that the metrics of the work-horse of a job are marked dead once it exits
+		"""
+		worker = metrics_util.MetricsWorker.__new__(metrics_util.MetricsWorker)
+		worker._horse_pid = 42
+		with mock.patch.object(metrics_util.Worker, "monitor_work_horse", side_effect=ValueError("Killed")), \
+				mock.patch.object(metrics_util.multiprocess, "mark_process_dead") as mark_process_dead:
+			with self.assertRaises(ValueError):
+				worker.monitor_work_horse(None, None)
+		mark_process_dead.assert_called_once_with(42, path="/tmp/metrics")
+
+class LogContextTest(TestCase):
+	def test_context_fields(self):
+		"""
+		Test that records carry the fields of the enclosing log contexts
+		"""
+		record = logging.LogRecord("ldms", logging.INFO, __file__, 1, "message", None, None)
+		with log_util.log_context(request_id="req-1"):
+			with log_util.log_context(task_id=5):
+				log_util.ContextFilter().filter(record)
+		self.assertEquals((record.request_id, record.task_id, record.indicator), ("req-1", 5, "-"))
+		self.assertEquals(log_util.get_log_context(), {})
+
+	def test_flush_logs(self):
+		"""
+		Test that the records of a job are written once flushed, since its process exits without 
+		running atexit, and that failed jobs are logged
+		"""
+		location = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, location, ignore_errors=True)
+		log_files = {'LOGFILE': os.path.join(location, "main.log"), 'ERROR_LOGFILE': os.path.join(location, "error.log")}
+		with mock.patch.dict(os.environ, log_files):
+			log_util._stop_listeners()
+			log_util._pid = None # the loggers are built again as in the process of a job
+			self.addCleanup(setattr, log_util, "_pid", None)
+			self.addCleanup(log_util._stop_listeners)
+			with log_util.log_context(task_id=7):
+				log_util.log("Finished task")
+				try:
+					raise ValueError("Invalid raster")
+				except ValueError as e:
+					self.assertTrue(log_util.log_job_exception(mock.Mock(id="job-1"), ValueError, e, e.__traceback__))
+			log_util.flush_logs()
+		with open(log_files['LOGFILE']) as fl:
+			self.assertIn("Finished task | request=- task=7", fl.read())
+		with open(log_files['ERROR_LOGFILE']) as fl:
+			self.assertIn("Job job-1 failed: Invalid raster", fl.read())
+
+class ZonalStatsTest(TestCase):
+	def test_zonal_counts(self):
+		"""
+		Test that the pixels of each zone are counted separately
+		"""
+		datasource = np.array([[1, 1, 2], [2, 3, -1], [1, 2, 3]], dtype=np.int32)
+		zones = np.array([[1, 1, 2], [1, 2, 2], [0, 0, 2]], dtype=np.uint16)
+		counts = get_zonal_counts(datasource, zones, 2, -1)
+		self.assertEquals(counts[0], {1: 2, 2: 1})
+		self.assertEquals(counts[1], {2: 1, 3: 2, -1: 1})
+		float_counts = get_zonal_counts(datasource.astype(np.float32), zones, 2, -1)
+		self.assertEquals(float_counts[1], {2.0: 1, 3.0: 2, -1.0: 1})
+
+	def test_overlapping_zones(self):
+		"""
+		Test that the pixels shared by overlapping zones are counted in each of them
+		"""
+		vectors = [Polygon.from_bbox(x).geojson for x in [(0, 0, 2, 4), (1, 0, 3, 4), (3, 0, 4, 4)]]
+		self.assertEquals(get_zone_layers(vectors), [[0, 2], [1]])
+		touching = [Polygon.from_bbox(x).geojson for x in [(0, 0, 2, 4), (2, 0, 4, 4)]]
+		self.assertEquals(get_zone_layers(touching), [[0, 1]])
+		self.assertEquals(get_zone_layers(touching, all_touched=True), [[0], [1]])
+
+		fd, meta_path = tempfile.mkstemp(suffix=".tif")
+		os.close(fd)
+		self.addCleanup(os.remove, meta_path)
+		datasource = np.arange(16, dtype=np.int32).reshape(4, 4)
+		with rasterio.open(meta_path, "w", driver="GTiff", height=4, width=4, count=1, dtype=np.int32, 
+						crs="EPSG:4326", transform=from_origin(0, 4, 1, 1), nodata=-1) as dst:
+			dst.write(datasource, 1)
+		with mock.patch.object(zonal_util, "get_settings", 
+					return_value=mock.Mock(raster_clipping_algorithm="Intersects")):
+			zones = rasterize_zones(vectors, meta_path, (4, 4))
+		self.assertEquals(zones.shape, (2, 4, 4))
+		counts = get_zonal_counts(datasource, zones, 3, -1)
+		for i, columns in enumerate([[0, 1], [1, 2], [3]]):
+			self.assertEquals(counts[i], {x: 1 for x in datasource[:, columns].ravel().tolist()})
+
+	def test_zonal_percentiles(self):
+		"""
+		Test that the percentile of each zone matches np.percentile and skips masked values
+		"""
+		values = ma.masked_equal(np.array([[1., 9., 4.], [3., -1., 7.], [2., 5., 6.]]), -1)
+		zones = np.array([[1, 2, 1], [2, 2, 1], [-1, 3, 3]])
+		result = get_zonal_percentiles(values, zones, 90, zone_nodata=-1, fill_value=-1)
+		expected = {1: np.percentile([1, 4, 7], 90), 2: np.percentile([9, 3], 90), 3: np.percentile([5, 6], 90)}
+		self.assertEquals(result[0, 0], expected[1])
+		self.assertEquals(result[1, 1], expected[2])
+		self.assertEquals(result[2, 2], expected[3])
+		self.assertEquals(result[2, 0], -1)
+
+class BlockCountsTest(TestCase):
+	def test_edge_blocks(self):
+		"""
+		Test that the blocks on the edges are counted instead of truncated
+		"""
+		arr = np.arange(20).reshape(4, 5) % 2
+		counts, totals = get_block_counts(arr, (3, 3), [1])
+		self.assertEquals(counts[1].tolist(), [[4, 3], [2, 1]])
+		self.assertEquals(totals.tolist(), [[9, 6], [3, 2]])
+
+class VITimeSeriesCubeTest(TestCase):
+	def test_years_read_once(self):
+		"""
+		Test that each year is clipped once and aligned to the shape and nodata of the cube
+		"""
+		models = [mock.Mock(pk=i, raster_year=2000 + i, rasterfile=mock.Mock()) for i in range(3)]
+		rasters = [(np.full((2, 2), 1, dtype=np.int16), -1),
+				   (np.array([[2, -2, 2]], dtype=np.int16), -2),
+				   (np.full((2, 2), 3, dtype=np.int16), -1)]
+		with mock.patch.object(timeseries_util, "get_raster_models", return_value=models), \
+			 mock.patch.object(timeseries_util, "extract_pixels_using_vector",
+				side_effect=[(arr, nodata, None) for arr, nodata in rasters]) as extract:
+			cube = timeseries_util.VITimeSeriesCube("Modis", "NDVI", "{}")
+			self.assertEquals(cube.get_years(end_year=2001), [2000, 2001])
+			first = cube.get_rasters(2000, 2001)
+			second = cube.get_rasters(2001, 2002)
+		self.assertEquals(extract.call_count, 3)
+		self.assertEquals(second[0].tolist(), [[2, -1], [-1, -1]])
+		self.assertEquals(first[1].tolist(), second[0].tolist())
+		self.assertFalse(second[1].flags.writeable)
+
+class ScratchArrayTest(TestCase):
+	@override_settings(SCRATCH={'MEMMAP_THRESHOLD': 0, 'CHUNK_BYTES': 1})
+	def test_memmapped_operations(self):
+		"""
+		Test that operations on memory-mapped scratch arrays match the in-memory ones
+		"""
+		with scratch_util.scratch_scope() as directory:
+			self.assertTrue(isinstance(scratch_util.scratch_array((2, 2)), np.memmap))
+			rasters = [ma.masked_equal(np.array([[1., 2.], [-1., 4.]]), -1), 
+					   ma.masked_equal(np.array([[3., -1.], [5., 6.]]), -1)]
+			product = accumulate_masked(np.multiply, rasters, -1)
+			expected = np.ma.multiply(rasters[0], rasters[1])
+			self.assertEquals(product.mask.tolist(), expected.mask.tolist())
+			self.assertEquals(product.data.tolist(), expected.data.tolist())
+			mean = scratch_util.reduce_arrays(np.mean, rasters)
+			self.assertEquals(mean.tolist(), np.mean(rasters, axis=0).tolist())
+		self.assertFalse(os.path.exists(directory))
+
+class DtypeTest(TestCase):
+	def test_class_dtypes(self):
+		"""
+		Test that class maps are held in the smallest integer type holding their values and nodata
+		"""
+		nodata = settings.DEFAULT_NODATA
+		matrix = [{'low': settings.MIN_INT, 'high': 1, 'mapping': 1}, 
+				  {'low': 1, 'high': settings.MAX_INT, 'mapping': 2}]
+		out = reclassify_by_matrix(np.array([[0.5, 3.], [np.nan, 2.]]), matrix, nodata)
+		self.assertEquals(out.dtype, np.uint8)
+		self.assertEquals(out.tolist(), [[1, 2], [nodata, 2]])
+		self.assertEquals(get_class_dtype([-1, 3]), np.int16)
+		self.assertEquals(get_class_dtype([1, 1000]), np.uint16)
+		self.assertEquals(get_class_dtype([1.5, 2]), None)
+		self.assertEquals(to_class_dtype(np.array([1., 2.]), -32768).dtype, np.int16)
+		self.assertEquals(to_class_dtype(np.array([1., np.nan])).dtype, np.int32)
+		masked = ma.masked_equal(np.array([1, 2, nodata], dtype=np.int64), nodata)
+		self.assertEquals(to_class_dtype(masked, nodata).mask.tolist(), [False, False, True])
+		self.assertEquals(to_continuous(masked).dtype, np.float32)
+
+class FakeRedis:
+	"""
+	In-memory stand-in for the commands of redis.Redis used by the cache and the single-flight. 
+	Keys and values are returned as bytes. Timeouts are ignored and `eval` only runs the scripts 
+	of the cache and the release script of the single-flight
+	"""
+	def __init__(self):
+		self.data = {}
+		self.subscribers = {}
+
+	@staticmethod
+	def to_bytes(value):
+		return value if isinstance(value, bytes) else str(value).encode("utf-8")
+
+	def pipeline(self):
+		return FakePipeline(self)
+
+	def get(self, key):
+		return self.data.get(self.to_bytes(key))
+
+	def set(self, key, value, ex=None, nx=False):
+		if nx and self.to_bytes(key) in self.data:
+			return None
+		self.data[self.to_bytes(key)] = self.to_bytes(value)
+		return True
+
+	def exists(self, *keys):
+		return len([x for x in keys if self.to_bytes(x) in self.data])
+
+	def delete(self, *keys):
+		return len([self.data.pop(self.to_bytes(x)) for x in keys if self.to_bytes(x) in self.data])
+
+	def expire(self, key, timeout):
+		return self.exists(key)
+
+	def persist(self, key):
+		return self.exists(key)
+
+	def incrby(self, key, amount):
+		value = int(self.get(key) or 0) + amount
+		self.set(key, value)
+		return value
+
+	def decrby(self, key, amount):
+		return self.incrby(key, -amount)
+
+	def hash(self, key):
+		return self.data.setdefault(self.to_bytes(key), {})
+
+	def hget(self, key, field):
+		return self.hash(key).get(self.to_bytes(field))
+
+	def hset(self, key, field, value):
+		self.hash(key)[self.to_bytes(field)] = self.to_bytes(value)
+
+	def hmget(self, key, fields):
+		return [self.hget(key, x) for x in fields]
+
+	def hdel(self, key, *fields):
+		return len([self.hash(key).pop(self.to_bytes(x)) for x in fields if self.to_bytes(x) in self.hash(key)])
+
+	def zadd(self, key, mapping):
+		self.hash(key).update({self.to_bytes(x): score for x, score in mapping.items()})
+
+	def zrem(self, key, *members):
+		return self.hdel(key, *members)
+
+	def zrange(self, key, start, end):
+		members = sorted(self.hash(key), key=self.hash(key).get)
+		return members[start:end + 1 if end != -1 else None]
+
+	def zrangebyscore(self, key, low, high):
+		return [x for x in self.zrange(key, 0, -1) if low <= self.hash(key)[x] <= high]
+
+	def scan_iter(self, match):
+		return [x for x in self.data if x.startswith(self.to_bytes(match.rstrip("*")))]
+
+	def pubsub(self, ignore_subscribe_messages=False):
+		return FakePubSub(self)
+
+	def publish(self, channel, message):
+		subscribers = self.subscribers.get(self.to_bytes(channel), [])
+		for pubsub in subscribers:
+			pubsub.messages.put({'type': 'message', 'channel': self.to_bytes(channel), 
+								'data': self.to_bytes(message)})
+		return len(subscribers)
+
+	def eval(self, script, numkeys, *args):
+		keys, argv = args[:numkeys], args[numkeys:]
+		if script == redis_cache.SET_SCRIPT:
+			key, lru_key, sizes_key, bytes_key = keys
+			value, ttl, nx, now = argv
+			if nx == '1' and self.exists(key):
+				return 0
+			size = int(self.hget(sizes_key, key) or 0)
+			self.set(key, value)
+			self.zadd(lru_key, {key: now})
+			self.hset(sizes_key, key, len(value))
+			self.incrby(bytes_key, len(value) - size)
+			return 1
+		if script == redis_cache.REMOVE_SCRIPT:
+			lru_key, sizes_key, expiry_key, bytes_key = keys[:4]
+			freed = deleted = 0
+			for key in keys[4:]:
+				if argv[0] == 'expired' and self.exists(key):
+					continue
+				if argv[0] != 'expired':
+					deleted += self.delete(key)
+				freed += int(self.hget(sizes_key, key) or 0)
+				self.zrem(lru_key, key)
+				self.hdel(sizes_key, key)
+				self.zrem(expiry_key, key)
+			self.decrby(bytes_key, freed)
+			return deleted
+		key, owner = keys[0], argv[0]
+		if self.get(key) == self.to_bytes(owner):
+			self.delete(key)
+			return self.publish(key, "done")
+		return 0
+
+class FakePubSub:
+	def __init__(self, client):
+		self.client = client
+		self.channels = []
+		self.messages = queue.Queue()
+
+	def subscribe(self, channel):
+		self.channels.append(self.client.to_bytes(channel))
+		self.client.subscribers.setdefault(self.channels[-1], []).append(self)
+
+	def get_message(self, timeout=0):
+		try:
+			return self.messages.get(timeout=timeout)
+		except queue.Empty:
+			return None
+
+	def close(self):
+		for channel in self.channels:
+			self.client.subscribers[channel].remove(self)
+
+class FakePipeline:
+	def __init__(self, client):
+		self.client = client
+		self.commands = []
+
+	def __getattr__(self, name):
+		def queue(*args, **kwargs):
+			self.commands.append((getattr(self.client, name), args, kwargs))
+		return queue
+
+	def execute(self):
+		res = [func(*args, **kwargs) for func, args, kwargs in self.commands]
+		self.commands = []
+		return res
+
+class RedisResultCacheTest(TestCase):
+	def get_cache(self, **options):
+		cache = redis_cache.RedisResultCache("redis://localhost:6379/0", {'OPTIONS': options})
+		cache._client = FakeRedis()
+		return cache
+
+	def get_size(self, cache, key):
+		return int(cache.client.hget(cache.sizes_key, cache.make_key(key)))
+
+	def test_round_trip(self):
+		"""
+		Test that values are read back from Redis once evicted from the in-process cache and 
+		that only large values are compressed
+		"""
+		cache = self.get_cache(COMPRESS_MIN_BYTES=100)
+		cache.set("small", {'a': [1, 2.5, None]})
+		cache.set("large", "x" * 200)
+		self.assertEquals(cache.client.get(cache.make_key("small"))[:2], b"mn")
+		self.assertEquals(cache.client.get(cache.make_key("large"))[:2], b"ms")
+		cache.l1.clear()
+		self.assertEquals(cache.get("small"), {'a': [1, 2.5, None]})
+		self.assertEquals(cache.get("large"), "x" * 200)
+		self.assertIsNone(cache.get("missing"))
+		self.assertEquals(cache.decode(b"pz" + zlib.compress(pickle.dumps([1, 2]))), [1, 2])
+
+	def test_evict_byte_accounting(self):
+		"""
+		Test that the least recently used entries are evicted once `MAX_BYTES` is exceeded and 
+		that the byte counter stays the sum of the sizes of the entries
+		"""
+		cache = self.get_cache(COMPRESS_MIN_BYTES=10 ** 6, MAX_BYTES=250)
+		for key in ["a", "b", "c"]:
+			cache.set(key, "x" * 100)
+			cache.client.zadd(cache.lru_key, {cache.make_key(key): ord(key)})
+		self.assertFalse(cache.has_key("a"))
+		self.assertTrue(cache.has_key("b") and cache.has_key("c"))
+		total = self.get_size(cache, "b") + self.get_size(cache, "c")
+		self.assertEquals(int(cache.client.get(cache.bytes_key)), total)
+
+		# "b" expires in Redis
+		cache.client.delete(cache.make_key("b"))
+		cache.client.zadd(cache.expiry_key, {cache.make_key("b"): 0})
+		cache.evict()
+		self.assertEquals(int(cache.client.get(cache.bytes_key)), self.get_size(cache, "c"))
+		self.assertIsNone(cache.client.hget(cache.sizes_key, cache.make_key("b")))
+		self.assertEquals(cache.client.zrange(cache.lru_key, 0, -1), [cache.make_key("c").encode("utf-8")])
+
+		cache.delete("c")
+		self.assertEquals(int(cache.client.get(cache.bytes_key)), 0)
+
+	def test_atomic_accounting(self):
+		"""
+		Test that the sizes are read and updated in the scripts rather than in separate commands
+		so that concurrent writers of the same key do not count it twice
+		"""
+		cache = self.get_cache(COMPRESS_MIN_BYTES=10 ** 6)
+		with mock.patch.object(cache.client, "pipeline", side_effect=AssertionError("not atomic")), \
+				mock.patch.object(cache.client, "eval", wraps=cache.client.eval) as eval_func:
+			cache.set("key", "x" * 100)
+			cache.set("key", "x" * 50)
+			self.assertFalse(cache.add("key", "y"))
+			self.assertTrue(cache.add("other", "y"))
+			self.assertEquals(int(cache.client.get(cache.bytes_key)), 
+							self.get_size(cache, "key") + self.get_size(cache, "other"))
+			cache.delete("other")
+		self.assertEquals([x[0][0] for x in eval_func.call_args_list], 
+						[redis_cache.SET_SCRIPT] * 4 + [redis_cache.REMOVE_SCRIPT])
+		self.assertEquals(int(cache.client.get(cache.bytes_key)), self.get_size(cache, "key"))
+		cache.l1.clear()
+		self.assertEquals(cache.get("key"), "x" * 50)
+
+	def test_relative_timeout(self):
+		"""
+		Test that timeouts are passed to Redis in seconds rather than as a timestamp
+		"""
+		cache = self.get_cache()
+		with mock.patch.object(cache.client, "eval", wraps=cache.client.eval) as eval_func:
+			cache.set("key", 1, timeout=100)
+		self.assertEquals(eval_func.call_args[0][7], 100)
+		self.assertEquals(cache.get_backend_timeout(None), None)
+		cache.set("key", 1, timeout=0)
+		self.assertFalse(cache.has_key("key"))
+
+class SingleFlightTest(TestCase):
+	def setUp(self):
+		self.client = FakeRedis()
+		patcher = mock.patch.object(singleflight_util, "get_connection", return_value=self.client)
+		patcher.start()
+		self.addCleanup(patcher.stop)
+
+	def test_flight_ownership(self):
+		"""
+		Test that a flight is held by the first owner and only released by it
+		"""
+		self.assertTrue(singleflight_util.acquire_flight("key", "sync:a"))
+		self.assertFalse(singleflight_util.acquire_flight("key", "sync:b"))
+		self.assertEquals(singleflight_util.get_flight_owner("key"), "sync:a")
+		singleflight_util.release_flight("key", "sync:b")
+		self.assertEquals(singleflight_util.get_flight_owner("key"), "sync:a")
+		singleflight_util.release_flight("key", "sync:a")
+		self.assertIsNone(singleflight_util.get_flight_owner("key"))
+		self.assertTrue(singleflight_util.acquire_flight("key", "sync:b"))
+
+	def test_wait_for_flight(self):
+		"""
+		Test that waiting requests return once the flight is released and time out otherwise
+		"""
+		singleflight_util.acquire_flight("key", "sync:a")
+		timer = threading.Timer(0.2, singleflight_util.release_flight, args=("key", "sync:a"))
+		timer.start()
+		start = time.time()
+		self.assertTrue(singleflight_util.wait_for_flight("key", timeout=10))
+		self.assertLess(time.time() - start, 5)
+		timer.join()
+
+		singleflight_util.acquire_flight("key", "sync:b")
+		self.assertFalse(singleflight_util.wait_for_flight("key", timeout=1))
+		self.assertEquals(self.client.subscribers[b"ldms:flight:key"], [])
+
+	def test_wait_timeout_below_web_server_timeout(self):
+		"""
+		Test that requests do not wait for an identical one longer than a web server request lasts
+		"""
+		self.assertLessEqual(singleflight_util.get_single_flight_settings()['WAIT_TIMEOUT'], 30)
+
+	def test_follower_reuses_result(self):
+		"""
+		Test that a queued request identical to a finished one saves its cached results 
+		instead of computing them
+		"""
+		analysis_func = mock.Mock(__name__="lulc")
+		task = mock.Mock()
+		with mock.patch.object(analysis_router, "get_cache_key", return_value=json.dumps({'stats': [1]})), \
+				mock.patch.object(analysis_router, "pre_analysis_save_task", return_value=(None, task)), \
+				mock.patch.object(analysis_router, "post_analysis_save_task") as post_save, \
+				mock.patch.object(analysis_router, "clone_post_request"):
+			res = analysis_router.run_flight_follower(analysis_func, "key", data={'vector': 1})
+		self.assertEquals(res.data, {'stats': [1]})
+		analysis_func.assert_not_called()
+		self.assertEquals(post_save.call_args[0][1:4], (task, {'stats': [1]}, None))
+
+		with mock.patch.object(analysis_router, "get_cache_key", return_value=None):
+			analysis_router.run_flight_follower(analysis_func, "key", data={'vector': 1})
+		analysis_func.assert_called_once()
+
+	def test_leader_failure_releases_dependents(self):
+		"""
+		Test that the jobs depending on a leader that failed are queued and that its flight is released
+		"""
+		job = mock.Mock(origin="default")
+		job.get_id.return_value = "leader"
+		singleflight_util.acquire_flight("key", singleflight_util.JOB_OWNER + "leader")
+		analysis_func = mock.Mock(side_effect=ValueError("Failed"))
+		with mock.patch.object(analysis_router, "get_current_job", return_value=job), \
+				mock.patch.object(analysis_router.django_rq, "get_queue") as get_queue:
+			with self.assertRaises(ValueError):
+				analysis_router.run_flight_leader(analysis_func, "key", data={'vector': 1})
+		get_queue.assert_called_with("default")
+		get_queue.return_value.enqueue_dependents.assert_called_once_with(job)
+		self.assertIsNone(singleflight_util.get_flight_owner("key"))
@@ -0,0 +1,253 @@
+"""
+Store of rasters pre-clipped to administrative units.
+
+Most requests reference a stored administrative unit instead of a custom polygon.
+Each `Raster` is clipped once per administrative unit and saved as a Cloud Optimized
+GeoTIFF (tiled, with internal overviews). `clip_raster_to_vector` looks up the store
+before clipping on the fly. Entries are invalidated when the source raster or the
+geometry of the administrative unit changes.
+"""
+
+import os
+import time
+import rasterio
+import rasterio.shutil
+from rasterio.enums import Resampling
+from django.conf import settings
+from django.contrib.gis.geos import Polygon
+from ldms.models import (AdminUnitRaster, Raster, RegionalAdminLevel,
+				AdminLevelZero, AdminLevelOne, AdminLevelTwo)
+from ldms.utils.file_util import file_exists, get_absolute_media_path, get_media_dir, get_temp_file
+from ldms.utils.vector_util import get_geometry_hash
+from ldms.utils.settings_util import get_settings
+
+ADMIN_LEVEL_MODELS = {
+	-1: RegionalAdminLevel,
+	0: AdminLevelZero,
+	1: AdminLevelOne,
+	2: AdminLevelTwo,
+}
+ADMIN_RASTER_SUBDIR = "admin_rasters"
+COG_BLOCK_SIZE = 256
+COG_OVERVIEW_FACTORS = [2, 4, 8, 16, 32]
+
+DEFAULT_STORE_SETTINGS = {
+	'ENABLED': True,
+	'REFRESH_SECONDS': 300,
+}
+
+_stored_sources = None # (time loaded, source files that have pre-clipped rasters)
+
+def get_store_settings():
+	"""Get settings of the store. Values are read from settings.ADMIN_RASTER_STORE
+	"""
+	setts = DEFAULT_STORE_SETTINGS.copy()
+	setts.update(getattr(settings, 'ADMIN_RASTER_STORE', {}))
+	return setts
+
+def get_stored_sources():
+	"""Get the source files that have pre-clipped rasters
+
+	The set is loaded once per process and reloaded every REFRESH_SECONDS so that clipping
+	a raster that is not in the store does not cost a query. Rasters pre-clipped by another
+	process are used once the set has been reloaded
+	"""
+	global _stored_sources
+	now = time.monotonic()
+	if _stored_sources is None or now - _stored_sources[0] > get_store_settings()['REFRESH_SECONDS']:
+		sources = AdminUnitRaster.objects.values_list('source_file', flat=True).distinct()
+		_stored_sources = (now, frozenset(sources))
+	return _stored_sources[1]
+
+def reset_stored_sources():
+	global _stored_sources
+	_stored_sources = None
+
+def get_admin_level(model):
+	"""Return the admin level of an administrative unit model or None if it is not an admin unit model
+	"""
+	for level, mdl in ADMIN_LEVEL_MODELS.items():
+		if mdl == model:
+			return level
+	return None
+
+def get_source_modified(source_file):
+	return os.stat(source_file).st_mtime_ns
+
+def get_admin_unit_raster(raster_file, vector, nodata, clipping_algorithm):
+	"""Retrieve a pre-clipped raster from the store
+
+	Args:
+		raster_file (string): Absolute path of the raster to be clipped
+		vector (geojson): Polygon used for clipping
+		nodata (number): Nodata value of the clipped raster
+		clipping_algorithm (string): Value of SystemSettings.raster_clipping_algorithm
+
+	Returns:
+		tuple (array, file, nodata) as returned by `clip_raster_to_vector` or None if
+		the raster has not been pre-clipped
+	"""
+	if not get_store_settings()['ENABLED'] or raster_file not in get_stored_sources():
+		return None
+	entry = AdminUnitRaster.objects.filter(source_file=raster_file,
+						clipping_algorithm=clipping_algorithm, nodata=nodata,
+						geometry_hash=get_geometry_hash(vector)).first()
+	if not entry:
+		return None
+	if not file_exists(entry.rasterfile, raise_exception=False) or \
+			entry.source_modified != get_source_modified(raster_file):
+		entry.delete()
+		return None
+	with rasterio.open(entry.rasterfile) as src:
+		out_image = src.read()
+	return (out_image, entry.rasterfile, entry.nodata)
+
+def get_admin_unit_raster_path(raster, admin_level, admin_unit_id):
+	"""Return the path of the pre-clipped raster file
+	"""
+	directory = get_media_dir(os.path.join(ADMIN_RASTER_SUBDIR, str(raster.id)))
+	os.makedirs(directory, exist_ok=True)
+	return os.path.join(directory, "%s_%s.tif" % (admin_level, admin_unit_id))
+
+def write_cog(out_image, out_meta, out_file):
+	"""Write a raster as a Cloud Optimized GeoTIFF i.e tiled with internal overviews
+
+	Args:
+		out_image (array): Raster of shape (bands, rows, cols)
+		out_meta (dict): Raster meta data
+		out_file (string): Destination file
+	"""
+	height, width = out_image.shape[1], out_image.shape[2]
+	meta = out_meta.copy()
+	meta.update({"driver": "GTiff", "height": height, "width": width, "compress": "lzw"})
+	tmp_file = get_temp_file(suffix=".tif")
+	with rasterio.open(tmp_file, "w", **meta) as dest:
+		dest.write(out_image)
+		# add overviews until the coarsest one fits in a single block
+		factors = [f for f in COG_OVERVIEW_FACTORS if max(height, width) > COG_BLOCK_SIZE * f // 2]
+		if factors:
+			dest.build_overviews(factors, Resampling.nearest)
+			dest.update_tags(ns='rio_overview', resampling='nearest')
+
+	# copy to a temporary name first so that readers never see a partial file
+	part_file = out_file + ".part"
+	rasterio.shutil.copy(tmp_file, part_file, driver="GTiff", tiled=True,
+				blockxsize=COG_BLOCK_SIZE, blockysize=COG_BLOCK_SIZE,
+				compress="lzw", copy_src_overviews=True)
+	os.replace(part_file, out_file)
+	os.remove(tmp_file)
+
+def precompute_admin_unit_rasters(raster_ids=None, admin_levels=None, admin_unit_ids=None, overwrite=False):
+	"""Clip rasters to every administrative unit that they overlap and save them in the store
+
+	Args:
+		raster_ids (list, optional): Rasters to clip. Defaults to all rasters
+		admin_levels (list, optional): Admin levels to clip to. Defaults to all levels
+		admin_unit_ids (list, optional): Restrict to these administrative units
+		overwrite (bool, optional): If True, rasters that are up to date are clipped again
+
+	Returns:
+		int: Number of rasters that were clipped
+	"""
+	from ldms.utils.raster_util import clip_raster
+
+	clipping_algorithm = get_settings().raster_clipping_algorithm
+	all_touched = clipping_algorithm == "All Touched"
+	admin_levels = admin_levels if admin_levels is not None else list(ADMIN_LEVEL_MODELS.keys())
+	rasters = Raster.objects.all()
+	if raster_ids is not None:
+		rasters = rasters.filter(id__in=raster_ids)
+
+	count = 0
+	for raster in rasters:
+		if not raster.rasterfile:
+			continue
+		source_file = get_absolute_media_path(raster.rasterfile.name)
+		if not file_exists(source_file, raise_exception=False):
+			continue
+		source_modified = get_source_modified(source_file)
+		with rasterio.open(source_file) as src:
+			nodata = src.meta['nodata'] or settings.DEFAULT_NODATA
+			bbox = Polygon.from_bbox(tuple(src.bounds))
+			bbox.srid = src.crs.to_epsg() if src.crs and src.crs.to_epsg() else 4326
+
+		for admin_level in admin_levels:
+			units = ADMIN_LEVEL_MODELS[admin_level].objects.filter(geom__intersects=bbox)
+			if admin_unit_ids is not None:
+				units = units.filter(id__in=admin_unit_ids)
+			for unit in units.only('id', 'geom'):
+				vector = unit.geom.geojson
+				geometry_hash = get_geometry_hash(vector)
+				entry = AdminUnitRaster.objects.filter(raster=raster,
+							admin_level=admin_level, admin_unit_id=unit.id).first()
+				if entry and not overwrite and entry.source_file == source_file and \
+						entry.source_modified == source_modified and \
+						entry.geometry_hash == geometry_hash and \
+						entry.clipping_algorithm == clipping_algorithm and \
+						entry.nodata == nodata and file_exists(entry.rasterfile, raise_exception=False):
+					continue
+				try:
+					out_image, out_meta = clip_raster(source_file, vector, nodata, all_touched)
+				except ValueError: # the unit does not overlap the raster
+					if entry:
+						entry.delete()
+					continue
+				out_file = get_admin_unit_raster_path(raster, admin_level, unit.id)
+				write_cog(out_image, out_meta, out_file)
+				AdminUnitRaster.objects.update_or_create(raster=raster,
+					admin_level=admin_level, admin_unit_id=unit.id,
+					defaults={
+						"source_file": source_file,
+						"source_modified": source_modified,
+						"geometry_hash": geometry_hash,
+						"clipping_algorithm": clipping_algorithm,
+						"nodata": nodata,
+						"rasterfile": out_file,
+					})
+				count += 1
+	reset_stored_sources()
+	return count
+
+def enqueue_precompute_admin_unit_rasters(**kwargs):
+	"""Run `precompute_admin_unit_rasters` as a background job
+	"""
+	from ldms.queue import RedisQueue
+	RedisQueue().enqueue_low(precompute_admin_unit_rasters, **kwargs)
+
+def invalidate_raster(raster):
+	"""Delete pre-clipped rasters whose source raster has changed and schedule
+	them to be clipped again
+	"""
+	entries = AdminUnitRaster.objects.filter(raster=raster)
+	if not entries.exists():
+		return
+	source_file = get_absolute_media_path(raster.rasterfile.name) if raster.rasterfile else None
+	source_modified = None
+	if source_file and file_exists(source_file, raise_exception=False):
+		source_modified = get_source_modified(source_file)
+	stale = [x for x in entries if x.source_file != source_file or x.source_modified != source_modified]
+	if not stale:
+		return
+	admin_levels = sorted(set([x.admin_level for x in stale]))
+	for entry in stale:
+		entry.delete()
+	if source_modified is not None:
+		enqueue_precompute_admin_unit_rasters(raster_ids=[raster.id], admin_levels=admin_levels)
+
+def invalidate_admin_unit(admin_level, admin_unit, deleted=False):
+	"""Delete pre-clipped rasters of an administrative unit whose geometry has changed
+	and schedule them to be clipped again
+	"""
+	entries = AdminUnitRaster.objects.filter(admin_level=admin_level, admin_unit_id=admin_unit.id)
+	if not entries.exists():
+		return
+	if not deleted:
+		entries = entries.exclude(geometry_hash=get_geometry_hash(admin_unit.geom.geojson))
+	raster_ids = list(set(entries.values_list('raster_id', flat=True)))
+	if not raster_ids:
+		return
+	for entry in entries:
+		entry.delete()
+	if not deleted:
+		enqueue_precompute_admin_unit_rasters(raster_ids=raster_ids,
+				admin_levels=[admin_level], admin_unit_ids=[admin_unit.id])
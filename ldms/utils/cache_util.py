@@ -1,19 +1,66 @@
 from django.core.cache import cache
+from django.conf import settings
 from ldms import CacheParamError
+from ldms.utils.vector_util import get_canonical_geometry
+from ldms.utils.metrics_util import count_cache_request
 from django.utils.translation import gettext as _
-from ldms.utils.json_sem_hash import get_json_sem_hash
-from ldms.models import SystemSettings
 import copy
+import json
+import hashlib
 
-def get_cached_results(request):
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+DEFAULT_CACHE_TIMEOUT = 86400 # 1 day
+CACHE_KEY_VERSION = 2 # Increment to invalidate keys generated by a previous version of `generate_cache_key`
+
+# Fields that do not change the results of an analysis
+NON_SEMANTIC_FIELDS = ["cached", "path"]
+
+# Fields that are converted to a type so that e.g 2015 and "2015" give the same key. 
+# The analysis treat the equivalent values the same way
+INTEGER_FIELDS = ["vector", "admin_level", "admin_0", "raster_type", "start_year", "end_year", 
+                "reference_eco_units", "reference_soc", "reference_raster", "computation_type", "class_map", 
+                "version", "baseline_year"]
+BOOLEAN_FIELDS = ["show_change"]
+GEOMETRY_FIELDS = ["custom_coords"]
+GEOMETRY_PRECISION = 7 # decimal places of coordinates of custom polygons (~1cm)
+
+# Values equivalent to a missing field. Defaults of raster_source depend on the analysis
+DEFAULT_FIELD_VALUES = {
+    "transform": "area",
+    "show_change": False,
+}
+API_DEFAULT_FIELD_VALUES = {
+    "lulc": {"raster_source": "LULC"},
+    "forestchange": {"raster_source": "LULC"},
+    "soc": {"raster_source": "LULC"},
+    "forestfire": {"raster_source": "Landsat 8"},
+    "carbonemission": {"raster_source": "Hansen"},
+    "productivity": {"raster_source": "Modis"},
+    "degradation": {"raster_source": "Modis"},
+    "esai": {"raster_source": "Modis"},
+    "ilswe": {"raster_source": "Modis"},
+    "rusle": {"raster_source": "Modis"},
+    "cvi": {"raster_source": "Modis"},
+}
+
+def get_cached_results(request, count_request=True):
     """Retrieve computed values from cache
 
     Args:
         request: HttpRequest object
+        count_request (bool, optional): Count the lookup in the hit rate of the cache exported 
+                                as a metric. Defaults to True
     """
     payload = copy.copy(request.data)
     key = generate_cache_key(payload, request.path)    
-    return get_cache_key(key) # Retrieve value of a cache key
+    value = get_cache_key(key) # Retrieve value of a cache key
+    if count_request:
+        count_cache_request(get_api_name(request.path), value is not None)
+    return value
 
 def get_cache_key(key):
     """Retrieve value of a cache key"""
@@ -25,14 +72,32 @@ def set_cache_key(key, value, timeout=None):
     Args:
         key (string): Cache key
         value (value): Value associated with the cache key
-        timeout (int, optional): Timeout of the cache key in seconds. Defaults to None.
+        timeout (int, optional): Timeout of the cache key in seconds. Defaults to None
+                                which means one day. See `get_cache_timeout`
     """
-    limit = SystemSettings.load().cache_limit or 86400 # 1 day
-    cache.set(key, value, limit)
+    cache.set(key, value, timeout or DEFAULT_CACHE_TIMEOUT)
+
+def get_cache_timeout(api_path, system_settings):
+    """Get the number of seconds that results of an API are cached
+
+    Timeouts of specific APIs are set in settings.RESULT_CACHE_TIMEOUTS keyed by the 
+    name of the API e.g "lulc" for /api/lulc/. Other APIs use SystemSettings.cache_limit
+
+    Args:
+        api_path (string): API Endpoint
+        system_settings (SystemSettings): Already loaded system settings
+    """
+    timeouts = getattr(settings, 'RESULT_CACHE_TIMEOUTS', {})
+    name = (api_path or "").strip("/").split("/")[-1]
+    return timeouts.get(name) or system_settings.cache_limit or DEFAULT_CACHE_TIMEOUT
 
 def generate_cache_key(obj, api_path):
     """Generate a hash key based on a dict
 
+    Equivalent payloads give the same key: fields that do not change the results are ignored,
+    typed fields are converted, fields having their default value are dropped and custom
+    polygons are replaced by a hash of their canonical geometry.
+
     Args:
         obj (object): An object with key value pairs
         api_path (string): API Endpoint. We want to distinguish hash keys for 
@@ -41,6 +106,72 @@ def generate_cache_key(obj, api_path):
     """
     if not isinstance(obj, dict):
         raise CacheParamError(_("You must specify a dict"))
-    if 'path' not in obj:
-        obj['path'] = api_path
-    return get_json_sem_hash(obj)
\ No newline at end of file
+    api_name = get_api_name(obj.get('path') or api_path)
+    params = normalize_cache_params(obj, api_name)
+    payload = json.dumps([CACHE_KEY_VERSION, api_name, params], sort_keys=True, 
+                        separators=(",", ":"), default=str)
+    return get_digest(payload.encode("utf-8"))
+
+def get_api_name(api_path):
+    """Get the name of an API from its path e.g "lulc" for /api/lulc/
+    """
+    return (api_path or "").strip("/").split("/")[-1]
+
+def get_digest(data):
+    """Fast non-cryptographic digest of bytes. Uses xxhash if installed, else blake2b
+    """
+    if xxhash:
+        return xxhash.xxh3_128_hexdigest(data)
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+def normalize_cache_params(obj, api_name):
+    """Normalize the parameters of an analysis for the generation of a cache key
+
+    Args:
+        obj (dict): Parameters of the analysis
+        api_name (string): Name of the API. See `get_api_name`
+    """
+    defaults = dict(DEFAULT_FIELD_VALUES, **API_DEFAULT_FIELD_VALUES.get(api_name, {}))
+    params = {}
+    for key, value in obj.items():
+        if key in NON_SEMANTIC_FIELDS or value is None:
+            continue
+        if key in INTEGER_FIELDS:
+            value = normalize_integer(value)
+        elif key in BOOLEAN_FIELDS:
+            value = normalize_boolean(value)
+        elif key in GEOMETRY_FIELDS:
+            value = normalize_geometry(value)
+        if value is None or (key in defaults and value == defaults[key]):
+            continue
+        params[key] = value
+    return params
+
+def normalize_integer(value):
+    """Convert "2015", 2015.0 and 2015 to 2015. Other values are returned unchanged
+    """
+    if isinstance(value, bool):
+        return value
+    try:
+        num = float(value)
+    except (TypeError, ValueError):
+        return value
+    return int(num) if num.is_integer() else value
+
+def normalize_boolean(value):
+    """Convert 1 and 0 to True and False. Other values are returned unchanged
+    """
+    if not isinstance(value, bool) and value in (0, 1):
+        return bool(value)
+    return value
+
+def normalize_geometry(value):
+    """Replace a geometry by a hash of its canonical form so that the same polygon gives 
+    the same value regardless of the precision of the coordinates or the starting vertex
+    """
+    if not value:
+        return None
+    geom = get_canonical_geometry(value, GEOMETRY_PRECISION)
+    if geom is None:
+        return value
+    return get_digest(bytes(geom.wkb))
@@ -0,0 +1,128 @@
+"""
+Estimation of the cost of queued analyses.
+
+The cost of an analysis is the number of pixels it reads (area of the polygon divided by
+the area of a pixel of the raster source) times the number of years it reads, in millions,
+weighted by how expensive the indicator is. It is used to route queued jobs to the
+`low`, `default` or `high` duration queues with a matching `job_timeout` so that small jobs
+do not wait behind country-scale ones. See settings.JOB_COST_ROUTING.
+"""
+
+from django.conf import settings
+from ldms.utils.vector_util import calculate_polygon_area
+from ldms.utils.cache_util import get_api_name, normalize_integer, API_DEFAULT_FIELD_VALUES
+
+DEFAULT_JOB_COST_ROUTING = {
+	'ENABLED': True,
+	'QUEUES': [('low', 10), ('default', 200), ('high', None)],
+	'SECONDS_PER_UNIT': 1.0,
+	'TIMEOUT_FACTOR': 4,
+	'MAX_JOB_TIMEOUT': 6 * 3600,
+}
+
+# Nominal pixel size in metres of the raster sources
+SOURCE_RESOLUTIONS = {
+	"LULC": 300,
+	"Modis": 250,
+	"Landsat 7": 30,
+	"Landsat 8": 30,
+	"Hansen": 30,
+	"Sentinel 2": 10,
+}
+DEFAULT_RESOLUTION = 250
+
+# Relative cost of the indicators per million pixels per year e.g ESAI reads more than 15 rasters
+INDICATOR_WEIGHTS = {
+	"lulc": 1,
+	"forestchange": 1,
+	"forestfire": 1,
+	"forestfirerisk": 1,
+	"soc": 2,
+	"state": 1,
+	"trajectory": 1,
+	"performance": 1.5,
+	"productivity": 3,
+	"degradation": 5,
+	"aridity": 1,
+	"climatequality": 4,
+	"soilquality": 4,
+	"vegetationquality": 4,
+	"managementquality": 4,
+	"esai": 20,
+	"carbonemission": 3,
+	"ilswe": 4,
+	"rusle": 4,
+	"cvi": 4,
+}
+DEFAULT_WEIGHT = 2
+
+# Indicators that read every year between start_year and end_year. Others read the two end years
+TIME_SERIES_INDICATORS = ["state", "trajectory", "performance", "productivity", "degradation"]
+
+def get_job_cost_routing():
+	"""Get settings of the routing of queued jobs. Values are read from settings.JOB_COST_ROUTING
+	"""
+	setts = DEFAULT_JOB_COST_ROUTING.copy()
+	setts.update(getattr(settings, 'JOB_COST_ROUTING', {}))
+	return setts
+
+def get_worker_queues():
+	"""Get the queues workers listen on, from the cheapest to the most expensive jobs. RQ serves
+	the first non-empty queue, so listening on the expensive queues first would starve cheap jobs
+	and the tiles of large analyses
+	"""
+	return [name for name, max_cost in get_job_cost_routing()['QUEUES']]
+
+def get_year_count(api_name, params):
+	"""Get the number of years of data an analysis reads
+	"""
+	start_year = normalize_integer(params.get('start_year'))
+	end_year = normalize_integer(params.get('end_year'))
+	years = [x for x in [start_year, end_year] if isinstance(x, int)]
+	if len(years) < 2:
+		return 1
+	if api_name in TIME_SERIES_INDICATORS:
+		return abs(end_year - start_year) + 1
+	return 1 if start_year == end_year else 2
+
+def estimate_job_cost(api_path, params, vector):
+	"""Estimate the cost of an analysis
+
+	Args:
+		api_path (string): API Endpoint e.g /api/lulc/
+		params (dict): Parameters of the analysis
+		vector (geojson): Area of interest
+
+	Returns:
+		float: Weighted millions of pixel-years or None if the area is unknown
+	"""
+	if not vector:
+		return None
+	api_name = get_api_name(api_path)
+	source = params.get('raster_source') or API_DEFAULT_FIELD_VALUES.get(api_name, {}).get('raster_source')
+	resolution = SOURCE_RESOLUTIONS.get(source, DEFAULT_RESOLUTION)
+	pixels = calculate_polygon_area(vector) * 10000 / resolution ** 2 # hectares to square metres
+	weight = INDICATOR_WEIGHTS.get(api_name, DEFAULT_WEIGHT)
+	return round(pixels * get_year_count(api_name, params) * weight / 10 ** 6, 4)
+
+def get_queue_for_cost(cost):
+	"""Get the queue and the job timeout of a job
+
+	Args:
+		cost (float): Estimated cost of the job. See `estimate_job_cost`
+
+	Returns:
+		tuple(string, int): Name of the queue and job timeout in seconds. The timeout is None
+			if the default timeout of the queue is to be used
+	"""
+	setts = get_job_cost_routing()
+	if cost is None or not setts['ENABLED']:
+		return ('default', None)
+	queue_name = setts['QUEUES'][-1][0]
+	for name, max_cost in setts['QUEUES']:
+		if max_cost is None or cost <= max_cost:
+			queue_name = name
+			break
+	queue_timeout = settings.RQ_QUEUES.get(queue_name, {}).get('DEFAULT_TIMEOUT') or 0
+	timeout = cost * setts['SECONDS_PER_UNIT'] * setts['TIMEOUT_FACTOR']
+	return (queue_name, int(min(max(timeout, queue_timeout), setts['MAX_JOB_TIMEOUT'])))
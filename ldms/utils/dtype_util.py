@@ -0,0 +1,79 @@
+"""
+Data types of the rasters of the analyses.
+
+Class maps e.g the output of `ldms.utils.raster_util.reclassify` are held and written in
+the smallest integer type holding their classes and nodata, uint8 for the class enums
+whose nodata is 255, instead of int64 in memory and int32 on disk. Continuous values computed
+from class maps or indices e.g the quality indices of Medalus are computed in float32, whose
+precision is that of the rasters they are read from.
+"""
+
+import numpy as np
+import numpy.ma as ma
+
+# smallest first. int8 and int64 are left out, GDAL before 3.5 cannot write them
+CLASS_DTYPES = (np.uint8, np.uint16, np.int16, np.int32)
+CONTINUOUS_DTYPE = np.float32
+
+def get_class_dtype(values):
+	"""Get the smallest integer type holding all of the values e.g the classes of an enum and nodata
+
+	Args:
+		values (list | array): Values to hold. The data of masked values is included
+
+	Returns:
+		dtype: Smallest of CLASS_DTYPES holding the values or None if any of them is not an integer
+	"""
+	values = np.asarray(ma.getdata(values))
+	if values.size == 0 or values.dtype == bool:
+		return np.dtype(np.uint8)
+	if np.issubdtype(values.dtype, np.floating):
+		if not np.isfinite(values).all() or (values != np.round(values)).any():
+			return None
+	elif not np.issubdtype(values.dtype, np.integer):
+		return None
+	min_val, max_val = values.min(), values.max()
+	for dtype in CLASS_DTYPES:
+		info = np.iinfo(dtype)
+		if info.min <= min_val and max_val <= info.max:
+			return np.dtype(dtype)
+	return None
+
+def get_enum_dtype(change_enum, nodata=None):
+	"""Get the smallest integer type holding the keys of a class enum and nodata
+
+	Args:
+		change_enum (enum.Enum): Enum of the classes e.g LandDegradationChangeEnum
+		nodata (number, optional): Value of nodata
+
+	Returns:
+		dtype: Smallest of CLASS_DTYPES or None if nodata is not an integer
+	"""
+	return get_class_dtype([x.key for x in change_enum] + ([] if nodata is None else [nodata]))
+
+def to_class_dtype(array, nodata=None, default=np.int32):
+	"""Cast a class map to the smallest integer type holding its values and nodata
+
+	Args:
+		array (ndarray | MaskedArray): Class map
+		nodata (number, optional): Value of nodata, held even if the array has no nodata pixel
+		default (dtype): Type of the arrays with values that are not integers e.g nan
+
+	Returns:
+		ndarray | MaskedArray: The array itself if it already has the type
+	"""
+	values = np.asarray(ma.getdata(array))
+	bounds = [] if nodata is None else [nodata]
+	if values.size:
+		if not np.issubdtype(values.dtype, np.integer) and get_class_dtype(values) is None:
+			return array.astype(default, copy=False)
+		bounds += [values.min(), values.max()] # enough once the values are known to be integers
+	return array.astype(get_class_dtype(bounds) or default, copy=False)
+
+def to_continuous(array):
+	"""Cast an array to CONTINUOUS_DTYPE, keeping its mask
+
+	Returns:
+		ndarray | MaskedArray: The array itself if it already has the type
+	"""
+	return array.astype(CONTINUOUS_DTYPE, copy=False)
@@ -0,0 +1,149 @@
+"""
+Instrumentation of the stages of queued analyses.
+
+Analyses wrap their stages (clipping, reading, computing, writing, publishing to GeoServer)
+in `timed_stage` or decorate them with `instrumented`. Within an RQ job, the running stage
+and the totals of each stage (calls, seconds, bytes read and pixels) are saved to
+`job.meta['progress']` and to `ScheduledTask.progress` of the task of the job, at most every
+`SAVE_INTERVAL` seconds. Outside of a job the stages are not recorded. Whether run within
+a job or not, the durations and the raster read of the stages are exported as Prometheus
+metrics. See `ldms.utils.metrics_util`.
+
+Stages computed in the processes forked by `ldms.utils.parallel_util` are not recorded,
+the call of `run_stages` is.
+"""
+
+import os
+import json
+import time
+import functools
+import logging
+import contextlib
+from django.utils import timezone
+from rq import get_current_job
+from ldms.utils.metrics_util import observe_stage
+
+log = logging.getLogger(f'ldms.apps.{__name__}')
+
+SAVE_INTERVAL = 1.0 # seconds
+
+_progress = None # progress of the job run by this process
+
+def get_progress():
+	"""Get the progress of the job run by this process or None if it is not run within a job
+	"""
+	global _progress
+	job = get_current_job()
+	if not job:
+		return None
+	if _progress is None or _progress['job'].id != job.id:
+		_progress = {
+			'job': job,
+			'pid': os.getpid(),
+			'running': [],
+			'stages': {},
+			'started_on': timezone.now().isoformat(),
+			'saved_at': 0,
+		}
+	if _progress['pid'] != os.getpid(): # forked child of the process running the job
+		return None
+	return _progress
+
+def get_progress_data(progress):
+	"""Get the JSON serializable part of the progress
+
+	Returns:
+		dict: {stage, stages, started_on, updated_on}. `stage` is the running stage and `stages`
+			the totals of each stage in the order they were first run
+	"""
+	return {
+		'stage': "/".join(progress['running']) or None,
+		'stages': list(progress['stages'].values()),
+		'started_on': progress['started_on'],
+		'updated_on': timezone.now().isoformat(),
+	}
+
+def save_progress(progress=None, force=False):
+	"""Save the progress to the job meta and to the task of the job
+	"""
+	from ldms.models import ScheduledTask
+	progress = progress or get_progress()
+	if not progress:
+		return
+	if not force and time.time() - progress['saved_at'] < SAVE_INTERVAL:
+		return
+	progress['saved_at'] = time.time()
+	job = progress['job']
+	data = get_progress_data(progress)
+	try:
+		job.meta['progress'] = data
+		job.save_meta()
+		task_id = job.meta.get('task_id')
+		if task_id:
+			ScheduledTask.objects.filter(pk=task_id).update(progress=json.dumps(data))
+	except Exception as e: # instrumentation must not fail the analysis
+		log.warning("Failed to save the progress of job %s: %s" % (job.id, e))
+
+def finish_progress():
+	"""Save the final progress of the job run by this process
+
+	Returns:
+		string: JSON of the progress or None if not run within a job
+	"""
+	progress = get_progress()
+	if not progress:
+		return None
+	save_progress(progress, force=True)
+	return json.dumps(get_progress_data(progress))
+
+@contextlib.contextmanager
+def timed_stage(name, **fields):
+	"""Record the duration of a stage
+
+	Args:
+		name (string): Name of the stage e.g "clip"
+		fields: Initial values of counters e.g bytes_read, pixels
+
+	Yields:
+		dict: Counters of the stage that the caller may increment e.g `info['pixels'] += arr.size`
+	"""
+	progress = get_progress()
+	info = {'bytes_read': 0, 'pixels': 0}
+	info.update(fields)
+	if not progress:
+		start = time.time()
+		try:
+			yield info
+		finally:
+			observe_stage(name, time.time() - start, info['bytes_read'], info['pixels'])
+		return
+
+	progress['running'].append(name)
+	path = "/".join(progress['running'])
+	stage = progress['stages'].setdefault(path, {'name': path, 'calls': 0, 'seconds': 0,
+							'bytes_read': 0, 'pixels': 0})
+	save_progress(progress)
+	start = time.time()
+	try:
+		yield info
+	finally:
+		seconds = time.time() - start
+		observe_stage(name, seconds, info['bytes_read'], info['pixels'])
+		stage['calls'] += 1
+		stage['seconds'] = round(stage['seconds'] + seconds, 3)
+		for key, val in info.items():
+			if isinstance(val, (int, float)):
+				stage[key] = stage.get(key, 0) + val
+		progress['running'].pop()
+		save_progress(progress)
+
+def instrumented(name=None):
+	"""Decorator recording the duration of a function as a stage. See `timed_stage`
+	"""
+	def decorator(func):
+		@functools.wraps(func)
+		def wrapper(*args, **kwargs):
+			with timed_stage(name or func.__name__):
+				return func(*args, **kwargs)
+		return wrapper
+	return decorator
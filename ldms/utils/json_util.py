@@ -0,0 +1,74 @@
+"""
+Serialization of analysis results.
+
+Results contain numpy scalars (counts, areas), numpy arrays and dicts keyed by numpy
+integers, none of which the json module handles. They are encoded directly instead of
+round tripping them through `eval(str(...))`.
+"""
+
+import json
+import enum
+import decimal
+import datetime
+import numpy as np
+
+try:
+	import orjson
+except ImportError:
+	orjson = None
+
+def to_python(obj):
+	"""Convert a numpy (or other non JSON) value into the equivalent Python value
+	"""
+	if isinstance(obj, np.floating) and obj.dtype.itemsize < 8:
+		# use the shortest representation e.g 0.1 instead of 0.10000000149011612 for float32
+		return float(str(obj))
+	if isinstance(obj, np.generic):
+		return obj.item()
+	if isinstance(obj, np.ndarray):
+		return obj.tolist()
+	if isinstance(obj, enum.Enum):
+		return obj.value
+	if isinstance(obj, decimal.Decimal):
+		return float(obj)
+	if isinstance(obj, (datetime.date, datetime.datetime)):
+		return obj.isoformat()
+	if isinstance(obj, (set, tuple)):
+		return list(obj)
+	return str(obj) # e.g lazy translation strings
+
+def _json_default(obj):
+	return to_python(obj)
+
+def normalize_keys(obj):
+	"""Recursively convert dict keys that are numpy scalars into Python values
+	"""
+	if isinstance(obj, dict):
+		return {(to_python(k) if isinstance(k, np.generic) else k): normalize_keys(v) for k, v in obj.items()}
+	if isinstance(obj, (list, tuple)):
+		return [normalize_keys(x) for x in obj]
+	return obj
+
+def encode_result(obj):
+	"""Encode the results of an analysis as a JSON string
+
+	orjson is used if it is installed. Note that it encodes NaN as null.
+
+	Args:
+		obj (object): Results e.g `Response.data`. Strings are returned unchanged
+
+	Returns:
+		string: JSON
+	"""
+	if isinstance(obj, str):
+		return obj
+	if orjson:
+		try:
+			return orjson.dumps(obj, default=_json_default,
+						option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS).decode("utf-8")
+		except TypeError:
+			pass
+	try:
+		return json.dumps(obj, default=_json_default)
+	except TypeError: # dict keys that are numpy scalars
+		return json.dumps(normalize_keys(obj), default=_json_default)
@@ -1,6 +1,37 @@
-import logging 
-import logging.handlers
+"""
+Logging to the main and error log files.
+
+Loggers are built once per process. Records are put on a queue by a `QueueHandler` and
+written to the rotating log files by a `QueueListener` thread so that the callers never
+wait for the disk. RQ forks a process per job so the listener is started again by the
+first record logged in a forked process. The process of a job ends with `os._exit`, which
+skips `atexit`, so jobs write the records left on the queues with `flush_logs` before they finish.
+
+Records carry the fields of the request or task being processed (request id, task id,
+indicator and AOI hash), set with `log_context`, so that a request can be traced from
+the web server to the jobs that compute it.
+"""
+
 import os
+import json
+import uuid
+import queue
+import atexit
+import hashlib
+import logging
+import logging.handlers
+import threading
+import contextlib
+import contextvars
+
+LOG_FORMAT = '[%(levelname)s] %(asctime)s | %(message)s | request=%(request_id)s task=%(task_id)s indicator=%(indicator)s aoi=%(aoi_hash)s'
+CONTEXT_FIELDS = ('request_id', 'task_id', 'indicator', 'aoi_hash')
+
+_context = contextvars.ContextVar('ldms_log_context', default={})
+_loggers = {}
+_listeners = []
+_pid = None
+_lock = threading.Lock()
 
 def get_log_files():
     """Get location of log files
@@ -8,18 +39,104 @@ def get_log_files():
     Returns:
         list(main_log, error_log)
     """
-    main_log = os.environ.get("LOGFILE", "logs/main.log") 
+    main_log = os.environ.get("LOGFILE", "logs/main.log")
     error_log = os.environ.get("ERROR_LOGFILE", "logs/error.log")
 
     # Create the file if it does not exist
+    for path in [main_log, error_log]:
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
     if not os.path.exists(main_log):
         open(main_log, 'w').close()
     if not os.path.exists(error_log):
         open(error_log, 'w').close()
     return (main_log, error_log)
 
+def get_log_context():
+    """Get the fields added to the records logged by the current request or job
+    """
+    return _context.get()
+
+@contextlib.contextmanager
+def log_context(**fields):
+    """Add fields to the records logged within the block e.g `with log_context(task_id=task.id):`
+
+    Args:
+        fields: Values of CONTEXT_FIELDS. Fields of enclosing blocks are kept
+    """
+    token = _context.set({**_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+def set_log_context(**fields):
+    """Add fields to the records logged by the rest of the current job. See `log_context`
+    """
+    _context.set({**_context.get(), **fields})
+
+def new_request_id(request=None):
+    """Get the id of a request from its X-Request-ID header or generate one
+
+    Args:
+        request (HttpRequest, optional): Web request
+    """
+    request_id = request.META.get('HTTP_X_REQUEST_ID') if request is not None else None
+    return request_id or uuid.uuid4().hex[:16]
+
+def get_aoi_hash(params):
+    """Get a short hash of the area of interest of an analysis
+
+    Args:
+        params (dict): Parameters of the analysis
+    """
+    aoi = {x: params.get(x) for x in ['admin_level', 'vector', 'custom_coords']}
+    return hashlib.sha1(json.dumps(aoi, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:12]
+
+class ContextFilter(logging.Filter):
+    """
+    Add the fields of `log_context` to the records. Fields passed with `extra` take precedence
+    """
+    def filter(self, record):
+        context = _context.get()
+        for fld in CONTEXT_FIELDS:
+            if not hasattr(record, fld):
+                setattr(record, fld, context.get(fld, "-"))
+        return True
+
+def _start_listener(path):
+    """Start a thread writing the records put on a queue to a log file
+
+    Returns:
+        Queue: Queue the records are put on
+    """
+    handler = logging.handlers.RotatingFileHandler(path,
+        maxBytes=10*1024*1024, #set to 10mb max size
+        backupCount=100)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    records = queue.Queue(-1)
+    listener = logging.handlers.QueueListener(records, handler)
+    listener.start()
+    _listeners.append(listener)
+    return records
+
+def _stop_listeners():
+    if _pid == os.getpid():
+        for listener in _listeners:
+            listener.stop() # writes the records left on the queue
+        _listeners.clear()
+
+atexit.register(_stop_listeners)
+
+def flush_logs():
+    """Wait until the records logged by this process are written to the log files
+    """
+    if _pid == os.getpid():
+        for listener in _listeners:
+            listener.queue.join()
+
 def _get_logger(is_error):
-    """Get a logger 
+    """Get a logger
 
     Args:
         is_error (bool): Are we logging errors ?
@@ -27,26 +144,47 @@ def _get_logger(is_error):
     Returns:
         Logger
     """
-    LOG_FILES = get_log_files()
-    handler = logging.handlers.RotatingFileHandler(LOG_FILES[0] if not is_error else LOG_FILES[1],
-        maxBytes=10*1024*1024, #set to 10mb max size
-        backupCount=100)
-    # LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-    LOG_FORMAT = '[%(levelname)s] %(asctime)s | %(message)s' 
-    # formatter = logging.Formatter(logging.BASIC_FORMAT)
-    formatter = logging.Formatter(LOG_FORMAT)
-    handler.setFormatter(formatter)
-
-    logger = logging.getLogger('ldms.apps.{__name__}' + str(is_error))
-    logger.setLevel(logging.WARNING if is_error else logging.INFO)
-    if (logger.hasHandlers()):# Do this to stop duplicated output
-        logger.handlers.clear()
-    logger.addHandler(handler)
-    logger.propagate = True
-    return logger
- 
-def log(message):
-    _get_logger(False).info(str(message))
-
-def log_error(error):
-    _get_logger(True).exception(str(error))
\ No newline at end of file
+    global _pid
+    if _pid == os.getpid():
+        return _loggers[is_error]
+    with _lock:
+        if _pid != os.getpid(): # first call or forked process whose listener threads were not copied
+            _listeners.clear()
+            LOG_FILES = get_log_files()
+            for key in [False, True]:
+                logger = logging.getLogger('ldms.apps.{__name__}' + str(key))
+                logger.setLevel(logging.WARNING if key else logging.INFO)
+                if (logger.hasHandlers()):# Do this to stop duplicated output
+                    logger.handlers.clear()
+                handler = logging.handlers.QueueHandler(_start_listener(LOG_FILES[1] if key else LOG_FILES[0]))
+                handler.addFilter(ContextFilter())
+                logger.addHandler(handler)
+                logger.propagate = True
+                _loggers[key] = logger
+            _pid = os.getpid()
+    return _loggers[is_error]
+
+def log(message, **fields):
+    """Log a message
+
+    Args:
+        fields: Fields of the record overriding those of `log_context`
+    """
+    _get_logger(False).info(str(message), extra=fields)
+
+def log_error(error, **fields):
+    """Log an error with the traceback of the exception being handled if any
+    """
+    _get_logger(True).exception(str(error), extra=fields)
+
+def log_job_exception(job, exc_type, exc_value, traceback):
+    """RQ exception handler logging the error of a failed job and writing the records of the job
+    before its process exits. See settings.RQ_EXCEPTION_HANDLERS
+
+    Returns:
+        bool: True so that the next handlers run
+    """
+    _get_logger(True).error("Job %s failed: %s" % (job.id, exc_value), 
+                            exc_info=(exc_type, exc_value, traceback))
+    flush_logs()
+    return True
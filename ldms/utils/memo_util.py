@@ -0,0 +1,55 @@
+"""
+Memo of sub-indicator computations shared within a single analysis run.
+
+Composite indicators build their sub-indicators from the same kwargs, e.g
+LandDegradation computes SOC, LULC and Productivity while SOC computes LULC change
+again. A `ComputationMemo` is passed to every indicator through the `memo` kwarg so
+that a computation with the same indicator, parameters and area of interest only
+runs once. Memoized values are shared and must not be modified by the callers.
+"""
+
+import json
+from ldms.utils.vector_util import get_geometry_hash
+
+class ComputationMemo:
+	"""
+	Results of computations keyed by (indicator, parameters, AOI)
+	"""
+	def __init__(self):
+		self.results = {}
+		self.hits = 0
+
+	def make_key(self, indicator, params, vector):
+		"""Generate the key of a computation
+
+		Args:
+			indicator (string): Name of the computation
+			params (dict): Parameters that determine the result
+			vector (geojson): Area of interest
+		"""
+		return (indicator,
+				json.dumps(params, sort_keys=True, default=str),
+				get_geometry_hash(vector) if vector else None)
+
+	def get_or_compute(self, indicator, params, vector, func):
+		"""Return the memoized result of a computation, computing it if it has not been done yet
+
+		Args:
+			indicator (string): Name of the computation
+			params (dict): Parameters that determine the result
+			vector (geojson): Area of interest
+			func (function): Function without arguments that does the computation
+		"""
+		key = self.make_key(indicator, params, vector)
+		if key in self.results:
+			self.hits += 1
+		else:
+			self.results[key] = func()
+		return self.results[key]
+
+def get_or_compute(memo, indicator, params, vector, func):
+	"""Same as `ComputationMemo.get_or_compute` but computes the result directly if `memo` is None
+	"""
+	if memo is None:
+		return func()
+	return memo.get_or_compute(indicator, params, vector, func)
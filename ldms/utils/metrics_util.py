@@ -0,0 +1,184 @@
+"""
+Prometheus metrics of the analyses.
+
+Metrics are exposed on /metrics/ (see `ldms.views.metrics`) when prometheus_client is installed
+and settings.METRICS['ENABLED'] is set, else recording them does nothing. The web server
+and the RQ workers run in different processes, so when settings.METRICS['MULTIPROC_DIR'] is
+set, each process writes its values to that directory and /metrics/ aggregates them. The
+directory must be shared by the web server and the workers and emptied when they are
+restarted. Workers must use `MetricsWorker` so that the values of the work-horse of each job are
+marked dead once it exits. The depth of the RQ queues is read from Redis when /metrics/ is scraped,
+never when the module is imported. /metrics/ is only served to staff users and to the clients in
+settings.METRICS['ALLOWED_NETWORKS'].
+"""
+
+import time
+import ipaddress
+import threading
+import contextlib
+import django_rq
+from rq import Worker
+from django.conf import settings
+
+try:
+	import prometheus_client
+	from prometheus_client import Counter, Histogram, CollectorRegistry, multiprocess
+	from prometheus_client.core import GaugeMetricFamily
+except ImportError:
+	prometheus_client = None
+
+DEFAULT_METRICS_SETTINGS = {
+	'ENABLED': False,
+	'MULTIPROC_DIR': None,
+	'ALLOWED_NETWORKS': ["127.0.0.1/32", "::1/128"],
+}
+
+ANALYSIS_BUCKETS = (0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, 7200, float("inf"))
+STAGE_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 1800, float("inf"))
+
+def get_metrics_settings():
+	"""Get settings of the metrics. Values are read from settings.METRICS
+	"""
+	setts = DEFAULT_METRICS_SETTINGS.copy()
+	setts.update(getattr(settings, 'METRICS', {}))
+	return setts
+
+def is_metrics_enabled():
+	return prometheus_client is not None and get_metrics_settings()['ENABLED']
+
+if prometheus_client:
+	ANALYSIS_SECONDS = Histogram("ldms_analysis_seconds",
+						"Duration of analyses. Queued analyses include the time spent in the queue",
+						["endpoint", "queued"], buckets=ANALYSIS_BUCKETS)
+	STAGE_SECONDS = Histogram("ldms_stage_seconds", "Duration of the stages of analyses",
+						["stage"], buckets=STAGE_BUCKETS)
+	RASTER_BYTES = Counter("ldms_raster_read_bytes", "Bytes of raster read", ["stage"])
+	RASTER_PIXELS = Counter("ldms_raster_read_pixels", "Pixels of raster read", ["stage"])
+	CACHE_REQUESTS = Counter("ldms_result_cache_requests", "Lookups of the cache of analysis results",
+						["endpoint", "result"])
+	ENQUEUED_JOBS = Counter("ldms_enqueued_jobs", "Jobs queued", ["queue"])
+
+def observe_analysis(endpoint, seconds, queued=False):
+	"""Record the duration of an analysis
+
+	Args:
+		endpoint (string): Name of the API e.g lulc
+		seconds (float): Duration
+		queued (bool): True if the analysis was queued
+	"""
+	if is_metrics_enabled():
+		ANALYSIS_SECONDS.labels(endpoint=endpoint, queued=str(queued).lower()).observe(seconds)
+
+@contextlib.contextmanager
+def time_analysis(endpoint):
+	"""Record the duration of an analysis computed within the request
+	"""
+	start = time.time()
+	try:
+		yield
+	finally:
+		observe_analysis(endpoint, time.time() - start)
+
+def observe_stage(stage, seconds, bytes_read=0, pixels=0):
+	"""Record the duration of a stage and the raster it read. See `ldms.utils.instrument_util`
+	"""
+	if not is_metrics_enabled():
+		return
+	STAGE_SECONDS.labels(stage=stage).observe(seconds)
+	if bytes_read:
+		RASTER_BYTES.labels(stage=stage).inc(bytes_read)
+	if pixels:
+		RASTER_PIXELS.labels(stage=stage).inc(pixels)
+
+def count_cache_request(endpoint, hit):
+	"""Count a lookup of the cache of analysis results
+	"""
+	if is_metrics_enabled():
+		CACHE_REQUESTS.labels(endpoint=endpoint, result="hit" if hit else "miss").inc()
+
+def count_enqueued_job(queue_name):
+	if is_metrics_enabled():
+		ENQUEUED_JOBS.labels(queue=queue_name).inc()
+
+class QueueCollector:
+	"""
+	Collect the number of jobs of the RQ queues by state when the metrics are scraped
+	"""
+	def collect(self):
+		gauge = GaugeMetricFamily("ldms_queue_jobs", "Jobs of the RQ queues", labels=["queue", "state"])
+		for name in settings.RQ_QUEUES:
+			try:
+				queue = django_rq.get_queue(name)
+				gauge.add_metric([name, "queued"], queue.count)
+				gauge.add_metric([name, "started"], queue.started_job_registry.count)
+				gauge.add_metric([name, "deferred"], queue.deferred_job_registry.count)
+				gauge.add_metric([name, "failed"], queue.failed_job_registry.count)
+			except Exception: # a queue whose Redis is unreachable must not break the other metrics
+				continue
+		yield gauge
+
+def get_registry():
+	"""Get a registry with the metrics of all the processes and the depth of the queues
+	"""
+	setts = get_metrics_settings()
+	if not setts['MULTIPROC_DIR']:
+		register_queue_collector()
+		return prometheus_client.REGISTRY
+	registry = CollectorRegistry()
+	multiprocess.MultiProcessCollector(registry, path=setts['MULTIPROC_DIR'])
+	registry.register(QueueCollector())
+	return registry
+
+QUEUE_COLLECTOR = None
+QUEUE_COLLECTOR_LOCK = threading.Lock()
+
+def register_queue_collector():
+	"""Register the depth of the queues with the default registry on the first scrape. The default 
+	registry collects the metrics it registers, so registering them on import would query Redis
+	"""
+	global QUEUE_COLLECTOR
+	with QUEUE_COLLECTOR_LOCK:
+		if QUEUE_COLLECTOR is None:
+			QUEUE_COLLECTOR = QueueCollector()
+			prometheus_client.REGISTRY.register(QUEUE_COLLECTOR)
+
+def is_metrics_client_allowed(request):
+	"""Check if a request may read the metrics i.e it comes from a staff user or from one of 
+	settings.METRICS['ALLOWED_NETWORKS']
+	"""
+	user = getattr(request, 'user', None)
+	if user is not None and user.is_staff:
+		return True
+	try:
+		address = ipaddress.ip_address(request.META.get('REMOTE_ADDR') or "")
+	except ValueError:
+		return False
+	networks = get_metrics_settings()['ALLOWED_NETWORKS']
+	return any([address in ipaddress.ip_network(x, strict=False) for x in networks])
+
+def mark_process_dead(pid):
+	"""Mark the values written by a process that exited as dead. See `MetricsWorker`
+	"""
+	setts = get_metrics_settings()
+	if is_metrics_enabled() and setts['MULTIPROC_DIR'] and pid:
+		multiprocess.mark_process_dead(pid, path=setts['MULTIPROC_DIR'])
+
+class MetricsWorker(Worker):
+	"""
+	RQ worker marking the metrics of the work-horse of each job as dead once it exits. 
+	See settings.RQ['WORKER_CLASS']
+	"""
+	def monitor_work_horse(self, job, queue):
+		pid = self.horse_pid
+		try:
+			return super().monitor_work_horse(job, queue)
+		finally:
+			mark_process_dead(pid)
+
+def generate_metrics():
+	"""Get the metrics in the Prometheus text format
+
+	Returns:
+		tuple(bytes, string): Metrics and content type
+	"""
+	return (prometheus_client.generate_latest(get_registry()), prometheus_client.CONTENT_TYPE_LATEST)
@@ -0,0 +1,88 @@
+"""
+Parallel execution of the independent stages of composite indicators.
+
+Trajectory, state and performance (Productivity), CQI, SQI, VQI and MQI (ESAI) and
+SOC, LULC and Productivity (Land Degradation) do not depend on each other until they
+are combined. When SystemSettings.enable_parallel_stages is set, the stages run in a
+pool of forked processes. Forking lets the workers inherit the indicator objects
+(including the request) so only the index of the stage and its result are pickled.
+
+Forked stages do not share the `ComputationMemo` of the run: each worker gets a copy of the
+memo as it was when the stages started, and the values memoized by a stage are lost when
+it returns. Computations needed by several stages are only done once if they are memoized
+before `run_stages` is called.
+"""
+
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from django import db
+from ldms.utils.settings_util import get_settings
+from ldms.utils.instrument_util import timed_stage
+
+_stages = [] # stages of the current run, inherited by the forked workers
+_in_worker = False # nested stages e.g Productivity within Land Degradation run sequentially
+
+def get_stage_workers():
+	"""Get the number of processes to use for the stages. 0 means the stages run sequentially
+	"""
+	if _in_worker:
+		return 0
+	setts = get_settings()
+	if not setts.enable_parallel_stages:
+		return 0
+	return setts.max_stage_workers or os.cpu_count()
+
+def stage(indicator, method, *args, **kwargs):
+	"""Wrap an indicator method into a stage
+
+	Args:
+		indicator (object): Indicator object whose `error` attribute is set on failure
+		method (function): Bound method of `indicator` that computes the stage
+
+	Returns:
+		function: Function without arguments returning a tuple (result, error)
+	"""
+	def run():
+		indicator.error = None
+		result = method(*args, **kwargs)
+		if indicator.error:
+			return (None, indicator.error)
+		return (result, None)
+	return run
+
+def _run_stage(index):
+	global _in_worker
+	_in_worker = True
+	return _stages[index]()
+
+def run_stages(stages):
+	"""Run independent stages, in parallel if enabled in the system settings
+
+	When running sequentially, stages after the first one that fails are skipped.
+
+	Args:
+		stages (list): Functions created by `stage`
+
+	Returns:
+		list: Tuples (result, error) in the same order as `stages`
+	"""
+	global _stages
+	workers = min(get_stage_workers(), len(stages))
+	if workers <= 1:
+		results = []
+		for stg in stages:
+			results.append(stg())
+			if results[-1][1]:
+				break
+		return results
+
+	_stages = stages
+	# database connections must not be shared with the forked processes
+	db.connections.close_all()
+	try:
+		with timed_stage("parallel_stages"), ProcessPoolExecutor(max_workers=workers,
+								mp_context=multiprocessing.get_context("fork")) as executor:
+			return list(executor.map(_run_stage, range(len(stages))))
+	finally:
+		_stages = []
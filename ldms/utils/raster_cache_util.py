@@ -0,0 +1,224 @@
+"""
+Cache of clipped rasters.
+
+Clipping the same raster with the same polygon happens many times within a request
+(e.g productivity clips the NDVI rasters for trajectory, state and performance) and
+across requests for the same administrative unit. Clipped rasters are stored on disk
+and the most recently used arrays are also kept in memory.
+Both tiers evict the least recently used entries once their byte budget is exceeded.
+Rasters in the temp directory e.g the output of `reproject_raster` are not cached since
+their paths, and therefore their keys, are never reused.
+"""
+
+import os
+import json
+import hashlib
+import uuid
+import shutil
+import tempfile
+import threading
+import collections
+import rasterio
+from django.conf import settings
+from ldms.utils.file_util import get_temp_file
+from ldms.utils.vector_util import get_geometry_hash
+
+DEFAULT_CACHE_SETTINGS = {
+	'ENABLED': True,
+	'LOCATION': os.path.join(settings.MEDIA_ROOT, "cache", "clipped"),
+	'MAX_BYTES': 2 * 1024 ** 3,
+	'MEMORY_MAX_BYTES': 256 * 1024 ** 2,
+}
+
+def get_cache_settings():
+	"""Get settings of the clipped raster cache. Values are read from settings.CLIPPED_RASTER_CACHE
+	"""
+	setts = DEFAULT_CACHE_SETTINGS.copy()
+	setts.update(getattr(settings, 'CLIPPED_RASTER_CACHE', {}))
+	return setts
+
+def generate_clip_cache_key(raster_file, vector, dest_nodata, clipping_algorithm):
+	"""Generate a key that identifies a clipped raster
+
+	The key changes whenever the source raster file is modified.
+
+	Args:
+		raster_file (string): Absolute path of the raster to be clipped
+		vector (geojson): Polygon used for clipping
+		dest_nodata (number): Nodata value of the clipped raster
+		clipping_algorithm (string): Value of SystemSettings.raster_clipping_algorithm
+	"""
+	stat = os.stat(raster_file)
+	obj = [os.path.abspath(raster_file), stat.st_mtime_ns, stat.st_size,
+			get_geometry_hash(vector), str(dest_nodata), clipping_algorithm]
+	return hashlib.sha1(json.dumps(obj).encode("utf-8")).hexdigest()
+
+def is_temp_file(raster_file):
+	"""Check if a raster is in the temp directory e.g a file generated by `get_temp_file`
+	"""
+	temp_dir = os.path.realpath(tempfile.gettempdir())
+	return os.path.commonpath([os.path.realpath(raster_file), temp_dir]) == temp_dir
+
+class ClippedRasterCache:
+	"""
+	Two tier (memory and disk) LRU cache of clipped rasters.
+
+	Entries are (array, file, nodata) tuples as returned by `clip_raster_to_vector`.
+	Files are stored as <key>.tif in the cache directory. The modification time of the
+	files is updated on every hit so that the disk tier can be evicted in LRU order.
+	Callers get a private path of the file, see `checkout`, so that evicting an entry never
+	removes a file that is still being read.
+	"""
+	def __init__(self, location, max_bytes, memory_max_bytes):
+		self.location = location
+		self.max_bytes = max_bytes
+		self.memory_max_bytes = memory_max_bytes
+		self.memory = collections.OrderedDict()
+		self.memory_bytes = 0
+		self.lock = threading.Lock()
+		os.makedirs(self.location, exist_ok=True)
+
+	def get_file_path(self, key):
+		return os.path.join(self.location, "%s.tif" % key)
+
+	def get(self, key):
+		"""Retrieve a cached clipped raster
+
+		Returns:
+			tuple (array, file, nodata) or None if the key is not cached
+		"""
+		with self.lock:
+			if key in self.memory:
+				self.memory.move_to_end(key)
+				out_image, out_file, nodata = self.memory[key]
+				try:
+					self.touch(out_file)
+					# return a copy since callers may modify the array
+					return (out_image.copy(), self.checkout(out_file), nodata)
+				except OSError: # the file has been evicted by another process
+					self.remove_from_memory(key)
+
+		out_file = self.get_file_path(key)
+		if not os.path.exists(out_file):
+			return None
+		try:
+			with rasterio.open(out_file) as src:
+				out_image = src.read()
+				nodata = src.nodata
+		except rasterio.errors.RasterioIOError:
+			return None
+		self.touch(out_file)
+		self.add_to_memory(key, out_image, out_file, nodata)
+		try:
+			out_file = self.checkout(out_file)
+		except OSError: # evicted by another process in the meantime
+			return None
+		return (out_image.copy(), out_file, nodata)
+
+	def set(self, key, out_image, out_file, nodata):
+		"""Store a clipped raster
+
+		Args:
+			key (string): Cache key
+			out_image (array): Clipped raster
+			out_file (string): File the clipped raster was written to. It is moved to the cache
+			nodata (number): Nodata value
+
+		Returns:
+			string: Private path of the cached file. See `checkout`
+		"""
+		cached_file = self.get_file_path(key)
+		try:
+			# renaming is atomic so other processes never read a partial file
+			os.replace(out_file, cached_file)
+		except OSError: # out_file is on another file system, it remains the private path
+			tmp_file = os.path.join(self.location, "%s.%s.tmp" % (key, uuid.uuid4().hex))
+			shutil.copyfile(out_file, tmp_file)
+			os.replace(tmp_file, cached_file)
+		else:
+			out_file = self.checkout(cached_file)
+		self.add_to_memory(key, out_image, cached_file, nodata)
+		self.evict()
+		return out_file
+
+	def checkout(self, cached_file):
+		"""Get a private path of a cached file in the temp dir
+
+		The path is a hard link to the cached file, so it costs no write and remains valid 
+		after the entry has been evicted. The file is copied if the temp dir is on another 
+		file system than the cache.
+
+		Returns:
+			string: Path of the file
+		"""
+		out_file = get_temp_file(suffix=".tif")
+		os.remove(out_file) # get_temp_file creates an empty file
+		try:
+			os.link(cached_file, out_file)
+		except OSError:
+			shutil.copyfile(cached_file, out_file)
+		return out_file
+
+	def touch(self, file):
+		try:
+			os.utime(file)
+		except OSError:
+			pass
+
+	def add_to_memory(self, key, out_image, out_file, nodata):
+		with self.lock:
+			if out_image.nbytes > self.memory_max_bytes:
+				return
+			self.remove_from_memory(key)
+			self.memory[key] = (out_image, out_file, nodata)
+			self.memory_bytes += out_image.nbytes
+			while self.memory_bytes > self.memory_max_bytes:
+				self.remove_from_memory(next(iter(self.memory)))
+
+	def remove_from_memory(self, key):
+		if key in self.memory:
+			out_image, out_file, nodata = self.memory.pop(key)
+			self.memory_bytes -= out_image.nbytes
+
+	def evict(self):
+		"""Delete the least recently used files until the size of the disk tier is within the budget
+		"""
+		entries = []
+		for entry in os.scandir(self.location):
+			if entry.is_file() and entry.name.endswith(".tif"):
+				stat = entry.stat()
+				entries.append((stat.st_mtime, stat.st_size, entry.path))
+		total = sum([x[1] for x in entries])
+		for mtime, size, path in sorted(entries):
+			if total <= self.max_bytes:
+				break
+			try:
+				os.remove(path)
+			except OSError:
+				pass
+			total -= size
+			with self.lock:
+				key = os.path.basename(path)[:-len(".tif")]
+				self.remove_from_memory(key)
+
+	def clear(self):
+		with self.lock:
+			self.memory.clear()
+			self.memory_bytes = 0
+		shutil.rmtree(self.location, ignore_errors=True)
+		os.makedirs(self.location, exist_ok=True)
+
+_cache = None
+
+def get_clip_cache():
+	"""Get the process wide clipped raster cache. Returns None if the cache is disabled
+	"""
+	global _cache
+	setts = get_cache_settings()
+	if not setts['ENABLED']:
+		return None
+	if _cache is None:
+		_cache = ClippedRasterCache(location=setts['LOCATION'],
+						max_bytes=setts['MAX_BYTES'],
+						memory_max_bytes=setts['MEMORY_MAX_BYTES'])
+	return _cache
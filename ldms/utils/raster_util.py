@@ -19,9 +19,12 @@ import rasterio
 import rasterio.mask
 from rasterio.enums import Resampling
 from rasterio.windows import Window
+from rasterio.vrt import WarpedVRT
 from rasterio.warp import calculate_default_transform, reproject, Resampling
 import tempfile
 import json
+import math
+import rasterio.features
 
 from ldms import AnalysisParamError
 from ldms.models import RegionalAdminLevel, AdminLevelTwo, AdminLevelZero
@@ -29,8 +32,15 @@ from ldms.enums import RasterSourceEnum, GenericRasterBandEnum, MODISBandEnum, \
 	Landsat7BandEnum, Landsat8BandEnum, RasterOperationEnum, RasterCategoryEnum
 from ldms.utils.common_util import cint, list_to_queryset
 from ldms.utils.settings_util import get_settings
+from ldms.utils.raster_cache_util import get_clip_cache, generate_clip_cache_key, is_temp_file
+from ldms.utils.admin_raster_util import get_admin_unit_raster
 from ldms.models import Raster
 from ldms.utils.geoserver_util import GeoServerHelper
+from ldms.utils.instrument_util import timed_stage
+from ldms.utils.scratch_util import scratch_array
+from ldms.utils.dtype_util import get_class_dtype, get_enum_dtype, to_class_dtype
+
+MAX_BINCOUNT_RANGE = 1 << 16 # Maximum range of values of an integer raster counted with np.bincount
 
 class RasterCalcHelper():   
 	"""
@@ -138,7 +148,13 @@ class RasterCalcHelper():
 			# self.raster_band_stats = rasterstats.zonal_stats(vectors=vectors,
 			# 				raster=raster_path,
 			# 				categorical=self.categorical) #[1]
-			self.raster_band_stats = rasterstats.zonal_stats(vectors=vectors,
+			if self.categorical:
+				# count the clipped pixels instead of reading the clipped file again
+				val_counts = get_class_counts(clipped_raster)
+				val_counts.pop(ndata, None)
+				self.raster_band_stats = [val_counts]
+			else:
+				self.raster_band_stats = rasterstats.zonal_stats(vectors=vectors,
 							raster=rastfile,
 							categorical=self.categorical) #[1]
 			
@@ -448,30 +464,35 @@ def harmonize_raster_nodata(arry, file, ref_file):
 	values = np.where(arry == nodata, base_nodata, arry)
 	return values
 
-def save_raster(dataset, source_path, target_path, dtype=rasterio.int32, no_data=None):	
+def save_raster(dataset, source_path, target_path, dtype=None, no_data=None):	
 	"""
 	Write raster dataset to disk
 
 	Args:
 		source_path (string): Path of raster where we will get the Metadata
 		target_path (string): Path to save the raster
+		dtype: Data type of the raster. If None, the smallest integer type holding the values 
+				and nodata, int32 if the values are not integers. See `ldms.utils.dtype_util`
 	"""
 	rasterin = get_absolute_media_path(source_path.replace("//", "/"), use_static_dir=False)
 	rasterout = target_path.replace("//", "/")
  
 	# open source to extract meta
 	meta = get_raster_meta(rasterin) 
+	if no_data:
+		meta.update({
+			"nodata": no_data
+		})
+	if dtype is None:
+		dataset = to_class_dtype(dataset, meta.get('nodata'))
+		dtype = dataset.dtype.name
 	meta.update({
 				 'dtype': dtype, # rasterio.uint8,
 				 'compress': 'lzw',
 				 'height': dataset.shape[0],
 				 'width': dataset.shape[1],				 
 				})	
-	if no_data:
-		meta.update({
-			"nodata": no_data
-		})
-	with rasterio.open(rasterout, 'w', **meta) as dst:		
+	with timed_stage("write", pixels=dataset.size), rasterio.open(rasterout, 'w', **meta) as dst:		
 		# dst.write(dataset.astype(rasterio.uint8), 1)
 		if len(dataset.shape) == 2:
 			dst.write(dataset.astype(dtype), 1)
@@ -578,7 +599,7 @@ def reproject_raster(reference_raster, raster, resampling=Resampling.average, se
 def return_raster_with_stats(request, datasource, prefix, change_enum, 
 							   metadata_raster_path, nodata, resolution,
 							   start_year, end_year, subdir=None, results=None,
-							   extras={}):
+							   extras={}, return_raw=False, val_counts=None):
 	"""Generates a raster and computes the statistics
 
 	Args:
@@ -593,52 +614,180 @@ def return_raster_with_stats(request, datasource, prefix, change_enum,
 		subdir (string): Name of sub directory to save the raster
 		results (object): An object already containing calculated values
 		extras (dict): Extra key value object that you may want to return in addition to std values
+		return_raw (bool): If True, the raster is neither saved nor published and the array is returned 
+					so that composite indicators can use it in memory. See `get_raw_result`
+		val_counts (dict): {value: count} frequency distribution of `datasource` if it has already been computed
 
 	Returns:
 		object : An object with url to download the generated raster and
 					statistics categorized by the change_enum 
 	"""
+	if return_raw:
+		return get_raw_result(datasource, nodata, resolution, metadata_raster_path, 
+					stats_args={'prefix': prefix, 'change_enum': change_enum, 'start_year': start_year, 
+						'end_year': end_year, 'subdir': subdir, 'results': results, 'extras': extras})
+
 	# TODO validate change_enum
 	# if type(change_enum) not in [StateChangeTernaryEnum, PerformanceChangeBinaryEnum, ProductivityChangeTernaryEnum]:
 	# 	raise AnalysisParamError(_("The change enum source specified is invalid. Ensure it is a valid enumeration"))
 	
-	out_file = get_absolute_media_path(file_path=None, 
-									is_random_file=True, 
-									random_file_prefix=prefix,
-									random_file_ext=".tif",
-									sub_dir=subdir,
-									use_static_dir=False)
+	out_file = get_output_raster_path(prefix=prefix, subdir=subdir)
 
 	raster_file = save_raster(dataset=datasource, 
 				source_path=metadata_raster_path,
 				target_path=out_file)
 	
-	raster_url = "%s" % (get_download_url(request, raster_file, use_static_dir=False))
-	results = results or []		
-	
 	# Get counts of change types		
-	# unique, counts = np.unique(datasource[datasource != nodata], return_counts=True)			
-	unique, counts = np.unique(datasource, return_counts=True)			
-	val_counts = dict(zip(unique, counts)) # convert to {val:count} freq distribution dictionary
+	if val_counts is None:
+		with timed_stage("stats", pixels=datasource.size):
+			val_counts = get_class_counts(datasource)
 	
-	if not results:
-		for mapping in change_enum:
-			key = cint(mapping.key)
-			if key in val_counts:
-				val = val_counts[mapping.key]
-				results.append({
-					'change_type': key,
-					'label': str(mapping.label),
-					'count': val,
-					'area': val * (resolution or 1)
-				})
-			else:
-				results.append({
-					'change_type': key,
-					'label': str(mapping.label),
-					'count': 0,
-					'area': 0
-				})
+	return get_raster_stats(request=request, 
+				out_file=out_file,
+				raster_file=raster_file,
+				val_counts=val_counts,
+				change_enum=change_enum,
+				nodata=nodata,
+				resolution=resolution,
+				start_year=start_year,
+				end_year=end_year,
+				results=results,
+				extras=extras)
+
+def get_class_counts(arry, val_counts=None):
+	"""Compute the {value: count} frequency distribution of a raster.
+
+	Integer rasters whose values span a small range (class maps) are counted in a single pass 
+	with `np.bincount` on the values offset by the minimum. Other rasters fall back to `np.unique`.
+
+	Args:
+		arry (array): Raster values. Masked values are not counted
+		val_counts (dict): Frequency distribution to add the counts to e.g when counting a raster 
+						block by block
+
+	Returns:
+		dict: {value: count} frequency distribution
+	"""
+	val_counts = val_counts if val_counts is not None else {}
+	values = arry.compressed() if isinstance(arry, ma.MaskedArray) else np.asarray(arry).ravel()
+	if values.size == 0:
+		return val_counts
+
+	unique, counts = None, None
+	if np.issubdtype(values.dtype, np.integer):
+		min_val, max_val = int(values.min()), int(values.max())
+		if max_val - min_val < MAX_BINCOUNT_RANGE:
+			if min_val != 0 or not np.can_cast(values.dtype, np.intp):
+				values = values.astype(np.intp) - min_val
+			counts = np.bincount(values, minlength=max_val - min_val + 1)
+			unique = np.nonzero(counts)[0]
+			counts = counts[unique]
+			unique = unique + min_val
+	if unique is None:
+		unique, counts = np.unique(values, return_counts=True)
+
+	for val, count in zip(unique.tolist(), counts):
+		val_counts[val] = val_counts.get(val, 0) + count
+	return val_counts
+
+def get_raw_result(datasource, nodata, resolution, metadata_raster_path, stats_args=None):
+	"""Result of an indicator that is passed in memory to a composite indicator
+
+	Args:
+		stats_args (dict): Remaining arguments of `return_raster_with_stats` so that the statistics 
+					can be computed later e.g once the tiles of a large area are merged
+
+	Returns:
+		dict: {datasource, nodata, resolution, meta_path, stats_args}
+	"""
+	return {
+		'datasource': datasource,
+		'nodata': nodata,
+		'resolution': resolution,
+		'meta_path': metadata_raster_path,
+		'stats_args': stats_args or {}
+	}
+
+def is_raw_result(result):
+	"""Check if `result` was returned by `get_raw_result`
+	"""
+	return isinstance(result, dict) and 'datasource' in result
+
+def return_raster_with_stats_by_block(request, raster_files, vector, func, prefix, change_enum, 
+							   nodata, resolution, start_year, end_year, subdir=None, 
+							   results=None, extras={}, dtype=None):
+	"""Same as `return_raster_with_stats` but the raster is clipped, computed and written 
+	block by block. The counts of each class are accumulated as the blocks are written.
+
+	Args:
+		request (request): Http Request
+		raster_files (list): Paths of the input rasters. The first raster determines the output grid
+		vector (geojson): Polygon to be used for clipping
+		func (function): Function that computes an output block from a list of input blocks.
+						See `write_raster_by_block`
+		prefix (string): Name to prefix the generated raster with
+		change_enum (enum.Enum): Type of Enumeration for different changes
+		nodata (int): Value of nodata
+		resolution (int): Resolution to use to compute statistics
+		subdir (string): Name of sub directory to save the raster
+		results (object): An object already containing calculated values
+		extras (dict): Extra key value object that you may want to return in addition to std values
+		dtype: Data type of the generated raster. If None, the smallest integer type holding the 
+				keys of change_enum and nodata, int32 if nodata is not an integer
+
+	Returns:
+		object : An object with url to download the generated raster and
+					statistics categorized by the change_enum 
+	"""
+	out_file = get_output_raster_path(prefix=prefix, subdir=subdir)
+	if dtype is None:
+		dtype = (get_enum_dtype(change_enum, nodata) or np.dtype(np.int32)).name
+	val_counts = write_raster_by_block(raster_files=raster_files, 
+				vector=vector, 
+				func=func, 
+				out_file=out_file, 
+				nodata=nodata,
+				dtype=dtype)
+
+	return get_raster_stats(request=request, 
+				out_file=out_file,
+				raster_file=out_file.split("/")[-1],
+				val_counts=val_counts,
+				change_enum=change_enum,
+				nodata=nodata,
+				resolution=resolution,
+				start_year=start_year,
+				end_year=end_year,
+				results=results,
+				extras=extras)
+
+def get_output_raster_path(prefix, subdir=None):
+	"""Get a random path in the media directory to save a generated raster
+	"""
+	return get_absolute_media_path(file_path=None, 
+									is_random_file=True, 
+									random_file_prefix=prefix,
+									random_file_ext=".tif",
+									sub_dir=subdir,
+									use_static_dir=False)
+
+def get_raster_stats(request, out_file, raster_file, val_counts, change_enum, nodata, 
+					 resolution, start_year, end_year, results=None, extras={}):
+	"""Build the statistics object of a generated raster
+
+	Args:
+		request (request): Http Request
+		out_file (string): Full path of the generated raster
+		raster_file (string): Name of the generated raster
+		val_counts (dict): {value: count} frequency distribution of the raster values
+		change_enum (enum.Enum): Type of Enumeration for different changes
+		nodata (int): Value of nodata
+		resolution (int): Resolution to use to compute statistics
+		results (object): An object already containing calculated values
+		extras (dict): Extra key value object that you may want to return in addition to std values
+	"""
+	raster_url = "%s" % (get_download_url(request, raster_file, use_static_dir=False))
+	results = results or get_change_stats(val_counts, change_enum, resolution)
 
 	nodata_count = 0 
 	if nodata in val_counts:
@@ -664,6 +813,37 @@ def return_raster_with_stats(request, datasource, prefix, change_enum,
 		} 
 	return stats_obj      
 
+def get_change_stats(val_counts, change_enum, resolution):
+	"""Get the count and the area of each class of a raster
+
+	Args:
+		val_counts (dict): {value: count} frequency distribution of the raster values
+		change_enum (enum.Enum): Type of Enumeration for different changes
+		resolution (int): Resolution to use to compute statistics
+
+	Returns:
+		list: [{change_type, label, count, area}] in the order of change_enum
+	"""
+	results = []
+	for mapping in change_enum:
+		key = cint(mapping.key)
+		if key in val_counts:
+			val = val_counts[mapping.key]
+			results.append({
+				'change_type': key,
+				'label': str(mapping.label),
+				'count': val,
+				'area': val * (resolution or 1)
+			})
+		else:
+			results.append({
+				'change_type': key,
+				'label': str(mapping.label),
+				'count': 0,
+				'area': 0
+			})
+	return results
+
 def generate_tiles(raster_file, nodata, change_enum):
 	"""Generate Tiles
 
@@ -675,8 +855,9 @@ def generate_tiles(raster_file, nodata, change_enum):
 	Returns:
 		Returns a WMS url
 	"""
-	geo = GeoServerHelper(analysis_enum=change_enum, nodata=nodata)
-	return geo.upload_raster(raster_file) 
+	with timed_stage("publish"):
+		geo = GeoServerHelper(analysis_enum=change_enum, nodata=nodata)
+		return geo.upload_raster(raster_file) 
 
 def test():	
 	x = np.array([1, 2, 3])
@@ -702,23 +883,23 @@ def do_raster_operation(rasters, operation, nodata):
 		
 		masked_rasters = []
 		# Mask nodata values
-		for i, itm in enumerate(rasters):
+		for itm in rasters:
 			# loop because np.ma.<arithmetic> replaces the masked values
 			itm = ma.array(itm, fill_value=nodata)
 			itm[itm==nodata] = ma.masked
 			masked_rasters.append(itm)
 
-			if i == 0:
-				res = itm
-			else:
-				if operation == RasterOperationEnum.ADD:
-					res = np.ma.add(res, itm)
-				elif operation == RasterOperationEnum.SUBTRACT:
-					res = np.ma.subtract(res, itm)
-				elif operation == RasterOperationEnum.MULTIPLY:
-					res = np.ma.multiply(res, itm)
-				elif operation == RasterOperationEnum.DIVIDE:
-					res = np.ma.divide(res, itm)
+		if len(masked_rasters) == 1:
+			res = masked_rasters[0]
+		elif operation == RasterOperationEnum.DIVIDE:
+			res = np.ma.divide(masked_rasters[0], masked_rasters[1])
+		elif masked_rasters:
+			ufuncs = {
+				RasterOperationEnum.ADD: np.add,
+				RasterOperationEnum.SUBTRACT: np.subtract,
+				RasterOperationEnum.MULTIPLY: np.multiply,
+			}
+			res = accumulate_masked(ufuncs[operation], masked_rasters, nodata) if operation in ufuncs else masked_rasters[0]
 		
 		# if operation == RasterOperationEnum.ADD:
 		# 	res = np.add.reduce(masked_rasters)
@@ -749,6 +930,138 @@ def do_raster_operation(rasters, operation, nodata):
 	# 		raise AnalysisParamError(_("The list must contain only 2 arrays"))
 	# return res
 
+def accumulate_masked(ufunc, rasters, nodata):
+	"""Apply a binary ufunc to masked rasters cumulatively e.g ((a * b) * c) * d
+
+	Gives the same result as chaining np.ma.<ufunc> but writes to a single array allocated
+	by `scratch_array` instead of allocating the data and mask of every intermediate result.
+
+	Args:
+		ufunc (ufunc): e.g np.multiply
+		rasters (list): Masked arrays
+		nodata (number): Fill value of the result
+
+	Returns:
+		MaskedArray: Masked where any of the rasters is masked. The data of the masked pixels 
+			is that of the first raster, as with np.ma
+	"""
+	shape = np.broadcast(*[ma.getdata(x) for x in rasters]).shape
+	data = scratch_array(shape, dtype=np.result_type(*[ma.getdata(x) for x in rasters]))
+	mask = scratch_array(shape, dtype=bool)
+	valid = scratch_array(shape, dtype=bool)
+	data[...] = ma.getdata(rasters[0])
+	mask[...] = ma.getmaskarray(rasters[0])
+	for raster in rasters[1:]:
+		np.logical_or(mask, ma.getmaskarray(raster), out=mask)
+		np.logical_not(mask, out=valid)
+		with np.errstate(all='ignore'):
+			ufunc(data, ma.getdata(raster), out=data, where=valid)
+	return ma.array(data, mask=mask, fill_value=nodata)
+
+def reclassify(array, breaks, labels, nodata):
+	"""Reclassify values of an array into classes in a single pass
+
+	Values x where breaks[i] <= x < breaks[i + 1] are assigned labels[i].
+	Values outside the breaks, nan values, masked values and values equal 
+	to nodata are assigned nodata
+
+	Args:
+		array (ndarray | MaskedArray): Array to reclassify
+		breaks (list): Sorted class boundaries. Must have one more element than labels
+		labels (list): Values to assign to each class
+		nodata (number): Nodata value
+
+	Returns:
+		ndarray: Reclassified array with the same shape as `array`
+	"""
+	values = ma.getdata(array)
+	invalid = ma.getmaskarray(array) | (values == nodata)
+	if np.issubdtype(values.dtype, np.floating):
+		invalid |= np.isnan(values)
+	lookup = np.array([nodata] + list(labels) + [nodata])
+	lookup = lookup.astype(get_class_dtype(lookup) or lookup.dtype) # e.g uint8 for the class enums
+	out = lookup[np.searchsorted(np.asarray(breaks, dtype=np.float64), values, side='right')]
+	out[invalid] = nodata
+	return out
+
+def get_reclassification_breaks(matrix, nodata, key='mapping'):
+	"""Convert a reclassification matrix into breaks and labels to be used by `reclassify`
+
+	The matrix is a list of dicts of the form {'low': x, 'high': y, `key`: z}.
+	Where rows overlap, the last row takes precedence (same as applying the rows in order).
+	Ranges not covered by any row are assigned nodata
+
+	Args:
+		matrix (list): Reclassification matrix
+		nodata (number): Nodata value
+		key (str): Key of the value to assign
+
+	Returns:
+		tuple (breaks, labels)
+	"""
+	breaks = sorted(set([row['low'] for row in matrix] + [row['high'] for row in matrix]))
+	labels = []
+	for low, high in zip(breaks[:-1], breaks[1:]):
+		label = nodata
+		for row in matrix:
+			if row['low'] <= low and row['high'] >= high:
+				label = row[key]
+		labels.append(label)
+	return (breaks, labels)
+
+def reclassify_by_matrix(array, matrix, nodata, key='mapping'):
+	"""Reclassify an array using a matrix of {'low', 'high', `key`} rows
+
+	Args:
+		array (ndarray | MaskedArray): Array to reclassify
+		matrix (list): Reclassification matrix
+		nodata (number): Nodata value
+		key (str): Key of the value to assign
+
+	Returns:
+		ndarray: Reclassified array
+	"""
+	breaks, labels = get_reclassification_breaks(matrix, nodata, key=key)
+	return reclassify(array, breaks, labels, nodata)
+
+def reclassify_combinations(arrays, keys, matrix, nodata, key='mapping'):
+	"""Map combinations of class values of several arrays to a new class value.
+
+	Each row of the matrix holds the value to match for each of `keys` and the value to assign
+	e.g. {'base': 1, 'curr': 2, 'mapping': 3}. Where several rows match, the last row wins. 
+	Pixels that do not match any row are assigned nodata
+
+	Args:
+		arrays (list): Arrays of the same shape, one for each key
+		keys (list): Keys of the matrix rows corresponding to each array
+		matrix (list): Combination matrix
+		nodata (number): Nodata value
+		key (str): Key of the value to assign
+
+	Returns:
+		ndarray: Reclassified array
+	"""
+	shape = np.shape(arrays[0])
+	valid = np.ones(shape, dtype=bool)
+	codes, classes = [], []
+	for arry, itm in zip(arrays, keys):
+		values = np.unique([row[itm] for row in matrix])
+		data = ma.getdata(arry)
+		code = np.clip(np.searchsorted(values, data), 0, len(values) - 1)
+		valid &= ~ma.getmaskarray(arry) & (values[code] == data)
+		codes.append(code)
+		classes.append(values)
+
+	labels = np.array([nodata] + [row[key] for row in matrix])
+	lookup = np.full([len(x) for x in classes], nodata, dtype=get_class_dtype(labels) or labels.dtype)
+	for row in matrix:
+		index = tuple(np.searchsorted(values, row[itm]) for values, itm in zip(classes, keys))
+		lookup[index] = row[key]
+
+	out = np.full(shape, nodata, dtype=lookup.dtype)
+	out[valid] = lookup[tuple(code[valid] for code in codes)]
+	return out
+
 def resample_raster(raster_file, scale=2):
 	"""
 	Resample a raster file.
@@ -885,24 +1198,220 @@ def mask_rasters(rasters, nodata):
 		res.append(arry)
 	return res
 
-def clip_raster_to_vector(raster_file, vector, use_temp_dir=True, dest_nodata=None):
+def is_block_processing_enabled():
+	"""Check if rasters should be processed block by block
 	"""
-	Mask out regions of a raster that are outside the polygons defined in the shapefile.
+	return get_settings().enable_block_processing
+
+def get_block_windows(height, width, window_budget):
+	"""Split a raster of size `height` x `width` into windows of at most `window_budget` pixels.
+	Windows span whole rows where possible so that the output is written in strips.
 
 	Args:
+		height (int): Number of rows
+		width (int): Number of columns
+		window_budget (int): Maximum number of pixels per window
+
+	Returns:
+		generator of rasterio.windows.Window
+	"""
+	window_budget = max(int(window_budget), 1)
+	if width <= window_budget:
+		rows = max(window_budget // max(width, 1), 1)
+		for row in range(0, height, rows):
+			yield Window(0, row, width, min(rows, height - row))
+	else:
+		side = max(int(math.sqrt(window_budget)), 1)
+		for row in range(0, height, side):
+			for col in range(0, width, side):
+				yield Window(col, row, min(side, width - col), min(side, height - row))
+
+class RasterStack:
+	"""
+	Rasters aligned onto the grid of a reference raster and read only within the window of a polygon.
+
+	Each raster is opened once. Rasters whose grid (crs, transform and size) differs from the
+	reference raster are warped on the fly through a `WarpedVRT`, so pixels line up instead of
+	being truncated to the smallest common shape. Only the window covering the polygon is read.
+	Pixels outside the polygon or equal to the nodata value of their raster are masked and
+	their data is set to `nodata`.
+
+	Usage:
+		with RasterStack([r_model.rasterfile.name, k_model.rasterfile.name], vector) as stack:
+			rasters = stack.read() # masked array of shape (rasters, rows, cols)
+	"""
+	def __init__(self, raster_files, vector, ref_file=None, nodata=None, resampling=Resampling.nearest):
+		"""
+		Args:
+			raster_files (list): Paths of the rasters to stack
+			vector (geojson): Polygon to be used for clipping
+			ref_file (string, optional): Raster whose grid the other rasters are aligned to. 
+						Defaults to the first raster
+			nodata (number, optional): Nodata value of the stack. Defaults to the nodata of the reference raster
+			resampling (enum): Rasterio Resampling method used to align the rasters
+		"""
+		self.raster_files = [get_absolute_media_path(x) for x in raster_files]
+		self.ref_file = get_absolute_media_path(ref_file) if ref_file else self.raster_files[0]
+		self.shapes = [json.loads(vector)]
+		self.all_touched = get_settings().raster_clipping_algorithm == "All Touched"
+		self.sources = []
+		self.datasets = []
+		with rasterio.open(self.ref_file) as ref:
+			self.nodata = nodata if nodata != None else ref.meta['nodata'] or settings.DEFAULT_NODATA
+			self.window = rasterio.features.geometry_window(ref, self.shapes)
+			self.transform = ref.window_transform(self.window)
+			self.meta = ref.meta.copy()
+			grid = (ref.crs, ref.transform, ref.width, ref.height)
+
+		self.height, self.width = int(self.window.height), int(self.window.width)
+		self.meta.update({"driver": "GTiff",
+					"height": self.height,
+					"width": self.width,
+					"transform": self.transform,
+					"count": 1,
+					"nodata": self.nodata,
+					"compress": "lzw"
+		})
+		try:
+			for file in self.raster_files:
+				src = rasterio.open(file)
+				self.sources.append(src)
+				if (src.crs, src.transform, src.width, src.height) == grid:
+					self.datasets.append(src)
+				else:
+					self.datasets.append(WarpedVRT(src, crs=grid[0], transform=grid[1], 
+								width=grid[2], height=grid[3], resampling=resampling,
+								nodata=src.nodata if src.nodata != None else self.nodata))
+		except Exception:
+			self.close()
+			raise
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+	def close(self):
+		for dataset in self.datasets + self.sources:
+			if not dataset.closed:
+				dataset.close()
+
+	def read_window(self, window):
+		"""Read a window of each raster
+
+		Args:
+			window (Window): Window relative to the window of the polygon
+
+		Returns:
+			list: Masked 2D array for each raster
+		"""
+		shape = (int(window.height), int(window.width))
+		outside = rasterio.features.geometry_mask(self.shapes, 
+					out_shape=shape, 
+					transform=windows.transform(window, self.transform), 
+					all_touched=self.all_touched)
+		src_window = Window(self.window.col_off + window.col_off, 
+							self.window.row_off + window.row_off,
+							window.width, window.height)
+		blocks = []
+		for dataset in self.datasets:
+			data = dataset.read(1, window=src_window)
+			mask = outside | (data == self.nodata)
+			if dataset.nodata != None:
+				mask |= (data == dataset.nodata)
+			blocks.append(ma.array(np.where(mask, self.nodata, data), mask=mask, fill_value=self.nodata))
+		return blocks
+
+	def read(self):
+		"""Read the window of the polygon of all the rasters
+
+		Returns:
+			MaskedArray: Array of shape (rasters, rows, cols)
+		"""
+		with timed_stage("read") as info:
+			rasters = ma.stack(self.read_window(Window(0, 0, self.width, self.height)))
+			rasters.set_fill_value(self.nodata)
+			info['pixels'] += rasters.size
+			info['bytes_read'] += rasters.data.nbytes
+		return rasters
+
+	def blocks(self, window_budget=None):
+		"""Iterate over the window of the polygon block by block
+
+		Args:
+			window_budget (int): Maximum number of pixels per block. Defaults to the system setting
+
+		Returns:
+			generator of tuple (Window, list): The window of the block relative to the window
+				of the polygon and the masked 2D blocks of each raster
+		"""
+		window_budget = window_budget or get_settings().block_processing_window_budget
+		for window in get_block_windows(self.height, self.width, window_budget):
+			yield (window, self.read_window(window))
+
+	def save_meta_raster(self):
+		"""Write a single pixel raster that carries the crs, transform and nodata of the stack
+		so that it can be passed as `metadata_raster_path` to `return_raster_with_stats`.
+		`save_raster` takes the height and width from the dataset being saved
+
+		Returns:
+			string: Path of the raster
+		"""
+		meta = self.meta.copy()
+		meta.update({"height": 1, "width": 1})
+		out_file = get_temp_file(suffix=".tif")
+		with rasterio.open(out_file, "w", **meta) as dest:
+			dest.write(np.full((1, 1, 1), self.nodata, dtype=meta['dtype']))
+		return out_file
+
+def write_raster_by_block(raster_files, vector, func, out_file, nodata, dtype=rasterio.int32, window_budget=None):
+	"""Clip rasters to a vector, apply `func` and write the result block by block.
+
+	Only a single block of each input raster is held in memory at a time, so peak memory 
+	is bounded by `window_budget` and not by the size of the vector.
+	The output grid is the same as the one `clip_raster_to_vector` produces for the first raster. 
+	The other rasters are aligned to the first raster through a `RasterStack`.
+
+	Args:
+		raster_files (list): Paths of the input rasters
 		vector (geojson): Polygon to be used for clipping
-		dest_nodata (number): Value to set as nodata when returning the clipped raster
-	
-	Returns (string, array): Tuple of Url of the clipped raster and the raster array
+		func (function): Function that receives a list of masked blocks (one per raster) and returns
+						the output block. Pixels outside the vector or having nodata are masked.
+		out_file (string): Path to save the output raster
+		nodata (number): Nodata value of the output raster
+		dtype: Data type of the output raster
+		window_budget (int): Maximum number of pixels per block. Defaults to the system setting
+
+	Returns:
+		dict: {value: count} frequency distribution of the values of the output raster
+	"""
+	val_counts = {}
+	with RasterStack(raster_files, vector, nodata=nodata) as stack:
+		out_meta = stack.meta.copy()
+		out_meta.update({"dtype": dtype})
+		with rasterio.open(out_file, "w", **out_meta) as dest:
+			for window, blocks in stack.blocks(window_budget):
+				out_block = ma.filled(func(blocks), nodata).astype(dtype)
+				dest.write(out_block, 1, window=window)
+
+				get_class_counts(out_block, val_counts)
+	return val_counts
+
+def clip_raster(file, vector, nodata, all_touched):
+	"""
+	Crop a raster to the bounds of a polygon and mask out the regions outside the polygon
+
+	Args:
+		file (string): Absolute path of the raster
+		vector (geojson): Polygon to be used for clipping
+		nodata (number): Value to assign to the masked out regions
+		all_touched (bool): If True, all pixels touched by the polygon are included
+
+	Returns:
+		tuple (array, dict): The clipped raster and its meta data
 	"""
-	file = get_absolute_media_path(raster_file)
-	if not file_exists(file):
-		return (None, None)
-		
-	all_touched = get_settings().raster_clipping_algorithm == "All Touched"
-	# read the file and crop areas outside the polygon
 	with rasterio.open(file) as src:
-		nodata = dest_nodata if dest_nodata != None else src.meta['nodata'] or settings.DEFAULT_NODATA
 		out_image, out_transform = rasterio.mask.mask(src, 
 					[json.loads(vector)], # accepts array of shapes
 					all_touched=all_touched,
@@ -922,6 +1431,46 @@ def clip_raster_to_vector(raster_file, vector, use_temp_dir=True, dest_nodata=No
 
 	# update nodata
 	out_meta.update({'nodata': nodata})
+	return (out_image, out_meta)
+
+def clip_raster_to_vector(raster_file, vector, use_temp_dir=True, dest_nodata=None):
+	"""
+	Mask out regions of a raster that are outside the polygons defined in the shapefile.
+
+	Args:
+		vector (geojson): Polygon to be used for clipping
+		dest_nodata (number): Value to set as nodata when returning the clipped raster
+	
+	Returns (string, array): Tuple of Url of the clipped raster and the raster array
+	"""
+	file = get_absolute_media_path(raster_file)
+	if not file_exists(file):
+		return (None, None)
+		
+	clipping_algorithm = get_settings().raster_clipping_algorithm
+	all_touched = clipping_algorithm == "All Touched"
+	# Only rasters in the temp dir are cached. Rasters in the media dir are meant to be kept.
+	# Sources in the temp dir e.g reprojected rasters are not cached, their keys are never reused
+	cache = get_clip_cache() if use_temp_dir and not is_temp_file(file) else None
+	with rasterio.open(file) as src:
+		nodata = dest_nodata if dest_nodata != None else src.meta['nodata'] or settings.DEFAULT_NODATA
+
+	if use_temp_dir:
+		# check if the raster has been pre-clipped to an administrative unit
+		stored = get_admin_unit_raster(file, vector, nodata, clipping_algorithm)
+		if stored:
+			return stored
+	if cache:
+		cache_key = generate_clip_cache_key(file, vector, nodata, clipping_algorithm)
+		cached = cache.get(cache_key)
+		if cached:
+			return cached
+
+	# read the file and crop areas outside the polygon
+	with timed_stage("clip") as info:
+		out_image, out_meta = clip_raster(file, vector, nodata, all_touched)
+		info['pixels'] += out_image.size
+		info['bytes_read'] += out_image.nbytes
 
 	# get output file
 	if use_temp_dir:
@@ -934,6 +1483,8 @@ def clip_raster_to_vector(raster_file, vector, use_temp_dir=True, dest_nodata=No
 									
 	with rasterio.open(out_file, "w", **out_meta) as dest:
 		dest.write(out_image)
+	if cache:
+		out_file = cache.set(cache_key, out_image.copy(), out_file, out_meta['nodata'])
 	return (out_image, out_file, out_meta['nodata'])
 
 def extract_pixels_using_vector(raster_file, vector, categorical=False, use_temp_dir=True):
@@ -1046,22 +1597,67 @@ def view_process(M, fun=None, blk_size=(16,16), overlap=None):
 
 	return output
 	
+def get_block_counts(array, block_size, values):
+	"""Count the pixels of each value in the blocks of a raster
+
+	The raster is viewed as (rows / block rows, block rows, cols / block cols, block cols) and 
+	the pixels matching each value are summed over the block axes. The blocks on the right and 
+	bottom edges are smaller if the raster is not a multiple of `block_size`: they are padded 
+	for the view and their padding is not counted.
+
+	Args:
+		array (array): Raster of shape (rows, cols) or (1, rows, cols)
+		block_size (tuple): (block rows, block cols)
+		values (list): Values to count
+
+	Returns:
+		tuple(dict, array): {value: count of each block} and the number of pixels of each block
+	"""
+	array = array.reshape(array.shape[-2:]) if array.ndim > 2 else array
+	(rows, cols), (block_rows, block_cols) = array.shape, block_size
+	out_rows, out_cols = -(-rows // block_rows), -(-cols // block_cols)
+	padding = ((0, out_rows * block_rows - rows), (0, out_cols * block_cols - cols))
+
+	def sum_blocks(mask):
+		if padding[0][1] or padding[1][1]:
+			mask = np.pad(mask, padding)
+		return mask.reshape(out_rows, block_rows, out_cols, block_cols).sum(axis=(1, 3), dtype=np.int32)
+
+	row_sizes = np.full(out_rows, block_rows, dtype=np.int32)
+	row_sizes[-1] = rows - (out_rows - 1) * block_rows
+	col_sizes = np.full(out_cols, block_cols, dtype=np.int32)
+	col_sizes[-1] = cols - (out_cols - 1) * block_cols
+	return ({val: sum_blocks(array == val) for val in values}, np.outer(row_sizes, col_sizes))
+
+def get_block_percentages(array, block_size, values):
+	"""Get the percentage of the pixels of each block of a raster that match each value. 
+	See `get_block_counts`
+
+	Returns:
+		dict: {value: percentage of each block}
+	"""
+	with timed_stage("blocks", pixels=array.size):
+		counts, totals = get_block_counts(array, block_size, values)
+		return {val: count / totals * 100 for val, count in counts.items()}
+
 def clip_raster_to_vector_windowed(raster_file, vector, window_size, use_temp_dir=True, 
-		apply_func=None, dest_nodata=None): 
+		block_func=None, dest_nodata=None): 
 	"""
-	Mask out regions of a raster that are outside the polygons defined in the shapefile.
+	Mask out regions of a raster that are outside the polygons defined in the shapefile and 
+	reduce each window of the clipped raster to a single pixel.
 
 	Args:
 		raster_file (string or array): Raster file or raster array
 		vector (geojson): Polygon to be used for clipping
-		window_size (tuple): How big are the blocks. A tuple of (width, height)
+		window_size (tuple): How big are the blocks. A tuple of (rows, cols)
 		use_temp_dir: If True, the resulting raster will be stored in /tmp directory, else in the media directory
-		apply_func (function, optional): Function to applied to the windowed blocks. Defaults to None. 
-										 This function must return an ndarray
+		block_func (function): Function reducing the clipped raster to an ndarray with a value per 
+							window e.g using `get_block_percentages`. Windows on the edges may be smaller
 		dest_nodata (number): Value to set as nodata when returning the clipped raster
 
 	Returns:
-		tuple(array, nodata, file): Raster, value of nodata, filepath of the generated raster
+		tuple(array, nodata, file): Raster, value of nodata, filepath of the generated raster. The 
+			pixels of the generated raster are the size of the windows
 	"""
 	def get_dest_file():
 		# get output file
@@ -1077,8 +1673,18 @@ def clip_raster_to_vector_windowed(raster_file, vector, window_size, use_temp_di
 	# Clip the raster first
 	array, file, nodata = clip_raster_to_vector(raster_file, vector, use_temp_dir=use_temp_dir, dest_nodata=dest_nodata)
 	out_file = get_dest_file()# get output file
-	out_raster = segment_and_concatenate(matrix=array, func=apply_func, block_size=window_size)
-	res = save_raster(dataset=out_raster, source_path=file, target_path=out_file)
+	out_raster = block_func(array)
+	meta = get_raster_meta(file)
+	meta.update({
+		'dtype': rasterio.int32,
+		'compress': 'lzw',
+		'count': 1,
+		'height': out_raster.shape[0],
+		'width': out_raster.shape[1],
+		'transform': meta['transform'] * meta['transform'].scale(window_size[1], window_size[0]),
+	})
+	with timed_stage("write", pixels=out_raster.size), rasterio.open(out_file, 'w', **meta) as dst:
+		dst.write(out_raster.astype(rasterio.int32), 1)
 	return (out_raster, out_file, nodata)
 	
 def reshape_rasters(rasters):
@@ -0,0 +1,276 @@
+"""
+Redis backend for the cache of analysis results.
+
+Enable it by setting `RESULT_CACHE_BACKEND=redis`, see `CACHES` in settings.py.
+
+Results are large JSON strings, so values are serialized with msgpack and compressed
+with zstd once they exceed `COMPRESS_MIN_BYTES`. Values written with pickle or zlib by
+earlier versions can still be read. The total size of the entries is bounded by `MAX_BYTES`:
+the least recently used entries are evicted once it is exceeded, independently of the
+eviction policy of the Redis server that RQ shares. Entries that expired in Redis are
+removed from the accounting of the sizes before evicting. Recently read entries are also kept
+in a small in-process cache (L1) so that repeated requests for the same administrative
+unit do not hit Redis at all. L1 entries are not invalidated across processes and are
+therefore only kept for `L1_TIMEOUT` seconds. Cached values must not be modified by callers.
+The sizes are updated in Lua scripts so that concurrent writers do not double-count them.
+"""
+
+import time
+import zlib
+import pickle
+import threading
+import redis
+import msgpack
+import zstandard
+import cachetools
+from django.core.cache.backends.base import BaseCache, DEFAULT_TIMEOUT
+
+# First byte of stored values
+FORMAT_MSGPACK = b"m"
+FORMAT_PICKLE = b"p"
+# Second byte of stored values
+COMPRESSION_NONE = b"n"
+COMPRESSION_ZLIB = b"z"
+COMPRESSION_ZSTD = b"s"
+
+DEFAULT_OPTIONS = {
+	'MAX_BYTES': 512 * 1024 ** 2,
+	'COMPRESS_MIN_BYTES': 1024,
+	'COMPRESSION_LEVEL': 3,
+	'L1_MAX_BYTES': 32 * 1024 ** 2,
+	'L1_TIMEOUT': 60,
+}
+
+# Store a value and its size. Returns 0 if the key exists and nx is set
+# KEYS: key, lru, sizes, bytes. ARGV: value, ttl ('' for none), nx ('1' or '0'), time
+SET_SCRIPT = """
+if ARGV[3] == '1' and redis.call('exists', KEYS[1]) == 1 then
+	return 0
+end
+local size = tonumber(redis.call('hget', KEYS[3], KEYS[1]) or 0)
+if ARGV[2] == '' then
+	redis.call('set', KEYS[1], ARGV[1])
+else
+	redis.call('set', KEYS[1], ARGV[1], 'EX', ARGV[2])
+end
+redis.call('zadd', KEYS[2], ARGV[4], KEYS[1])
+redis.call('hset', KEYS[3], KEYS[1], #ARGV[1])
+redis.call('incrby', KEYS[4], #ARGV[1] - size)
+return 1
+"""
+
+# Remove entries from the accounting and return the number of deleted keys. With ARGV[1] == 'expired'
+# the values are kept and only the entries that no longer exist are removed
+# KEYS: lru, sizes, expiry, bytes, entries...
+REMOVE_SCRIPT = """
+local freed = 0
+local deleted = 0
+for i = 5, #KEYS do
+	local remove = true
+	if ARGV[1] == 'expired' then
+		remove = redis.call('exists', KEYS[i]) == 0
+	else
+		deleted = deleted + redis.call('del', KEYS[i])
+	end
+	if remove then
+		freed = freed + tonumber(redis.call('hget', KEYS[2], KEYS[i]) or 0)
+		redis.call('zrem', KEYS[1], KEYS[i])
+		redis.call('hdel', KEYS[2], KEYS[i])
+		redis.call('zrem', KEYS[3], KEYS[i])
+	end
+end
+redis.call('decrby', KEYS[4], freed)
+return deleted
+"""
+
+class RedisResultCache(BaseCache):
+	"""
+	Django cache backend storing compressed values in Redis with a size bounded LRU eviction
+	"""
+	def __init__(self, server, params):
+		super().__init__(params)
+		options = DEFAULT_OPTIONS.copy()
+		options.update(params.get('OPTIONS', {}))
+		self.server = server
+		self.max_bytes = options['MAX_BYTES']
+		self.compress_min_bytes = options['COMPRESS_MIN_BYTES']
+		self.compression_level = options['COMPRESSION_LEVEL']
+		self.l1 = cachetools.TTLCache(maxsize=options['L1_MAX_BYTES'],
+						ttl=options['L1_TIMEOUT'], getsizeof=lambda item: item[1])
+		self.l1_lock = threading.Lock()
+		self._client = None
+
+		# Keys used to track the entries for eviction
+		self.lru_key = self.make_key("__lru__")
+		self.sizes_key = self.make_key("__sizes__")
+		self.bytes_key = self.make_key("__bytes__")
+		self.expiry_key = self.make_key("__expiry__") # time at which the entries with a timeout expire
+
+	@property
+	def client(self):
+		if self._client is None:
+			self._client = redis.Redis.from_url(self.server)
+		return self._client
+
+	def get_backend_timeout(self, timeout=DEFAULT_TIMEOUT):
+		"""Return the timeout in seconds. Redis expires keys relative to now rather than at a timestamp
+		"""
+		if timeout == DEFAULT_TIMEOUT:
+			timeout = self.default_timeout
+		elif timeout == 0:
+			timeout = -1
+		return timeout
+
+	def encode(self, value):
+		"""Serialize and compress a value
+		"""
+		fmt, data = FORMAT_MSGPACK, msgpack.packb(value, use_bin_type=True)
+		compression = COMPRESSION_NONE
+		if len(data) >= self.compress_min_bytes:
+			compression = COMPRESSION_ZSTD
+			data = zstandard.ZstdCompressor(level=self.compression_level).compress(data)
+		return fmt + compression + data
+
+	def decode(self, data):
+		"""Decompress and deserialize a value encoded by `encode`
+		"""
+		fmt, compression, data = data[0:1], data[1:2], data[2:]
+		if compression == COMPRESSION_ZSTD:
+			data = zstandard.ZstdDecompressor().decompress(data)
+		elif compression == COMPRESSION_ZLIB:
+			data = zlib.decompress(data)
+		if fmt == FORMAT_MSGPACK:
+			return msgpack.unpackb(data, raw=False)
+		return pickle.loads(data)
+
+	def get_l1(self, key):
+		with self.l1_lock:
+			return self.l1.get(key)
+
+	def set_l1(self, key, value, size):
+		with self.l1_lock:
+			if size <= self.l1.maxsize:
+				self.l1[key] = (value, size)
+
+	def delete_l1(self, key):
+		with self.l1_lock:
+			self.l1.pop(key, None)
+
+	def get(self, key, default=None, version=None):
+		key = self.make_key(key, version=version)
+		self.validate_key(key)
+		item = self.get_l1(key)
+		if item is not None:
+			return item[0]
+		data = self.client.get(key)
+		if data is None:
+			return default
+		value = self.decode(data)
+		self.set_l1(key, value, len(data))
+		self.client.zadd(self.lru_key, {key: time.time()})
+		return value
+
+	def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+		key = self.make_key(key, version=version)
+		self.validate_key(key)
+		self._set(key, self.encode(value), self.get_backend_timeout(timeout))
+
+	def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+		key = self.make_key(key, version=version)
+		self.validate_key(key)
+		return self._set(key, self.encode(value), self.get_backend_timeout(timeout), nx=True)
+
+	def _set(self, key, data, timeout, nx=False):
+		if timeout is not None and timeout <= 0:
+			self._delete(key)
+			return False
+		ttl = int(timeout) if timeout is not None else None
+		stored = self.client.eval(SET_SCRIPT, 4, key, self.lru_key, self.sizes_key, self.bytes_key,
+						data, ttl if ttl is not None else '', '1' if nx else '0', time.time())
+		if not stored:
+			return False
+		self.set_expiry(key, ttl)
+		self.delete_l1(key)
+		self.evict()
+		return True
+
+	def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+		key = self.make_key(key, version=version)
+		timeout = self.get_backend_timeout(timeout)
+		if timeout is None:
+			touched = bool(self.client.persist(key))
+		else:
+			touched = bool(self.client.expire(key, int(timeout)))
+		if touched:
+			self.set_expiry(key, int(timeout) if timeout is not None else None)
+		return touched
+
+	def set_expiry(self, key, ttl):
+		"""Record when an entry expires so that it can be removed from the accounting. See `remove_expired`
+		"""
+		if ttl is None:
+			self.client.zrem(self.expiry_key, key)
+		else:
+			self.client.zadd(self.expiry_key, {key: time.time() + ttl})
+
+	def delete(self, key, version=None):
+		key = self.make_key(key, version=version)
+		self.validate_key(key)
+		return self._delete(key)
+
+	def _delete(self, key):
+		self.delete_l1(key)
+		return bool(self.remove_entries([key]))
+
+	def remove_entries(self, keys, expired=False):
+		"""Delete entries and remove them from the LRU, the sizes and the byte counter. With `expired`,
+		only the entries that Redis already expired are removed from the accounting
+		"""
+		return self.client.eval(REMOVE_SCRIPT, 4 + len(keys), self.lru_key, self.sizes_key, self.expiry_key, 
+						self.bytes_key, *keys, 'expired' if expired else 'delete')
+
+	def has_key(self, key, version=None):
+		key = self.make_key(key, version=version)
+		self.validate_key(key)
+		return self.get_l1(key) is not None or bool(self.client.exists(key))
+
+	def remove_expired(self):
+		"""Remove the entries that Redis expired from the LRU, the sizes and the byte counter
+		"""
+		keys = self.client.zrangebyscore(self.expiry_key, 0, time.time())
+		if not keys:
+			return
+		self.remove_entries(keys, expired=True)
+		self.client.zrem(self.expiry_key, *keys) # entries that still exist were given a new timeout meanwhile
+
+	def evict(self, batch_size=50):
+		"""Delete the least recently used entries until the size of the cache is within `MAX_BYTES`.
+		Entries that already expired are removed from the accounting first.
+		"""
+		self.remove_expired()
+		excess = int(self.client.get(self.bytes_key) or 0) - self.max_bytes
+		while excess > 0:
+			keys = self.client.zrange(self.lru_key, 0, batch_size - 1)
+			if not keys:
+				self.client.delete(self.bytes_key)
+				break
+			sizes = self.client.hmget(self.sizes_key, keys)
+			# only evict as many entries as needed
+			freed = 0
+			for i, size in enumerate(sizes):
+				freed += int(size or 0)
+				if freed >= excess:
+					keys = keys[:i + 1]
+					break
+			self.remove_entries(keys)
+			with self.l1_lock:
+				for key in keys:
+					self.l1.pop(key.decode("utf-8"), None)
+			excess = int(self.client.get(self.bytes_key) or 0) - self.max_bytes
+
+	def clear(self):
+		with self.l1_lock:
+			self.l1.clear()
+		keys = [x for x in self.client.scan_iter(match=self.make_key("*"))]
+		for i in range(0, len(keys), 500):
+			self.client.delete(*keys[i:i + 500])
@@ -0,0 +1,160 @@
+"""
+Scratch arrays of the analyses.
+
+Arrays of more than settings.SCRATCH['MEMMAP_THRESHOLD'] bytes are backed by `np.memmap` files
+instead of memory, so that analyses of large areas run at the speed of the disk instead of
+running out of memory. The files are written to a directory per job (or per synchronous
+request, see `scratch_scope`) under settings.SCRATCH['DIR'], removed once the job is done.
+RQ runs each job in a process of its own, so directories of jobs that were killed e.g because
+they timed out are removed when the next directory is created. Mapped arrays remain valid
+after their file has been removed.
+"""
+
+import os
+import re
+import atexit
+import shutil
+import tempfile
+import contextlib
+import contextvars
+import numpy as np
+import numpy.ma as ma
+from django.conf import settings
+from rq import get_current_job
+
+DEFAULT_SCRATCH_SETTINGS = {
+	'DIR': None, # defaults to the temp dir of the system
+	'MEMMAP_THRESHOLD': 256 * 1024 ** 2,
+	'CHUNK_BYTES': 64 * 1024 ** 2,
+}
+
+_scope_dir = contextvars.ContextVar('ldms_scratch_dir', default=None)
+_job_dir = None # (job id, directory, pid) of the job run by this process
+
+def get_scratch_settings():
+	"""Get settings of the scratch arrays. Values are read from settings.SCRATCH
+	"""
+	setts = DEFAULT_SCRATCH_SETTINGS.copy()
+	setts.update(getattr(settings, 'SCRATCH', {}))
+	return setts
+
+def get_scratch_root():
+	return os.path.join(get_scratch_settings()['DIR'] or tempfile.gettempdir(), "ldms-scratch")
+
+def _pid_exists(pid):
+	try:
+		os.kill(pid, 0)
+	except ProcessLookupError:
+		return False
+	except PermissionError:
+		pass
+	return True
+
+def _remove_stale_dirs(root):
+	"""Remove the directories of the processes that no longer exist. Directory names end with the pid
+	"""
+	for name in os.listdir(root):
+		match = re.match(r".*-(\d+)$", name)
+		if match and not _pid_exists(int(match.group(1))):
+			shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+
+def _make_dir(name):
+	root = get_scratch_root()
+	os.makedirs(root, exist_ok=True)
+	_remove_stale_dirs(root)
+	return tempfile.mkdtemp(prefix="%s-" % name, suffix="-%s" % os.getpid(), dir=root)
+
+def get_scratch_dir():
+	"""Get the directory of the scratch files of the current request or job, creating it if needed
+	"""
+	global _job_dir
+	scope_dir = _scope_dir.get()
+	if scope_dir:
+		return scope_dir
+	job = get_current_job()
+	job_id = job.id if job else "process"
+	if _job_dir is None or _job_dir[0] != job_id:
+		cleanup_scratch()
+		_job_dir = (job_id, _make_dir(job_id), os.getpid())
+	return _job_dir[1]
+
+def cleanup_scratch():
+	"""Remove the scratch files of the job run by this process. Arrays still in use remain valid
+	"""
+	global _job_dir
+	if _job_dir is not None:
+		if _job_dir[2] == os.getpid(): # not a process forked by the job e.g by ldms.utils.parallel_util
+			shutil.rmtree(_job_dir[1], ignore_errors=True)
+		_job_dir = None
+
+atexit.register(cleanup_scratch)
+
+@contextlib.contextmanager
+def scratch_scope(name="request"):
+	"""Write the scratch files of the arrays allocated within the block to a directory removed
+	at the end of the block e.g for the analyses computed by the web server
+	"""
+	directory = _make_dir(name)
+	token = _scope_dir.set(directory)
+	try:
+		yield directory
+	finally:
+		_scope_dir.reset(token)
+		shutil.rmtree(directory, ignore_errors=True)
+
+def scratch_array(shape, dtype=np.float64, fill_value=None):
+	"""Allocate an array, backed by a file of the scratch directory if it is larger than the threshold
+
+	Args:
+		shape (tuple): Shape of the array
+		dtype (dtype): Type of the values
+		fill_value (number, optional): Initial value of the elements. Left uninitialised if None
+
+	Returns:
+		ndarray: Array or np.memmap
+	"""
+	shape = tuple(int(x) for x in np.atleast_1d(shape))
+	nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+	if nbytes > get_scratch_settings()['MEMMAP_THRESHOLD']:
+		fd, path = tempfile.mkstemp(suffix=".dat", dir=get_scratch_dir())
+		os.close(fd)
+		array = np.memmap(path, dtype=dtype, mode="w+", shape=shape) # zero filled
+		if fill_value is not None and fill_value != 0:
+			array[:] = fill_value
+		return array
+	if fill_value is None:
+		return np.empty(shape, dtype=dtype)
+	return np.full(shape, fill_value, dtype=dtype)
+
+def stack_arrays(arrays):
+	"""Same as `np.stack(arrays)` with the result allocated by `scratch_array`
+	"""
+	arrays = [np.asarray(x) for x in arrays]
+	out = scratch_array((len(arrays),) + arrays[0].shape, dtype=np.result_type(*arrays))
+	for i, arr in enumerate(arrays):
+		out[i] = arr
+	return out
+
+def reduce_arrays(func, arrays):
+	"""Compute `func(np.stack(arrays), axis=0)` e.g `np.mean` a band of rows at a time so that
+	only a band of the stack is held in memory. The result is allocated by `scratch_array`
+
+	Args:
+		func (function): Reduction with an `axis` argument e.g np.mean or np.std
+		arrays (list): Arrays of the same shape. Masks are ignored as `np.mean(arrays, axis=0)` does
+	"""
+	arrays = [np.asarray(ma.getdata(x)) for x in arrays]
+	shape = arrays[0].shape
+	if not shape:
+		return func(np.stack(arrays), axis=0)
+	row_bytes = max(1, len(arrays) * arrays[0][:1].nbytes)
+	rows = max(1, get_scratch_settings()['CHUNK_BYTES'] // row_bytes)
+	out = None
+	for start in range(0, shape[0], rows):
+		band = func(np.stack([x[start:start + rows] for x in arrays]), axis=0)
+		if out is None:
+			out = scratch_array(shape, dtype=band.dtype)
+		out[start:start + rows] = band
+	if out is None: # no rows
+		return func(np.stack(arrays), axis=0)
+	return out
@@ -0,0 +1,98 @@
+"""
+Single-flight coalescing of identical analysis requests.
+
+The first request for a cache key takes a flight, a Redis key holding the owner of the
+computation (`sync:<id>` for a request computed in the web process or `job:<id>` for a
+queued job). Identical requests that arrive while the flight is held either wait for the
+owner to publish that it has finished and then read the result from the cache, or, if
+they are queued, depend on the owner's job. Waiting requests that time out compute the
+results themselves.
+"""
+
+import time
+import django_rq
+from django.conf import settings
+
+FLIGHT_KEY = "ldms:flight:%s"
+SYNC_OWNER = "sync:"
+JOB_OWNER = "job:"
+
+DEFAULT_SINGLE_FLIGHT_SETTINGS = {
+	'ENABLED': True,
+	'LOCK_TIMEOUT': 3600,
+	# requests wait in the web process, so this must be well below the timeout of the web
+	# server e.g 30 seconds by default for gunicorn
+	'WAIT_TIMEOUT': 20,
+}
+
+# Delete the key only if it is still held by the owner
+RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+	redis.call('del', KEYS[1])
+	return redis.call('publish', KEYS[1], 'done')
+end
+return 0
+"""
+
+def get_single_flight_settings():
+	"""Get settings of the request coalescing. Values are read from settings.SINGLE_FLIGHT
+	"""
+	setts = DEFAULT_SINGLE_FLIGHT_SETTINGS.copy()
+	setts.update(getattr(settings, 'SINGLE_FLIGHT', {}))
+	return setts
+
+def is_single_flight_enabled():
+	return get_single_flight_settings()['ENABLED']
+
+def get_connection():
+	return django_rq.get_connection('default')
+
+def acquire_flight(key, owner):
+	"""Take the flight of a cache key
+
+	Args:
+		key (string): Cache key of the request
+		owner (string): Owner of the flight e.g sync:<id> or job:<job_id>
+
+	Returns:
+		bool: True if the flight was taken, False if another request holds it
+	"""
+	timeout = get_single_flight_settings()['LOCK_TIMEOUT']
+	return bool(get_connection().set(FLIGHT_KEY % key, owner, nx=True, ex=timeout))
+
+def get_flight_owner(key):
+	"""Get the owner of the flight of a cache key or None if no request holds it
+	"""
+	owner = get_connection().get(FLIGHT_KEY % key)
+	return owner.decode("utf-8") if owner else None
+
+def release_flight(key, owner):
+	"""Release the flight of a cache key and notify the waiting requests
+	"""
+	get_connection().eval(RELEASE_SCRIPT, 1, FLIGHT_KEY % key, owner)
+
+def wait_for_flight(key, timeout=None):
+	"""Wait until the flight of a cache key is released
+
+	Args:
+		key (string): Cache key of the request
+		timeout (int, optional): Maximum number of seconds to wait. Defaults to settings.SINGLE_FLIGHT['WAIT_TIMEOUT']
+
+	Returns:
+		bool: True if the flight was released, False if the wait timed out
+	"""
+	timeout = timeout or get_single_flight_settings()['WAIT_TIMEOUT']
+	conn = get_connection()
+	pubsub = conn.pubsub(ignore_subscribe_messages=True)
+	pubsub.subscribe(FLIGHT_KEY % key)
+	try:
+		deadline = time.time() + timeout
+		while time.time() < deadline:
+			# check after subscribing so that a release in between is not missed
+			if not conn.exists(FLIGHT_KEY % key):
+				return True
+			if pubsub.get_message(timeout=min(1.0, max(deadline - time.time(), 0))):
+				return True
+		return False
+	finally:
+		pubsub.close()
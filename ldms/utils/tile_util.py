@@ -0,0 +1,212 @@
+"""
+Split large queued analyses into spatial tiles that are computed by separate jobs.
+
+The area of interest is split into a grid of tiles of `TILE_SIZE` degrees. Each tile is
+computed by its own job and its output is checkpointed in the directory of the run: a
+GeoTIFF of the tile and a pickle holding the nodata, resolution and the arguments needed to
+compute the statistics. The pickle is written last so a tile is done once it exists, and a
+retried job skips the tiles that are already done. A tile that fails its last attempt is
+checkpointed with its error, as is a tile whose job died without raising e.g because its
+work-horse was killed, once a watchdog job finds it failed. Once all the tiles are done, a merge
+job mosaics them and computes the statistics of the whole area, or fails the analysis with the
+error of the first failed tile. The extras of the tiles e.g the values of CQI as a string only
+cover their tile, so they are neither checkpointed nor part of the merged results.
+See settings.TILED_JOBS.
+"""
+
+import os
+import shutil
+import pickle
+import rasterio
+import django_rq
+from rasterio.merge import merge
+from django.conf import settings
+from django.utils.translation import gettext as _
+from django.contrib.gis.geos import GEOSGeometry, Polygon, MultiPolygon
+from ldms.utils.file_util import get_media_dir
+from ldms.utils.raster_util import save_raster, return_raster_with_stats
+
+DEFAULT_TILED_JOBS_SETTINGS = {
+	'ENABLED': True,
+	'MIN_COST': 200,
+	'TILE_SIZE': 2.0,
+	'RETRIES': 2,
+	'WATCHDOG_INTERVAL': 600,
+}
+
+TILES_SUB_DIR = "tiles"
+MERGE_KEY = "ldms:tiles:%s:merge"
+MERGE_KEY_TIMEOUT = 7 * 86400
+
+def get_tiled_jobs_settings():
+	"""Get settings of the tiling of queued analyses. Values are read from settings.TILED_JOBS
+	"""
+	setts = DEFAULT_TILED_JOBS_SETTINGS.copy()
+	setts.update(getattr(settings, 'TILED_JOBS', {}))
+	return setts
+
+def split_vector(vector, tile_size):
+	"""Split a polygon into tiles along a grid
+
+	Args:
+		vector (geojson): Polygon or MultiPolygon
+		tile_size (float): Size of the tiles in the units of the vector (degrees)
+
+	Returns:
+		list: GeoJSON of the non-empty intersections of the polygon with the cells of the grid
+	"""
+	geom = GEOSGeometry(vector)
+	xmin, ymin, xmax, ymax = geom.extent
+	tiles = []
+	y = ymin
+	while y < ymax:
+		x = xmin
+		while x < xmax:
+			cell = Polygon.from_bbox((x, y, min(x + tile_size, xmax), min(y + tile_size, ymax)))
+			cell.srid = geom.srid
+			tile = get_polygonal(geom.intersection(cell))
+			if tile:
+				tiles.append(tile.geojson)
+			x += tile_size
+		y += tile_size
+	return tiles
+
+def get_polygonal(geom):
+	"""Drop the points and lines of an intersection. Returns None if nothing is left
+	"""
+	if geom.empty:
+		return None
+	if geom.geom_type in ["Polygon", "MultiPolygon"]:
+		return geom
+	polygons = []
+	for part in geom:
+		if part.geom_type == "Polygon":
+			polygons.append(part)
+		elif part.geom_type == "MultiPolygon":
+			polygons.extend(list(part))
+	if not polygons:
+		return None
+	return MultiPolygon(polygons, srid=geom.srid)
+
+def get_run_dir(run_id):
+	"""Get the directory holding the checkpoints of a tiled run
+	"""
+	return get_media_dir(os.path.join(TILES_SUB_DIR, run_id))
+
+def get_tile_paths(run_id, index):
+	"""Get the paths of the raster and of the metadata of a tile
+	"""
+	base = os.path.join(get_run_dir(run_id), "tile_%s" % (index))
+	return (base + ".tif", base + ".pkl")
+
+def save_tile(run_id, index, result, error):
+	"""Checkpoint the output of a tile
+
+	Args:
+		run_id (string): ID of the tiled run
+		index (int): Index of the tile
+		result (dict): Raw result of the tile. See `ldms.utils.raster_util.get_raw_result`
+		error (string): Error of the computation of the tile if any
+	"""
+	os.makedirs(get_run_dir(run_id), exist_ok=True)
+	raster_path, meta_path = get_tile_paths(run_id, index)
+	checkpoint = {'error': error}
+	if not error:
+		# the tiles of a run are mosaicked in the type of the first tile so they all use the same type
+		save_raster(dataset=result['datasource'],
+					source_path=result['meta_path'],
+					target_path=raster_path,
+					dtype=rasterio.int32)
+		stats_args = result.get('stats_args') or {}
+		checkpoint.update({
+			'nodata': result['nodata'],
+			'resolution': result['resolution'],
+			'stats_args': {k: v for k, v in stats_args.items() if k != 'extras'}
+		})
+	# write to a temporary file first so that a killed job does not leave a partial checkpoint
+	with open(meta_path + ".tmp", "wb") as fl:
+		pickle.dump(checkpoint, fl, pickle.HIGHEST_PROTOCOL)
+	os.replace(meta_path + ".tmp", meta_path)
+
+def load_tile(run_id, index):
+	"""Load the checkpoint of a tile or None if the tile is not done
+	"""
+	meta_path = get_tile_paths(run_id, index)[1]
+	if not os.path.exists(meta_path):
+		return None
+	with open(meta_path, "rb") as fl:
+		return pickle.load(fl)
+
+def count_done_tiles(run_id, count):
+	"""Count the tiles of a run that are done
+	"""
+	return len([i for i in range(count) if os.path.exists(get_tile_paths(run_id, i)[1])])
+
+def claim_merge(run_id):
+	"""Claim the merge of a run. Only the first of the tiles that finish at the same time gets it
+
+	Returns:
+		bool: True if the caller must queue the merge job
+	"""
+	conn = django_rq.get_connection('default')
+	return bool(conn.set(MERGE_KEY % run_id, 1, nx=True, ex=MERGE_KEY_TIMEOUT))
+
+def is_merge_claimed(run_id):
+	"""Check if the merge of a run was claimed. See `claim_merge`
+	"""
+	conn = django_rq.get_connection('default')
+	return bool(conn.exists(MERGE_KEY % run_id))
+
+def merge_tiles(request, run_id, count):
+	"""Mosaic the tiles of a run and compute the statistics of the whole area
+
+	Returns:
+		tuple(object, error): Results as returned by `return_raster_with_stats` and the error 
+			of the first tile that failed if any
+	"""
+	tiles = [load_tile(run_id, i) for i in range(count)]
+	if None in tiles:
+		return (None, _("Some tiles of the analysis are missing"))
+	errors = [x['error'] for x in tiles if x['error']]
+	if errors:
+		return (None, errors[0])
+	nodata = tiles[0]['nodata']
+	datasource, meta_path = mosaic_tiles(run_id, count, nodata)
+	res = return_raster_with_stats(request=request,
+				datasource=datasource,
+				metadata_raster_path=meta_path,
+				nodata=nodata,
+				resolution=tiles[0]['resolution'],
+				**tiles[0]['stats_args'])
+	return (res, None)
+
+def mosaic_tiles(run_id, count, nodata):
+	"""Mosaic the rasters of the tiles of a run
+
+	Returns:
+		tuple(array, path): Mosaic and the path of a raster with its metadata
+	"""
+	paths = [get_tile_paths(run_id, i)[0] for i in range(count)]
+	datasets = [rasterio.open(x) for x in paths]
+	try:
+		mosaic, transform = merge(datasets, nodata=nodata)
+		meta = datasets[0].meta.copy()
+	finally:
+		for ds in datasets:
+			ds.close()
+	meta.update({
+		'height': mosaic.shape[1],
+		'width': mosaic.shape[2],
+		'transform': transform,
+		'nodata': nodata,
+		'compress': 'lzw',
+	})
+	out_path = os.path.join(get_run_dir(run_id), "mosaic.tif")
+	with rasterio.open(out_path, "w", **meta) as dst:
+		dst.write(mosaic)
+	return (mosaic[0], out_path)
+
+def remove_run(run_id):
+	"""Delete the checkpoints of a run
+	"""
+	shutil.rmtree(get_run_dir(run_id), ignore_errors=True)
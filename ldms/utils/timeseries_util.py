@@ -0,0 +1,93 @@
+"""
+Yearly vegetation index rasters of an area of interest.
+
+Trajectory, state and performance all read the NDVI/SAVI/MSAVI rasters of overlapping
+periods. A `VITimeSeriesCube` resolves the `Raster` models of every year in one query and
+clips each year on first use into a (years, rows, cols) array, so that a
+year is read once per analysis whatever the number of sub-indicators that use it.
+The array is memory-mapped when it is large, see `ldms.utils.scratch_util`. The sub-indicators
+get views of the array which must not be modified.
+"""
+
+import numpy as np
+from ldms.utils.raster_util import get_raster_models, extract_pixels_using_vector
+from ldms.utils.scratch_util import scratch_array
+
+class VITimeSeriesCube:
+	"""
+	Rasters of a vegetation index clipped to a vector, indexed by year
+	"""
+	def __init__(self, raster_source, veg_index, vector, admin_0=None):
+		"""
+		Args:
+			raster_source (string): Value of RasterSourceEnum e.g Modis
+			veg_index (string): Value of RasterCategoryEnum. One of NDVI, MSAVI or SAVI
+			vector (geojson): Polygon the rasters are clipped to
+			admin_0 (int, optional): Country whose rasters are used in place of the regional ones
+		"""
+		self.vector = vector
+		self.models = {}
+		models = get_raster_models(raster_source=raster_source,
+								raster_category=veg_index,
+								admin_zero_id=admin_0)
+		for model in sorted(models, key=lambda x: x.pk): # same model as get_raster_models(raster_year=year).first()
+			if model.raster_year and model.raster_year not in self.models:
+				self.models[model.raster_year] = model
+		self.years = sorted(self.models.keys())
+		self.array = None # (years, rows, cols) array allocated when the first year is read
+		self.nodata = None
+		self.loaded = set()
+
+	def get_model(self, year):
+		"""Get the Raster model of a year or None if there is no raster for the year
+		"""
+		return self.models.get(year)
+
+	def get_years(self, start_year=None, end_year=None):
+		"""Get the years that have a raster between start_year and end_year (inclusive)
+		"""
+		return [x for x in self.years if (start_year is None or x >= start_year)
+										and (end_year is None or x <= end_year)]
+
+	def get_models(self, start_year=None, end_year=None):
+		"""Get the Raster models of the years between start_year and end_year ordered by year
+		"""
+		return [self.models[x] for x in self.get_years(start_year, end_year)]
+
+	def get_rasters(self, start_year, end_year):
+		"""Get the rasters of the years between start_year and end_year, reading the years not read yet
+
+		Returns:
+			list: Views of the (rows, cols) raster of each year ordered by year
+		"""
+		years = self.get_years(start_year, end_year)
+		for year in years:
+			if year not in self.loaded:
+				self._load(year)
+		rasters = []
+		for year in years:
+			raster = np.asarray(self.array[self.years.index(year)])
+			raster.flags.writeable = False
+			rasters.append(raster)
+		return rasters
+
+	def _load(self, year):
+		"""Clip the raster of a year and copy it to the cube
+
+		The rows, columns, dtype and nodata of the cube are those of the first year read. Rasters
+		of other years are cropped or padded with nodata to the shape of the cube.
+		"""
+		raster, nodata, rastfile = extract_pixels_using_vector(self.models[year].rasterfile.name, self.vector)
+		if self.array is None:
+			# the pages of the years that are never read are not allocated
+			self.array = scratch_array((len(self.years),) + raster.shape, dtype=raster.dtype)
+			self.nodata = nodata
+		out = self.array[self.years.index(year)]
+		rows, cols = min(out.shape[0], raster.shape[0]), min(out.shape[1], raster.shape[1])
+		if (rows, cols) != out.shape:
+			out[:] = self.nodata
+		values = raster[:rows, :cols]
+		if nodata != self.nodata:
+			values = np.where(values == nodata, self.nodata, values)
+		out[:rows, :cols] = values
+		self.loaded.add(year)
@@ -0,0 +1,160 @@
+"""
+Vectorized per-pixel trend statistics.
+
+All functions operate on a stack of rasters of shape (years, rows, cols) and
+compute the statistic for every pixel at once instead of calling
+`scipy.stats.linregress` / `scipy.stats.kendalltau` once per pixel.
+Results are equivalent to the scipy implementations.
+"""
+
+import math
+import numpy as np
+from scipy import special
+from ldms.utils.scratch_util import stack_arrays
+
+def stack_rasters(rasters):
+	"""Stack a list of 2D rasters into a (years, rows, cols) array
+
+	Args:
+		rasters (list | ndarray): List of 2D arrays or an already stacked 3D array
+
+	Returns:
+		ndarray: Array of shape (years, rows, cols)
+	"""
+	if isinstance(rasters, np.ndarray) and rasters.ndim == 3:
+		return rasters
+	return stack_arrays(rasters)
+
+def ols_slope(series, time_array):
+	"""Compute the least squares slope for each column of `series`.
+
+	Since the years are the same for every pixel, the slope is a weighted sum
+	of the values, slope = sum(w_k * y_k) where w_k = (t_k - mean(t)) / sum((t - mean(t))^2)
+
+	Args:
+		series (ndarray): Array of shape (years, ...)
+		time_array (list): Years corresponding to the first axis of `series`
+
+	Returns:
+		ndarray: Slopes of shape series.shape[1:]
+	"""
+	t = np.asarray(time_array, dtype=np.float64)
+	dt = t - t.mean()
+	weights = dt / np.sum(dt * dt)
+	return np.tensordot(weights, series, axes=(0, 0))
+
+def _exact_kendall_pvalues(size):
+	"""Exact two sided p-values of Kendall's tau for a series without ties.
+
+	Returns an array indexed by c = min(discordant, total - discordant).
+	Uses the Mahonian numbers (number of permutations of `size` with k inversions)
+	as per p. 68 of Maurice G. Kendall, "Rank Correlation Methods" (4th Edition)
+	"""
+	tot = size * (size - 1) // 2
+	max_c = tot // 2
+	if size <= 2:
+		return np.ones(max_c + 1)
+	if size >= 171: # factorial overflows a float, scipy returns 0
+		return np.zeros(max_c + 1)
+	counts = [1] + [0] * max_c
+	for j in range(2, size + 1):
+		prev = counts[:]
+		for i in range(1, max_c + 1):
+			counts[i] = counts[i - 1] + prev[i] - (prev[i - j] if i >= j else 0)
+	factorial = math.factorial(size)
+	pvalues = np.empty(max_c + 1)
+	cumulative = 0
+	for c in range(max_c + 1):
+		cumulative += counts[c]
+		pvalues[c] = 2.0 * cumulative / factorial
+	if 2 * max_c == tot:
+		pvalues[max_c] = 1.0
+	return np.minimum(pvalues, 1.0)
+
+def mann_kendall(series, time_array):
+	"""Compute the Mann-Kendall trend test for each column of `series`.
+
+	Matches `scipy.stats.kendalltau(time_array, values)` for every pixel. The exact
+	distribution is used when there are no ties and either the series is short (<= 33)
+	or it is (almost) perfectly monotonic, otherwise the tie corrected normal
+	approximation is used. Constant series return nan for tau and pvalue.
+
+	Args:
+		series (ndarray): Array of shape (years, ...)
+		time_array (list): Distinct years corresponding to the first axis of `series`
+
+	Returns:
+		tuple (S, tau, pvalue) each of shape series.shape[1:]
+	"""
+	series = np.asarray(series)
+	size = series.shape[0]
+	out_shape = series.shape[1:]
+	t = np.asarray(time_array)
+	order = np.argsort(t, kind='mergesort')
+	series = series[order]
+
+	tot = size * (size - 1) // 2
+	s = np.zeros(out_shape, dtype=np.int64)
+	ytie = np.zeros(out_shape, dtype=np.int64) # tied pairs
+	y1 = np.zeros(out_shape, dtype=np.int64) # sum of t(t-1)(2t+5) over tie groups
+	for i in range(size):
+		ties = np.zeros(out_shape, dtype=np.int64) # count of values equal to series[i]
+		for j in range(size):
+			if j > i:
+				s += (series[j] > series[i]).astype(np.int64) - (series[j] < series[i])
+			ties += (series[j] == series[i])
+		ytie += ties - 1
+		y1 += (ties - 1) * (2 * ties + 5)
+	ytie //= 2
+
+	has_nan = np.isnan(series).any(axis=0) if np.issubdtype(series.dtype, np.floating) \
+				else np.zeros(out_shape, dtype=bool)
+	constant = (ytie == tot) | has_nan
+
+	with np.errstate(divide='ignore', invalid='ignore'):
+		tau = s / np.sqrt(tot) / np.sqrt(tot - ytie)
+		tau = np.clip(tau, -1., 1.)
+
+		# asymptotic p-value
+		var = (size * (size - 1) * (2. * size + 5) - y1) / 18.
+		pvalue = special.erfc(np.abs(s) / np.sqrt(var) / np.sqrt(2))
+
+	# exact p-value
+	dis = (tot - s) // 2
+	c = np.minimum(dis, tot - dis)
+	exact = (ytie == 0) & ((size <= 33) | (c <= 1)) & ~constant
+	if exact.any():
+		pvalue[exact] = _exact_kendall_pvalues(size)[c[exact]]
+
+	tau[constant] = np.nan
+	pvalue[constant] = np.nan
+	return (s, tau, pvalue)
+
+def compute_trend(rasters, time_array, nodata, compute_pvalue=True):
+	"""Compute per pixel OLS slope and Mann-Kendall p-value of a raster time series.
+
+	Pixels that have nodata in any of the years are assigned `nodata`.
+
+	Args:
+		rasters (list | ndarray): List of 2D rasters (one per year) or a (years, rows, cols) array
+		time_array (list): Year of each raster
+		nodata (number): Nodata value
+		compute_pvalue (bool): If False, skip the significance test and return None for the pvalue
+
+	Returns:
+		tuple (slope, pvalue) 2D arrays of float64
+	"""
+	stack = stack_rasters(rasters)
+	shape = stack.shape[1:]
+	invalid = np.any(stack == nodata, axis=0)
+	valid_values = stack[:, ~invalid].astype(np.float64)
+
+	slope = np.full(shape, nodata, dtype=np.float64)
+	slope[~invalid] = ols_slope(valid_values, time_array)
+
+	pvalue = None
+	if compute_pvalue:
+		pvalue = np.full(shape, nodata, dtype=np.float64)
+		s, tau, valid_pvalue = mann_kendall(valid_values, time_array)
+		pvalue[~invalid] = valid_pvalue
+	return (slope, pvalue)
@@ -18,6 +18,7 @@ import shapely.geometry
 import pyproj
 from shapely.geometry import shape
 from shapely.ops import transform
+import numpy as np
 from functools import partial
 from ldms.utils.settings_util import get_settings
 import geopandas as gpd
@@ -30,6 +31,8 @@ import zipfile
 import shutil
 import tempfile
 import logging
+import hashlib
+import functools
 
 log = logging.getLogger(f'ldms.apps.{__name__}')
 
@@ -362,6 +365,42 @@ def validate_custom_polygon(vector_coords):
 	except:
 		return (None, _("Vector %s is invalid" % (vector_coords)))
 
+@functools.lru_cache(maxsize=32)
+def get_geometry_hash(vector):
+	"""Return a hash of a geometry that does not depend on how the geometry is written 
+	e.g whitespace, ordering of keys or the starting point of the rings
+
+	Args:
+		vector (string): GeoJSON or WKT of the geometry
+
+	Returns:
+		string: Hex digest of the normalized geometry
+	"""
+	geom = GEOSGeometry(vector)
+	geom.normalize()
+	return hashlib.sha1(bytes(geom.wkb)).hexdigest()
+
+def get_canonical_geometry(vector, precision=7):
+	"""Return a geometry that is the same for equivalent inputs. Coordinates are snapped to 
+	`precision` decimal places and the geometry is normalized i.e rings are oriented consistently 
+	and start at the same vertex.
+
+	Args:
+		vector (string): GeoJSON (geometry or feature) or WKT of the geometry
+		precision (int): Number of decimal places to keep
+
+	Returns:
+		GEOSGeometry: Canonical geometry or None if `vector` is not a valid geometry
+	"""
+	res = validate_custom_polygon(vector if isinstance(vector, str) else json.dumps(vector))
+	if not res or res[1]:
+		return None
+	geom = shapely.geometry.shape(json.loads(res[0]))
+	geom = transform(lambda x, y, z=None: (np.round(x, precision), np.round(y, precision)), geom)
+	geom = GEOSGeometry(memoryview(geom.wkb))
+	geom.normalize()
+	return geom
+
 def get_vector_from_db(level_id, admin_shapefile_id):
 	"""Retrieve the shapefile stored in the database
 
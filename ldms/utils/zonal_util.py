@@ -0,0 +1,203 @@
+"""
+Statistics of an analysis per zone e.g per administrative unit of a country.
+
+The analysis is computed once over the bounding box of all the zones and the zones are
+rasterised on the grid of its output as an array of zone ids (0 outside of the zones). The
+pixels of every zone are then counted in a single pass. Zones that overlap e.g an administrative
+unit and its parent are rasterised in separate layers so that the pixels they share are counted
+in each of them. See `ldms.analysis.analysis_router.batch_analysis`.
+"""
+
+import json
+import rasterio
+import numpy as np
+import numpy.ma as ma
+from rasterio import features
+from django.contrib.gis.geos import GEOSGeometry, Polygon
+from ldms.utils.raster_util import get_change_stats, get_class_counts
+from ldms.utils.settings_util import get_settings
+
+MAX_ZONAL_BINS = 1 << 20 # Maximum number of zones times the range of values counted with np.bincount
+
+def get_zones_extent(vectors):
+	"""Get the bounding box of a list of polygons
+
+	Args:
+		vectors (list): GeoJSON of the polygons
+
+	Returns:
+		geojson: Polygon of the bounding box
+	"""
+	geoms = [GEOSGeometry(x) for x in vectors]
+	extents = [x.extent for x in geoms]
+	bbox = (min(x[0] for x in extents), min(x[1] for x in extents),
+			max(x[2] for x in extents), max(x[3] for x in extents))
+	polygon = Polygon.from_bbox(bbox)
+	polygon.srid = geoms[0].srid
+	return polygon.geojson
+
+def get_zone_layers(vectors, all_touched=False):
+	"""Group polygons into layers whose polygons do not share pixels
+
+	Args:
+		vectors (list): GeoJSON of the polygons
+		all_touched (bool): If True, polygons that touch may share the pixels of their boundary
+
+	Returns:
+		list: Indices of the polygons of each layer, a single layer if none of them overlap
+	"""
+	geoms = [GEOSGeometry(x) for x in vectors]
+	extents = [x.extent for x in geoms]
+
+	def share_pixels(i, j):
+		a, b = extents[i], extents[j]
+		if a[0] > b[2] or b[0] > a[2] or a[1] > b[3] or b[1] > a[3]:
+			return False
+		if all_touched:
+			return geoms[i].intersects(geoms[j])
+		return geoms[i].relate_pattern(geoms[j], "T********") # interiors intersect
+
+	layers = []
+	for i in range(len(geoms)):
+		for layer in layers:
+			if not any(share_pixels(i, j) for j in layer):
+				layer.append(i)
+				break
+		else:
+			layers.append([i])
+	return layers
+
+def rasterize_zones(vectors, metadata_raster_path, shape):
+	"""Rasterise polygons on the grid of a raster
+
+	Args:
+		vectors (list): GeoJSON of the polygons
+		metadata_raster_path (string): Path of a raster whose transform is that of the grid
+		shape (tuple): (rows, cols) of the grid
+
+	Returns:
+		array: Zone ids, 1 for the first polygon, 2 for the second one and so on. 0 outside of the polygons.
+			(layers, rows, cols) if some polygons overlap, see `get_zone_layers`
+	"""
+	with rasterio.open(metadata_raster_path) as src:
+		transform = src.transform
+	all_touched = get_settings().raster_clipping_algorithm == "All Touched"
+	dtype = np.uint16 if len(vectors) < np.iinfo(np.uint16).max else np.int32
+	layers = []
+	for indices in get_zone_layers(vectors, all_touched):
+		shapes = [(json.loads(vectors[i]), i + 1) for i in indices]
+		layers.append(features.rasterize(shapes, out_shape=shape, transform=transform, fill=0,
+						all_touched=all_touched, dtype=dtype))
+	return layers[0] if len(layers) == 1 else np.stack(layers)
+
+def get_zonal_counts(datasource, zones, zone_count, nodata):
+	"""Compute the {value: count} frequency distribution of each zone
+
+	Integer rasters are counted in a single `np.bincount` of zone * number of values + value.
+
+	Args:
+		datasource (array): Raster values. Masked values are not counted
+		zones (array): Zone ids or layers of zone ids. See `rasterize_zones`
+		zone_count (int): Number of zones
+		nodata (number): Value of nodata. Counted so that the area of nodata of each zone is known
+
+	Returns:
+		list: {value: count} of each zone
+	"""
+	if isinstance(datasource, ma.MaskedArray):
+		datasource = datasource.filled(nodata)
+	datasource = np.asarray(datasource)
+	if datasource.ndim == 3:
+		datasource = datasource[0]
+	if zones.ndim == 3: # each zone is in one of the layers
+		layers = [get_zonal_counts(datasource, x, zone_count, nodata) for x in zones]
+		return [{k: v for counts in x for k, v in counts.items()} for x in zip(*layers)]
+	inside = zones > 0
+	values = datasource[inside]
+	zone_ids = zones[inside].astype(np.intp) - 1
+	if values.size == 0:
+		return [{} for i in range(zone_count)]
+
+	if np.issubdtype(values.dtype, np.integer):
+		min_val, max_val = int(values.min()), int(values.max())
+		span = max_val - min_val + 1
+		if span * zone_count <= MAX_ZONAL_BINS:
+			counts = np.bincount(zone_ids * span + (values.astype(np.intp) - min_val),
+								minlength=span * zone_count).reshape(zone_count, span)
+			zonal_counts = []
+			for row in counts:
+				present = np.nonzero(row)[0]
+				zonal_counts.append(dict(zip((present + min_val).tolist(), row[present])))
+			return zonal_counts
+
+	# values of large ranges or of floats are counted zone by zone
+	order = np.argsort(zone_ids, kind="stable")
+	bounds = np.searchsorted(zone_ids[order], np.arange(zone_count + 1))
+	values = values[order]
+	return [get_class_counts(values[bounds[i]:bounds[i + 1]]) for i in range(zone_count)]
+
+def get_zonal_stats(val_counts, change_enum, nodata, resolution):
+	"""Get the statistics of a zone in the format of `ldms.utils.raster_util.get_raster_stats`
+
+	Returns:
+		dict: {stats, nodata}
+	"""
+	return {
+		'stats': get_change_stats(val_counts, change_enum, resolution),
+		'nodata': val_counts.get(nodata, 0) * (resolution or 1),
+	}
+
+def get_zonal_percentiles(values, zones, q, zone_nodata=None, fill_value=np.nan):
+	"""Compute the q-th percentile of the values of each zone and assign it to the pixels of the zone
+
+	The valid pixels are sorted once by zone and by value, so that the pixels of each zone are a
+	contiguous sorted segment, and the percentile of every segment is interpolated at once as
+	`np.percentile` does. This is O(n log n) in the number of pixels whatever the number of zones.
+
+	Args:
+		values (array): Values of the pixels. Masked and NaN values are not used
+		zones (array): Zone of each pixel e.g ecological units. Same shape as `values`
+		q (float): Percentile between 0 and 100
+		zone_nodata (number, optional): Value of the pixels that are not within a zone
+		fill_value (number, optional): Value of the pixels whose zone has no valid value
+
+	Returns:
+		array: Percentile of the zone of each pixel
+	"""
+	shape = np.shape(values)
+	zone_mask = ma.getmaskarray(zones).ravel()
+	zones = np.asarray(ma.getdata(zones)).ravel()
+	values_mask = ma.getmaskarray(values).ravel()
+	values = np.asarray(ma.getdata(values), dtype=np.float64).ravel()
+
+	in_zone = ~zone_mask
+	if zone_nodata is not None:
+		in_zone &= zones != zone_nodata
+	valid = in_zone & ~values_mask & ~np.isnan(values)
+
+	result = np.full(zones.shape, fill_value, dtype=np.float64)
+	if not valid.any():
+		return result.reshape(shape)
+
+	valid_zones, valid_values = zones[valid], values[valid]
+	order = np.lexsort((valid_values, valid_zones))
+	sorted_zones, sorted_values = valid_zones[order], valid_values[order]
+	unique_zones, starts, counts = np.unique(sorted_zones, return_index=True, return_counts=True)
+
+	# linear interpolation between the closest ranks
+	positions = (counts - 1) * (q / 100)
+	lower = np.floor(positions).astype(np.intp)
+	upper = np.minimum(lower + 1, counts - 1)
+	fraction = positions - lower
+	below, above = sorted_values[starts + lower], sorted_values[starts + upper]
+	diff = above - below
+	percentiles = np.where(fraction >= 0.5, above - diff * (1 - fraction), below + diff * fraction)
+
+	# scatter the percentiles to the pixels of the zones, including those whose value is not valid
+	pixel_zones = zones[in_zone]
+	index = np.minimum(np.searchsorted(unique_zones, pixel_zones), unique_zones.size - 1)
+	found = unique_zones[index] == pixel_zones
+	zone_pixels = result[in_zone]
+	zone_pixels[found] = percentiles[index[found]]
+	result[in_zone] = zone_pixels
+	return result.reshape(shape)
@@ -1,9 +1,12 @@
 from django.shortcuts import render
+from django.http import HttpResponse, Http404
 from django.contrib.auth.models import Group #, User
 from rest_framework import viewsets, status
 from rest_framework.permissions import IsAuthenticated
 import json
 from ldms.utils.cache_util import get_cached_results
+from django.core.exceptions import PermissionDenied
+from ldms.utils.metrics_util import is_metrics_enabled, is_metrics_client_allowed, generate_metrics
 from rest_framework import permissions as rest_permissions
 from django.contrib.auth import get_user_model
 
@@ -74,9 +77,20 @@ def api_root(request, format=None):
 
 @api_view(['GET'])
 def cache_exists(request):
-	results = get_cached_results(request)
+	results = get_cached_results(request, count_request=False)
 	return Response({"exists": results != None })
 
+def metrics(request):
+	"""
+	Prometheus metrics. See `ldms.utils.metrics_util`
+	"""
+	if not is_metrics_enabled():
+		raise Http404()
+	if not is_metrics_client_allowed(request):
+		raise PermissionDenied()
+	content, content_type = generate_metrics()
+	return HttpResponse(content, content_type=content_type)
+
 # class UserViewSet(viewsets.ModelViewSet):
 # 	"""
 # 	API Endpoint that allows users to be viewed or edited
@@ -258,6 +258,50 @@ CACHES = {
         'LOCATION': 'ldms_cache', # table to store cache, run python manage.py createcachetable
     }
 }
+if os.getenv('RESULT_CACHE_BACKEND', 'db') == 'redis':
+    # Store results in the Redis server used by RQ instead of the database
+    CACHES['default'] = {
+        'BACKEND': 'ldms.utils.redis_cache.RedisResultCache',
+        'LOCATION': os.getenv('RESULT_CACHE_URL', 'redis://%s:6379/1' % os.getenv('REDIS_HOST', 'localhost')),
+        'KEY_PREFIX': 'ldms',
+        'OPTIONS': {
+            'MAX_BYTES': int(os.getenv('RESULT_CACHE_MAX_BYTES', 512 * 1024 ** 2)), # evict least recently used entries beyond this size
+            'COMPRESS_MIN_BYTES': 1024, # compress values larger than this
+            'L1_MAX_BYTES': int(os.getenv('RESULT_CACHE_L1_MAX_BYTES', 32 * 1024 ** 2)), # in-process cache of hot entries
+            'L1_TIMEOUT': 60,
+        }
+    }
+
+# Number of seconds results of an analysis are cached, keyed by the name of the API e.g "lulc" for /api/lulc/
+# Analysis not listed here are cached for SystemSettings.cache_limit seconds
+RESULT_CACHE_TIMEOUTS = {
+}
+
+# Cache of rasters clipped to a polygon. Entries are keyed by the source raster (path and modification time),
+# the geometry, nodata and clipping algorithm. Least recently used entries are evicted once the budgets are exceeded
+CLIPPED_RASTER_CACHE = {
+    'ENABLED': os.getenv('CLIPPED_RASTER_CACHE_ENABLED', 'True') == 'True',
+    'LOCATION': os.getenv('CLIPPED_RASTER_CACHE_LOCATION', os.path.join(MEDIA_ROOT, 'cache', 'clipped')),
+    'MAX_BYTES': int(os.getenv('CLIPPED_RASTER_CACHE_MAX_BYTES', 2 * 1024 ** 3)), # disk tier
+    'MEMORY_MAX_BYTES': int(os.getenv('CLIPPED_RASTER_CACHE_MEMORY_MAX_BYTES', 256 * 1024 ** 2)), # in-memory tier
+}
+
+# Rasters pre-clipped to administrative units (see ldms/utils/admin_raster_util.py). Each process reloads the list
+# of rasters in the store every REFRESH_SECONDS
+ADMIN_RASTER_STORE = {
+    'ENABLED': os.getenv('ADMIN_RASTER_STORE_ENABLED', 'True') == 'True',
+    'REFRESH_SECONDS': 300,
+}
+
+# Identical analysis requests arriving while the first one is being computed wait for its results
+# instead of computing them again. Only applies when result caching is enabled
+SINGLE_FLIGHT = {
+    'ENABLED': os.getenv('SINGLE_FLIGHT_ENABLED', 'True') == 'True',
+    'LOCK_TIMEOUT': 3600, # seconds after which a computation that did not finish is no longer waited for
+    # maximum seconds a request waits for an identical one to finish. Keep it well below the
+    # timeout of the web server (gunicorn --timeout, 30 seconds by default)
+    'WAIT_TIMEOUT': int(os.getenv('SINGLE_FLIGHT_WAIT_TIMEOUT', 20)),
+}
 
 RQ_QUEUES = {
     # 'default': {
@@ -270,8 +314,13 @@ RQ_QUEUES = {
         # 'PASSWORD': 'ldms123',
         'DEFAULT_TIMEOUT': 500,
     },
+    # the queues must share a Redis database: workers listen on all of them and queued requests
+    # depend on identical jobs of any of them
     'high': {
-        'URL': os.getenv('REDISTOGO_URL', 'redis://localhost'),
+        'HOST': os.getenv('REDIS_HOST', 'localhost'),
+        'PORT': 6379,
+        'DB': 0,
+        # 'PASSWORD': 'ldms123',
         'DEFAULT_TIMEOUT': 5000,
     },
     'low': {
@@ -283,6 +332,59 @@ RQ_QUEUES = {
     }
 }
 
+# Log the errors of failed jobs and write their records before the process of the job exits
+RQ_EXCEPTION_HANDLERS = ['ldms.utils.log_util.log_job_exception']
+
+# Workers mark the metrics of the process of each job as dead once it exits (see ldms/utils/metrics_util.py)
+RQ = {
+    'WORKER_CLASS': 'ldms.utils.metrics_util.MetricsWorker',
+}
+
+# Queued analyses are routed to the queues by their estimated cost (see ldms/utils/cost_util.py) so that
+# small jobs do not wait behind country-scale ones. Workers must listen on all the queues from the cheapest to the
+# most expensive, `rqworker low default high`, since RQ always serves the first non-empty queue
+JOB_COST_ROUTING = {
+    'ENABLED': os.getenv('JOB_COST_ROUTING_ENABLED', 'True') == 'True',
+    # (queue, maximum cost) from the cheapest to the most expensive jobs. None means no limit
+    'QUEUES': [('low', 10), ('default', 200), ('high', None)],
+    'SECONDS_PER_UNIT': 1.0, # estimated seconds of processing per unit of cost
+    'TIMEOUT_FACTOR': 4, # job_timeout is the estimated duration times this factor but not less than DEFAULT_TIMEOUT of the queue
+    'MAX_JOB_TIMEOUT': 6 * 3600,
+}
+
+# Queued ESAI and Medalus analyses whose estimated cost is at least MIN_COST are split into tiles of TILE_SIZE
+# degrees computed by separate jobs. Tiles are checkpointed in MEDIA_ROOT/tiles so that retried jobs resume
+TILED_JOBS = {
+    'ENABLED': os.getenv('TILED_JOBS_ENABLED', 'True') == 'True',
+    'MIN_COST': 200,
+    'TILE_SIZE': 2.0,
+    'RETRIES': 2, # number of times a failed tile job is retried
+    # seconds between the checks for tiles whose job was killed e.g out of memory. Requires rqscheduler
+    'WATCHDOG_INTERVAL': 600,
+}
+
+# Prometheus metrics exposed on /metrics/ (see ldms/utils/metrics_util.py). Requires prometheus_client.
+# The web server and the RQ workers write their metrics to MULTIPROC_DIR which must be shared by them
+# and emptied before they are started
+METRICS = {
+    'ENABLED': os.getenv('METRICS_ENABLED', 'False') == 'True',
+    'MULTIPROC_DIR': os.getenv('METRICS_MULTIPROC_DIR'),
+    # networks of the clients allowed to scrape /metrics/ besides staff users e.g 'METRICS_ALLOWED_NETWORKS=127.0.0.1/32 10.0.0.0/8'
+    'ALLOWED_NETWORKS': os.getenv('METRICS_ALLOWED_NETWORKS', '127.0.0.1/32 ::1/128').split(' '),
+}
+if METRICS['MULTIPROC_DIR']:
+    # must be set before prometheus_client is imported
+    os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', METRICS['MULTIPROC_DIR'])
+    os.environ.setdefault('prometheus_multiproc_dir', METRICS['MULTIPROC_DIR'])
+
+# Intermediate arrays of the analyses larger than MEMMAP_THRESHOLD bytes are memory-mapped to files in a
+# directory per job under DIR (see ldms/utils/scratch_util.py). DIR defaults to the temp dir of the system
+SCRATCH = {
+    'DIR': os.getenv('SCRATCH_DIR'),
+    'MEMMAP_THRESHOLD': int(os.getenv('SCRATCH_MEMMAP_THRESHOLD', 256 * 1024 ** 2)),
+    'CHUNK_BYTES': 64 * 1024 ** 2, # size of the bands of rows of the per pixel mean and standard deviation
+}
+
 # Add a logger for rq_scheduler in order to display when jobs are queueud
 LOGGING = {
     'version': 1,
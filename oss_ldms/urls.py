@@ -68,6 +68,7 @@ urlpatterns = [
     url(r'^api/ilswe/', analysis_router.enqueue_ilswe, name='ilswe'),  
     url(r'^api/rusle/', analysis_router.enqueue_rusle, name='rusle'), 
     url(r'^api/cvi/', analysis_router.enqueue_cvi, name='cvi'), 
+    url(r'^api/batch/', analysis_router.enqueue_batch, name='batch'),
     # url(r'^api/login/', auth_util.do_login, name="login"),
     # url(r'^api/register/', auth_util.create_user, name="register_user"),  
     # url(r'^api/updateuser/', auth_util.update_user, name="update_user"), 
@@ -77,6 +78,7 @@ urlpatterns = [
     url(r'^api/test/', analysis_router.test_render, name='test'),    
     url(r'^api/iscached/', view=views.cache_exists, name='cache-exists'),
     url(r'^api/forest_fire_qml/', analysis_router.forest_fire_qml, name='forest_fire_qml'),  
+    url(r'^metrics/$', views.metrics, name='metrics'),
     
     # Include the documentation for the API
     url(r'api-docs/', include_docs_urls(title='OSS LDMS API')),